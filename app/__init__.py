@@ -10,6 +10,7 @@ from sentry_sdk.integrations.flask import FlaskIntegration
 # Import database functions and User class from the root directory
 import database
 from database import User 
+from . import activity_log
 
 # Cloudinary setting
 import cloudinary
@@ -49,9 +50,10 @@ def api_key_required(f):
     return decorated_function
 
 def get_db():
-        if 'db' not in g:
-            g.db = database.get_db_connection()
-        return g.db    
+    # ยืม connection จาก pool ผูกไว้กับ g.db และคืนใน teardown_appcontext
+    if 'db' not in g:
+        g.db = database.get_db_connection()
+    return g.db
 
 def create_app():
     """
@@ -118,13 +120,9 @@ def create_app():
 
     # --- START: Global Functions & Context Processor ---
     # We define these inside create_app to associate them with the app instance.
-
-    @cache.memoize(timeout=300)
-    def get_cached_unread_notification_count():
-        conn = get_db()
-        # Ensure the connection is not closed prematurely
-        count = database.get_unread_notification_count(conn)
-        return count
+    # ผู้ใช้/ประกาศ/จำนวนแจ้งเตือน มาจาก global_cache (cache ระดับ request + shared TTL สั้น ล้างเมื่อข้อมูลเปลี่ยน)
+    from . import global_cache
+    global_cache.init_app(app)
 
     @app.context_processor
     def inject_global_data():
@@ -132,9 +130,8 @@ def create_app():
         latest_announcement = None
         if current_user.is_authenticated:
             try:
-                unread_count = get_cached_unread_notification_count()
-                conn = get_db()
-                latest_announcement = database.get_latest_active_announcement(conn)
+                unread_count = global_cache.get_unread_notification_count()
+                latest_announcement = global_cache.get_latest_announcement()
             except Exception as e:
                 print(f"Error in context processor: {e}")
         
@@ -149,17 +146,14 @@ def create_app():
     # --- User Loader for Flask-Login ---
     @login_manager.user_loader
     def load_user(user_id):
-        conn = database.get_db_connection()
-        user = User.get(conn, user_id)
-        conn.close()
-        return user
+        return global_cache.get_user(user_id)
 
     # --- Teardown Context for Database Connection ---
     @app.teardown_appcontext
     def close_db(e=None):
         db = g.pop('db', None)
         if db is not None:
-            db.close()
+            database.release_db_connection(db) # คืน connection เข้า pool แทนการปิด
 
     @app.after_request
     def log_activity(response):
@@ -170,19 +164,13 @@ def create_app():
         'api_search' in request.endpoint: # ไม่ต้อง log ทุกครั้งที่พิมพ์ค้นหา
             return response
         
-        try:
-            conn = get_db()
-            database.add_activity_log(
-                conn,
-                user_id=current_user.id,
-                endpoint=request.endpoint,
-                method=request.method,
-                url=request.path # แก้จาก request.url เป็น request.path เพื่อให้สั้นลง
-            )
-            conn.commit()
-        except Exception as e:
-            print(f"CRITICAL: Error logging activity: {e}")
-            # ไม่ต้อง rollback เพราะอาจทำให้ transaction อื่นรวนได้
+        # ใส่ queue ให้ thread เบื้องหลังเขียนเป็น batch ไม่ต้องรอ INSERT/commit ใน request
+        activity_log.log_activity(
+            user_id=current_user.id,
+            endpoint=request.endpoint,
+            method=request.method,
+            url=request.path # แก้จาก request.url เป็น request.path เพื่อให้สั้นลง
+        )
 
         return response       
 
@@ -0,0 +1,142 @@
+# activity_log.py
+# บันทึก activity log แบบ buffered แทนการ INSERT + commit ในทุก request
+# - request แค่ใส่รายการลง queue (ไม่รอฐานข้อมูล) ถ้า queue เต็มจะทิ้งรายการและนับไว้ ไม่ทำให้หน้าเว็บช้า
+# - thread เบื้องหลัง (หนึ่งตัวต่อ worker process) เขียนลงฐานข้อมูลทีละหลายแถวเมื่อครบ FLUSH_BATCH_SIZE หรือทุก FLUSH_INTERVAL_SECONDS
+# - ตอน worker ปิด (atexit) จะเขียนรายการที่ค้างอยู่ให้หมดก่อน
+import atexit
+import queue
+import threading
+import time
+
+import database
+
+FLUSH_BATCH_SIZE = 200
+FLUSH_INTERVAL_SECONDS = 2.0
+MAX_QUEUE_SIZE = 10000
+SHUTDOWN_TIMEOUT_SECONDS = 5.0
+_STOP = object() # ใส่ลง queue เพื่อปลุก thread ที่กำลังรอให้เขียน batch ที่ถืออยู่แล้วหยุด
+
+
+class ActivityLogWriter:
+    def __init__(self, batch_size=FLUSH_BATCH_SIZE, flush_interval=FLUSH_INTERVAL_SECONDS, max_queue_size=MAX_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.dropped_count = 0
+        self._reported_dropped_count = 0
+        self.written_count = 0
+
+    def log(self, user_id, endpoint, method, url):
+        """ใส่รายการลง queue คืน False ถ้า queue เต็ม (รายการถูกทิ้ง)"""
+        entry = (user_id, database.get_bkk_time().isoformat(), endpoint, method, url)
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            with self._lock:
+                self.dropped_count += 1
+            return False
+        self._ensure_started()
+        return True
+
+    def _ensure_started(self):
+        # เริ่ม thread ตอนมี log แรกในแต่ละ process (thread ไม่ติดไปกับ worker ที่ fork มาจาก master)
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='activity-log-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+
+    def _take_batch(self):
+        """รอรายการจาก queue จนครบ batch_size หรือหมดเวลา flush_interval"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and not self._stop_event.is_set():
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                break
+            batch.append(entry)
+        return batch
+
+    def _write(self, batch):
+        with self._write_lock:
+            conn = None
+            try:
+                conn = database.get_db_connection()
+                database.bulk_add_activity_logs(conn, batch)
+                conn.commit()
+                self.written_count += len(batch)
+            except Exception as e:
+                print(f"CRITICAL: Error writing {len(batch)} activity logs: {e}")
+                if conn is not None:
+                    conn.rollback()
+            finally:
+                if conn is not None:
+                    database.release_db_connection(conn)
+        self._report_dropped()
+
+    def _report_dropped(self):
+        with self._lock:
+            newly_dropped = self.dropped_count - self._reported_dropped_count
+            self._reported_dropped_count = self.dropped_count
+        if newly_dropped:
+            print(f"WARNING: Activity log queue full, dropped {newly_dropped} entries (total {self.dropped_count})")
+
+    def flush(self):
+        """เขียนรายการที่ค้างใน queue ทั้งหมดทันที (ใช้ตอนปิด worker)"""
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is not _STOP:
+                    batch.append(entry)
+            if not batch:
+                return
+            self._write(batch)
+
+    def shutdown(self):
+        self._stop_event.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                pass # queue เต็มแสดงว่า thread ไม่ได้รออยู่ จะเห็น stop event เองหลังเขียน batch ปัจจุบัน
+            thread.join(SHUTDOWN_TIMEOUT_SECONDS)
+        self.flush()
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written_count,
+            'dropped': self.dropped_count,
+        }
+
+
+writer = ActivityLogWriter()
+atexit.register(writer.shutdown)
+
+
+def log_activity(user_id, endpoint, method, url):
+    return writer.log(user_id, endpoint, method, url)
@@ -8,6 +8,7 @@ from flask_login import login_user, logout_user, login_required, current_user
 import database
 from database import User # Assuming User class is in database.py
 
+from . import get_db
 from .utils import make_request
 
 # Create a Blueprint named 'auth'. This is how we group related routes.
@@ -22,9 +23,8 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        conn = database.get_db_connection()
+        conn = get_db()
         user = User.get_by_username(conn, username)
-        conn.close()
 
         if user and check_password_hash(user.password, password):
             login_user(user, remember=True)
@@ -0,0 +1,39 @@
+# barcode_renderer.py
+# สร้าง SVG ของบาร์โค้ด / QR พร้อม cache (LRU ในแต่ละ worker process)
+# key คือ (ชนิดรหัส, ค่า, ตัวเลือกของ writer) รหัสเดิมที่พิมพ์ซ้ำ (เช่น ติดสติกเกอร์ทั้งล็อตของสินค้าเดียวกัน) ไม่ต้องสร้างใหม่
+import functools
+
+import barcode
+import qrcode
+import qrcode.image.svg
+from barcode.writer import SVGWriter
+
+BARCODE_CACHE_SIZE = 4096
+CODE128_WRITER_OPTIONS = {'module_height': 10.0, 'font_size': 10, 'text_distance': 3.0, 'quiet_zone': 2.0}
+QRCODE_OPTIONS = {'box_size': 20}
+
+
+@functools.lru_cache(maxsize=BARCODE_CACHE_SIZE)
+def _render_svg(symbology, value, options_items):
+    options = dict(options_items)
+    if symbology == 'qrcode':
+        image = qrcode.make(value, image_factory=qrcode.image.svg.SvgPathImage, **options)
+        return image.to_string().decode('utf-8')
+    # render() คืน bytes ของ SVG ตรงๆ ไม่ต้องเขียนผ่าน BytesIO
+    return barcode.get(symbology, value, writer=SVGWriter()).render(options).decode('utf-8')
+
+
+def get_svg(symbology, value, options=None):
+    """SVG (ข้อความ) ของรหัส value, symbology: 'code128' (หรือชนิดอื่นของ python-barcode) หรือ 'qrcode'"""
+    if options is None:
+        options = QRCODE_OPTIONS if symbology == 'qrcode' else CODE128_WRITER_OPTIONS
+    return _render_svg(symbology, str(value), tuple(sorted(options.items())))
+
+
+def get_svgs(symbology, values, options=None):
+    """SVG ของหลายรหัส (ตามลำดับ values) รหัสที่ซ้ำกันสร้างครั้งเดียว"""
+    return [get_svg(symbology, value, options) for value in values]
+
+
+def cache_info():
+    return _render_svg.cache_info()
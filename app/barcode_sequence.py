@@ -0,0 +1,88 @@
+# barcode_sequence.py
+# ออกรหัส EAN-13 (885 + เลขลำดับ 9 หลัก + check digit) ที่ไม่ซ้ำกัน แทนการใช้เวลาปัจจุบัน (ขอพร้อมกันในวินาทีเดียวกันได้รหัสซ้ำ)
+# - แต่ละ worker process จองช่วงเลขจาก barcode_sequences ครั้งละ BARCODE_BLOCK_SIZE แล้วแจกจาก memory
+#   การจองใช้ connection แยก (database.open_dedicated_connection: ไม่ผ่าน pool, commit ทันที)
+#   จึงไม่แย่ง connection ใน pool กับ request และเลขที่จองแล้วไม่ย้อนกลับตาม transaction ของ request
+#   (เลขที่จองแล้วแต่ไม่ได้ใช้ เช่น worker ปิดไปก่อน จะถูกข้ามไป ไม่มีผลกับความไม่ซ้ำ)
+# - ก่อนคืนรหัสจะตรวจกับตารางบาร์โค้ดทั้งสามประเภท (query เดียว) รหัสที่มีอยู่แล้ว เช่น บาร์โค้ดจากผู้ผลิต จะถูกข้าม
+# บน SQLite การจองต้องรอ lock การเขียน ควรเรียกก่อนเริ่มเขียนข้อมูลใน request (เหมือนเดิม)
+import os
+import threading
+
+import database
+
+BARCODE_PREFIX = '885'
+BARCODE_SEQUENCE_NAME = 'ean13'
+BARCODE_BLOCK_SIZE = int(os.environ.get('BARCODE_BLOCK_SIZE', 100))
+MAX_BARCODE_VALUE = 10 ** (12 - len(BARCODE_PREFIX)) - 1
+MAX_BARCODES_PER_REQUEST = 1000
+
+
+def calculate_ean13_check_digit(number_str):
+    """คำนวณ Check Digit สำหรับ EAN-13"""
+    if not number_str.isdigit() or len(number_str) != 12:
+        raise ValueError("ต้องเป็นตัวเลข 12 หลักเท่านั้น")
+
+    # ผลรวมเลขตำแหน่งคี่ (1, 3, 5, ...)
+    odd_sum = sum(int(digit) for digit in number_str[0::2])
+    # ผลรวมเลขตำแหน่งคู่ (2, 4, 6, ...)
+    even_sum = sum(int(digit) for digit in number_str[1::2])
+
+    total_sum = odd_sum + (even_sum * 3)
+
+    # หาเลขที่บวกแล้วจะครบ 10 พอดี
+    check_digit = (10 - (total_sum % 10)) % 10
+    return str(check_digit)
+
+
+def format_ean13(value):
+    if not 0 < value <= MAX_BARCODE_VALUE:
+        raise ValueError("เลขลำดับบาร์โค้ดเกินช่วงที่รองรับ")
+    base_12_digits = f"{BARCODE_PREFIX}{value:0{12 - len(BARCODE_PREFIX)}d}"
+    return f"{base_12_digits}{calculate_ean13_check_digit(base_12_digits)}"
+
+
+class BarcodeSequence:
+    def __init__(self, sequence_name=BARCODE_SEQUENCE_NAME, block_size=BARCODE_BLOCK_SIZE):
+        self.sequence_name = sequence_name
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next_value = 1
+        self._last_value = 0 # ยังไม่มีช่วงที่จองไว้
+
+    def _reserve(self, count):
+        # จองไม่บ่อย (ครั้งละ block_size ค่า) เปิด connection ใหม่แล้วปิดเลย ไม่ต้องถือค้างไว้
+        conn = database.open_dedicated_connection()
+        try:
+            first_value, last_value = database.reserve_barcode_block(conn, self.sequence_name, max(count, self.block_size))
+        finally:
+            conn.close()
+        self._next_value, self._last_value = first_value, last_value
+
+    def take_values(self, count):
+        """เลขลำดับที่ยังไม่เคยแจก count ค่า (จองช่วงใหม่เมื่อช่วงที่ถืออยู่ไม่พอ)"""
+        with self._lock:
+            values = []
+            while len(values) < count:
+                if self._next_value > self._last_value:
+                    self._reserve(count - len(values))
+                take = min(count - len(values), self._last_value - self._next_value + 1)
+                values.extend(range(self._next_value, self._next_value + take))
+                self._next_value += take
+            return values
+
+    def generate(self, conn, count=1):
+        """รหัส EAN-13 ใหม่ count รหัส ไม่ซ้ำกันเองและไม่ซ้ำกับบาร์โค้ดในตาราง tire/wheel/spare_part_barcodes"""
+        barcodes = []
+        while len(barcodes) < count:
+            candidates = [format_ean13(value) for value in self.take_values(count - len(barcodes))]
+            existing = database.get_existing_barcodes(conn, candidates)
+            barcodes.extend(code for code in candidates if code not in existing)
+        return barcodes
+
+
+sequence = BarcodeSequence()
+
+
+def generate_barcodes(conn, count=1):
+    return sequence.generate(conn, count)
@@ -0,0 +1,134 @@
+# catalog_cache.py
+# Cache รายการสินค้าทั้งหมด (ยาง/แม็ก/อะไหล่) แบบมีเวอร์ชัน
+# - การขาย/แก้ไขสินค้า จะ patch เฉพาะแถวที่เปลี่ยนใน list ที่ cache ไว้ แล้วเพิ่มเลขเวอร์ชัน
+# - list ที่ cache ไว้ใช้ได้เฉพาะเมื่อเวอร์ชันตรงกับเวอร์ชันล่าสุดเท่านั้น จึงไม่เสิร์ฟข้อมูลเก่า
+#   แม้หลาย worker จะ patch พร้อมกัน (เลขเวอร์ชันเพิ่มแบบ atomic ผ่าน cache.inc)
+import time
+
+import database
+from . import cache, get_db
+
+CATALOG_TIMEOUT = 3600
+
+CATALOG_LOADERS = {
+    'tire': lambda conn: database.get_all_tires(conn, include_deleted=False),
+    'wheel': lambda conn: database.get_all_wheels(conn, include_deleted=False),
+    'spare_part': lambda conn: database.get_all_spare_parts(conn, query=None, brand_filter='all', category_filter='all', include_deleted=False),
+}
+
+ITEM_LOADERS = {
+    'tire': database.get_tires_by_ids,
+    'wheel': database.get_wheels_by_ids,
+    'spare_part': database.get_spare_parts_by_ids,
+}
+
+SORT_KEYS = {
+    'tire': database.tire_listing_sort_key,
+    'wheel': database.wheel_listing_sort_key,
+    'spare_part': database.spare_part_listing_sort_key,
+}
+
+# listener ที่อยากรู้เมื่อ catalogue เปลี่ยน (เช่น search index) รับ (item_type, item_ids หรือ None = ทั้งหมด)
+_change_listeners = []
+
+
+def _version_key(item_type):
+    return f"catalog:{item_type}:version"
+
+
+def _list_key(item_type):
+    return f"catalog:{item_type}:list"
+
+
+def on_catalog_change(listener):
+    _change_listeners.append(listener)
+    return listener
+
+
+def _notify(item_type, item_ids):
+    for listener in _change_listeners:
+        try:
+            listener(item_type, item_ids)
+        except Exception as e:
+            print(f"Error in catalog change listener: {e}")
+
+
+def get_catalog_version(item_type):
+    version = cache.get(_version_key(item_type))
+    if version is None:
+        # เริ่มเวอร์ชันจากเวลาปัจจุบัน (ms) เพื่อไม่ให้ชนกับ list เก่าที่อาจค้างอยู่ถ้า key เวอร์ชันถูก evict
+        cache.add(_version_key(item_type), int(time.time() * 1000), timeout=0)
+        version = cache.get(_version_key(item_type))
+    return int(version)
+
+
+def get_catalog_entry(item_type):
+    """คืน (version, items) ของ catalogue ประเภทนี้ ใช้ version เป็น key ของข้อมูลที่สร้างต่อจาก list (เช่น search index)"""
+    version = get_catalog_version(item_type)
+    entry = cache.get(_list_key(item_type))
+    if entry is not None and entry.get('version') == version:
+        return version, entry['items']
+
+    print(f"--- CACHE MISS (CATALOG {item_type.upper()}) --- Fetching complete list from DB (version {version})")
+    conn = get_db()
+    items = CATALOG_LOADERS[item_type](conn)
+    cache.set(_list_key(item_type), {'version': version, 'items': items}, timeout=CATALOG_TIMEOUT)
+    return version, items
+
+
+def get_catalog(item_type):
+    """คืน list สินค้าทั้งหมดของประเภทนี้ (ไม่รวมที่ถูกลบ) จาก cache หรือโหลดใหม่เมื่อเวอร์ชันไม่ตรง"""
+    return get_catalog_entry(item_type)[1]
+
+
+def _bump_version(item_type):
+    get_catalog_version(item_type)
+    # Flask-Caching ไม่มี inc ในตัว ใช้ของ backend (RedisCache ใช้ INCR ซึ่งเป็น atomic)
+    return cache.cache.inc(_version_key(item_type))
+
+
+def refresh_catalog_items(item_type, item_ids):
+    """
+    โหลดเฉพาะสินค้าที่เปลี่ยนจาก DB แล้ว patch เข้า list ที่ cache ไว้ (เพิ่ม/แทนที่/ลบออกถ้าถูกลบ)
+    ควรเรียกหลัง conn.commit() เพื่อให้อ่านได้ค่าล่าสุด
+    """
+    item_ids = {int(item_id) for item_id in item_ids if item_id is not None}
+    if not item_ids:
+        return
+
+    try:
+        _patch_catalog(item_type, item_ids)
+    except Exception as e:
+        # patch ไม่สำเร็จ ให้ทิ้ง list แล้วโหลดใหม่ทั้งหมดในครั้งถัดไปแทน
+        print(f"Error patching {item_type} catalog cache: {e}")
+        cache.delete(_list_key(item_type))
+
+
+def _patch_catalog(item_type, item_ids):
+    entry = cache.get(_list_key(item_type))
+    new_version = _bump_version(item_type)
+
+    # list ใน cache ต้องเป็นเวอร์ชันก่อนหน้าพอดี ถ้ามีคนอื่น patch แทรกเข้ามา ให้ทิ้งแล้วโหลดใหม่รอบหน้า
+    if entry is None or new_version is None or entry.get('version') != int(new_version) - 1:
+        cache.delete(_list_key(item_type))
+        _notify(item_type, item_ids)
+        return
+
+    conn = get_db()
+    fresh_rows = {row['id']: row for row in ITEM_LOADERS[item_type](conn, item_ids)}
+
+    items = [item for item in entry['items'] if item['id'] not in item_ids]
+    for item_id, row in fresh_rows.items():
+        if not row.get('is_deleted'):
+            items.append(row)
+    items.sort(key=SORT_KEYS[item_type])
+
+    cache.set(_list_key(item_type), {'version': int(new_version), 'items': items}, timeout=CATALOG_TIMEOUT)
+    _notify(item_type, item_ids)
+
+
+def invalidate_catalog(item_type):
+    """ทิ้ง list ทั้งหมด (ใช้กับการเปลี่ยนแปลงแบบกว้าง เช่น import หรือแก้โปรโมชัน)"""
+    _bump_version(item_type)
+    cache.delete(_list_key(item_type))
+    _notify(item_type, None)
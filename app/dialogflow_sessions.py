@@ -0,0 +1,33 @@
+# dialogflow_sessions.py
+# สถานะบทสนทนาของแชทบอท (Dialogflow) เก็บฝั่ง server ตาม session id แทนการส่งรายการยางทั้งหมดไปกลับใน outputContexts
+# - เก็บใน Flask-Caching ตัวเดียวกับส่วนอื่น: Redis เมื่อตั้ง REDIS_URL (ใช้ร่วมกันทุก worker)
+#   ไม่งั้นเป็น SimpleCache ในหน่วยความจำ (มี TTL และจำกัดจำนวน key)
+# - เก็บเฉพาะข้อมูลที่ต้องใช้ต่อ: เบอร์ยาง, id ของยางที่แสดงให้ลูกค้าเห็น, จำนวนเส้น, รายการที่เลือก และข้อมูลจัดส่ง
+#   ราคา/สต็อกอ่านจาก tire_offers ทุกครั้ง ต้นทุนจึงไม่ออกไปนอก server
+# - context ของ Dialogflow ยังส่งกลับไปเหมือนเดิม (ใช้เลือก intent) แต่ไม่มี parameters ขนาดใหญ่แล้ว
+from . import cache
+
+SESSION_TIMEOUT = 30 * 60 # วินาที (นับใหม่ทุกครั้งที่บันทึก)
+
+
+def _session_key(session_id):
+    return f"dialogflow:session:{session_id}"
+
+
+def get_state(session_id):
+    return cache.get(_session_key(session_id)) or {}
+
+
+def save_state(session_id, state):
+    cache.set(_session_key(session_id), state, timeout=SESSION_TIMEOUT)
+
+
+def update_state(session_id, **changes):
+    state = get_state(session_id)
+    state.update(changes)
+    save_state(session_id, state)
+    return state
+
+
+def clear_state(session_id):
+    cache.delete(_session_key(session_id))
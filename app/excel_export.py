@@ -0,0 +1,225 @@
+# excel_export.py
+# ส่งออกข้อมูลสินค้า (ยาง/แม็ก/อะไหล่) เป็น Excel หรือ CSV แบบ streaming
+# - รับแถวจาก generator (database.iter_export_rows) ทีละแถว ไม่สร้าง list/DataFrame ของทั้ง catalogue
+# - Excel ใช้ xlsxwriter โหมด constant_memory เขียนทีละแถวลงไฟล์ชั่วคราว หน่วยความจำคงที่ไม่ขึ้นกับจำนวนสินค้า
+# - CSV ส่งเป็น chunk ทันทีที่อ่านได้ (ผู้ใช้เริ่มดาวน์โหลดได้เลย)
+# รูปแบบชีท/คอลัมน์เหมือนไฟล์เดิม จึงนำไฟล์ที่ export ไปแก้แล้ว import กลับได้เหมือนเดิม
+import csv
+from decimal import Decimal
+from io import StringIO
+
+import xlsxwriter
+
+CSV_CHUNK_ROWS = 500
+INSTRUCTIONS_SHEET_NAME = 'คำแนะนำการใช้งาน'
+
+# columns: (หัวคอลัมน์, key ในแถว, รูปแบบ, ความกว้าง, ซ่อนคอลัมน์)
+# รูปแบบ: left, center, integer, decimal, read_only (คอลัมน์ระบบ ไม่ควรแก้ไข)
+EXPORT_SPECS = {
+    'tire': {
+        'label': 'ยาง',
+        'sheet_name': 'Tires Data',
+        'tab': 'tires_excel',
+        'file_name': 'tire_stock_template',
+        'group_key': 'brand',
+        'instructions': [
+            '1. ห้าม! เปลี่ยนชื่อชีท "Tires Data" และห้าม! ลบ/ย้าย/เปลี่ยนชื่อคอลัมน์ในชีท "Tires Data"',
+            '2. ข้อมูลในคอลัมน์ที่มีคำว่า "(ห้ามแก้ไข)" หรือ "(ระบบ)" เป็นข้อมูลที่สร้าง/คำนวณโดยระบบ ไม่ควรแก้ไข',
+            '3. การแก้ไขค่าในคอลัมน์ "สต็อก" จะถูกบันทึกเป็นการเคลื่อนไหว (รับเข้า/จ่ายออก)',
+            '4. หากต้องการเพิ่มสินค้าใหม่ ไม่ต้องกรอก "ID (ห้ามแก้ไข)"',
+            '5. ตรวจสอบประเภทข้อมูลให้ถูกต้อง (ตัวเลข, ข้อความ)',
+            '6. สามารถเปลี่ยนชื่อไฟล์ได้',
+        ],
+        'columns': [
+            ('ยี่ห้อ', 'brand', 'left', 15, False),
+            ('รุ่นยาง', 'model', 'left', 20, False),
+            ('เบอร์ยาง', 'size', 'center', 15, False),
+            ('ปีผลิต', 'year_of_manufacture', 'center', 8, False),
+            ('สต็อก', 'quantity', 'integer', 10, False),
+            ('ทุน', 'cost_sc', 'decimal', 12, False),
+            ('ทุนล็อต', 'cost_dunlop', 'decimal', 12, False),
+            ('ราคาส่ง 1', 'wholesale_price1', 'decimal', 12, False),
+            ('ราคาส่งหน้าร้าน', 'wholesale_price2', 'decimal', 17, False),
+            ('ราคาขาย', 'price_per_item', 'decimal', 12, False),
+            ('Barcode ID (ระบบ)', 'primary_barcode', 'read_only', 20, True),
+            ('ID (ห้ามแก้ไข)', 'id', 'read_only', 15, True),
+            ('ทุนค้าส่ง 2 (ระบบ)', 'cost_online', 'read_only', 15, True),
+            ('ID โปรโมชัน (ระบบ)', 'promotion_id', 'read_only', 15, True),
+            ('ชื่อโปรโมชัน (ระบบ)', 'promo_name', 'read_only', 20, True),
+            ('ประเภทโปรโมชัน (ระบบ)', 'promo_type', 'read_only', 20, True),
+            ('ค่าโปรโมชัน Value1 (ระบบ)', 'promo_value1', 'read_only', 20, True),
+            ('ค่าโปรโมชัน Value2 (ระบบ)', 'promo_value2', 'read_only', 20, True),
+            ('รายละเอียดโปรโมชัน (ระบบ)', 'display_promo_description_text', 'read_only', 30, True),
+            ('ราคาโปรโมชันคำนวณ(เส้น) (ระบบ)', 'display_promo_price_per_item', 'read_only', 25, True),
+            ('ราคาโปรโมชันคำนวณ(4เส้น) (ระบบ)', 'display_price_for_4', 'read_only', 25, True),
+        ],
+    },
+    'wheel': {
+        'label': 'แม็ก',
+        'sheet_name': 'Wheels Data',
+        'tab': 'wheels_excel',
+        'file_name': 'wheel_stock_template',
+        'group_key': 'brand',
+        'instructions': [
+            '1. ห้าม! เปลี่ยนชื่อชีท "Wheels Data" และห้าม! ลบ/ย้าย/เปลี่ยนชื่อคอลัมน์ในชีท "Wheels Data"',
+            '2. ข้อมูลในคอลัมน์ที่มีคำว่า "(ห้ามแก้ไข)" หรือ "(ระบบ)" เป็นข้อมูลที่สร้าง/คำนวณโดยระบบ ไม่ควรแก้ไข',
+            '3. การแก้ไขค่าในคอลัมน์ "สต็อก" จะถูกบันทึกเป็นการเคลื่อนไหว (รับเข้า/จ่ายออก)',
+            '4. หากต้องการเพิ่มสินค้าใหม่ ไม่ต้องกรอก "ID (ห้ามแก้ไข)"',
+            '5. "ไฟล์รูปภาพ (URL ระบบ)" คือ URL รูปภาพที่ระบบใช้ ไม่ควรแก้ไขโดยตรง หากต้องการเปลี่ยนรูป ให้ใช้ฟังก์ชันอัปโหลดในระบบ',
+            '6. ตรวจสอบประเภทข้อมูลให้ถูกต้อง (ตัวเลข, ข้อความ)',
+        ],
+        'columns': [
+            ('ยี่ห้อ', 'brand', 'left', 15, False),
+            ('ลาย', 'model', 'left', 20, False),
+            ('ขอบ', 'diameter', 'center', 8, False),
+            ('รู', 'pcd', 'center', 10, False),
+            ('กว้าง', 'width', 'center', 8, False),
+            ('ET', 'et', 'center', 8, False),
+            ('สี', 'color', 'center', 15, False),
+            ('สต็อก', 'quantity', 'integer', 10, False),
+            ('ทุน', 'cost', 'decimal', 12, False),
+            ('ทุน Online', 'cost_online', 'decimal', 12, False),
+            ('ราคาส่ง 1', 'wholesale_price1', 'decimal', 12, False),
+            ('ราคาส่งหน้าร้าน', 'wholesale_price2', 'decimal', 17, False),
+            ('ราคาขาย', 'retail_price', 'decimal', 12, False),
+            ('Barcode ID (ระบบ)', 'primary_barcode', 'read_only', 20, True),
+            ('ID (ห้ามแก้ไข)', 'id', 'read_only', 25, True),
+            ('ไฟล์รูปภาพ (URL ระบบ)', 'image_filename', 'read_only', 25, True),
+        ],
+    },
+    'spare_part': {
+        'label': 'อะไหล่',
+        'sheet_name': 'Spare Parts Data',
+        'tab': 'spare_parts_excel',
+        'file_name': 'spare_parts_stock_template',
+        'group_key': 'category_name',
+        'instructions': [
+            '1. ห้าม! เปลี่ยนชื่อชีท "Spare Parts Data" และห้าม! ลบ/ย้าย/เปลี่ยนชื่อคอลัมน์ในชีท "Spare Parts Data"',
+            '2. ข้อมูลในคอลัมน์ที่มีคำว่า "(ห้ามแก้ไข)" หรือ "(ระบบ)" เป็นข้อมูลที่สร้าง/คำนวณโดยระบบ ไม่ควรแก้ไข',
+            '3. การแก้ไขค่าในคอลัมน์ "สต็อก" จะถูกบันทึกเป็นการเคลื่อนไหว (รับเข้า/จ่ายออก)',
+            '4. หากต้องการเพิ่มสินค้าใหม่ ไม่ต้องกรอก "ID (ห้ามแก้ไข)"',
+            '5. "ไฟล์รูปภาพ (URL ระบบ)" คือ URL รูปภาพที่ระบบใช้ ไม่ควรแก้ไขโดยตรง หากต้องการเปลี่ยนรูป ให้ใช้ฟังก์ชันอัปโหลดในระบบ',
+            '6. "หมวดหมู่" ต้องตรงกับหมวดหมู่ที่มีอยู่ในระบบ (สร้าง/จัดการได้ที่หน้าจัดการหมวดหมู่)',
+            '7. ตรวจสอบประเภทข้อมูลให้ถูกต้อง (ตัวเลข, ข้อความ)',
+        ],
+        'columns': [
+            ('ชื่ออะไหล่', 'name', 'left', 25, False),
+            ('Part Number', 'part_number', 'center', 15, False),
+            ('ยี่ห้อ', 'brand', 'left', 15, False),
+            ('หมวดหมู่', 'category_name', 'left', 20, False),
+            ('คำอธิบาย', 'description', 'left', 30, False),
+            ('สต็อก', 'quantity', 'integer', 10, False),
+            ('ทุน', 'cost', 'decimal', 12, False),
+            ('ราคาขายปลีก', 'retail_price', 'decimal', 14, False),
+            ('ราคาส่ง 1', 'wholesale_price1', 'decimal', 12, False),
+            ('ราคาส่ง 2', 'wholesale_price2', 'decimal', 12, False),
+            ('ทุน Online', 'cost_online', 'decimal', 12, False),
+            ('Barcode ID (ระบบ)', 'primary_barcode', 'read_only', 25, True),
+            ('ID (ห้ามแก้ไข)', 'id', 'read_only', 25, True),
+            ('ID หมวดหมู่ (ระบบ)', 'category_id', 'read_only', 25, True),
+            ('ไฟล์รูปภาพ (URL ระบบ)', 'image_filename', 'read_only', 25, True),
+        ],
+    },
+}
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def _cell_value(value):
+    # xlsxwriter/csv ไม่รู้จัก Decimal จาก psycopg2 โดยตรง
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _write_instructions(workbook, spec):
+    worksheet = workbook.add_worksheet(INSTRUCTIONS_SHEET_NAME)
+    warning_format = workbook.add_format({'font_color': 'red', 'text_wrap': True})
+    worksheet.write('A1', f"คำแนะนำการใช้งานไฟล์นำเข้า/ส่งออกข้อมูล{spec['label']}", workbook.add_format({'bold': True, 'font_size': 14}))
+    worksheet.write('A3', 'วัตถุประสงค์:', workbook.add_format({'bold': True}))
+    worksheet.write('A4', f"ไฟล์นี้ใช้สำหรับ Export ข้อมูลสต็อก{spec['label']}ปัจจุบัน และสามารถใช้เป็นแม่แบบเพื่อนำเข้าข้อมูลใหม่หรือแก้ไขข้อมูลที่มีอยู่ได้", workbook.add_format({'text_wrap': True}))
+    worksheet.write('A6', 'ข้อควรระวัง:', workbook.add_format({'bold': True, 'font_color': 'red'}))
+    for offset, line in enumerate(spec['instructions']):
+        worksheet.write(6 + offset, 0, line, warning_format)
+    worksheet.set_column('A:A', 80)
+
+
+def write_export_workbook(item_type, rows, path):
+    """
+    เขียน rows (iterable ของ dict) ลงไฟล์ xlsx ที่ path ด้วยโหมด constant_memory
+    เนื่องจากอ่านข้อมูลล่วงหน้าไม่ได้ ความกว้างคอลัมน์จึงใช้ค่าคงที่จาก EXPORT_SPECS
+    คืนจำนวนแถวที่เขียน
+    """
+    spec = EXPORT_SPECS[item_type]
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    try:
+        _write_instructions(workbook, spec)
+        worksheet = workbook.add_worksheet(spec['sheet_name'])
+
+        header_format = workbook.add_format({
+            'bold': True, 'text_wrap': True, 'valign': 'vcenter',
+            'fg_color': '#D7E4BC', 'border': 1, 'align': 'center'
+        })
+        read_only_header_format = workbook.add_format({
+            'bold': True, 'text_wrap': True, 'valign': 'vcenter',
+            'fg_color': '#D9D9D9', 'border': 1, 'font_color': '#5C5C5C', 'align': 'center'
+        })
+        cell_formats = {
+            'read_only': workbook.add_format({'font_color': '#808080', 'italic': True, 'align': 'center', 'valign': 'vcenter'}),
+            'integer': workbook.add_format({'num_format': '#,##0', 'align': 'center'}),
+            'decimal': workbook.add_format({'num_format': '#,##0.00', 'align': 'right'}),
+            'center': workbook.add_format({'align': 'center'}),
+            'left': workbook.add_format({'align': 'left'}),
+        }
+
+        columns = spec['columns']
+        formats = [cell_formats[kind] for _, _, kind, _, _ in columns]
+        for col_num, (header, _, kind, width, hidden) in enumerate(columns):
+            worksheet.set_column(col_num, col_num, width, formats[col_num], {'hidden': True} if hidden else None)
+            worksheet.write(0, col_num, header, read_only_header_format if kind == 'read_only' else header_format)
+        worksheet.freeze_panes(1, 0)
+
+        # เว้นหนึ่งแถวระหว่างกลุ่ม (ยี่ห้อ หรือ หมวดหมู่ของอะไหล่) เหมือนไฟล์เดิม
+        group_key = spec['group_key']
+        current_row = 1
+        last_group = None
+        row_count = 0
+        for row in rows:
+            group = str(row.get(group_key) or '').lower() # เรียงแบบไม่สนตัวพิมพ์ จึงเทียบกลุ่มแบบเดียวกัน
+            if row_count and group != last_group:
+                current_row += 1
+            for col_num, (_, key, _, _, _) in enumerate(columns):
+                worksheet.write(current_row, col_num, _cell_value(row.get(key)), formats[col_num])
+            current_row += 1
+            last_group = group
+            row_count += 1
+    finally:
+        workbook.close()
+    return row_count
+
+
+def iter_export_csv(item_type, rows):
+    """
+    generator คืน CSV เป็น chunk (str) สำหรับ streaming response
+    ขึ้นต้นด้วย BOM ให้ Excel เปิดภาษาไทยได้ถูกต้อง
+    """
+    spec = EXPORT_SPECS[item_type]
+    columns = spec['columns']
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for header, _, _, _, _ in columns])
+    yield '\ufeff' + buffer.getvalue()
+
+    buffer.seek(0)
+    buffer.truncate()
+    pending = 0
+    for row in rows:
+        writer.writerow(['' if row.get(key) is None else _cell_value(row.get(key)) for _, key, _, _, _ in columns])
+        pending += 1
+        if pending >= CSV_CHUNK_ROWS:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if pending:
+        yield buffer.getvalue()
@@ -0,0 +1,550 @@
+# excel_import.py
+# นำเข้าข้อมูลสินค้า (ยาง/แม็ก/อะไหล่) จากไฟล์ Excel แบบ bulk
+# - แปลง/ตรวจสอบคอลัมน์ทั้ง DataFrame ในครั้งเดียว แทนการวน iterrows() ทีละแถว
+# - โหลดสินค้าและบาร์โค้ดที่มีอยู่ครั้งเดียวแล้วจับคู่ในหน่วยความจำ (ID -> Barcode -> ยี่ห้อ/รุ่น/ขนาด)
+# - เขียนลงฐานข้อมูลด้วย executemany ทั้งหมดใน transaction เดียว (ผู้เรียกเป็นคน commit)
+# - โหมด dry run คืนรายการที่จะเปลี่ยน (diff) โดยไม่เขียนอะไรลงฐานข้อมูล
+# - รันเป็น background job ได้ สถานะ/ความคืบหน้าเก็บในตาราง import_jobs ให้หน้าเว็บ poll
+import json
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+import database
+
+ID_COLUMN = 'ID (ห้ามแก้ไข)'
+BARCODE_COLUMN = 'Barcode ID (ระบบ)'
+WRITE_BATCH_SIZE = 500
+JOB_RETENTION = 24 * 3600 # วินาที งานที่เก่ากว่านี้ถูกลบตอนเริ่มงานใหม่
+JOB_HEARTBEAT_INTERVAL = 30 # วินาที
+JOB_STALE_AFTER = 5 * 60 # วินาที ไม่มี heartbeat นานเท่านี้ = worker ที่รันงานหยุดไปแล้ว
+JOB_STALE_MESSAGE = 'การนำเข้าถูกยกเลิกเพราะ worker ที่รันงานหยุดทำงาน (ไม่มีข้อมูลใดถูกบันทึก) กรุณานำเข้าใหม่อีกครั้ง'
+
+ITEM_TYPE_LABELS = {'tire': 'ยาง', 'wheel': 'ล้อแม็ก', 'spare_part': 'อะไหล่'}
+
+# fields: (ชื่อคอลัมน์ในตาราง, ชื่อคอลัมน์ใน Excel, ชนิดข้อมูล)
+# ชนิด: text, lower (ตัวพิมพ์เล็ก), float, int, year (ตัวเลขถ้าได้ ไม่งั้นเป็นข้อความ)
+IMPORT_SPECS = {
+    'tire': {
+        'label': 'ยาง',
+        'sheet_name': 'Tires Data',
+        'tab': 'tires_excel',
+        'required_columns': ['ยี่ห้อ', 'รุ่นยาง', 'เบอร์ยาง', 'ปีผลิต', 'สต็อก',
+                             'ทุน', 'ทุนล็อต', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย'],
+        'fields': [
+            ('brand', 'ยี่ห้อ', 'lower'),
+            ('model', 'รุ่นยาง', 'lower'),
+            ('size', 'เบอร์ยาง', 'text'),
+            ('year_of_manufacture', 'ปีผลิต', 'year'),
+            ('quantity', 'สต็อก', 'int'),
+            ('cost_sc', 'ทุน', 'float'),
+            ('cost_dunlop', 'ทุนล็อต', 'float'),
+            ('cost_online', 'ทุนค้าส่ง 2 (ระบบ)', 'float'),
+            ('wholesale_price1', 'ราคาส่ง 1', 'float'),
+            ('wholesale_price2', 'ราคาส่งหน้าร้าน', 'float'),
+            ('price_per_item', 'ราคาขาย', 'float'),
+            ('promotion_id', 'ID โปรโมชัน (ระบบ)', 'int'),
+        ],
+        'blank_row_fields': ['brand', 'model', 'size', 'quantity'],
+        'blank_row_message': "ข้อมูลหลัก (ยี่ห้อ, รุ่นยาง, เบอร์ยาง, สต็อก) ว่างเปล่า. แถวถูกข้าม.",
+        'required_text': (['brand', 'model', 'size'], "ข้อมูล 'ยี่ห้อ', 'รุ่นยาง', หรือ 'เบอร์ยาง' ไม่สามารถเว้นว่างได้"),
+        'required_numbers': (['price_per_item'], "ข้อมูล 'ราคาขาย' ไม่สามารถเว้นว่างได้"),
+        'natural_key_label': 'ยี่ห้อ/รุ่น/เบอร์',
+    },
+    'wheel': {
+        'label': 'แม็ก',
+        'sheet_name': 'Wheels Data',
+        'tab': 'wheels_excel',
+        'required_columns': ['ยี่ห้อ', 'ลาย', 'ขอบ', 'รู', 'กว้าง', 'ET', 'สี', 'สต็อก',
+                             'ทุน', 'ทุน Online', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย'],
+        'fields': [
+            ('brand', 'ยี่ห้อ', 'lower'),
+            ('model', 'ลาย', 'lower'),
+            ('diameter', 'ขอบ', 'float'),
+            ('pcd', 'รู', 'text'),
+            ('width', 'กว้าง', 'float'),
+            ('et', 'ET', 'int'),
+            ('color', 'สี', 'text'),
+            ('quantity', 'สต็อก', 'int'),
+            ('cost', 'ทุน', 'float'),
+            ('cost_online', 'ทุน Online', 'float'),
+            ('wholesale_price1', 'ราคาส่ง 1', 'float'),
+            ('wholesale_price2', 'ราคาส่งหน้าร้าน', 'float'),
+            ('retail_price', 'ราคาขาย', 'float'),
+            ('image_filename', 'ไฟล์รูปภาพ (URL ระบบ)', 'text'),
+        ],
+        'blank_row_fields': ['brand', 'model', 'diameter', 'quantity'],
+        'blank_row_message': "ข้อมูลหลัก (ยี่ห้อ, ลาย, ขอบ, สต็อก) ว่างเปล่า. แถวถูกข้าม.",
+        'required_text': (['brand', 'model', 'pcd'], "ข้อมูล 'ยี่ห้อ', 'ลาย', หรือ 'รู' ไม่สามารถเว้นว่างได้"),
+        'required_numbers': (['diameter', 'width', 'retail_price'], "ข้อมูล 'ขอบ', 'กว้าง', หรือ 'ราคาขาย' ไม่สามารถเว้นว่างได้"),
+        'natural_key_label': 'ยี่ห้อ/ลาย/ขอบ/รู/กว้าง',
+    },
+    'spare_part': {
+        'label': 'อะไหล่',
+        'sheet_name': 'Spare Parts Data',
+        'tab': 'spare_parts_excel',
+        'required_columns': ['ชื่ออะไหล่', 'Part Number', 'ยี่ห้อ', 'หมวดหมู่', 'คำอธิบาย', 'สต็อก',
+                             'ทุน', 'ราคาขายปลีก', 'ราคาส่ง 1', 'ราคาส่ง 2', 'ทุน Online'],
+        'fields': [
+            ('name', 'ชื่ออะไหล่', 'text'),
+            ('part_number', 'Part Number', 'text'),
+            ('brand', 'ยี่ห้อ', 'lower'),
+            ('description', 'คำอธิบาย', 'text'),
+            ('quantity', 'สต็อก', 'int'),
+            ('cost', 'ทุน', 'float'),
+            ('retail_price', 'ราคาขายปลีก', 'float'),
+            ('wholesale_price1', 'ราคาส่ง 1', 'float'),
+            ('wholesale_price2', 'ราคาส่ง 2', 'float'),
+            ('cost_online', 'ทุน Online', 'float'),
+            ('image_filename', 'ไฟล์รูปภาพ (URL ระบบ)', 'text'),
+            ('category_id', 'ID หมวดหมู่ (ระบบ)', 'int'),
+            ('category_name', 'หมวดหมู่', 'lower'),
+        ],
+        'blank_row_fields': ['name', 'quantity', 'retail_price'],
+        'blank_row_message': "ข้อมูลหลัก (ชื่ออะไหล่, สต็อก, ราคาขายปลีก) ว่างเปล่า. แถวถูกข้าม.",
+        'required_text': (['name'], "ข้อมูล 'ชื่ออะไหล่' หรือ 'ราคาขายปลีก' ไม่สามารถเว้นว่างได้"),
+        'required_numbers': (['retail_price'], "ข้อมูล 'ชื่ออะไหล่' หรือ 'ราคาขายปลีก' ไม่สามารถเว้นว่างได้"),
+        'natural_key_label': 'ชื่อ/Part Number/ยี่ห้อ',
+    },
+}
+
+
+def _natural_keys(item_type, values):
+    """key ที่ใช้หาสินค้าเดิมเมื่อไม่มี ID/Barcode (ตัวแรกที่เจอถือเป็นสินค้าเดิม)"""
+    if item_type == 'tire':
+        return [(values['brand'], values['model'], values['size'])]
+    if item_type == 'wheel':
+        diameter = float(values['diameter']) if values['diameter'] is not None else None
+        width = float(values['width']) if values['width'] is not None else None
+        return [(values['brand'], values['model'], diameter, values['pcd'], width)]
+    if values['part_number']:
+        return [('part_number', values['name'], values['part_number'])]
+    return [('brand', values['name'], values['brand'])]
+
+
+def _existing_natural_keys(item_type, row):
+    if item_type == 'spare_part':
+        keys = [('brand', row['name'], row['brand'])]
+        if row['part_number']:
+            keys.append(('part_number', row['name'], row['part_number']))
+        return keys
+    return _natural_keys(item_type, row)
+
+
+def describe_item(item_type, values):
+    if item_type == 'tire':
+        return f"{values.get('brand') or ''} {values.get('model') or ''} {values.get('size') or ''}".strip()
+    if item_type == 'wheel':
+        return f"{values.get('brand') or ''} {values.get('model') or ''} {values.get('diameter')}x{values.get('width')} {values.get('pcd') or ''}".strip()
+    if values.get('part_number'):
+        return f"{values.get('name')} ({values.get('part_number')})"
+    return values.get('name') or ''
+
+
+# --- อ่านและแปลงข้อมูลจาก Excel ---
+
+def read_import_sheet(item_type, file):
+    """อ่านชีทข้อมูลจากไฟล์ Excel และตรวจว่ามีคอลัมน์ครบ (raise ValueError ถ้าไม่ถูกต้อง)"""
+    spec = IMPORT_SPECS[item_type]
+    xls = pd.ExcelFile(file)
+    if spec['sheet_name'] not in xls.sheet_names:
+        raise ValueError(f'ไม่พบชีทชื่อ "{spec["sheet_name"]}" ในไฟล์. โปรดตรวจสอบว่าคุณใช้ไฟล์แม่แบบที่ถูกต้อง')
+    df = xls.parse(spec['sheet_name'], dtype={BARCODE_COLUMN: str})
+    missing_cols = [col for col in spec['required_columns'] if col not in df.columns]
+    if missing_cols:
+        raise ValueError(f'ไฟล์ Excel ขาดคอลัมน์ที่จำเป็น: {", ".join(missing_cols)}. โปรดดาวน์โหลดไฟล์ตัวอย่างเพื่อดูรูปแบบที่ถูกต้อง.')
+    return df
+
+
+def _column(df, column):
+    if column in df.columns:
+        return df[column]
+    return pd.Series([np.nan] * len(df), index=df.index, dtype=object)
+
+
+def _text_series(raw, lower=False):
+    values = raw.astype(object).where(raw.notna(), '').astype(str).str.strip()
+    if lower:
+        values = values.str.lower()
+    return pd.Series([value or None for value in values.tolist()], index=raw.index, dtype=object)
+
+
+def _numeric_series(raw):
+    """คืน (ตัวเลข, แถวที่กรอกมาแต่ไม่ใช่ตัวเลข)"""
+    if raw.dtype == object:
+        raw = raw.map(lambda value: value.strip() if isinstance(value, str) else value).replace('', np.nan)
+    values = pd.to_numeric(raw, errors='coerce')
+    return values, raw.notna() & values.isna()
+
+
+def _year_series(raw):
+    numbers = pd.to_numeric(raw, errors='coerce')
+    texts = _text_series(raw)
+    return pd.Series([int(number) if not pd.isna(number) else text for number, text in zip(numbers, texts)],
+                     index=raw.index, dtype=object)
+
+
+def _to_python_list(values, kind):
+    if kind == 'int':
+        return [int(value) if not pd.isna(value) else None for value in values.tolist()]
+    if kind == 'float':
+        return [float(value) if not pd.isna(value) else None for value in values.tolist()]
+    return values.tolist()
+
+
+def prepare_records(conn, item_type, df):
+    """
+    แปลงทุกคอลัมน์ของ DataFrame ในครั้งเดียว คืน (records, errors)
+    records: list ของ dict (row_number, item_id, barcode, values) เฉพาะแถวที่ผ่านการตรวจสอบ
+    errors: list ของ (row_number, ข้อความ)
+    """
+    spec = IMPORT_SPECS[item_type]
+    row_numbers = (df.index + 2).tolist()
+    error_by_row = {}
+
+    def flag(mask, message):
+        for row_number in np.asarray(row_numbers)[np.asarray(mask, dtype=bool)].tolist():
+            error_by_row.setdefault(row_number, message)
+
+    columns = {}
+    present = {}
+    for field, column, kind in spec['fields']:
+        raw = _column(df, column)
+        if kind in ('int', 'float'):
+            values, invalid = _numeric_series(raw)
+            if kind == 'int':
+                values = np.trunc(values)
+            flag(invalid, f"ข้อมูลตัวเลขไม่ถูกต้องในคอลัมน์ '{column}'")
+            present[field] = values.notna()
+        elif kind == 'year':
+            values = _year_series(raw)
+            present[field] = values.notna()
+        else:
+            values = _text_series(raw, lower=(kind == 'lower'))
+            present[field] = values.notna()
+        columns[field] = _to_python_list(values, kind)
+
+    blank = ~np.logical_or.reduce([present[field].to_numpy() for field in spec['blank_row_fields']])
+    flag(blank, spec['blank_row_message'])
+
+    text_fields, text_message = spec['required_text']
+    flag(~np.logical_and.reduce([present[field].to_numpy() for field in text_fields]), text_message)
+    number_fields, number_message = spec['required_numbers']
+    flag(~np.logical_and.reduce([present[field].to_numpy() for field in number_fields]), number_message)
+
+    item_ids, invalid_ids = _numeric_series(_column(df, ID_COLUMN))
+    flag(invalid_ids, f"'{ID_COLUMN}' ไม่ใช่ตัวเลขที่ถูกต้อง")
+    item_ids = _to_python_list(np.trunc(item_ids), 'int')
+    barcodes = [barcode if barcode and barcode.lower() not in ('none', 'nan') else None
+                for barcode in _text_series(_column(df, BARCODE_COLUMN)).tolist()]
+
+    if item_type == 'spare_part':
+        _resolve_spare_part_categories(conn, columns, row_numbers, error_by_row)
+
+    quantities = columns['quantity']
+    records = []
+    for position, row_number in enumerate(row_numbers):
+        if row_number in error_by_row:
+            continue
+        values = {field: columns[field][position] for field in database.IMPORT_ITEM_COLUMNS[item_type]}
+        if quantities[position] is None:
+            values['quantity'] = 0
+        records.append({'row_number': row_number, 'item_id': item_ids[position],
+                        'barcode': barcodes[position], 'values': values})
+
+    errors = sorted(error_by_row.items())
+    return records, errors
+
+
+def _resolve_spare_part_categories(conn, columns, row_numbers, error_by_row):
+    categories = database.get_all_spare_part_categories(conn)
+    category_ids_by_name = {category['name'].lower(): category['id'] for category in categories}
+    valid_category_ids = {category['id'] for category in categories}
+
+    for position, row_number in enumerate(row_numbers):
+        category_id = columns['category_id'][position]
+        category_name = columns['category_name'][position]
+        if category_id is not None:
+            if category_id not in valid_category_ids:
+                error_by_row.setdefault(row_number, f"ID หมวดหมู่ (ระบบ) '{category_id}' ไม่ถูกต้องหรือไม่มีในระบบ")
+        elif category_name:
+            category_id = category_ids_by_name.get(category_name)
+            if category_id is None:
+                error_by_row.setdefault(row_number, f"หมวดหมู่ '{category_name}' ไม่มีในระบบ. โปรดสร้างหมวดหมู่นี้ก่อน หรือใช้หมวดหมู่ที่มีอยู่แล้ว.")
+            columns['category_id'][position] = category_id
+
+
+# --- จับคู่กับข้อมูลเดิมและสร้างแผนการนำเข้า ---
+
+def _values_differ(old, new):
+    if old is None or new is None:
+        return old is not new
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return abs(float(old) - float(new)) > 1e-9
+    return str(old) != str(new)
+
+
+def build_import_plan(conn, item_type, records):
+    """
+    จับคู่แต่ละแถวกับสินค้าเดิมโดยไม่ query ซ้ำ (โหลดสินค้าและบาร์โค้ดครั้งเดียว)
+    สินค้าใหม่ใช้ id ชั่วคราวเป็นเลขติดลบ จนกว่าจะ insert จริงใน apply_import_plan
+    """
+    spec = IMPORT_SPECS[item_type]
+    columns = database.IMPORT_ITEM_COLUMNS[item_type]
+    items = database.get_import_items(conn, item_type)
+    barcode_owners = database.get_all_barcode_owners(conn)
+
+    ids_by_key = {}
+    for item_id in sorted(items):
+        for key in _existing_natural_keys(item_type, items[item_id]):
+            ids_by_key.setdefault(key, item_id)
+
+    plan = {
+        'item_type': item_type,
+        'inserts': {},
+        'updates': {},
+        'barcodes': [],
+        'movements': [],
+        'cost_history': [],
+        'changes': [],
+        'errors': [],
+        'imported_count': 0,
+        'updated_count': 0,
+    }
+
+    for record in records:
+        row_number = record['row_number']
+        values = record['values']
+        excel_id = record['item_id']
+        barcode = record['barcode']
+        try:
+            existing_id = excel_id if excel_id is not None and excel_id in items else None
+
+            if existing_id is None and barcode:
+                owner_type, owner_id = barcode_owners.get(barcode, (None, None))
+                if owner_type == item_type:
+                    existing_id = owner_id
+                    if excel_id is not None and owner_id != excel_id:
+                        raise ValueError(f"ID ({excel_id}) ใน Excel ไม่ตรงกับ ID ที่พบจาก Barcode ({owner_id}). กรุณาแก้ไข ID ใน Excel หรือลบออก.")
+                elif owner_type is not None:
+                    raise ValueError(f"Barcode ID '{barcode}' ซ้ำกับ{ITEM_TYPE_LABELS[owner_type]} ID {owner_id}. Barcode ID ต้องไม่ซ้ำกันข้ามประเภทสินค้า.")
+
+            if existing_id is None:
+                for key in _natural_keys(item_type, values):
+                    existing_id = ids_by_key.get(key)
+                    if existing_id is not None:
+                        break
+                if existing_id is not None and excel_id is not None and existing_id != excel_id:
+                    raise ValueError(f"ID ({excel_id}) ใน Excel ไม่ตรงกับสินค้าที่มีอยู่แล้วด้วย {spec['natural_key_label']} ({existing_id}). กรุณาแก้ไข ID ใน Excel หรือลบออก.")
+        except ValueError as e:
+            plan['errors'].append((row_number, str(e)))
+            continue
+
+        quantity = values['quantity']
+        if existing_id is None:
+            placeholder_id = -(len(plan['inserts']) + 1)
+            plan['inserts'][placeholder_id] = values
+            if barcode:
+                plan['barcodes'].append((placeholder_id, barcode, True))
+                barcode_owners[barcode] = (item_type, placeholder_id)
+            plan['movements'].append((placeholder_id, 'IN', quantity, quantity, "Import from Excel (initial stock)"))
+            plan['changes'].append({'row_number': row_number, 'action': 'insert', 'item_id': None,
+                                    'description': describe_item(item_type, values),
+                                    'changes': {'quantity': (None, quantity)}})
+            plan['imported_count'] += 1
+            items[placeholder_id] = dict(values, id=placeholder_id)
+            for key in _existing_natural_keys(item_type, values):
+                ids_by_key.setdefault(key, placeholder_id)
+            continue
+
+        old = items[existing_id]
+        if 'image_filename' in values and values['image_filename'] is None:
+            # ไม่มี URL รูปในไฟล์ ให้ใช้รูปเดิม
+            values['image_filename'] = old.get('image_filename')
+        if item_type == 'tire' and _values_differ(old.get('cost_sc'), values['cost_sc']):
+            plan['cost_history'].append((existing_id, old.get('cost_sc'), values['cost_sc']))
+        if barcode and barcode_owners.get(barcode, (None,))[0] != item_type:
+            plan['barcodes'].append((existing_id, barcode, False))
+            barcode_owners[barcode] = (item_type, existing_id)
+
+        if existing_id < 0:
+            plan['inserts'][existing_id] = values
+        else:
+            plan['updates'][existing_id] = values
+
+        old_quantity = old.get('quantity') or 0
+        if quantity != old_quantity:
+            movement_type = 'IN' if quantity > old_quantity else 'OUT'
+            plan['movements'].append((existing_id, movement_type, abs(quantity - old_quantity), quantity, "Import from Excel (Qty Update)"))
+
+        changes = {column: (old.get(column), values[column]) for column in columns if _values_differ(old.get(column), values[column])}
+        plan['changes'].append({'row_number': row_number, 'action': 'update' if changes else 'unchanged',
+                                'item_id': existing_id if existing_id > 0 else None,
+                                'description': describe_item(item_type, values), 'changes': changes})
+        plan['updated_count'] += 1
+        items[existing_id] = dict(values, id=existing_id)
+        for key in _existing_natural_keys(item_type, values):
+            ids_by_key.setdefault(key, existing_id)
+
+    return plan
+
+
+# --- เขียนลงฐานข้อมูล ---
+
+def _batches(rows, size=WRITE_BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def apply_import_plan(conn, plan, user_id=None, progress=None):
+    """เขียนแผนการนำเข้าลงฐานข้อมูลด้วย executemany (ไม่ commit) progress(processed, total) ถูกเรียกหลังแต่ละ batch"""
+    item_type = plan['item_type']
+    columns = database.IMPORT_ITEM_COLUMNS[item_type]
+    total = len(plan['updates']) + len(plan['inserts'])
+    processed = 0
+
+    update_rows = [tuple(values[column] for column in columns) + (item_id,) for item_id, values in plan['updates'].items()]
+    for batch in _batches(update_rows):
+        database.bulk_update_import_items(conn, item_type, batch)
+        processed += len(batch)
+        if progress:
+            progress(processed, total)
+
+    new_ids = {}
+    placeholder_ids = list(plan['inserts'])
+    for batch in _batches(placeholder_ids):
+        inserted_ids = database.bulk_insert_import_items(
+            conn, item_type, [tuple(plan['inserts'][placeholder_id][column] for column in columns) for placeholder_id in batch])
+        new_ids.update(zip(batch, inserted_ids))
+        processed += len(batch)
+        if progress:
+            progress(processed, total)
+
+    def resolve(item_id):
+        return new_ids.get(item_id, item_id)
+
+    database.bulk_add_barcodes(conn, item_type, [(resolve(item_id), barcode, is_primary) for item_id, barcode, is_primary in plan['barcodes']])
+    database.bulk_add_import_movements(conn, item_type, [(resolve(item_id),) + tuple(rest) for item_id, *rest in plan['movements']], user_id=user_id)
+    if plan['cost_history']:
+        database.bulk_add_tire_cost_history(conn, [(resolve(item_id), old_cost, new_cost) for item_id, old_cost, new_cost in plan['cost_history']],
+                                            user_id, notes="แก้ไขผ่านการนำเข้า Excel")
+    return new_ids
+
+
+def run_import(conn, item_type, df, user_id=None, dry_run=False, progress=None):
+    """
+    ตรวจสอบ + จับคู่ + (ถ้าไม่ใช่ dry run) เขียนลงฐานข้อมูล ผู้เรียกต้อง commit/rollback เอง
+    คืน dict สรุปผล: imported_count, updated_count, errors (ข้อความ), changes (diff ต่อแถว)
+    """
+    records, errors = prepare_records(conn, item_type, df)
+    plan = build_import_plan(conn, item_type, records)
+    if not dry_run:
+        apply_import_plan(conn, plan, user_id=user_id, progress=progress)
+    return {
+        'item_type': item_type,
+        'dry_run': dry_run,
+        'total_rows': len(df),
+        'imported_count': plan['imported_count'],
+        'updated_count': plan['updated_count'],
+        'errors': [f"แถวที่ {row_number}: {message}" for row_number, message in sorted(errors + plan['errors'])],
+        'changes': plan['changes'],
+    }
+
+
+def import_summary_message(result):
+    label = IMPORT_SPECS[result['item_type']]['label']
+    message = f"นำเข้าข้อมูล{label}สำเร็จ: เพิ่มใหม่ {result['imported_count']} รายการ, อัปเดต {result['updated_count']} รายการ."
+    error_rows = result['errors']
+    if error_rows:
+        message += f' พบข้อผิดพลาดใน {len(error_rows)} แถว: {"; ".join(error_rows[:5])}{"..." if len(error_rows) > 5 else ""}'
+    return message
+
+
+# --- Background job ---
+# สถานะงานเก็บในตาราง import_jobs (ไม่ใช่ cache ของ process) ทุก worker จึง poll ได้ และงานที่ worker ตายกลางทาง
+# (restart/timeout/deploy) จะหยุดส่ง heartbeat แล้วถูกปิดเป็น failed ตอน poll แทนที่จะค้าง running ตลอด
+# การเขียนสถานะใช้ connection แยกที่ commit ทันที ไม่ปนกับ transaction ของการนำเข้า
+
+def _job_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _write_job(write, *args, **kwargs):
+    conn = database.open_dedicated_connection()
+    try:
+        write(conn, *args, **kwargs)
+    finally:
+        conn.close()
+
+
+def _update_job(job_id, **fields):
+    try:
+        _write_job(database.update_import_job, job_id, **fields)
+    except Exception as e:
+        print(f"WARNING: Could not update import job {job_id}: {e}")
+
+
+def get_import_job(conn, job_id):
+    """สถานะงานสำหรับหน้าเว็บ (ผู้เรียกเป็นคน commit) งานที่ไม่มี heartbeat เกิน JOB_STALE_AFTER ถือว่าล้มเหลว"""
+    job = database.get_import_job(conn, job_id)
+    if not job:
+        return None
+    stale_before = database.get_bkk_time() - timedelta(seconds=JOB_STALE_AFTER)
+    if job['status'] in ('queued', 'running') and job['heartbeat_at'] < stale_before.isoformat():
+        if database.fail_stale_import_job(conn, job_id, stale_before, JOB_STALE_MESSAGE):
+            print(f"WARNING: Import job {job_id} ({job['owner']}) stopped sending heartbeats, marked as failed")
+        job = database.get_import_job(conn, job_id)
+    result = json.loads(job.pop('result') or '{}')
+    job.update(result)
+    return job
+
+
+def start_import_job(app, item_type, df, user_id, on_complete=None):
+    """
+    เริ่มนำเข้าใน thread แยก (ใช้ connection ของตัวเอง) คืน job_id สำหรับ poll สถานะ
+    on_complete(item_type) ถูกเรียกหลัง commit สำเร็จ (เช่น ล้าง cache ที่เกี่ยวข้อง)
+    """
+    job_id = uuid.uuid4().hex
+    created_before = database.get_bkk_time() - timedelta(seconds=JOB_RETENTION)
+    _write_job(database.delete_import_jobs_before, created_before)
+    _write_job(database.create_import_job, job_id, item_type, user_id, len(df), _job_owner(), message='รอเริ่มนำเข้า')
+    thread = threading.Thread(target=_run_import_job, args=(app, job_id, item_type, df, user_id, on_complete), daemon=True)
+    thread.start()
+    return job_id
+
+
+def _send_heartbeats(job_id, stopped):
+    while not stopped.wait(JOB_HEARTBEAT_INTERVAL):
+        _update_job(job_id)
+
+
+def _run_import_job(app, job_id, item_type, df, user_id, on_complete):
+    stopped = threading.Event()
+    threading.Thread(target=_send_heartbeats, args=(job_id, stopped), daemon=True).start()
+    with app.app_context():
+        conn = database.get_db_connection()
+        # SQLite ล็อกทั้งไฟล์ระหว่าง transaction เขียน connection อื่นจึงบันทึกความคืบหน้าระหว่างนั้นไม่ได้
+        progress = None
+        if database.is_postgres_conn(conn):
+            progress = lambda processed, total: _update_job(job_id, processed=processed, total=total, message='กำลังบันทึกข้อมูล')
+        try:
+            _update_job(job_id, status='running', message='กำลังตรวจสอบข้อมูล')
+            result = run_import(conn, item_type, df, user_id=user_id, progress=progress)
+            conn.commit()
+            if on_complete:
+                on_complete(item_type)
+            _update_job(job_id, status='done', message=import_summary_message(result), processed=len(df),
+                        result=json.dumps({'imported_count': result['imported_count'], 'updated_count': result['updated_count'],
+                                           'errors': result['errors'][:100]}, ensure_ascii=False))
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in import job {job_id}: {e}")
+            _update_job(job_id, status='failed', message=f'เกิดข้อผิดพลาดร้ายแรงในการนำเข้าไฟล์ Excel: {e}')
+        finally:
+            stopped.set()
+            database.release_db_connection(conn)
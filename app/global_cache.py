@@ -0,0 +1,91 @@
+# global_cache.py
+# cache ข้อมูลที่ใช้ในทุกหน้า: ผู้ใช้ที่ login (user_loader), ประกาศล่าสุด และจำนวนแจ้งเตือนที่ยังไม่อ่าน (context processor)
+# - ระดับ request: เก็บใน g ไม่ query ซ้ำเมื่อ render หลาย template ใน request เดียว
+# - ระดับ shared: Flask-Caching TTL สั้น ใช้ร่วมกันทุก worker
+# - database แจ้งผ่าน on_data_change เมื่อข้อมูลเปลี่ยน -> ลบ key ทันที และลบซ้ำตอนจบ request (หลัง commit)
+#   กันกรณี request อื่นอ่านค่าเก่าก่อน commit แล้ว cache กลับเข้าไป
+from flask import g, has_app_context
+
+import database
+from . import cache, get_db
+
+GLOBAL_CACHE_TIMEOUT = 60 # วินาที
+ANNOUNCEMENT_KEY = 'global:latest_announcement'
+UNREAD_COUNT_KEY = 'global:unread_notification_count'
+
+
+def _user_key(user_id):
+    return f"global:user:{user_id}"
+
+
+def _cached(key, loader):
+    request_cache = g.setdefault('_global_cache', {})
+    if key in request_cache:
+        return request_cache[key]
+    entry = cache.get(key)
+    if entry is None:
+        # ห่อด้วย dict เพื่อให้ cache ค่า None ได้ (เช่น ไม่มีประกาศ)
+        entry = {'value': loader()}
+        cache.set(key, entry, timeout=GLOBAL_CACHE_TIMEOUT)
+    request_cache[key] = entry['value']
+    return entry['value']
+
+
+def invalidate(key):
+    cache.delete(key)
+    if has_app_context():
+        g.setdefault('_global_cache', {}).pop(key, None)
+        g.setdefault('_global_cache_pending', set()).add(key)
+
+
+def _flush_pending_invalidations(e=None):
+    for key in g.pop('_global_cache_pending', ()):
+        cache.delete(key)
+
+
+def _load_user(user_id):
+    user = database.User.get(get_db(), user_id)
+    # ไม่เก็บ password hash ใน cache (login ใช้ User.get_by_username อ่านจากฐานข้อมูลเสมอ)
+    return (user.id, user.username, user.role) if user else None
+
+
+def get_user(user_id):
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    data = _cached(_user_key(user_id), lambda: _load_user(user_id))
+    if not data:
+        return None
+    user_id, username, role = data
+    return database.User(user_id, username, None, role)
+
+
+def get_latest_announcement():
+    def load():
+        announcement = database.get_latest_active_announcement(get_db())
+        return dict(announcement) if announcement else None
+    return _cached(ANNOUNCEMENT_KEY, load)
+
+
+def get_unread_notification_count():
+    return _cached(UNREAD_COUNT_KEY, lambda: database.get_unread_notification_count(get_db()))
+
+
+def init_app(app):
+    database.on_data_change('announcements', _invalidate_announcement)
+    database.on_data_change('notifications', _invalidate_unread_count)
+    database.on_data_change('user', _invalidate_user)
+    app.teardown_appcontext(_flush_pending_invalidations)
+
+
+def _invalidate_announcement():
+    invalidate(ANNOUNCEMENT_KEY)
+
+
+def _invalidate_unread_count():
+    invalidate(UNREAD_COUNT_KEY)
+
+
+def _invalidate_user(user_id):
+    invalidate(_user_key(user_id))
@@ -0,0 +1,123 @@
+# pdf_renderer.py
+# สร้าง PDF ใบรับรถ / ใบเสร็จ / แผ่นสติกเกอร์บาร์โค้ด ผ่าน cache และ process pool แทนการสร้าง ReportLab story บน request thread ทุกครั้ง
+# - key ของ cache เป็น hash ของเนื้อหาที่ใช้สร้างเอกสาร (ใบงาน + รายการ + template) พิมพ์ซ้ำจึงได้ไฟล์จาก cache
+#   และเมื่อใบงาน/template ถูกแก้ key จะเปลี่ยนเอง ไม่ต้องสั่งลบ cache
+# - การสร้างครั้งแรกส่งไปที่ process pool (ฟอนต์ลงทะเบียนครั้งเดียวต่อ worker) จำกัดงานที่รอได้ไม่เกิน PDF_RENDER_MAX_PENDING
+#   ถ้าคิวเต็มเกิน PDF_RENDER_QUEUE_TIMEOUT วินาที, สร้างนานเกิน PDF_RENDER_TIMEOUT หรือ process ใน pool ล่ม
+#   จะ raise PdfRenderBusy ให้ route แจ้งผู้ใช้ลองใหม่ (pool ที่ล่มจะถูกทิ้งแล้วสร้างใหม่ในครั้งถัดไป)
+#   งานที่เกินเวลายังถือช่องคิวไว้จนกว่า worker จะสร้างเสร็จจริง จำนวนงานใน pool จึงไม่เกิน PDF_RENDER_MAX_PENDING
+# - PDF_RENDER_WORKERS=0 จะสร้างใน process เดียวกับ request (ใช้ตอนพัฒนา/ทดสอบ)
+import atexit
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+import database
+import document_generator
+from . import cache
+
+PDF_CACHE_TIMEOUT = 24 * 60 * 60 # วินาที
+PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS', 2))
+PDF_RENDER_MAX_PENDING = int(os.environ.get('PDF_RENDER_MAX_PENDING', 8))
+PDF_RENDER_QUEUE_TIMEOUT = 10 # วินาที
+PDF_RENDER_TIMEOUT = 60 # วินาที
+JOB_TEMPLATE_NAME = 'Job Order'
+
+
+class PdfRenderBusy(Exception):
+    """สร้าง PDF ไม่ได้ชั่วคราว (คิวเต็ม / ใช้เวลานานเกิน / process สร้าง PDF ล่ม) ให้ผู้ใช้ลองใหม่"""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(PDF_RENDER_MAX_PENDING)
+
+
+def _get_pool():
+    # สร้าง pool ตอนใช้ครั้งแรกในแต่ละ worker process และใช้ spawn
+    # (ไม่ fork ต่อจาก process ที่มี thread และ connection ของฐานข้อมูลเปิดอยู่)
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _discard_pool(broken_pool):
+    # ProcessPoolExecutor ที่ล่มแล้วรับงานใหม่ไม่ได้อีก ต้องทิ้งแล้วให้ _get_pool สร้างใหม่
+    global _pool
+    with _pool_lock:
+        if _pool is broken_pool:
+            _pool = None
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+atexit.register(shutdown)
+
+
+def _cache_key(kind, data, template_data):
+    payload = json.dumps([kind, data, template_data], sort_keys=True, default=str, ensure_ascii=False)
+    return f"pdf:{kind}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+def _render(kind, data, template_data):
+    if PDF_RENDER_WORKERS <= 0:
+        return document_generator.render_pdf_bytes(kind, data, template_data)
+    if not _pending.acquire(timeout=PDF_RENDER_QUEUE_TIMEOUT):
+        raise PdfRenderBusy("ระบบกำลังสร้างเอกสารจำนวนมาก กรุณาลองใหม่อีกครั้ง")
+    pool = _get_pool()
+    try:
+        future = pool.submit(document_generator.render_pdf_bytes, kind, data, template_data)
+    except BrokenProcessPool as e:
+        _pending.release()
+        current_app.logger.error(f"PDF render pool is broken ({e}), restarting it")
+        _discard_pool(pool)
+        raise PdfRenderBusy("ระบบสร้างเอกสารขัดข้องชั่วคราว กรุณาลองใหม่อีกครั้ง")
+    except BaseException:
+        _pending.release()
+        raise
+    # คืนช่องคิวเมื่องานใน worker จบจริงเท่านั้น (งานที่เกินเวลายังกิน worker อยู่ ยังต้องนับเป็นงานที่รอ)
+    future.add_done_callback(lambda _: _pending.release())
+    try:
+        return future.result(timeout=PDF_RENDER_TIMEOUT)
+    except FutureTimeoutError:
+        current_app.logger.warning(f"PDF render ({kind}) took longer than {PDF_RENDER_TIMEOUT}s")
+        raise PdfRenderBusy("การสร้างเอกสารใช้เวลานานเกินไป กรุณาลองใหม่อีกครั้ง")
+    except BrokenProcessPool as e:
+        current_app.logger.error(f"PDF render pool is broken ({e}), restarting it")
+        _discard_pool(pool)
+        raise PdfRenderBusy("ระบบสร้างเอกสารขัดข้องชั่วคราว กรุณาลองใหม่อีกครั้ง")
+
+
+def get_job_template(conn):
+    return database.get_template_by_name(conn, JOB_TEMPLATE_NAME) or {}
+
+
+def get_pdf(kind, data, template_data):
+    """
+    คืน bytes ของ PDF (จาก cache ถ้าเคยสร้างจากเนื้อหาเดียวกัน) หรือ None ถ้าสร้างไม่สำเร็จ
+    kind: 'job_order', 'receipt' (data = job), 'receipt_batch' (data = list ของ job)
+          หรือ 'label_sheet' (data = list ของสติกเกอร์, template_data = label preset)
+    """
+    key = _cache_key(kind, data, template_data)
+    pdf_bytes = cache.get(key)
+    if pdf_bytes is None:
+        pdf_bytes = _render(kind, data, template_data)
+        if pdf_bytes is not None:
+            cache.set(key, pdf_bytes, timeout=PDF_CACHE_TIMEOUT)
+    return pdf_bytes
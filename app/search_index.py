@@ -0,0 +1,190 @@
+# search_index.py
+# ดัชนีค้นหาในหน่วยความจำสำหรับรายการสินค้า (สร้างคู่กับ list ใน catalog_cache)
+# - เก็บข้อความที่ normalize แล้ว (ตัวพิมพ์เล็ก + ตัดช่องว่าง) ไม่ต้อง .lower()/str() ทุก request
+# - posting list ของ n-gram (1-3 ตัวอักษร) สำหรับค้นหาแบบ substring
+# - map ยี่ห้อ -> id สำหรับกรองยี่ห้อ
+from collections import defaultdict
+
+from . import catalog_cache
+
+NGRAM_SIZE = 3
+
+
+def normalize_text(value):
+    """แปลงเป็นตัวพิมพ์เล็กและตัดช่องว่างทั้งหมดออก"""
+    if value is None:
+        return ''
+    return ''.join(str(value).split()).lower()
+
+
+def _wheel_spec_text(wheel):
+    return f"{wheel.get('diameter')}x{wheel.get('width')} {wheel.get('pcd') or ''} ET{wheel.get('et')} {wheel.get('color') or ''}"
+
+
+# ฟิลด์ที่ใช้ค้นหาของสินค้าแต่ละประเภท
+SEARCH_FIELDS = {
+    'tire': lambda t: (t.get('brand'), t.get('model'), t.get('size')),
+    'wheel': lambda w: (w.get('brand'), w.get('model'), w.get('diameter'), w.get('pcd'), w.get('width'),
+                        w.get('color'), w.get('et'), _wheel_spec_text(w)),
+    'spare_part': lambda p: (p.get('name'), p.get('description'), p.get('part_number'), p.get('brand')),
+}
+
+
+def _search_texts(item_type, item):
+    return [text for text in (normalize_text(value) for value in SEARCH_FIELDS[item_type](item)) if text]
+
+
+class CatalogSearchIndex:
+    def __init__(self, item_type, version, items):
+        self.item_type = item_type
+        self.version = version
+        self.items = items
+        self.position_by_id = {}
+        self.texts_by_id = {}
+        self.ngram_postings = defaultdict(set)
+        self.ids_by_brand = defaultdict(list)
+
+        for position, item in enumerate(items):
+            self.position_by_id[item['id']] = position
+            self.ids_by_brand[(item.get('brand') or '').lower()].append(item['id'])
+            self._add_texts(item['id'], _search_texts(item_type, item))
+
+    def _add_texts(self, item_id, texts):
+        self.texts_by_id[item_id] = texts
+        for text in texts:
+            for gram in _ngrams(text):
+                self.ngram_postings[gram].add(item_id)
+
+    def updated(self, version, items, changed_ids=None):
+        """
+        ดัชนีใหม่ของ items (เวอร์ชัน version) สร้าง n-gram ใหม่เฉพาะแถวที่ข้อความค้นหาเปลี่ยน
+        changed_ids = id ที่อาจเปลี่ยน (None = ไม่รู้ ให้เทียบแถวเดิมกับแถวใหม่ทั้ง list)
+        posting list ที่ไม่ถูกแตะใช้ร่วมกับดัชนีเดิม ดัชนีเดิมไม่ถูกแก้ request ที่กำลังค้นอยู่จึงไม่กระทบ
+        """
+        index = CatalogSearchIndex.__new__(CatalogSearchIndex)
+        index.item_type = self.item_type
+        index.version = version
+        index.items = items
+        index.position_by_id = {}
+        index.ids_by_brand = defaultdict(list)
+        index.texts_by_id = dict(self.texts_by_id)
+        index.ngram_postings = defaultdict(set, self.ngram_postings)
+
+        if changed_ids is None:
+            old_items = {item['id']: item for item in self.items}
+            changed_ids = {item['id'] for item in items if old_items.pop(item['id'], None) != item}
+            changed_ids.update(old_items) # แถวที่ถูกลบออกไป
+        new_texts = {}
+        for position, item in enumerate(items):
+            index.position_by_id[item['id']] = position
+            index.ids_by_brand[(item.get('brand') or '').lower()].append(item['id'])
+            if item['id'] in changed_ids:
+                new_texts[item['id']] = _search_texts(self.item_type, item)
+
+        copied_grams = set()
+        for item_id in changed_ids:
+            texts = new_texts.get(item_id)
+            if texts == self.texts_by_id.get(item_id):
+                continue
+            for text in index.texts_by_id.pop(item_id, ()):
+                for gram in _ngrams(text):
+                    index._own_posting(gram, copied_grams).discard(item_id)
+            if texts is not None:
+                index.texts_by_id[item_id] = texts
+                for text in texts:
+                    for gram in _ngrams(text):
+                        index._own_posting(gram, copied_grams).add(item_id)
+        return index
+
+    def _own_posting(self, gram, copied_grams):
+        # copy-on-write: set ของ gram นี้ยังเป็นของดัชนีเดิมอยู่ ให้ copy ก่อนแก้
+        if gram not in copied_grams:
+            self.ngram_postings[gram] = set(self.ngram_postings.get(gram, ()))
+            copied_grams.add(gram)
+        return self.ngram_postings[gram]
+
+    def search(self, query=None, brand_filter=None, limit=None):
+        """คืนรายการที่ตรงเงื่อนไข เรียงตามลำดับเดียวกับ list ต้นฉบับ"""
+        normalized_query = normalize_text(query)
+        candidate_ids = None
+
+        if normalized_query:
+            candidate_ids = self._match_query(normalized_query)
+
+        if brand_filter and brand_filter != 'all':
+            brand_ids = self.ids_by_brand.get(brand_filter.lower(), ())
+            candidate_ids = set(brand_ids) if candidate_ids is None else candidate_ids.intersection(brand_ids)
+
+        if candidate_ids is None:
+            return self.items[:limit] if limit else list(self.items)
+
+        positions = sorted(self.position_by_id[item_id] for item_id in candidate_ids)
+        if limit:
+            positions = positions[:limit]
+        return [self.items[position] for position in positions]
+
+    def _match_query(self, normalized_query):
+        if len(normalized_query) <= NGRAM_SIZE:
+            # n-gram ยาวเท่ากับคำค้นพอดี posting list คือผลลัพธ์เลย
+            return set(self.ngram_postings.get(normalized_query, ()))
+
+        grams = sorted((normalized_query[i:i + NGRAM_SIZE] for i in range(len(normalized_query) - NGRAM_SIZE + 1)),
+                       key=lambda gram: len(self.ngram_postings.get(gram, ())))
+        candidates = set(self.ngram_postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            if not candidates:
+                break
+            candidates &= self.ngram_postings.get(gram, set())
+
+        # ยืนยันว่าเป็น substring จริง (trigram ครบไม่ได้แปลว่าเรียงติดกัน)
+        return {item_id for item_id in candidates
+                if any(normalized_query in text for text in self.texts_by_id[item_id])}
+
+
+def _ngrams(text):
+    grams = set()
+    length = len(text)
+    for size in range(1, NGRAM_SIZE + 1):
+        for i in range(length - size + 1):
+            grams.add(text[i:i + size])
+    return grams
+
+
+# ดัชนีเก็บแยกต่อ worker process
+# - เทียบเลขเวอร์ชันก่อน ถ้าดัชนีตรงกับเวอร์ชันล่าสุดแล้วไม่ต้องดึง list ทั้งก้อนจาก cache
+# - เมื่อเวอร์ชันเปลี่ยน สร้าง n-gram ใหม่เฉพาะแถวที่เปลี่ยน (updated) แทนการสร้างดัชนีใหม่ทั้งหมด
+#   ถ้า worker นี้เป็นคน patch เอง (ได้ id จาก on_catalog_change ครบทุกเวอร์ชันที่ข้ามไป) ใช้ id ชุดนั้นเลย
+#   ไม่งั้น (worker อื่นเป็นคนแก้) เทียบแถวเดิมกับแถวใหม่เพื่อหาแถวที่เปลี่ยน
+_indexes = {}
+_local_changes = {} # item_type -> (จำนวนครั้งที่ catalogue เปลี่ยนใน worker นี้, id ที่เปลี่ยน หรือ None = ไม่รู้)
+
+
+@catalog_cache.on_catalog_change
+def _record_catalog_change(item_type, item_ids):
+    count, changed_ids = _local_changes.get(item_type, (0, set()))
+    if item_ids is None or changed_ids is None:
+        changed_ids = None
+    else:
+        changed_ids = changed_ids | set(item_ids)
+    _local_changes[item_type] = (count + 1, changed_ids)
+
+
+def get_search_index(item_type):
+    index = _indexes.get(item_type)
+    if index is not None and index.version == catalog_cache.get_catalog_version(item_type):
+        return index
+
+    version, items = catalog_cache.get_catalog_entry(item_type)
+    change_count, changed_ids = _local_changes.pop(item_type, (0, None))
+    if index is None:
+        index = CatalogSearchIndex(item_type, version, items)
+    elif index.version != version:
+        if index.version + change_count != version:
+            changed_ids = None # มีการเปลี่ยนจาก worker อื่นปนอยู่ id ที่รู้ไม่ครบ
+        index = index.updated(version, items, changed_ids)
+    _indexes[item_type] = index
+    return index
+
+
+def search_catalog(item_type, query=None, brand_filter=None, limit=None):
+    return get_search_index(item_type).search(query, brand_filter, limit)
@@ -2,6 +2,7 @@
 
 import os
 import json
+from datetime import datetime
 from io import BytesIO
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import BadRequest
@@ -12,20 +13,20 @@ from flask import (
 from flask_login import login_required, current_user
 
 import database
-import document_generator
+from . import get_db, pdf_renderer
 
 bp = Blueprint('service', __name__, url_prefix='/service')
 
-def get_db():
-    if 'db' not in g:
-        g.db = database.get_db_connection()
-    return g.db
+def get_job(conn, job_id):
+    """get_job_by_id แบบ cache ไว้ใน g ตลอด request (route ที่ใช้ใบงานซ้ำไม่ต้อง query ใหม่)"""
+    jobs = g.setdefault('_service_jobs', {})
+    if job_id not in jobs:
+        jobs[job_id] = database.get_job_by_id(conn, job_id)
+    return jobs[job_id]
 
-@bp.teardown_app_request
-def close_db(exception):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+def forget_job(job_id):
+    """ลบใบงานออกจาก cache ของ request หลังแก้ไขสถานะ/รายการ"""
+    g.get('_service_jobs', {}).pop(job_id, None)
 
 @bp.route('/')
 @login_required
@@ -103,9 +104,9 @@ def api_create_job():
 
         # สร้างและบันทึก PDF
         try:
-            full_job_data = database.get_job_by_id(conn, job_id)
-            if full_job_data:
-                pdf_bytes_io = document_generator.generate_job_order_pdf(full_job_data)
+            full_job_data = get_job(conn, job_id)
+            pdf_bytes = pdf_renderer.get_pdf('job_order', full_job_data, pdf_renderer.get_job_template(conn)) if full_job_data else None
+            if pdf_bytes:
                 plate_number = full_job_data.get('car_plate')
                 base_filename = plate_number if plate_number and plate_number.strip() else full_job_data['job_number']
                 safe_filename = secure_filename(base_filename) + ".pdf"
@@ -113,7 +114,7 @@ def api_create_job():
                 os.makedirs(job_list_folder, exist_ok=True)
                 file_path = os.path.join(job_list_folder, safe_filename)
                 with open(file_path, 'wb') as f:
-                    f.write(pdf_bytes_io.getbuffer())
+                    f.write(pdf_bytes)
                 current_app.logger.info(f"Successfully saved job order PDF to: {file_path}")
         except Exception as pdf_error:
             current_app.logger.error(f"Failed to generate or save PDF for job_id {job_id}: {pdf_error}", exc_info=True)
@@ -137,7 +138,7 @@ def edit_job(job_id):
         return redirect(url_for('service.jobs_list'))
 
     conn = get_db()
-    job = database.get_job_by_id(conn, job_id)
+    job = get_job(conn, job_id)
 
     if not job:
         flash('ไม่พบใบงานที่ระบุ', 'danger')
@@ -189,6 +190,7 @@ def api_update_job(job_id):
         )
         
         conn.commit()
+        forget_job(job_id)
         return jsonify({'success': True, 'message': 'อัปเดตใบงานสำเร็จ!', 'job_id': job_id})
     except Exception as e:
         conn.rollback()
@@ -204,7 +206,7 @@ def confirm_job(job_id):
 
     conn = get_db()
     try:
-        job = database.get_job_by_id(conn, job_id)
+        job = get_job(conn, job_id)
         if not job:
             flash('ไม่พบใบงานที่ระบุ', 'danger')
             return redirect(url_for('service.jobs_list'))
@@ -212,6 +214,7 @@ def confirm_job(job_id):
         if job['status'] == 'draft':
             database.update_job_status(conn, job_id, 'open')
             conn.commit()
+            forget_job(job_id)
             flash(f'ยืนยันใบงาน #{job["job_number"]} เป็น Open สำเร็จ!', 'success')
         else:
             flash(f'ใบงาน #{job["job_number"]} ไม่ได้อยู่ในสถานะฉบับร่าง', 'warning')
@@ -227,20 +230,23 @@ def confirm_job(job_id):
 @login_required
 def print_job_order(job_id):
     conn = get_db()
-    job = database.get_job_by_id(conn, job_id)
+    job = get_job(conn, job_id)
     if not job:
         flash('ไม่พบใบงานที่ต้องการพิมพ์', 'danger')
         return redirect(url_for('service.jobs_list'))
 
-    template = database.get_template_by_name(conn, 'Job Order')
-    if not template:
-        template = {} # Fallback
-
-    # เรียกใช้ฟังก์ชันสร้าง "ใบรับรถ"
-    pdf_bytes = document_generator.generate_job_order_pdf(job, template)
+    # สร้าง "ใบรับรถ" (พิมพ์ซ้ำจะได้ไฟล์จาก cache)
+    try:
+        pdf_bytes = pdf_renderer.get_pdf('job_order', job, pdf_renderer.get_job_template(conn))
+    except pdf_renderer.PdfRenderBusy as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('service.view_job', job_id=job_id))
+    if not pdf_bytes:
+        flash('เกิดข้อผิดพลาดในการสร้างไฟล์ PDF', 'danger')
+        return redirect(url_for('service.view_job', job_id=job_id))
     
     return send_file(
-        pdf_bytes,
+        BytesIO(pdf_bytes),
         mimetype='application/pdf',
         as_attachment=False,
         download_name=f'ใบรับรถ_{job["job_number"]}.pdf'
@@ -250,7 +256,7 @@ def print_job_order(job_id):
 @login_required
 def print_receipt(job_id):
     conn = get_db()
-    job = database.get_job_by_id(conn, job_id)
+    job = get_job(conn, job_id)
     if not job:
         flash('ไม่พบใบงานที่ต้องการพิมพ์', 'danger')
         return redirect(url_for('service.jobs_list'))
@@ -260,20 +266,56 @@ def print_receipt(job_id):
         flash('ใบงานยังไม่เสร็จสิ้น ไม่สามารถพิมพ์ใบเสร็จได้', 'warning')
         return redirect(url_for('service.view_job', job_id=job_id))
 
-    template = database.get_template_by_name(conn, 'Job Order')
-    if not template:
-        template = {} # Fallback
-
-    # เรียกใช้ฟังก์ชันใหม่สำหรับสร้าง "ใบเสร็จ"
-    pdf_bytes = document_generator.generate_receipt_pdf(job, template)
+    # สร้าง "ใบเสร็จ" (พิมพ์ซ้ำจะได้ไฟล์จาก cache)
+    try:
+        pdf_bytes = pdf_renderer.get_pdf('receipt', job, pdf_renderer.get_job_template(conn))
+    except pdf_renderer.PdfRenderBusy as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('service.view_job', job_id=job_id))
+    if not pdf_bytes:
+        flash('เกิดข้อผิดพลาดในการสร้างไฟล์ PDF', 'danger')
+        return redirect(url_for('service.view_job', job_id=job_id))
     
     return send_file(
-        pdf_bytes,
+        BytesIO(pdf_bytes),
         mimetype='application/pdf',
         as_attachment=False,
         download_name=f'ใบเสร็จ_{job["job_number"]}.pdf'
     )
 
+@bp.route('/print_receipts_batch')
+@login_required
+def print_receipts_batch():
+    """พิมพ์ใบเสร็จของใบงานที่ปิดงานในวันที่เลือก (ค่าเริ่มต้นวันนี้) รวมเป็น PDF ไฟล์เดียวสำหรับสรุปสิ้นวัน"""
+    date_str = request.args.get('date', '').strip()
+    try:
+        day = datetime.strptime(date_str, '%Y-%m-%d').date() if date_str else database.get_bkk_time().date()
+    except ValueError:
+        flash('รูปแบบวันที่ไม่ถูกต้อง', 'danger')
+        return redirect(url_for('service.jobs_list'))
+
+    conn = get_db()
+    jobs = [job for job in (get_job(conn, job_id) for job_id in database.get_completed_job_ids(conn, day)) if job]
+    if not jobs:
+        flash(f"ไม่มีใบงานที่ปิดงานในวันที่ {day.strftime('%d/%m/%Y')}", 'info')
+        return redirect(url_for('service.jobs_list'))
+
+    try:
+        pdf_bytes = pdf_renderer.get_pdf('receipt_batch', jobs, pdf_renderer.get_job_template(conn))
+    except pdf_renderer.PdfRenderBusy as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('service.jobs_list'))
+    if not pdf_bytes:
+        flash('เกิดข้อผิดพลาดในการสร้างไฟล์ PDF', 'danger')
+        return redirect(url_for('service.jobs_list'))
+
+    return send_file(
+        BytesIO(pdf_bytes),
+        mimetype='application/pdf',
+        as_attachment=False,
+        download_name=f"ใบเสร็จ_{day.strftime('%Y%m%d')}.pdf"
+    )
+
 @bp.route('/api/job/search_products')
 @login_required
 def api_job_search_products():
@@ -283,7 +325,7 @@ def api_job_search_products():
 
     conn = get_db()
     search_term = f"%{query.lower()}%"
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = database.is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     like_op = "ILIKE" if is_postgres else "LIKE"
 
@@ -348,7 +390,7 @@ def api_job_search_products():
 @login_required
 def view_job(job_id):
     conn = get_db()
-    job = database.get_job_by_id(conn, job_id)
+    job = get_job(conn, job_id)
     if not job:
         flash('ไม่พบใบงานที่ระบุ', 'danger')
         return redirect(url_for('service.jobs_list'))
@@ -379,7 +421,7 @@ def finalize_job(job_id):
 
     conn = get_db()
     try:
-        job = database.get_job_by_id(conn, job_id)
+        job = get_job(conn, job_id)
         if not job:
             flash('ไม่พบใบงานที่ระบุ', 'danger')
             return redirect(url_for('service.jobs_list'))
@@ -401,6 +443,7 @@ def finalize_job(job_id):
 
         database.update_job_status(conn, job_id, 'completed')
         conn.commit()
+        forget_job(job_id)
         flash('ปิดงานและตัดสต็อกเรียบร้อยแล้ว!', 'success')
         return redirect(url_for('service.view_job', job_id=job_id))
     except Exception as e:
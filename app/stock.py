@@ -1,8 +1,4 @@
 # -*- coding: utf-8 -*-
-import qrcode
-import qrcode.image.svg
-import barcode
-from barcode.writer import SVGWriter
 import psycopg2
 import sqlite3
 from datetime import datetime, timedelta
@@ -11,7 +7,7 @@ from collections import OrderedDict, defaultdict
 import re
 from flask import (
     Blueprint, render_template, request, redirect, url_for, flash, g, send_file, 
-    current_app, jsonify, session, send_from_directory
+    current_app, jsonify, session, send_from_directory, Response, stream_with_context
 )
 import pandas as pd
 from io import BytesIO
@@ -21,10 +17,13 @@ import os
 import json
 import document_generator
 import uuid
+import itertools
+import bisect
+import tempfile
 import database
 from database import get_bkk_time
 from . import cache, api_key_required, get_db
-from . import cache
+from . import activity_log, barcode_renderer, barcode_sequence, catalog_cache, excel_export, excel_import, pdf_renderer, search_index, tire_offers
 from .utils import make_request
 bp = Blueprint('stock', __name__)
 
@@ -47,11 +46,6 @@ def allowed_image_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS
 
-def get_db():
-    if 'db' not in g:
-        g.db = database.get_db_connection()
-    return g.db
-
 # Helper to convert a timestamp to BKK timezone
 def convert_to_bkk_time(timestamp_obj):
     if timestamp_obj is None:
@@ -78,22 +72,8 @@ def convert_to_bkk_time(timestamp_obj):
     return dt_obj.astimezone(BKK_TZ)
 
 def get_cached_wheels(query, brand_filter):
-    all_wheels = get_all_wheels_list_cached()
-    filtered_wheels = [
-        w for w in all_wheels
-        if (not query or \
-            # เพิ่มเงื่อนไขนี้เข้าไปเพื่อค้นหาจากชื่อแบรนด์
-            query.lower() in w.get('brand', '').lower() or \
-            query.lower() in w.get('model', '').lower() or \
-            query.lower() in str(w.get('diameter', '')).lower() or \
-            query.lower() in w.get('pcd', '').lower() or \
-            query.lower() in str(w.get('width', '')).lower() or \
-            query.lower() in w.get('color', '').lower() or \
-            query.lower() in str(w.get('et', '')).lower()
-           )
-        and (not brand_filter or brand_filter == 'all' or w.get('brand', '').lower() == brand_filter.lower())
-    ]
-    return filtered_wheels
+    # ค้นหาผ่าน search index ในหน่วยความจำ (สร้างจาก list ใน catalog_cache)
+    return search_index.search_catalog('wheel', query, brand_filter)
 
 @cache.memoize(timeout=900) # ข้อมูลยี่ห้อเปลี่ยนแปลงไม่บ่อย Cache ไว้นานขึ้นได้
 def get_cached_tire_brands():
@@ -110,59 +90,30 @@ def get_cached_wheel_brands():
         return database.get_all_wheel_brands(conn)
 
 def get_cached_tires(query, brand_filter):
-    all_tires_raw = get_all_tires_list_cached()
-    filtered_tires = [
-        t for t in all_tires_raw
-        if (not query or \
-            query.lower() in t.get('brand', '').lower() or \
-            query.lower() in t.get('model', '').lower() or \
-            query.lower() in t.get('size', '').lower() \
-           )
-        and (not brand_filter or brand_filter == 'all' or t.get('brand', '').lower() == brand_filter.lower())
-    ]
-    return filtered_tires
-
-@cache.memoize(timeout=300) # Cache 5 นาที
-def get_cached_unread_notification_count():
-    with current_app.app_context():
-        conn = get_db()
-        return database.get_unread_notification_count(conn)
+    return search_index.search_catalog('tire', query, brand_filter)
 
 #New Cache Logic ----- For Tire Wheel Spare
+# list ทั้งหมดมาจาก catalog_cache (patch ทีละรายการเมื่อมีการเคลื่อนไหว ไม่ต้องโหลดใหม่ทั้งตาราง)
 
-@cache.memoize(timeout=3600)
 def get_all_spare_parts_cached():
-    print(f"--- CACHE MISS (ALL SPARE PARTS) --- Fetching all spare parts from DB...")
-    with current_app.app_context():
-        conn = get_db()
-        # เปลี่ยน None เป็น 'all' เพื่อให้ตรงกับเงื่อนไขการกรอง
-        return database.get_all_spare_parts(conn, query=None, brand_filter='all', category_filter='all', include_deleted=False)
+    return catalog_cache.get_catalog('spare_part')
 
-@cache.memoize(timeout=600)
 def get_all_tires_list_cached():
-    print("--- CACHE MISS (All Tires List) --- Fetching complete tire list from DB")
-    with current_app.app_context():
-        conn = get_db()
-        return database.get_all_tires(conn, include_deleted=False)
+    return catalog_cache.get_catalog('tire')
 
-@cache.memoize(timeout=600)
 def get_all_wheels_list_cached():
-    print("--- CACHE MISS (All Wheels List) --- Fetching complete wheel list from DB")
-    with current_app.app_context():
-        conn = get_db()
-        return database.get_all_wheels(conn, include_deleted=False)
+    return catalog_cache.get_catalog('wheel')
 
 #---------------------------------------------------------#
 
 def get_cached_spare_parts(query, brand_filter, category_filter):
-    all_spare_parts = get_all_spare_parts_cached()
-    filtered_parts = [
-        p for p in all_spare_parts
-        if (not query or query.lower() in p['name'].lower() or query.lower() in p['description'].lower() or query.lower() in p['part_number'].lower())
-        and (not brand_filter or brand_filter == 'all' or p['brand'].lower() == brand_filter.lower())
-        and (not category_filter or category_filter == 'all' or (isinstance(category_filter, list) and p['category_id'] in category_filter) or (isinstance(category_filter, str) and str(p['category_id']) == category_filter))
-    ]
-    return filtered_parts
+    matched_parts = search_index.search_catalog('spare_part', query, brand_filter)
+    if not category_filter or category_filter == 'all':
+        return matched_parts
+    if isinstance(category_filter, list):
+        category_ids = set(category_filter)
+        return [p for p in matched_parts if p['category_id'] in category_ids]
+    return [p for p in matched_parts if str(p['category_id']) == category_filter]
 
 @cache.memoize(timeout=900)
 def get_cached_spare_part_brands(): # NEW
@@ -434,153 +385,262 @@ def process_spare_part_report_data(all_spare_parts, include_summary_in_output=Tr
     return grouped_data
 
 
-@bp.route('/')
-@login_required
-def index():
-    conn = get_db()
-    today = get_bkk_time().date()
-
-    tire_query = request.args.get('tire_query', '').strip()
-    tire_selected_brand = request.args.get('tire_brand_filter', 'all').strip()
-    is_tire_search_active = bool(tire_query or (tire_selected_brand and tire_selected_brand != 'all'))
-    all_tires_raw = get_cached_tires(tire_query, tire_selected_brand)
-    available_tire_brands = get_cached_tire_brands()
-    todays_commissions_raw = database.get_commission_programs_for_date(conn, today)
-    todays_commissions = {f"{p['item_type']}-{p['item_id']}": p['commission_amount_per_item'] for p in todays_commissions_raw}
-
-
-    # NEW: Filter tire data based on viewing permissions before sending to template
-    tires_for_display_filtered_by_permissions = []
-    for tire_data in all_tires_raw:
-        filtered_tire = dict(tire_data) # Create a copy to modify
-        if not current_user.can_view_cost(): # If no permission to view cost
-            filtered_tire['cost_sc'] = None
-            filtered_tire['cost_dunlop'] = None
-            filtered_tire['cost_online'] = None
-        if not current_user.can_view_wholesale_price_1():
-            filtered_tire['wholesale_price1'] = None
-        if not current_user.can_view_wholesale_price_2():
-            filtered_tire['wholesale_price2'] = None
-
-        # NOTE: Logic for hiding retail price and promotions for 'wholesale_sales' and 'viewer' roles
-        # will be handled in process_tire_report_data using current_user.can_view_retail_price()
-        # and current_user.is_retail_sales() together.
-        if not current_user.can_view_retail_price():
-            filtered_tire['price_per_item'] = None
-            # Clear all promotion data if retail price cannot be viewed
-            filtered_tire['promotion_id'] = None
-            filtered_tire['promo_is_active'] = None
-            filtered_tire['promo_name'] = None
-            filtered_tire['promo_type'] = None
-            filtered_tire['promo_value1'] = None
-            filtered_tire['promo_value2'] = None
-            filtered_tire['display_promo_description_text'] = None
-            filtered_tire['display_promo_price_per_item'] = None
-            filtered_tire['display_price_for_4'] = None
-        tires_for_display_filtered_by_permissions.append(filtered_tire) #
-
-    # Pass current_user object to process_tire_report_data
-    tires_by_brand_for_display = process_tire_report_data(
-        tires_for_display_filtered_by_permissions,
-        current_user, # Pass the current_user object
-        include_summary_in_output=is_tire_search_active
-    )
-
-    wheel_query = request.args.get('wheel_query', '').strip()
-    wheel_selected_brand = request.args.get('wheel_brand_filter', 'all').strip()
-    is_wheel_search_active = bool(wheel_query or (wheel_selected_brand and wheel_selected_brand != 'all'))
-    all_wheels = get_cached_wheels(wheel_query, wheel_selected_brand)
-    available_wheel_brands = get_cached_wheel_brands()
-
-    # NEW: Filter wheel data based on viewing permissions before sending to template
-    wheels_for_display = []
-    for wheel_data in all_wheels:
-        filtered_wheel = dict(wheel_data) # Create a copy to modify
-        if not current_user.can_view_cost(): # If no permission to view cost
-            filtered_wheel['cost'] = None
-            filtered_wheel['cost_online'] = None
-        if not current_user.can_view_wholesale_price_1():
-            filtered_wheel['wholesale_price1'] = None
-        if not current_user.can_view_wholesale_price_2():
-            filtered_wheel['wholesale_price2'] = None
-        if not current_user.can_view_retail_price(): # If no permission to view retail price
-            filtered_wheel['retail_price'] = None
-        wheels_for_display.append(filtered_wheel) #
-
-    wheels_by_brand_for_display = process_wheel_report_data(wheels_for_display, include_summary_in_output=is_wheel_search_active)
-
-    # NEW: Spare Part data for index page
-    spare_part_query = request.args.get('spare_part_query', '').strip()
-    spare_part_selected_brand = request.args.get('spare_part_brand_filter', 'all').strip()
-    spare_part_selected_category = request.args.get('spare_part_category_filter', 'all').strip()
-
-    is_spare_part_search_active = bool(spare_part_query or
-                                       (spare_part_selected_brand and spare_part_selected_brand != 'all') or
-                                       (spare_part_selected_category and spare_part_selected_category != 'all'))
-
-    available_spare_part_categories = get_cached_spare_part_categories_hierarchical()
-    if spare_part_selected_category and spare_part_selected_category != 'all':
-        selected_category_id = int(spare_part_selected_category)
-        category_ids_to_filter = [selected_category_id]
-    
-        # ตรวจสอบและเพิ่ม ID ของหมวดหมู่ย่อย
-        for main_cat in available_spare_part_categories:
-            if main_cat.get('id') == selected_category_id:
-                for sub_cat in main_cat.get('children', []):
-                    category_ids_to_filter.append(sub_cat.get('id'))
-                break
+# --- หน้าแรก (สต็อกสินค้า) ---
+# render เฉพาะแท็บที่เปิดอยู่ แท็บอื่นโหลดผ่าน index_tab เมื่อกดเปิด
+# แต่ละแท็บแบ่งหน้าตามกลุ่ม (ยี่ห้อ / หมวดหมู่อะไหล่) ครั้งละ INDEX_GROUPS_PER_PAGE กลุ่ม (cursor = กลุ่มสุดท้ายของหน้าก่อน)
+# กลุ่มที่มีเกิน INDEX_GROUP_PREVIEW_ROWS แถว แสดงบางส่วนก่อน กด "แสดงทั้งหมด" จึงโหลดทั้งกลุ่ม
+INDEX_TABS = {'tires': 'tire', 'wheels': 'wheel', 'spare-parts': 'spare_part'}
+INDEX_TAB_TEMPLATES = {
+    'tires': 'partials/_index_tires.html',
+    'wheels': 'partials/_index_wheels.html',
+    'spare-parts': 'partials/_index_spare_parts.html',
+}
+INDEX_GROUPS_PER_PAGE = 15
+INDEX_GROUP_PREVIEW_ROWS = 30
+UNCATEGORIZED_SPARE_PART = 'ไม่ระบุหมวดหมู่'
+
+# คอลัมน์ที่ต้องซ่อนตามสิทธิ์การดูราคา (ยางที่ดูราคาปลีกไม่ได้ จะไม่เห็นโปรโมชันด้วย)
+COST_COLUMNS = {
+    'tire': ('cost_sc', 'cost_dunlop', 'cost_online'),
+    'wheel': ('cost', 'cost_online'),
+    'spare_part': ('cost', 'cost_online'),
+}
+RETAIL_PRICE_COLUMNS = {
+    'tire': ('price_per_item', 'promotion_id', 'promo_is_active', 'promo_name', 'promo_type', 'promo_value1', 'promo_value2',
+             'display_promo_description_text', 'display_promo_price_per_item', 'display_price_for_4'),
+    'wheel': ('retail_price',),
+    'spare_part': ('retail_price',),
+}
+
+def hidden_price_columns(item_type, user):
+    hidden = []
+    if not user.can_view_cost():
+        hidden.extend(COST_COLUMNS[item_type])
+    if not user.can_view_wholesale_price_1():
+        hidden.append('wholesale_price1')
+    if not user.can_view_wholesale_price_2():
+        hidden.append('wholesale_price2')
+    if not user.can_view_retail_price():
+        hidden.extend(RETAIL_PRICE_COLUMNS[item_type])
+    return hidden
+
+def mask_price_columns(item_type, rows, user):
+    """ล้างค่าคอลัมน์ราคาที่ผู้ใช้ไม่มีสิทธิ์ดู (copy เฉพาะเมื่อมีคอลัมน์ต้องซ่อน)"""
+    hidden = hidden_price_columns(item_type, user)
+    if not hidden:
+        return rows
+    blanks = dict.fromkeys(hidden)
+    return [{**row, **blanks} for row in rows]
+
+def _spare_part_category_ids(selected_category, categories):
+    """หมวดหมู่ที่เลือกพร้อมหมวดหมู่ย่อย หรือ 'all'"""
+    if not selected_category or selected_category == 'all':
+        return 'all'
+    selected_category_id = int(selected_category)
+    category_ids = [selected_category_id]
+    for main_cat in categories:
+        if main_cat.get('id') == selected_category_id:
+            category_ids.extend(sub_cat.get('id') for sub_cat in main_cat.get('children', []))
+            break
+    return category_ids
+
+def _index_tab_rows(tab):
+    """(รายการที่ค้นหา/กรองแล้ว, มีการค้นหาอยู่หรือไม่) ของแท็บ ตามพารามิเตอร์ใน request.args"""
+    if tab == 'tires':
+        query = request.args.get('tire_query', '').strip()
+        brand = request.args.get('tire_brand_filter', 'all').strip()
+        return get_cached_tires(query, brand), bool(query or (brand and brand != 'all'))
+    if tab == 'wheels':
+        query = request.args.get('wheel_query', '').strip()
+        brand = request.args.get('wheel_brand_filter', 'all').strip()
+        return get_cached_wheels(query, brand), bool(query or (brand and brand != 'all'))
+    query = request.args.get('spare_part_query', '').strip()
+    brand = request.args.get('spare_part_brand_filter', 'all').strip()
+    category = request.args.get('spare_part_category_filter', 'all').strip()
+    category_ids = _spare_part_category_ids(category, get_cached_spare_part_categories_hierarchical())
+    is_search_active = bool(query or (brand and brand != 'all') or (category and category != 'all'))
+    return get_cached_spare_parts(query, brand, category_ids), is_search_active
+
+def _index_group_key(tab, row):
+    return (row['category_name'] or '') if tab == 'spare-parts' else row['brand']
+
+def _process_index_rows(tab, rows, user, is_search_active):
+    if tab == 'tires':
+        return process_tire_report_data(rows, user, include_summary_in_output=is_search_active)
+    if tab == 'wheels':
+        return process_wheel_report_data(rows, include_summary_in_output=is_search_active)
+    return process_spare_part_report_data(rows, include_summary_in_output=is_search_active)
+
+# --- มุมมอง catalogue ตามชุดสิทธิ์ ---
+# ผู้ใช้ที่มีสิทธิ์ดูราคาเหมือนกันเห็นข้อมูลเหมือนกันทุกอย่าง จึงซ่อนราคา คำนวณโปรโมชันและสรุปยอดของทั้ง catalogue
+# ครั้งเดียวต่อ (แท็บ, ชุดสิทธิ์) แล้วใช้ร่วมกันทุก request จนกว่าเวอร์ชัน catalogue จะเปลี่ยน (ขาย/รับเข้า/แก้ไข/แก้โปรโมชัน)
+# เก็บแยกต่อ worker process แบบเดียวกับ search_index (ไม่ต้อง pickle ข้อมูลทั้งก้อนผ่าน cache ทุก request)
+_catalog_views = {}
+
+def permission_profile(user):
+    """สิทธิ์ที่มีผลกับข้อมูลในหน้าแรก ผู้ใช้ที่ได้ค่าเดียวกันใช้มุมมองเดียวกัน"""
+    return (user.can_view_cost(), user.can_view_wholesale_price_1(), user.can_view_wholesale_price_2(),
+            user.can_view_retail_price(), user.is_retail_sales())
+
+def _first_view_item(tab, group_data):
+    if tab == 'spare-parts':
+        return next(iter(group_data['brands'].values()))['items_list'][0]
+    return group_data['items_list'][0]
+
+def _build_catalog_view(tab, version, items, user):
+    print(f"--- BUILDING CATALOG VIEW ({tab.upper()}) --- version {version}, profile {permission_profile(user)}")
+    groups = _process_index_rows(tab, mask_price_columns(INDEX_TABS[tab], items, user), user, False)
+    view = {'version': version, 'keys': [], 'groups': {}, 'group_of': {}}
+    for name, group_data in groups.items():
+        key = _index_group_key(tab, _first_view_item(tab, group_data))
+        view['keys'].append(key)
+        view['groups'][key] = (name, group_data)
+        item_lists = [brand_data['items_list'] for brand_data in group_data['brands'].values()] if tab == 'spare-parts' else [group_data['items_list']]
+        for item_list in item_lists:
+            for item in item_list:
+                view['group_of'][item['id']] = key
+    return view
+
+def get_catalog_view(tab, user):
+    """
+    catalogue ของแท็บที่จัดกลุ่มและซ่อนราคาตามสิทธิ์ของ user แล้ว
+    {'version', 'keys': กลุ่มเรียงตามลำดับ, 'groups': {key: (ชื่อที่แสดง, ข้อมูลกลุ่ม)}, 'group_of': {id สินค้า: key}}
+    ห้ามแก้ไขข้อมูลที่ได้ เพราะใช้ร่วมกันทุก request
+    """
+    view_key = (tab, permission_profile(user))
+    view = _catalog_views.get(view_key)
+    # เทียบเลขเวอร์ชันก่อน ดึง list ทั้งก้อนจาก cache เฉพาะตอนต้องสร้างมุมมองใหม่
+    if view is None or view['version'] != catalog_cache.get_catalog_version(INDEX_TABS[tab]):
+        version, items = catalog_cache.get_catalog_entry(INDEX_TABS[tab])
+        view = _build_catalog_view(tab, version, items, user)
+        _catalog_views[view_key] = view
+    return view
+
+def _summary_for(summary, items, is_search_active, is_complete):
+    # กลุ่มที่แสดงครบทุกแถวใช้ยอดที่คำนวณไว้ในมุมมอง ถ้าถูกกรองบางแถวออกจึงรวมยอดใหม่
+    quantity = summary['quantity'] if is_complete else sum(int(item.get('quantity') or 0) for item in items)
+    return {**summary, 'is_summary_to_show': is_search_active, 'quantity': quantity,
+            'formatted_quantity': f'<span class="summary-quantity-value">{quantity}</span>'}
+
+def _filter_items(items, row_ids):
+    return list(items) if row_ids is None else [item for item in items if item['id'] in row_ids]
+
+def _page_group(tab, group_data, row_ids, is_search_active):
+    """สำเนาของกลุ่มในมุมมองสำหรับ request นี้ (เฉพาะแถวใน row_ids ถ้ามีการค้นหา) ตัด/แก้ได้โดยไม่กระทบมุมมอง"""
+    if tab != 'spare-parts':
+        items = _filter_items(group_data['items_list'], row_ids)
+        return {'items_list': items,
+                'summary': _summary_for(group_data['summary'], items, is_search_active, len(items) == len(group_data['items_list']))}
+
+    brands = OrderedDict()
+    category_items = []
+    for brand_name, brand_data in group_data['brands'].items():
+        items = _filter_items(brand_data['items_list'], row_ids)
+        if items:
+            brands[brand_name] = {'items_list': items,
+                                  'summary': _summary_for(brand_data['summary'], items, is_search_active, len(items) == len(brand_data['items_list']))}
+            category_items.extend(items)
+    is_complete = len(brands) == len(group_data['brands']) and all(
+        len(brands[name]['items_list']) == len(data['items_list']) for name, data in group_data['brands'].items())
+    return {'brands': brands, 'summary': _summary_for(group_data['summary'], category_items, is_search_active, is_complete)}
+
+def _truncate_index_group(tab, group_data):
+    """ตัดกลุ่มให้เหลือ INDEX_GROUP_PREVIEW_ROWS แถวแรก เก็บจำนวนที่ซ่อนไว้ใน hidden_count"""
+    if tab == 'spare-parts':
+        item_lists = [(brand_name, brand_data['items_list']) for brand_name, brand_data in group_data['brands'].items()]
     else:
-        # หากไม่ได้เลือกหมวดหมู่ใด ๆ ให้ใช้ 'all'
-        category_ids_to_filter = 'all'
-    
-    all_spare_parts_raw = get_cached_spare_parts(spare_part_query, spare_part_selected_brand, category_ids_to_filter)
-    available_spare_part_brands = get_cached_spare_part_brands()
-
-    # Filter spare part data based on viewing permissions
-    spare_parts_for_display = []
-    for part_data in all_spare_parts_raw:
-        filtered_part = dict(part_data)
-        if not current_user.can_view_cost():
-            filtered_part['cost'] = None
-            filtered_part['cost_online'] = None
-        if not current_user.can_view_wholesale_price_1():
-            filtered_part['wholesale_price1'] = None
-        if not current_user.can_view_wholesale_price_2():
-            filtered_part['wholesale_price2'] = None
-        if not current_user.can_view_retail_price():
-            filtered_part['retail_price'] = None
-        spare_parts_for_display.append(filtered_part)
-
-    spare_parts_by_category_and_brand = process_spare_part_report_data(
-        spare_parts_for_display,
-        include_summary_in_output=is_spare_part_search_active
-    )
+        item_lists = [(None, group_data['items_list'])]
+    total = sum(len(items) for _, items in item_lists)
+    group_data['hidden_count'] = max(total - INDEX_GROUP_PREVIEW_ROWS, 0)
+    remaining = INDEX_GROUP_PREVIEW_ROWS
+    for brand_name, items in item_lists:
+        del items[remaining:]
+        remaining -= len(items)
+        if brand_name is not None and not items:
+            del group_data['brands'][brand_name]
+
+def build_index_tab(tab, cursor=None, group=None):
+    """
+    ข้อมูลของหนึ่งหน้าในแท็บ: กลุ่มถัดจาก cursor ไม่เกิน INDEX_GROUPS_PER_PAGE กลุ่ม หรือเฉพาะกลุ่ม group แบบครบทุกแถว
+    แถวที่แสดงมาจากมุมมองตามสิทธิ์ของผู้ใช้ (get_catalog_view) กรองตามผลการค้นหา
+    """
+    rows, is_search_active = _index_tab_rows(tab)
+    view = get_catalog_view(tab, current_user)
+    row_ids = None
+    group_keys = view['keys']
+    if is_search_active:
+        row_ids = {row['id'] for row in rows}
+        matched_keys = {view['group_of'][row_id] for row_id in row_ids if row_id in view['group_of']}
+        group_keys = [key for key in group_keys if key in matched_keys]
+
+    next_cursor = None
+    if group is not None:
+        page_keys = [group] if group in group_keys else []
+    else:
+        start = bisect.bisect_right(group_keys, cursor) if cursor is not None else 0
+        page_keys = group_keys[start:start + INDEX_GROUPS_PER_PAGE]
+        if start + INDEX_GROUPS_PER_PAGE < len(group_keys):
+            next_cursor = page_keys[-1]
+
+    groups = OrderedDict()
+    for key in page_keys:
+        name, group_data = view['groups'][key]
+        page_group = _page_group(tab, group_data, row_ids, is_search_active)
+        page_group['key'] = key
+        page_group['hidden_count'] = 0
+        if group is None:
+            _truncate_index_group(tab, page_group)
+        groups[name] = page_group
+
+    return {
+        'tab': tab,
+        'groups': groups,
+        'next_cursor': next_cursor,
+        'is_first_page': cursor is None and group is None,
+        'search_args': {key: value for key, value in request.args.items() if key not in ('tab', 'cursor', 'group')},
+        'todays_commissions': get_todays_commissions(),
+    }
 
+def get_todays_commissions():
+    if '_todays_commissions' not in g:
+        programs = database.get_commission_programs_for_date(get_db(), get_bkk_time().date())
+        g._todays_commissions = {f"{p['item_type']}-{p['item_id']}": p['commission_amount_per_item'] for p in programs}
+    return g._todays_commissions
 
+@bp.route('/')
+@login_required
+def index():
     active_tab = request.args.get('tab', 'tires')
+    if active_tab not in INDEX_TABS:
+        active_tab = 'tires'
 
-    spare_parts_by_brand_by_category = process_spare_part_report_data(spare_parts_for_display)
     return render_template('index.html',
-                           tires_by_brand_for_display=tires_by_brand_for_display,      
-                           wheels_by_brand_for_display=wheels_by_brand_for_display,                   
-                           tire_query=tire_query,
-                           available_tire_brands=available_tire_brands,
-                           todays_commissions=todays_commissions, # NEW
-                           tire_selected_brand=tire_selected_brand, 
-                           wheel_query=wheel_query,
-                           available_wheel_brands=available_wheel_brands,
-                           wheel_selected_brand=wheel_selected_brand,
-                           is_spare_part_search_active=is_spare_part_search_active,
-                           spare_parts_by_category_and_brand=spare_parts_by_category_and_brand,
-                           spare_part_query=spare_part_query,
-                           available_spare_part_brands=available_spare_part_brands,
-                           spare_part_selected_brand=spare_part_selected_brand,
-                           available_spare_part_categories=available_spare_part_categories,
-                           spare_part_selected_category=spare_part_selected_category,
+                           tab_data=build_index_tab(active_tab),
+                           tab_templates=INDEX_TAB_TEMPLATES,
+                           tire_query=request.args.get('tire_query', '').strip(),
+                           available_tire_brands=get_cached_tire_brands(),
+                           tire_selected_brand=request.args.get('tire_brand_filter', 'all').strip(),
+                           wheel_query=request.args.get('wheel_query', '').strip(),
+                           available_wheel_brands=get_cached_wheel_brands(),
+                           wheel_selected_brand=request.args.get('wheel_brand_filter', 'all').strip(),
+                           spare_part_query=request.args.get('spare_part_query', '').strip(),
+                           available_spare_part_brands=get_cached_spare_part_brands(),
+                           spare_part_selected_brand=request.args.get('spare_part_brand_filter', 'all').strip(),
+                           available_spare_part_categories=get_cached_spare_part_categories_hierarchical(),
+                           spare_part_selected_category=request.args.get('spare_part_category_filter', 'all').strip(),
                            active_tab=active_tab,
                            current_user=current_user # Pass current_user to template
                           )
 
+@bp.route('/index_tab/<tab>')
+@login_required
+def index_tab(tab):
+    """HTML ของแท็บในหน้าแรก: ?cursor=<กลุ่มสุดท้ายที่แสดงแล้ว> หน้าถัดไป, ?group=<กลุ่ม> ทุกแถวของกลุ่มนั้น"""
+    if tab not in INDEX_TABS:
+        return jsonify({"success": False, "message": "ไม่พบแท็บที่ระบุ"}), 404
+    tab_data = build_index_tab(tab, cursor=request.args.get('cursor'), group=request.args.get('group'))
+    return render_template(INDEX_TAB_TEMPLATES[tab], tab_data=tab_data, current_user=current_user)
+
 # --- Promotions Routes (assuming these are already in your app.py) ---
 @bp.route('/promotions')
 @login_required
@@ -688,6 +748,7 @@ def edit_promotion(promo_id):
                 conn.commit()
                 flash('แก้ไขโปรโมชันสำเร็จ!', 'success')
                 cache.delete_memoized(get_all_promotions_cached)
+                catalog_cache.invalidate_catalog('tire') # ราคาโปรฝังอยู่ในแต่ละแถวของยาง
                 return redirect(url_for('stock.promotions'))
             except ValueError as e:
                 conn.rollback()
@@ -722,7 +783,7 @@ def delete_promotion(promo_id):
             conn.commit()
             flash('ลบโปรโมชันสำเร็จ! สินค้าที่เคยใช้โปรโมชันนี้จะถูกตั้งค่าโปรโมชันเป็น "ไม่มี"', 'success')
             cache.delete_memoized(get_all_promotions_cached)
-            cache.delete_memoized(get_all_tires_list_cached)
+            catalog_cache.invalidate_catalog('tire')
         except Exception as e:
             conn.rollback()
             flash(f'เกิดข้อผิดพลาดในการลบโปรโมชัน: {e}', 'danger')
@@ -809,7 +870,7 @@ def add_item():
                 year_of_manufacture = year_of_manufacture.strip() if year_of_manufacture and year_of_manufacture.strip() else None
 
                 cursor = conn.cursor()
-                if "psycopg2" in str(type(conn)):
+                if database.is_postgres_conn(conn):
                     cursor.execute("SELECT id FROM tires WHERE brand = %s AND model = %s AND size = %s", (brand, model, size))
                 else:
                     cursor.execute("SELECT id FROM tires WHERE brand = ? AND model = ? AND size = ?", (brand, model, size))
@@ -831,7 +892,7 @@ def add_item():
                     conn.commit()
                     flash(f'เพิ่มยาง {brand.title()} รุ่น {model.title()} เบอร์ {size} จำนวน {quantity} เส้น สำเร็จ!', 'success')
                     cache.delete_memoized(get_cached_tire_brands)
-                    cache.delete_memoized(get_all_tires_list_cached)
+                    catalog_cache.refresh_catalog_items('tire', [new_tire_id])
                 return redirect(url_for('stock.add_item', tab='tire'))
 
             except ValueError:
@@ -930,7 +991,7 @@ def add_item():
                 wholesale_price2 = float(wholesale_price2) if wholesale_price2 and wholesale_price2.strip() else None
 
                 cursor = conn.cursor()
-                if "psycopg2" in str(type(conn)):
+                if database.is_postgres_conn(conn):
                     cursor.execute("""
                         SELECT id FROM wheels WHERE brand = %s AND model = %s AND diameter = %s 
                         AND width = %s AND pcd = %s AND color = %s AND et IS NOT DISTINCT FROM %s
@@ -954,7 +1015,7 @@ def add_item():
                     conn.commit()
                     flash(f'เพิ่มแม็ก {brand.title()} ลาย {model.title()} จำนวน {quantity} วง สำเร็จ!', 'success')
                     cache.delete_memoized(get_cached_wheel_brands)
-                    cache.delete_memoized(get_all_wheels_list_cached)
+                    catalog_cache.refresh_catalog_items('wheel', [new_wheel_id])
                 return redirect(url_for('stock.index', tab='wheels'))
             except ValueError:
                 conn.rollback()
@@ -1041,7 +1102,7 @@ def add_item():
                 wholesale_price2 = float(wholesale_price2) if wholesale_price2 and wholesale_price2.strip() else None
 
                 cursor = conn.cursor()
-                is_postgres = "psycopg2" in str(type(conn))
+                is_postgres = database.is_postgres_conn(conn)
 
                 # Check for existing spare part by name and (optional) part_number/brand
                 if part_number: # Prefer part_number if provided for uniqueness
@@ -1068,7 +1129,7 @@ def add_item():
                         database.add_spare_part_barcode(conn, new_spare_part_id, scanned_barcode_for_add, is_primary=True)
                     conn.commit()
                     flash(f'เพิ่มอะไหล่ "{name}" จำนวน {quantity} ชิ้น สำเร็จ!', 'success')
-                    cache.delete_memoized(get_all_spare_parts_cached)
+                    catalog_cache.refresh_catalog_items('spare_part', [new_spare_part_id])
                     cache.delete_memoized(get_cached_spare_part_brands)
                 return redirect(url_for('stock.add_item', tab='spare_part'))
 
@@ -1171,7 +1232,7 @@ def edit_tire(tire_id):
                 conn.commit()
                 flash('แก้ไขข้อมูลยางสำเร็จ!', 'success')
                 cache.delete_memoized(get_cached_tire_brands)
-                cache.delete_memoized(get_all_tires_list_cached)
+                catalog_cache.refresh_catalog_items('tire', [tire_id])
                 return redirect(url_for('stock.index', tab='tires'))
             except ValueError:
                 conn.rollback()
@@ -1252,7 +1313,7 @@ def delete_tire(tire_id):
         database.delete_tire(conn, tire_id)
         conn.commit()
         cache.delete_memoized(get_cached_tire_brands)
-        cache.delete_memoized(get_all_tires_list_cached)
+        catalog_cache.refresh_catalog_items('tire', [tire_id])
         return jsonify({"success": True, "message": "ลบยางสำเร็จ!"})
     except Exception as e:
         conn.rollback()
@@ -1382,7 +1443,7 @@ def edit_wheel(wheel_id):
             database.update_wheel(conn, wheel_id, brand, model, diameter, pcd, width, et, current_quantity, color, cost, cost_online, wholesale_price1, wholesale_price2, retail_price, current_image_url)
             conn.commit()
             flash('แก้ไขข้อมูลแม็กสำเร็จ!', 'success')
-            cache.delete_memoized(get_all_wheels_list_cached)
+            catalog_cache.refresh_catalog_items('wheel', [wheel_id])
             cache.delete_memoized(get_cached_wheel_brands)
             return redirect(url_for('stock.wheel_detail', wheel_id=wheel_id))
 
@@ -1483,7 +1544,7 @@ def delete_wheel(wheel_id):
     try:
         database.delete_wheel(conn, wheel_id)
         conn.commit()
-        cache.delete_memoized(get_all_wheels_list_cached)
+        catalog_cache.refresh_catalog_items('wheel', [wheel_id])
         cache.delete_memoized(get_cached_wheel_brands)
         return jsonify({"success": True, "message": "ลบแม็กสำเร็จ!"})
     except Exception as e:
@@ -1670,7 +1731,7 @@ def edit_spare_part(spare_part_id):
                                            current_image_url, category_id_db)
                 conn.commit()
                 flash('แก้ไขข้อมูลอะไหล่สำเร็จ!', 'success')
-                cache.delete_memoized(get_all_spare_parts_cached)
+                catalog_cache.refresh_catalog_items('spare_part', [spare_part_id])
                 cache.delete_memoized(get_cached_spare_part_brands)
                 return redirect(url_for('stock.spare_part_detail', spare_part_id=spare_part_id))
             except ValueError:
@@ -1707,7 +1768,7 @@ def delete_spare_part(spare_part_id):
     try:
         database.delete_spare_part(conn, spare_part_id)
         conn.commit()
-        cache.delete_memoized(get_all_spare_parts_cached)
+        catalog_cache.refresh_catalog_items('spare_part', [spare_part_id])
         cache.delete_memoized(get_cached_spare_part_brands)
         return jsonify({"success": True, "message": "ลบอะไหล่สำเร็จ!"})
     except Exception as e:
@@ -1775,27 +1836,6 @@ def api_manage_spare_part_barcodes(spare_part_id):
              return jsonify({"success": False, "message": f"บาร์โค้ด '{barcode_string}' มีอยู่ในระบบแล้ว"}), 409
         return jsonify({"success": False, "message": f"เกิดข้อผิดพลาดในการจัดการ Barcode ID: {str(e)}"}), 500
 
-@cache.memoize(timeout=600) # Cache 10 นาที เพราะข้อมูลเปลี่ยนเมื่อมีการเพิ่ม/ลบสินค้า
-def get_all_tires_list_cached():
-    print("--- CACHE MISS (All Tires List) --- Fetching complete tire list from DB")
-    with current_app.app_context():
-        conn = get_db()
-        return database.get_all_tires(conn, include_deleted=False)
-
-@cache.memoize(timeout=600)
-def get_all_wheels_list_cached():
-    print("--- CACHE MISS (All Wheels List) --- Fetching complete wheel list from DB")
-    with current_app.app_context():
-        conn = get_db()
-        return database.get_all_wheels(conn, include_deleted=False)
-
-@cache.memoize(timeout=600)
-def get_all_spare_parts_list_cached():
-    print("--- CACHE MISS (All Spare Parts List) --- Fetching complete spare part list from DB")
-    with current_app.app_context():
-        conn = get_db()
-        return database.get_all_spare_parts(conn)
-
 
 # --- Stock Movement Routes (Movement editing) (assuming these are already in your app.py) ---
 @bp.route('/stock_movement', methods=('GET', 'POST'))
@@ -1808,7 +1848,7 @@ def stock_movement():
 
     tires = get_all_tires_list_cached()
     wheels = get_all_wheels_list_cached()
-    spare_parts = get_all_spare_parts_list_cached() # NEW: Get all spare parts for dropdown
+    spare_parts = get_all_spare_parts_cached() # NEW: Get all spare parts for dropdown
 
     sales_channels = get_all_sales_channels_cached()
     online_platforms = get_all_online_platforms_cached()
@@ -1833,7 +1873,7 @@ def stock_movement():
         LEFT JOIN wholesale_customers wc ON tm.wholesale_customer_id = wc.id
         ORDER BY tm.timestamp DESC LIMIT 50
     """
-    if "psycopg2" in str(type(conn)):
+    if database.is_postgres_conn(conn):
         cursor_tire = conn.cursor()
         cursor_tire.execute(tire_movements_query)
         tire_movements_history_raw = cursor_tire.fetchall()
@@ -1866,7 +1906,7 @@ def stock_movement():
         LEFT JOIN wholesale_customers wc ON wm.wholesale_customer_id = wc.id
         ORDER BY wm.timestamp DESC LIMIT 50
     """
-    if "psycopg2" in str(type(conn)):
+    if database.is_postgres_conn(conn):
         cursor_wheel = conn.cursor()
         cursor_wheel.execute(wheel_movements_query)
         wheel_movements_history_raw = cursor_wheel.fetchall()
@@ -1898,7 +1938,7 @@ def stock_movement():
         LEFT JOIN wholesale_customers wc ON spm.wholesale_customer_id = wc.id
         ORDER BY spm.timestamp DESC LIMIT 50
     """
-    if "psycopg2" in str(type(conn)):
+    if database.is_postgres_conn(conn):
         cursor_spare_part = conn.cursor()
         cursor_spare_part.execute(spare_part_movements_query)
         spare_part_movements_history_raw = cursor_spare_part.fetchall()
@@ -2110,7 +2150,7 @@ def stock_movement():
                                             wholesale_customer_id=final_wholesale_customer_id,
                                             return_customer_type=return_customer_type)
                 flash(f'บันทึกการเคลื่อนไหวสต็อกยางสำเร็จ! คงเหลือ: {new_quantity} เส้น', 'success')
-                cache.delete_memoized(get_all_tires_list_cached)
+                catalog_cache.refresh_catalog_items('tire', [tire_id])
 
                 tire_info = database.get_tire(conn, tire_id)
                 message = (
@@ -2120,7 +2160,6 @@ def stock_movement():
                     )
                 database.add_notification(conn, message, current_user.id)
                 conn.commit()
-                cache.delete_memoized(get_cached_unread_notification_count)
                 return redirect(url_for('stock.stock_movement', tab='tire_movements'))
 
             # --- Process Wheel Movement ---
@@ -2150,7 +2189,7 @@ def stock_movement():
                                              wholesale_customer_id=final_wholesale_customer_id,
                                              return_customer_type=return_customer_type)
                 flash(f'บันทึกการเคลื่อนไหวสต็อกแม็กสำเร็จ! คงเหลือ: {new_quantity} วง', 'success')
-                cache.delete_memoized(get_all_wheels_list_cached)
+                catalog_cache.refresh_catalog_items('wheel', [wheel_id])
 
                 wheel_info = database.get_wheel(conn, wheel_id)
                 message = (
@@ -2160,7 +2199,6 @@ def stock_movement():
                     )
                 database.add_notification(conn, message, current_user.id)
                 conn.commit()
-                cache.delete_memoized(get_cached_unread_notification_count)
                 return redirect(url_for('stock.stock_movement', tab='wheel_movements'))
 
             # NEW: Process Spare Part Movement
@@ -2199,9 +2237,7 @@ def stock_movement():
                 )
                 database.add_notification(conn, message, current_user.id)
                 conn.commit()
-                cache.delete_memoized(get_all_spare_parts_cached)
-                cache.delete_memoized(get_all_spare_parts_list_cached)
-                cache.delete_memoized(get_cached_unread_notification_count)
+                catalog_cache.refresh_catalog_items('spare_part', [spare_part_id])
                 return redirect(url_for('stock.stock_movement', tab='spare_part_movements'))
 
 
@@ -2424,8 +2460,7 @@ def edit_tire_movement(movement_id):
             )
             database.add_notification(conn, message, current_user.id)
             conn.commit()
-            cache.delete_memoized(get_cached_unread_notification_count)
-            cache.delete_memoized(get_all_tires_list_cached)
+            catalog_cache.refresh_catalog_items('tire', [movement_data['tire_id']])
             return redirect(url_for('stock.daily_stock_report'))
         except ValueError as e:
             flash(f'ข้อมูลไม่ถูกต้อง: {e}', 'danger')
@@ -2640,8 +2675,7 @@ def edit_wheel_movement(movement_id):
             conn.commit()
             
             flash('แก้ไขข้อมูลการเคลื่อนไหวสต็อกแม็กสำเร็จ!', 'success')
-            cache.delete_memoized(get_cached_unread_notification_count)
-            cache.delete_memoized(get_all_wheels_list_cached)
+            catalog_cache.refresh_catalog_items('wheel', [movement_data['wheel_id']])
             return redirect(url_for('stock.daily_stock_report'))
         except ValueError as e:
             flash(f'ข้อมูลไม่ถูกต้อง: {e}', 'danger')
@@ -2667,6 +2701,7 @@ def delete_tire_movement_action(movement_id):
 
     conn = get_db()
     try:
+        tire_id = database.get_movement_item_id(conn, 'tire', movement_id)
         item_details, move_type, quantity_change = database.delete_tire_movement(conn, movement_id, current_user.id)
         message = (f"ลบรายการสต็อกยาง: {item_details} ประเภท [{move_type}] จำนวน {quantity_change} เส้น โดย {current_user.username}")
         database.add_notification(conn, message, current_user.id)
@@ -2675,8 +2710,7 @@ def delete_tire_movement_action(movement_id):
         # เปลี่ยนจาก flash เป็น session
         session['post_action_sweetalert'] = {'icon': 'success', 'message': 'ลบรายการเคลื่อนไหวยางและปรับสต็อกเรียบร้อย!'}
 
-        cache.delete_memoized(get_all_tires_list_cached)
-        cache.delete_memoized(get_cached_unread_notification_count)
+        catalog_cache.refresh_catalog_items('tire', [tire_id])
 
     except ValueError as e:
         # เปลี่ยนจาก flash เป็น session
@@ -2700,6 +2734,7 @@ def delete_wheel_movement_action(movement_id):
     conn = get_db()
     try:
         # ส่ง user id เข้าไปในฟังก์ชัน และรับค่าที่ return กลับมา
+        wheel_id = database.get_movement_item_id(conn, 'wheel', movement_id)
         item_details, move_type, quantity_change = database.delete_wheel_movement(conn, movement_id, current_user.id)
         
         # สร้าง Notification
@@ -2714,8 +2749,7 @@ def delete_wheel_movement_action(movement_id):
         session['post_action_sweetalert'] = {'icon': 'success', 'message': 'ลบรายการเคลื่อนไหวแม็กและปรับสต็อกเรียบร้อย!'}
         
         # เคลียร์ Cache
-        cache.delete_memoized(get_all_wheels_list_cached)
-        cache.delete_memoized(get_cached_unread_notification_count) # เคลียร์ cache กระดิ่ง
+        catalog_cache.refresh_catalog_items('wheel', [wheel_id])
 
     except ValueError as e:
         session['post_action_sweetalert'] = {'icon': 'error', 'message': f'เกิดข้อผิดพลาด: {e}'}
@@ -2910,9 +2944,7 @@ def edit_spare_part_movement(movement_id):
             )
             database.add_notification(conn, message, current_user.id)
             conn.commit()
-            cache.delete_memoized(get_all_spare_parts_cached)
-            cache.delete_memoized(get_all_spare_parts_list_cached)
-            cache.delete_memoized(get_cached_unread_notification_count)
+            catalog_cache.refresh_catalog_items('spare_part', [movement_data['spare_part_id']])
             flash('แก้ไขข้อมูลการเคลื่อนไหวสต็อกอะไหล่สำเร็จ!', 'success')
             return redirect(url_for('stock.daily_stock_report', tab='spare_part_movements_history'))
         except ValueError as e:
@@ -2940,6 +2972,7 @@ def delete_spare_part_movement_action(movement_id):
     conn = get_db()
     try:
         # ส่ง user id เข้าไปในฟังก์ชัน และรับค่าที่ return กลับมา
+        spare_part_id = database.get_movement_item_id(conn, 'spare_part', movement_id)
         item_details, move_type, quantity_change = database.delete_spare_part_movement(conn, movement_id, current_user.id)
         
         # สร้าง Notification
@@ -2954,9 +2987,7 @@ def delete_spare_part_movement_action(movement_id):
         session['post_action_sweetalert'] = {'icon': 'success', 'message': 'ลบรายการเคลื่อนไหวอะไหล่และปรับสต็อกเรียบร้อย!'}
 
         # เคลียร์ Cache
-        cache.delete_memoized(get_all_spare_parts_cached)
-        cache.delete_memoized(get_all_spare_parts_list_cached)
-        cache.delete_memoized(get_cached_unread_notification_count) # เคลียร์ cache กระดิ่ง
+        catalog_cache.refresh_catalog_items('spare_part', [spare_part_id])
         cache.delete_memoized(get_cached_spare_part_brands)
 
     except ValueError as e:
@@ -2999,7 +3030,7 @@ def summary_details():
     
     # --- START: CORRECTED SECTION ---
 
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = database.is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     
     base_params = [start_date_obj.isoformat(), end_date_obj.isoformat()]
@@ -3135,6 +3166,48 @@ def summary_details():
                             spare_part_movements=processed_spare_part_movements,
                             current_user=current_user)
 
+def _build_daily_item_report(balances, movements_raw, id_field, key_fields, extra_fields=()):
+    """
+    รวมยอดจาก database.get_daily_stock_balances เข้ากับรายการเคลื่อนไหวของวันนั้น จัดกลุ่มตาม key_fields
+    สินค้าที่ถูกลบจะแสดงเฉพาะเมื่อมีการเคลื่อนไหวในวันนั้น
+    """
+    movements_by_item = defaultdict(list)
+    for movement in movements_raw:
+        movements_by_item[movement[id_field]].append({
+            'id': movement['id'],
+            'timestamp': movement['timestamp'],
+            'type': movement['type'],
+            'quantity_change': movement['quantity_change'],
+            'notes': movement['notes'],
+            'image_filename': movement['image_filename'],
+            'user_username': movement['user_username'],
+            'channel_name': movement['channel_name'],
+            'online_platform_name': movement['online_platform_name'],
+            'wholesale_customer_name': movement['wholesale_customer_name'],
+            'return_customer_type': movement['return_customer_type']
+        })
+
+    detailed_report = {}
+    for item_id, row in balances.items():
+        item_movements = movements_by_item.get(item_id, [])
+        if not item_movements and row['is_deleted']:
+            continue
+
+        key = tuple(row[field] for field in key_fields)
+        data = detailed_report.get(key)
+        if data is None:
+            data = {'IN': 0, 'OUT': 0, 'RETURN': 0, 'remaining_quantity': 0, id_field: item_id, 'movements': []}
+            for field in key_fields + tuple(extra_fields):
+                data[field] = row[field]
+            detailed_report[key] = data
+
+        data['IN'] += row['in_quantity']
+        data['OUT'] += row['out_quantity']
+        data['RETURN'] += row['return_quantity']
+        data['remaining_quantity'] += row['closing_quantity']
+        data['movements'].extend(item_movements)
+    return detailed_report
+
 # --- daily_stock_report (assuming this is already in your app.py) ---
 @bp.route('/daily_stock_report')
 @login_required
@@ -3178,8 +3251,7 @@ def daily_stock_report():
     # --- END: โค้ดที่แก้ไข ---
     
     report_date = report_datetime_obj.date()
-    is_psycopg2_conn = "psycopg2" in str(type(conn))
-    timestamp_cast = "::timestamptz" if is_psycopg2_conn else ""
+    is_psycopg2_conn = database.is_postgres_conn(conn)
     placeholder = "%s" if is_psycopg2_conn else "?"
 
     # --- Tire Report Data ---
@@ -3218,113 +3290,10 @@ def daily_stock_report():
         processed_tire_movements_raw_today.append(movement_data)
     tire_movements_raw = processed_tire_movements_raw_today
     
-    # ... (ส่วนที่เหลือของโค้ดในการคำนวณและประมวลผลข้อมูลยาง ไม่มีการเปลี่ยนแปลง) ...
-    tire_quantities_before_report = defaultdict(int)
-    tire_ids_involved = set()
-    for movement in tire_movements_raw:
-        tire_ids_involved.add(movement['tire_main_id'])
-
-    day_before_report = report_datetime_obj.replace(hour=0, minute=0, second=0) - timedelta(microseconds=1)
-    day_before_report_iso = day_before_report.isoformat()
-
-    sql_date_filter_end_of_day = report_datetime_obj.replace(hour=23, minute=59, second=59, microsecond=999999).isoformat()
-    distinct_tire_ids_query_all_history = f"""
-        SELECT DISTINCT tire_id
-        FROM tire_movements
-        WHERE timestamp <= {placeholder}{timestamp_cast}
-    """
-    if is_psycopg2_conn:
-        cursor = conn.cursor() # New cursor for this query
-        cursor.execute(distinct_tire_ids_query_all_history, (sql_date_filter_end_of_day,))
-        rows = cursor.fetchall()
-        cursor.close()
-    else:
-        rows = conn.execute(distinct_tire_ids_query_all_history, (sql_date_filter_end_of_day,)).fetchall()
-
-    for row in rows:
-        tire_ids_involved.add(row['tire_id'])
-
-
-    tire_quantities_before_report = defaultdict(int)
-    if tire_ids_involved:
-        ids_list = list(tire_ids_involved)
-        placeholders_for_in = ', '.join([placeholder] * len(ids_list))
-
-        query_initial_quantities = f"""
-        SELECT
-        tire_id,
-        COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0) as initial_quantity
-        FROM tire_movements
-        WHERE tire_id IN ({placeholders_for_in}) AND timestamp < {placeholder}{timestamp_cast}
-        GROUP BY tire_id
-        """
-        params = ids_list + [day_before_report_iso]
-
-        if is_psycopg2_conn:
-            cursor = conn.cursor()
-            cursor.execute(query_initial_quantities, tuple(params))
-            initial_quantities_rows = cursor.fetchall()
-            cursor.close()
-        else:
-            # For SQLite, remove the ::timestamptz cast if it exists in the placeholder string
-            query_sqlite = query_initial_quantities.replace(timestamp_cast, "")
-            initial_quantities_rows = conn.execute(query_sqlite, tuple(params)).fetchall()
-
-        for row in initial_quantities_rows:
-            tire_quantities_before_report[row['tire_id']] = row['initial_quantity']
-
+    # ยอดยกมา/รับเข้า/จ่ายออก/รับคืน/คงเหลือ ของยางทุกรายการ (อ่านจาก daily_stock_snapshots)
+    tire_balances = database.get_daily_stock_balances(conn, 'tire', report_date)
+    detailed_tire_report = _build_daily_item_report(tire_balances, tire_movements_raw, 'tire_main_id', ('brand', 'model', 'size'))
     sorted_detailed_tire_report = []
-    # Add channel_name, online_platform_name, wholesale_customer_name, return_customer_type to detailed_tire_report
-    detailed_tire_report = defaultdict(lambda: {'IN': 0, 'OUT': 0, 'RETURN': 0, 'remaining_quantity': 0, 'tire_main_id': None, 'brand': '', 'model': '', 'size': '', 'movements': []}) #
-
-    for movement in tire_movements_raw:
-        key = (movement['brand'], movement['model'], movement['size'])
-        tire_id = movement['tire_main_id']
-
-        if key not in detailed_tire_report:
-            detailed_tire_report[key]['tire_main_id'] = tire_id
-            detailed_tire_report[key]['brand'] = movement['brand']
-            detailed_tire_report[key]['model'] = movement['model']
-            detailed_tire_report[key]['size'] = movement['size']
-            detailed_tire_report[key]['remaining_quantity'] = tire_quantities_before_report[tire_id]
-
-        if movement['type'] == 'IN':
-            detailed_tire_report[key]['IN'] += movement['quantity_change']
-            detailed_tire_report[key]['remaining_quantity'] += movement['quantity_change']
-        elif movement['type'] == 'OUT':
-            detailed_tire_report[key]['OUT'] += movement['quantity_change'] # สะสมยอดจ่ายออก
-            detailed_tire_report[key]['remaining_quantity'] -= movement['quantity_change']
-        elif movement['type'] == 'RETURN': #
-            detailed_tire_report[key]['RETURN'] += movement['quantity_change'] # สะสมยอดรับคืน
-            detailed_tire_report[key]['remaining_quantity'] += movement['quantity_change'] # รับคืนเพิ่มสต็อก
-
-        # เพิ่มรายละเอียด movement เข้าไปในลิสต์
-        detailed_tire_report[key]['movements'].append({
-            'id': movement['id'],
-            'timestamp': movement['timestamp'],
-            'type': movement['type'],
-            'quantity_change': movement['quantity_change'],
-            'notes': movement['notes'],
-            'image_filename': movement['image_filename'],
-            'user_username': movement['user_username'],
-            'channel_name': movement['channel_name'],
-            'online_platform_name': movement['online_platform_name'],
-            'wholesale_customer_name': movement['wholesale_customer_name'],
-            'return_customer_type': movement['return_customer_type']
-        })
-
-    for tire_id, qty in tire_quantities_before_report.items():
-        if not any(item['tire_main_id'] == tire_id for item in tire_movements_raw):
-            tire_info = database.get_tire(conn, tire_id)
-            if tire_info and not tire_info['is_deleted']:
-                key = (tire_info['brand'], tire_info['model'], tire_info['size'])
-                if key not in detailed_tire_report:
-                    detailed_tire_report[key]['tire_main_id'] = tire_id
-                    detailed_tire_report[key]['brand'] = tire_info['brand']
-                    detailed_tire_report[key]['model'] = tire_info['model']
-                    detailed_tire_report[key]['size'] = tire_info['size']
-                    detailed_tire_report[key]['remaining_quantity'] = qty
-
 
     tire_brand_summaries = defaultdict(lambda: {'IN': 0, 'OUT': 0, 'RETURN': 0, 'current_quantity_sum': 0}) #
     sorted_unique_tire_items = sorted(detailed_tire_report.items(), key=lambda x: x[0])
@@ -3407,115 +3376,9 @@ def daily_stock_report():
         processed_wheel_movements_raw_today.append(movement_data)
     wheel_movements_raw = processed_wheel_movements_raw_today
     
-    # ... (ส่วนที่เหลือของโค้ดในการคำนวณและประมวลผลข้อมูลแม็ก ไม่มีการเปลี่ยนแปลง) ...
-    wheel_quantities_before_report = defaultdict(int)
-    wheel_ids_involved = set()
-    for movement in wheel_movements_raw:
-        wheel_ids_involved.add(movement['wheel_main_id'])
-
-    day_before_report = report_datetime_obj.replace(hour=0, minute=0, second=0) - timedelta(microseconds=1)
-    day_before_report_iso = day_before_report.isoformat()
-
-    distinct_wheel_ids_query_all_history = f"""
-    SELECT DISTINCT wheel_id
-    FROM wheel_movements
-    WHERE timestamp <= {placeholder}{timestamp_cast}
-    """
-    if is_psycopg2_conn:
-        cursor_wheel = conn.cursor()
-        cursor_wheel.execute(distinct_wheel_ids_query_all_history, (sql_date_filter_end_of_day,))
-        rows = cursor_wheel.fetchall()
-        cursor_wheel.close()
-    else:
-        rows = conn.execute(distinct_wheel_ids_query_all_history, (sql_date_filter_end_of_day,)).fetchall()
-
-    for row in rows:
-        wheel_ids_involved.add(row['wheel_id'])
-
-
-    if wheel_ids_involved:
-        ids_list = list(wheel_ids_involved)
-        placeholders_for_in = ', '.join([placeholder] * len(ids_list))
-
-        query_initial_quantities = f"""
-            SELECT
-                wheel_id,
-                COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0) as initial_quantity
-            FROM wheel_movements
-            WHERE wheel_id IN ({placeholders_for_in}) AND timestamp < {placeholder}{timestamp_cast}
-            GROUP BY wheel_id
-        """
-        params = ids_list + [day_before_report_iso]
-
-        if is_psycopg2_conn:
-            cursor = conn.cursor()
-            cursor.execute(query_initial_quantities, tuple(params))
-            initial_quantities_rows = cursor.fetchall()
-            cursor.close()
-        else:
-            query_sqlite = query_initial_quantities.replace(timestamp_cast, "")
-            initial_quantities_rows = conn.execute(query_sqlite, tuple(params)).fetchall()
-
-        for row in initial_quantities_rows:
-            wheel_quantities_before_report[row['wheel_id']] = row['initial_quantity']
-
-
+    wheel_balances = database.get_daily_stock_balances(conn, 'wheel', report_date)
+    detailed_wheel_report = _build_daily_item_report(wheel_balances, wheel_movements_raw, 'wheel_main_id', ('brand', 'model', 'diameter', 'pcd', 'width'))
     sorted_detailed_wheel_report = []
-    # Add channel_name, online_platform_name, wholesale_customer_name, return_customer_type to detailed_wheel_report
-    detailed_wheel_report = defaultdict(lambda: {'IN': 0, 'OUT': 0, 'RETURN': 0, 'remaining_quantity': 0, 'wheel_main_id': None, 'brand': '', 'model': '', 'diameter': None, 'pcd': '', 'width': None, 'movements': []}) #
-
-    for movement in wheel_movements_raw:
-        key = (movement['brand'], movement['model'], movement['diameter'], movement['pcd'], movement['width'])
-        wheel_id = movement['wheel_main_id']
-
-        if key not in detailed_wheel_report:
-            detailed_wheel_report[key]['wheel_main_id'] = wheel_id
-            detailed_wheel_report[key]['brand'] = movement['brand']
-            detailed_wheel_report[key]['model'] = movement['model']
-            detailed_wheel_report[key]['diameter'] = movement['diameter']
-            detailed_wheel_report[key]['pcd'] = movement['pcd']
-            detailed_wheel_report[key]['width'] = movement['width']
-            detailed_wheel_report[key]['remaining_quantity'] = wheel_quantities_before_report[wheel_id]
-
-        if movement['type'] == 'IN':
-            detailed_wheel_report[key]['IN'] += movement['quantity_change']
-            detailed_wheel_report[key]['remaining_quantity'] += movement['quantity_change']
-        elif movement['type'] == 'OUT':
-            detailed_wheel_report[key]['OUT'] += movement['quantity_change'] # สะสมยอดจ่ายออก
-            detailed_wheel_report[key]['remaining_quantity'] -= movement['quantity_change']
-        elif movement['type'] == 'RETURN': #
-            detailed_wheel_report[key]['RETURN'] += movement['quantity_change'] # สะสมยอดรับคืน
-            detailed_wheel_report[key]['remaining_quantity'] += movement['quantity_change'] # รับคืนเพิ่มสต็อก
-
-        # เพิ่มรายละเอียด movement เข้าไปในลิสต์
-        detailed_wheel_report[key]['movements'].append({
-            'id': movement['id'],
-            'timestamp': movement['timestamp'],
-            'type': movement['type'],
-            'quantity_change': movement['quantity_change'],
-            'notes': movement['notes'],
-            'image_filename': movement['image_filename'],
-            'user_username': movement['user_username'],
-            'channel_name': movement['channel_name'],
-            'online_platform_name': movement['online_platform_name'],
-            'wholesale_customer_name': movement['wholesale_customer_name'],
-            'return_customer_type': movement['return_customer_type']
-        })
-
-    for wheel_id, qty in wheel_quantities_before_report.items():
-        if not any(item['wheel_main_id'] == wheel_id for item in wheel_movements_raw):
-            wheel_info = database.get_wheel(conn, wheel_id)
-            if wheel_info and not wheel_info['is_deleted']:
-                key = (wheel_info['brand'], wheel_info['model'], wheel_info['diameter'], wheel_info['pcd'], wheel_info['width'])
-                if key not in detailed_wheel_report:
-                    detailed_wheel_report[key]['wheel_main_id'] = wheel_id
-                    detailed_wheel_report[key]['brand'] = wheel_info['brand']
-                    detailed_wheel_report[key]['model'] = wheel_info['model']
-                    detailed_wheel_report[key]['diameter'] = wheel_info['diameter']
-                    detailed_wheel_report[key]['pcd'] = wheel_info['pcd']
-                    detailed_wheel_report[key]['width'] = wheel_info['width']
-                    detailed_wheel_report[key]['remaining_quantity'] = qty
-
 
     wheel_brand_summaries = defaultdict(lambda: {'IN': 0, 'OUT': 0, 'RETURN': 0, 'current_quantity_sum': 0}) #
     sorted_unique_wheel_items = sorted(detailed_wheel_report.items(), key=lambda x: x[0])
@@ -3602,109 +3465,9 @@ def daily_stock_report():
         processed_spare_part_movements_raw_today.append(movement_data)
     spare_part_movements_raw = processed_spare_part_movements_raw_today
     
-    # ... (ส่วนที่เหลือของโค้ดในการคำนวณและประมวลผลข้อมูลอะไหล่ ไม่มีการเปลี่ยนแปลง) ...
-    spare_part_quantities_before_report = defaultdict(int)
-    spare_part_ids_involved = set()
-    for movement in spare_part_movements_raw:
-        spare_part_ids_involved.add(movement['spare_part_main_id'])
-
-    day_before_report = report_datetime_obj.replace(hour=0, minute=0, second=0) - timedelta(microseconds=1)
-    day_before_report_iso = day_before_report.isoformat()
-
-    distinct_spare_part_ids_query_all_history = f"""
-    SELECT DISTINCT spare_part_id
-    FROM spare_part_movements
-    WHERE timestamp <= {placeholder}{timestamp_cast}
-    """
-    if is_psycopg2_conn:
-        cursor_spare_part = conn.cursor()
-        cursor_spare_part.execute(distinct_spare_part_ids_query_all_history, (sql_date_filter_end_of_day,))
-        rows = cursor_spare_part.fetchall()
-        cursor_spare_part.close()
-    else:
-        rows = conn.execute(distinct_spare_part_ids_query_all_history, (sql_date_filter_end_of_day,)).fetchall()
-
-    for row in rows:
-        spare_part_ids_involved.add(row['spare_part_id'])
-
-
-    if spare_part_ids_involved:
-        ids_list = list(spare_part_ids_involved)
-        placeholders_for_in = ', '.join([placeholder] * len(ids_list))
-
-        query_initial_quantities = f"""
-            SELECT
-                spare_part_id,
-                COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0) as initial_quantity
-            FROM spare_part_movements
-            WHERE spare_part_id IN ({placeholders_for_in}) AND timestamp < {placeholder}{timestamp_cast}
-            GROUP BY spare_part_id
-        """
-        params = ids_list + [day_before_report_iso]
-
-        if is_psycopg2_conn:
-            cursor = conn.cursor()
-            cursor.execute(query_initial_quantities, tuple(params))
-            initial_quantities_rows = cursor.fetchall()
-            cursor.close()
-        else:
-            query_sqlite = query_initial_quantities.replace(timestamp_cast, "")
-            initial_quantities_rows = conn.execute(query_sqlite, tuple(params)).fetchall()
-
-        for row in initial_quantities_rows:
-            spare_part_quantities_before_report[row['spare_part_id']] = row['initial_quantity']
-
+    spare_part_balances = database.get_daily_stock_balances(conn, 'spare_part', report_date)
+    detailed_spare_part_report = _build_daily_item_report(spare_part_balances, spare_part_movements_raw, 'spare_part_main_id', ('name', 'brand', 'part_number'), extra_fields=('category_name',))
     sorted_detailed_spare_part_report = []
-    detailed_spare_part_report = defaultdict(lambda: {'IN': 0, 'OUT': 0, 'RETURN': 0, 'remaining_quantity': 0, 'spare_part_main_id': None, 'name': '', 'brand': '', 'part_number': '', 'category_name': '', 'movements': []})
-
-    for movement in spare_part_movements_raw:
-        key = (movement['spare_part_name'], movement['spare_part_brand'], movement['part_number'])
-        spare_part_id = movement['spare_part_main_id']
-
-        if key not in detailed_spare_part_report:
-            detailed_spare_part_report[key]['spare_part_main_id'] = spare_part_id
-            detailed_spare_part_report[key]['name'] = movement['spare_part_name']
-            detailed_spare_part_report[key]['brand'] = movement['spare_part_brand']
-            detailed_spare_part_report[key]['part_number'] = movement['part_number']
-            detailed_spare_part_report[key]['category_name'] = movement['category_name']
-            detailed_spare_part_report[key]['remaining_quantity'] = spare_part_quantities_before_report[spare_part_id]
-
-        if movement['type'] == 'IN':
-            detailed_spare_part_report[key]['IN'] += movement['quantity_change']
-            detailed_spare_part_report[key]['remaining_quantity'] += movement['quantity_change']
-        elif movement['type'] == 'OUT':
-            detailed_spare_part_report[key]['OUT'] += movement['quantity_change']
-            detailed_spare_part_report[key]['remaining_quantity'] -= movement['quantity_change']
-        elif movement['type'] == 'RETURN':
-            detailed_spare_part_report[key]['RETURN'] += movement['quantity_change']
-            detailed_spare_part_report[key]['remaining_quantity'] += movement['quantity_change']
-
-        detailed_spare_part_report[key]['movements'].append({
-            'id': movement['id'],
-            'timestamp': movement['timestamp'],
-            'type': movement['type'],
-            'quantity_change': movement['quantity_change'],
-            'notes': movement['notes'],
-            'image_filename': movement['image_filename'],
-            'user_username': movement['user_username'],
-            'channel_name': movement['channel_name'],
-            'online_platform_name': movement['online_platform_name'],
-            'wholesale_customer_name': movement['wholesale_customer_name'],
-            'return_customer_type': movement['return_customer_type']
-        })
-
-    for spare_part_id, qty in spare_part_quantities_before_report.items():
-        if not any(item['spare_part_main_id'] == spare_part_id for item in spare_part_movements_raw):
-            spare_part_info = database.get_spare_part(conn, spare_part_id)
-            if spare_part_info and not spare_part_info['is_deleted']:
-                key = (spare_part_info['name'], spare_part_info['brand'], spare_part_info['part_number'])
-                if key not in detailed_spare_part_report:
-                    detailed_spare_part_report[key]['spare_part_main_id'] = spare_part_id
-                    detailed_spare_part_report[key]['name'] = spare_part_info['name']
-                    detailed_spare_part_report[key]['brand'] = spare_part_info['brand']
-                    detailed_spare_part_report[key]['part_number'] = spare_part_info['part_number']
-                    detailed_spare_part_report[key]['category_name'] = spare_part_info['category_name']
-                    detailed_spare_part_report[key]['remaining_quantity'] = qty
 
     spare_part_category_summaries = defaultdict(lambda: {'IN': 0, 'OUT': 0, 'RETURN': 0, 'current_quantity_sum': 0})
     sorted_unique_spare_part_items = sorted(detailed_spare_part_report.items(), key=lambda x: (x[1]['category_name'] or '', x[0]))
@@ -3761,20 +3524,8 @@ def daily_stock_report():
     tire_total_out = sum(item['OUT'] for item in sorted_detailed_tire_report if not item['is_summary'])
     tire_total_return = sum(item['RETURN'] for item in sorted_detailed_tire_report if not item['is_summary']) #
 
-    tire_total_remaining_for_report_date = 0
-    query_total_before_tires = f"""
-        SELECT COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0)
-        FROM tire_movements
-        WHERE timestamp < {placeholder}{timestamp_cast}
-    """
-    if is_psycopg2_conn:
-        cursor = conn.cursor()
-        cursor.execute(query_total_before_tires, (start_of_report_day_iso,))
-        initial_total_tires = cursor.fetchone()[0] or 0
-        cursor.close()
-    else:
-        initial_total_tires = conn.execute(query_total_before_tires, (start_of_report_day_iso,)).fetchone()[0] or 0
-
+    # ยอดยกมารวม (รวมสินค้าที่ถูกลบ) จากผลรวมยอดยกมาของแต่ละรายการ
+    initial_total_tires = sum(row['opening_quantity'] for row in tire_balances.values())
     tire_total_remaining_for_report_date = initial_total_tires + tire_total_in + tire_total_return - tire_total_out #
 
 
@@ -3782,20 +3533,7 @@ def daily_stock_report():
     wheel_total_out = sum(item['OUT'] for item in sorted_detailed_wheel_report if not item['is_summary'])
     wheel_total_return = sum(item['RETURN'] for item in sorted_detailed_wheel_report if not item['is_summary']) #
 
-    wheel_total_remaining_for_report_date = 0
-    query_total_before_wheels = f"""
-        SELECT COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0)
-        FROM wheel_movements
-        WHERE timestamp < {placeholder}{timestamp_cast};
-    """
-    if is_psycopg2_conn:
-        cursor = conn.cursor()
-        cursor.execute(query_total_before_wheels, (start_of_report_day_iso,))
-        initial_total_wheels = cursor.fetchone()[0] or 0
-        cursor.close()
-    else:
-        initial_total_wheels = conn.execute(query_total_before_wheels, (start_of_report_day_iso,)).fetchone()[0] or 0
-
+    initial_total_wheels = sum(row['opening_quantity'] for row in wheel_balances.values())
     wheel_total_remaining_for_report_date = initial_total_wheels + wheel_total_in + wheel_total_return - wheel_total_out #
 
     # NEW: Spare Part Totals
@@ -3803,20 +3541,7 @@ def daily_stock_report():
     spare_part_total_out = sum(item['OUT'] for item in sorted_detailed_spare_part_report if not item['is_summary'])
     spare_part_total_return = sum(item['RETURN'] for item in sorted_detailed_spare_part_report if not item['is_summary'])
 
-    spare_part_total_remaining_for_report_date = 0
-    query_total_before_spare_parts = f"""
-        SELECT COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0)
-        FROM spare_part_movements
-        WHERE timestamp < {placeholder}{timestamp_cast};
-    """
-    if is_psycopg2_conn:
-        cursor = conn.cursor()
-        cursor.execute(query_total_before_spare_parts, (start_of_report_day_iso,))
-        initial_total_spare_parts = cursor.fetchone()[0] or 0
-        cursor.close()
-    else:
-        initial_total_spare_parts = conn.execute(query_total_before_spare_parts, (start_of_report_day_iso,)).fetchone()[0] or 0
-
+    initial_total_spare_parts = sum(row['opening_quantity'] for row in spare_part_balances.values())
     spare_part_total_remaining_for_report_date = initial_total_spare_parts + spare_part_total_in + spare_part_total_return - spare_part_total_out
 
 
@@ -3900,7 +3625,7 @@ def summary_stock_report():
     else:
         display_range_str = f"จากวันที่ {start_day} {start_month_th} {start_year_be} - {end_day} {end_month_th} {end_year_be}"
 
-    is_psycopg2_conn = "psycopg2" in str(type(conn))
+    is_psycopg2_conn = database.is_postgres_conn(conn)
     timestamp_cast = "::timestamptz" if is_psycopg2_conn else ""
     placeholder = "%s" if is_psycopg2_conn else "?"
     start_of_period_iso = start_date_obj.isoformat()
@@ -4198,69 +3923,32 @@ def summary_stock_report():
         for item in data.get('RETURN', [])
     ))
 
-    try:
-        # Total initial stock (sum of all IN/RETURN - all OUT up to start_of_period_iso)
-        query_overall_initial_tires = f"""
-            SELECT COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0)
-            FROM tire_movements
-            WHERE timestamp < {placeholder}{timestamp_cast};
-        """
-        if is_psycopg2_conn:
-            cursor = conn.cursor()
-            cursor.execute(query_overall_initial_tires, (start_of_period_iso,))
-            overall_tire_initial = int(cursor.fetchone()[0] or 0)
-            cursor.close()
-        else:
-            query_for_sqlite = query_overall_initial_tires.replace(f"{timestamp_cast}", "").replace(placeholder, '?')
-            overall_tire_initial = int(conn.execute(query_for_sqlite, (start_of_period_iso,)).fetchone()[0] or 0)
-        # flash(f"DEBUG (Overall Tire Initial): {overall_tire_initial}", "info")
-    except Exception as e:
-        print(f"ERROR: Failed to fetch overall initial tire stock: {e}")
-        flash(f"เกิดข้อผิดพลาดในการคำนวณสต็อกยางเริ่มต้น: {e}", "danger")
-        conn.rollback()
-        overall_tire_initial = 0
+    # ยอดยกมา ณ ต้นช่วง (ต่อสินค้า) จาก daily_stock_snapshots ใช้ทั้งยอดรวมและยอดรวมตามยี่ห้อด้านล่าง
+    period_balances = {}
+    for item_type in ('tire', 'wheel', 'spare_part'):
+        try:
+            period_balances[item_type] = database.get_stock_period_balances(conn, item_type, start_date_obj.date(), end_date_obj.date())
+        except Exception as e:
+            print(f"ERROR: Failed to fetch initial {item_type} stock: {e}")
+            flash(f"เกิดข้อผิดพลาดในการคำนวณสต็อกเริ่มต้น ({item_type}): {e}", "danger")
+            conn.rollback()
+            period_balances[item_type] = {}
 
-    try:
-        query_overall_initial_wheels = f"""
-            SELECT COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0)
-            FROM wheel_movements
-            WHERE timestamp < {placeholder}{timestamp_cast};
-        """
-        if is_psycopg2_conn:
-            cursor = conn.cursor()
-            cursor.execute(query_overall_initial_wheels, (start_of_period_iso,))
-            overall_wheel_initial = int(cursor.fetchone()[0] or 0)
-            cursor.close()
-        else:
-            query_for_sqlite = query_overall_initial_wheels.replace(f"{timestamp_cast}", "").replace(placeholder, '?')
-            overall_wheel_initial = int(conn.execute(query_for_sqlite, (start_of_period_iso,)).fetchone()[0] or 0)
-        # flash(f"DEBUG (Overall Wheel Initial): {overall_wheel_initial}", "info")
-    except Exception as e:
-        print(f"ERROR: Failed to fetch overall initial wheel stock: {e}")
-        flash(f"เกิดข้อผิดพลาดในการคำนวณสต็อกแม็กเริ่มต้น: {e}", "danger")
-        conn.rollback()
-        overall_wheel_initial = 0
+    overall_tire_initial = sum(balance['opening_quantity'] for balance in period_balances['tire'].values())
+    overall_wheel_initial = sum(balance['opening_quantity'] for balance in period_balances['wheel'].values())
+    overall_spare_part_initial = sum(balance['opening_quantity'] for balance in period_balances['spare_part'].values())
 
-    # NEW: Query for overall initial spare part stock
-    try:
-        query_overall_initial_spare_parts = f"""
-            SELECT COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0)
-            FROM spare_part_movements
-            WHERE timestamp < {placeholder}{timestamp_cast};
-        """
-        if is_psycopg2_conn:
-            cursor = conn.cursor()
-            cursor.execute(query_overall_initial_spare_parts, (start_of_period_iso,))
-            overall_spare_part_initial = int(cursor.fetchone()[0] or 0)
-            cursor.close()
-        else:
-            query_for_sqlite = query_overall_initial_spare_parts.replace(f"{timestamp_cast}", "").replace(placeholder, '?')
-            overall_spare_part_initial = int(conn.execute(query_for_sqlite, (start_of_period_iso,)).fetchone()[0] or 0)
-    except Exception as e:
-        print(f"ERROR: Failed to fetch overall initial spare part stock: {e}")
-        flash(f"เกิดข้อผิดพลาดในการคำนวณสต็อกอะไหล่เริ่มต้น: {e}", "danger")
-        conn.rollback()
-        overall_spare_part_initial = 0
+    def sum_opening_by(item_type, field):
+        items = database.get_stock_report_items(conn, item_type)
+        totals = defaultdict(int)
+        for item_id, balance in period_balances[item_type].items():
+            if item_id in items:
+                totals[items[item_id][field]] += balance['opening_quantity']
+        return totals
+
+    tire_initial_by_brand = sum_opening_by('tire', 'brand')
+    wheel_initial_by_brand = sum_opening_by('wheel', 'brand')
+    spare_part_initial_by_category = sum_opening_by('spare_part', 'category_id')
 
 
     # Total final stock (initial + movements within period)
@@ -4538,20 +4226,7 @@ def summary_stock_report():
 
         # tire_brand_totals_for_summary_report ถูกกำหนดค่าเริ่มต้นแล้ว ไม่ต้องกำหนดซ้ำ
         for brand in all_tire_brands:
-            query_brand_initial_tire = f"""
-                SELECT COALESCE(SUM(CASE WHEN tm.type = 'IN' OR tm.type = 'RETURN' THEN tm.quantity_change ELSE -tm.quantity_change END), 0)
-                FROM tire_movements tm
-                JOIN tires t ON tm.tire_id = t.id
-                WHERE t.brand = {placeholder} AND tm.timestamp < {placeholder}{timestamp_cast};
-            """
-            if is_psycopg2_conn:
-                cursor = conn.cursor()
-                cursor.execute(query_brand_initial_tire, (brand, start_of_period_iso))
-                brand_initial_qty = int(cursor.fetchone()[0] or 0)
-                cursor.close()
-            else:
-                query_for_sqlite = query_brand_initial_tire.replace(f"{timestamp_cast}", "").replace(placeholder, '?')
-                brand_initial_qty = int(conn.execute(query_for_sqlite, (brand, start_of_period_iso)).fetchone()[0] or 0)
+            brand_initial_qty = tire_initial_by_brand.get(brand, 0)
 
             total_in_brand = 0
             total_out_brand = 0
@@ -4597,20 +4272,7 @@ def summary_stock_report():
 
         # wheel_brand_totals_for_summary_report ถูกกำหนดค่าเริ่มต้นแล้ว ไม่ต้องกำหนดซ้ำ
         for brand in all_wheel_brands:
-            query_brand_initial_wheel = f"""
-                SELECT COALESCE(SUM(CASE WHEN type = 'IN' OR type = 'RETURN' THEN quantity_change ELSE -quantity_change END), 0)
-                FROM wheel_movements wm
-                JOIN wheels w ON wm.wheel_id = w.id
-                WHERE w.brand = {placeholder} AND wm.timestamp < {placeholder}{timestamp_cast};
-            """
-            if is_psycopg2_conn:
-                cursor = conn.cursor()
-                cursor.execute(query_brand_initial_wheel, (brand, start_of_period_iso))
-                brand_initial_qty = int(cursor.fetchone()[0] or 0)
-                cursor.close()
-            else:
-                query_for_sqlite = query_brand_initial_wheel.replace(f"{timestamp_cast}", "").replace(placeholder, '?')
-                brand_initial_qty = int(conn.execute(query_for_sqlite, (brand, start_of_period_iso)).fetchone()[0] or 0)
+            brand_initial_qty = wheel_initial_by_brand.get(brand, 0)
 
             total_in_brand = 0
             total_out_brand = 0
@@ -4655,20 +4317,7 @@ def summary_stock_report():
             cat_id = category_info['id']
             cat_name = category_info['name']
 
-            query_category_initial_spare_part = f"""
-                SELECT COALESCE(SUM(CASE WHEN spm.type = 'IN' OR spm.type = 'RETURN' THEN spm.quantity_change ELSE -spm.quantity_change END), 0)
-                FROM spare_part_movements spm
-                JOIN spare_parts sp ON spm.spare_part_id = sp.id
-                WHERE sp.category_id = {placeholder} AND spm.timestamp < {placeholder}{timestamp_cast};
-            """
-            if is_psycopg2_conn:
-                cursor = conn.cursor()
-                cursor.execute(query_category_initial_spare_part, (cat_id, start_of_period_iso))
-                category_initial_qty = int(cursor.fetchone()[0] or 0)
-                cursor.close()
-            else:
-                query_for_sqlite = query_category_initial_spare_part.replace(f"{timestamp_cast}", "").replace(placeholder, '?')
-                category_initial_qty = int(conn.execute(query_for_sqlite, (cat_id, start_of_period_iso)).fetchone()[0] or 0)
+            category_initial_qty = spare_part_initial_by_category.get(cat_id, 0)
 
             total_in_category = 0
             total_out_category = 0
@@ -4767,1155 +4416,156 @@ def export_import():
 
     conn = get_db()
     active_tab = request.args.get('tab', 'tires_excel')
-    return render_template('export_import.html', active_tab=active_tab, current_user=current_user)
+    import_job_id = request.args.get('import_job')
+    return render_template('export_import.html', active_tab=active_tab, import_job_id=import_job_id, current_user=current_user)
+
+def _export_items(item_type):
+    """
+    ส่งออกสินค้าเป็น xlsx (ค่าเริ่มต้น) หรือ csv (?format=csv)
+    อ่านจากฐานข้อมูลเป็น stream ไม่โหลดทั้ง catalogue เข้าหน่วยความจำ
+    """
+    spec = excel_export.EXPORT_SPECS[item_type]
+    if not current_user.can_edit(): # Admin or Editor
+        flash(f"คุณไม่มีสิทธิ์ในการส่งออกข้อมูล{spec['label']}", 'danger')
+        return redirect(url_for('stock.export_import', tab=spec['tab']))
+
+    conn = get_db()
+    rows = database.iter_export_rows(conn, item_type)
+    first_row = next(rows, None)
+    if first_row is None:
+        flash(f"ไม่มีข้อมูล{spec['label']}ให้ส่งออก", 'warning')
+        return redirect(url_for('stock.export_import', tab=spec['tab']))
+    rows = itertools.chain([first_row], rows)
+
+    if request.args.get('format') == 'csv':
+        response = Response(stream_with_context(excel_export.iter_export_csv(item_type, rows)), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f"attachment; filename={spec['file_name']}.csv"
+        return response
+
+    # xlsx เป็น zip ต้องปิดไฟล์ให้เสร็จก่อนส่ง จึงเขียนลงไฟล์ชั่วคราวแบบ constant_memory แล้วค่อยส่ง
+    fd, temp_path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        excel_export.write_export_workbook(item_type, rows, temp_path)
+        response = send_file(temp_path, download_name=f"{spec['file_name']}.xlsx", as_attachment=True, mimetype=excel_export.XLSX_MIMETYPE)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
+    return response
 
 @bp.route('/export_tires_action')
 @login_required
 def export_tires_action():
-    # Check permission directly inside the route function
-    if not current_user.can_edit(): # Admin or Editor
-        flash('คุณไม่มีสิทธิ์ในการส่งออกข้อมูลยาง', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='tires_excel'))
-        
-    conn = get_db()
-    tires = database.get_all_tires(conn)
-
-    if not tires:
-        flash('ไม่มีข้อมูลยางให้ส่งออก', 'warning')
-        return redirect(url_for('stock.export_import', tab='tires_excel'))
-
-    data = []
-    for tire in tires:
-        primary_barcode = ""
-        barcodes = database.get_barcodes_for_tire(conn, tire['id'])
-        for bc in barcodes:
-            if bc['is_primary_barcode']:
-                primary_barcode = bc['barcode_string']
-                break
-        if not primary_barcode and barcodes:
-            primary_barcode = barcodes[0]['barcode_string']
-
-        data.append({
-            'ยี่ห้อ': tire['brand'],
-            'รุ่นยาง': tire['model'],
-            'เบอร์ยาง': tire['size'],
-            'ปีผลิต': tire['year_of_manufacture'],
-            'สต็อก': tire['quantity'],
-            'ทุน': tire['cost_sc'], 
-            'ทุนล็อต': tire['cost_dunlop'], 
-            'ราคาส่ง 1': tire['wholesale_price1'], 
-            'ราคาส่งหน้าร้าน': tire['wholesale_price2'], 
-            'ราคาขาย': tire['price_per_item'], 
-            'Barcode ID (ระบบ)': primary_barcode,
-            'ID (ห้ามแก้ไข)': tire['id'],
-            # Hidden/System columns (explicitly added here to manage names for import/export)
-            'ทุนค้าส่ง 2 (ระบบ)': tire['cost_online'],
-            'ID โปรโมชัน (ระบบ)': tire['promotion_id'],
-            'ชื่อโปรโมชัน (ระบบ)': tire['promo_name'],
-            'ประเภทโปรโมชัน (ระบบ)': tire['promo_type'],
-            'ค่าโปรโมชัน Value1 (ระบบ)': tire['promo_value1'],
-            'ค่าโปรโมชัน Value2 (ระบบ)': tire['promo_value2'],
-            'รายละเอียดโปรโมชัน (ระบบ)': tire['display_promo_description_text'],
-            'ราคาโปรโมชันคำนวณ(เส้น) (ระบบ)': tire['display_promo_price_per_item'],
-            'ราคาโปรโมชันคำนวณ(4เส้น) (ระบบ)': tire['display_price_for_4'],
-        })
+    return _export_items('tire')
 
-    df = pd.DataFrame(data)
-
-    # --- Sort DataFrame before writing to Excel (lowercase for consistent sorting) ---
-    df['ยี่ห้อ_sort'] = df['ยี่ห้อ'].str.lower()
-    df['รุ่นยาง_sort'] = df['รุ่นยาง'].str.lower()
-    df['เบอร์ยาง_sort'] = df['เบอร์ยาง'].str.lower()
-    df = df.sort_values(by=['ยี่ห้อ_sort', 'รุ่นยาง_sort', 'เบอร์ยาง_sort', 'ID (ห้ามแก้ไข)'], ascending=True)
-    df = df.drop(columns=['ยี่ห้อ_sort', 'รุ่นยาง_sort', 'เบอร์ยาง_sort']) # Drop sort columns
-
-    # Define column order for the main data sheet
-    main_sheet_cols = [
-        'ยี่ห้อ', 'รุ่นยาง', 'เบอร์ยาง', 'ปีผลิต', 'สต็อก',
-        'ทุน', 'ทุนล็อต', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย', 
-        'Barcode ID (ระบบ)', 'ID (ห้ามแก้ไข)',
-        'ทุนค้าส่ง 2 (ระบบ)',
-        'ID โปรโมชัน (ระบบ)', 'ชื่อโปรโมชัน (ระบบ)', 'ประเภทโปรโมชัน (ระบบ)',
-        'ค่าโปรโมชัน Value1 (ระบบ)', 'ค่าโปรโมชัน Value2 (ระบบ)',
-        'รายละเอียดโปรโมชัน (ระบบ)', 'ราคาโปรโมชันคำนวณ(เส้น) (ระบบ)', 'ราคาโปรโมชันคำนวณ(4เส้น) (ระบบ)',
-    ]
-    df = df[main_sheet_cols] # Reorder DataFrame columns
-
-    output = BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    workbook = writer.book
-
-    # --- Add an Instructions Sheet ---
-    instructions_sheet_name = 'คำแนะนำการใช้งาน'
-    instructions_ws = workbook.add_worksheet(instructions_sheet_name)
-    instructions_ws.write('A1', 'คำแนะนำการใช้งานไฟล์นำเข้า/ส่งออกข้อมูลยาง', workbook.add_format({'bold': True, 'font_size': 14}))
-    instructions_ws.write('A3', 'วัตถุประสงค์:', workbook.add_format({'bold': True}))
-    instructions_ws.write('A4', 'ไฟล์นี้ใช้สำหรับ Export ข้อมูลสต็อกยางปัจจุบัน และสามารถใช้เป็นแม่แบบเพื่อนำเข้าข้อมูลใหม่หรือแก้ไขข้อมูลที่มีอยู่ได้', workbook.add_format({'text_wrap': True}))
-    instructions_ws.write('A6', 'ข้อควรระวัง:', workbook.add_format({'bold': True, 'font_color': 'red'}))
-    instructions_ws.write('A7', '1. ห้าม! เปลี่ยนชื่อชีท "Tires Data" และห้าม! ลบ/ย้าย/เปลี่ยนชื่อคอลัมน์ในชีท "Tires Data"', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A8', '2. ข้อมูลในคอลัมน์ที่มีคำว่า "(ห้ามแก้ไข)" หรือ "(ระบบ)" เป็นข้อมูลที่สร้าง/คำนวณโดยระบบ ไม่ควรแก้ไข', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A9', '3. การแก้ไขค่าในคอลัมน์ "สต็อก" จะถูกบันทึกเป็นการเคลื่อนไหว (รับเข้า/จ่ายออก)', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A10', '4. หากต้องการเพิ่มสินค้าใหม่ ไม่ต้องกรอก "ID (ห้ามแก้ไข)"', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A11', '5. ตรวจสอบประเภทข้อมูลให้ถูกต้อง (ตัวเลข, ข้อความ)', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A12', '6. สามารถเปลี่ยนชื่อไฟล์ได้' , workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.set_column('A:A', 80) # Adjust width for instructions
-
-    # --- Write data to the main sheet with blank rows between brands ---
-    data_sheet_name = 'Tires Data'
-    worksheet = workbook.add_worksheet(data_sheet_name) # Create worksheet manually
-
-    # Define formats
-    header_format = workbook.add_format({
-        'bold': True, 'text_wrap': True, 'valign': 'vcenter',
-        'fg_color': '#D7E4BC', 'border': 1, 'align': 'center'
-    })
-    read_only_header_format = workbook.add_format({ # Format for headers of columns not meant for import
-        'bold': True, 'text_wrap': True, 'valign': 'vcenter',
-        'fg_color': '#D9D9D9', 'border': 1, 'font_color': '#5C5C5C', 'align': 'center'
-    })
-    read_only_cell_format = workbook.add_format({ # Format for cells in columns not meant for import
-        'font_color': '#808080', 'italic': True, 'align': 'center', 'valign': 'vcenter'
-    })
-    integer_format = workbook.add_format({'num_format': '#,##0', 'align': 'center'})
-    decimal_format = workbook.add_format({'num_format': '#,##0.00', 'align': 'right'})
-    text_center_format = workbook.add_format({'align': 'center'})
-    text_left_format = workbook.add_format({'align': 'left'})
-    
-    # Write headers to the main sheet
-    for col_num, value in enumerate(df.columns.values):
-        is_read_only_col = '(ห้ามแก้ไข)' in value or '(ระบบ)' in value
-        current_header_format = read_only_header_format if is_read_only_col else header_format
-        worksheet.write(0, col_num, value, current_header_format)
-
-        # Set initial column widths based on header and max data length
-        max_len = max(df[value].astype(str).apply(len).max(), len(value)) + 2
-        
-        if value == 'ยี่ห้อ':
-            worksheet.set_column(col_num, col_num, max(max_len, 15), text_left_format)
-        elif value == 'รุ่นยาง':
-            worksheet.set_column(col_num, col_num, max(max_len, 20), text_left_format)
-        elif value == 'เบอร์ยาง':
-            worksheet.set_column(col_num, col_num, max(max_len, 15), text_center_format)
-        elif value == 'สต็อก':
-            worksheet.set_column(col_num, col_num, max(max_len, 10), integer_format)
-        elif value == 'ปีผลิต':
-            worksheet.set_column(col_num, col_num, max(max_len, 8), text_center_format)
-        elif value == 'ราคาขาย': 
-            worksheet.set_column(col_num, col_num, max(max_len, 12), decimal_format)
-        elif value == 'Barcode ID (ระบบ)': 
-            worksheet.set_column(col_num, col_num, max(max_len, 20), read_only_cell_format, {'hidden': True})
-        elif value == 'ทุนค้าส่ง 2 (ระบบ)': 
-            worksheet.set_column(col_num, col_num, max(max_len, 15), read_only_cell_format, {'hidden': True}) # HIDDEN
-        elif value in ['ทุน', 'ทุนล็อต', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย']: 
-            worksheet.set_column(col_num, col_num, max(max_len, 12), decimal_format)
-        elif is_read_only_col: 
-            worksheet.set_column(col_num, col_num, max(max_len, 15), read_only_cell_format)
-            if value in ['ID (ห้ามแก้ไข)', 'ID โปรโมชัน (ระบบ)', 'ชื่อโปรโมชัน (ระบบ)', 'ประเภทโปรโมชัน (ระบบ)', 'ค่าโปรโมชัน Value1 (ระบบ)', 'ค่าโปรโมชัน Value2 (ระบบ)', 'รายละเอียดโปรโมชัน (ระบบ)', 'ราคาโปรโมชันคำนวณ(เส้น) (ระบบ)', 'ราคาโปรโมชันคำนวณ(4เส้น) (ระบบ)']:
-                worksheet.set_column(col_num, col_num, None, None, {'hidden': True})
-        else:
-            worksheet.set_column(col_num, col_num, max_len)
+def _clear_import_caches(item_type):
+    """ล้าง cache ที่เกี่ยวข้องหลังนำเข้า Excel (เรียกได้ทั้งจาก request และ background job)"""
+    catalog_cache.invalidate_catalog(item_type)
+    if item_type == 'tire':
+        cache.delete_memoized(get_cached_tire_brands)
+        cache.delete_memoized(get_cached_wholesale_summary)
+    elif item_type == 'wheel':
+        cache.delete_memoized(get_cached_wheel_brands)
+        cache.delete_memoized(get_cached_wholesale_summary)
+    else:
+        cache.delete_memoized(get_cached_spare_part_brands)
+        cache.delete_memoized(get_cached_spare_part_categories_hierarchical) # New categories might be referenced
 
-    # Write data rows with blank rows between brands
-    current_row = 1
-    last_brand = None
-    
-    for index, row_data in df.iterrows():
-        current_brand = row_data['ยี่ห้อ']
-        if last_brand is not None and current_brand != last_brand:
-            current_row += 1 # Add a blank row between brands
+def _handle_excel_import(item_type):
+    """
+    นำเข้า Excel ของสินค้าประเภทนี้ (ดู excel_import.py) ตาม import_mode ในฟอร์ม
+    - apply: ตรวจสอบและบันทึกทันที
+    - dry_run: แสดงรายการที่จะเปลี่ยนโดยไม่บันทึก
+    - background: บันทึกเบื้องหลัง แล้วกลับไปหน้า export_import เพื่อติดตามความคืบหน้า
+    """
+    spec = excel_import.IMPORT_SPECS[item_type]
+    tab = spec['tab']
 
-        for col_num, col_name in enumerate(df.columns.values):
-            cell_value = row_data[col_name]
-            cell_format = None
+    if not current_user.can_edit(): # Admin or Editor
+        flash(f"คุณไม่มีสิทธิ์ในการนำเข้าข้อมูล{spec['label']}", 'danger')
+        return redirect(url_for('stock.export_import', tab=tab))
 
-            # Determine format based on column name and whether it's a read-only column
-            is_read_only_col = '(ห้ามแก้ไข)' in col_name or '(ระบบ)' in col_name
-            
-            if is_read_only_col:
-                cell_format = read_only_cell_format
-            elif col_name == 'สต็อก':
-                cell_format = integer_format
-            elif col_name in ['ทุน', 'ทุนล็อต', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย']:
-                cell_format = decimal_format
-            elif col_name == 'ยี่ห้อ':
-                cell_format = text_left_format
-            elif col_name == 'รุ่นยาง':
-                cell_format = text_left_format
-            elif col_name in ['เบอร์ยาง', 'ปีผลิต']:
-                cell_format = text_center_format
-            
-            # --- Handle NaN values by writing None instead of np.nan ---
-            if pd.isna(cell_value):
-                worksheet.write(current_row, col_num, None, cell_format) # Write None to produce a blank cell
-            else:
-                worksheet.write(current_row, col_num, cell_value, cell_format)
-        current_row += 1
-        last_brand = current_brand
-
-    # --- Add Freeze Panes ---
-    worksheet.freeze_panes(1, 0) # Freeze the first row (headers)
-
-
-    # --- REMOVED: Create Summary by Brand Sheet (for Tires) ---
-
-
-    writer.close()
-    output.seek(0)
-
-    return send_file(output, download_name='tire_stock_template.xlsx', as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-
-@bp.route('/import_tires_action', methods=['POST'])
-@login_required
-def import_tires_action():
-    # Check permission directly inside the route function
-    if not current_user.can_edit(): # Admin or Editor
-        flash('คุณไม่มีสิทธิ์ในการนำเข้าข้อมูลยาง', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='tires_excel'))
-        
-    if 'file' not in request.files:
+    file = request.files.get('file')
+    if file is None:
         flash('ไม่พบไฟล์ที่อัปโหลด', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='tires_excel'))
-    
-    file = request.files['file']
-    
+        return redirect(url_for('stock.export_import', tab=tab))
     if file.filename == '':
         flash('ไม่ได้เลือกไฟล์', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='tires_excel'))
-    
-    if file and allowed_excel_file(file.filename):
-        try:
-            xls = pd.ExcelFile(file)
-            if 'Tires Data' not in xls.sheet_names:
-                flash('ไม่พบชีทชื่อ "Tires Data" ในไฟล์. โปรดตรวจสอบว่าคุณใช้ไฟล์แม่แบบที่ถูกต้อง', 'danger')
-                conn.rollback()
-                return redirect(url_for('stock.export_import', tab='tires_excel'))
-            
-            df = xls.parse('Tires Data', dtype={'Barcode ID (ระบบ)': str})
-            
-            conn = get_db()
-            imported_count = 0
-            updated_count = 0
-            error_rows = []
-
-            expected_tire_cols = [
-                'ยี่ห้อ', 'รุ่นยาง', 'เบอร์ยาง', 'ปีผลิต', 'สต็อก',
-                'ทุน', 'ทุนล็อต', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย' 
-            ]
-            
-            if not all(col in df.columns for col in expected_tire_cols):
-                missing_cols = [col for col in expected_tire_cols if col not in df.columns]
-                flash(f'ไฟล์ Excel ขาดคอลัมน์ที่จำเป็น: {", ".join(missing_cols)}. โปรดดาวน์โหลดไฟล์ตัวอย่างเพื่อดูรูปแบบที่ถูกต้อง.', 'danger')
-                conn.rollback()
-                return redirect(url_for('stock.export_import', tab='tires_excel'))
-
-            for index, row in df.iterrows():
-                if pd.isna(row.get('ยี่ห้อ')) and pd.isna(row.get('รุ่นยาง')) and pd.isna(row.get('เบอร์ยาง')) and pd.isna(row.get('สต็อก')):
-                    error_rows.append(f"แถวที่ {index + 2}: ข้อมูลหลัก (ยี่ห้อ, รุ่นยาง, เบอร์ยาง, สต็อก) ว่างเปล่า. แถวถูกข้าม.")
-                    continue
-
-                try:
-                    tire_id_from_excel = int(row.get('ID (ห้ามแก้ไข)')) if pd.notna(row.get('ID (ห้ามแก้ไข)')) else None
-                    barcode_id_from_excel = str(row.get('Barcode ID (ระบบ)', '')).strip()
-                    promotion_id_from_excel_raw = row.get('ID โปรโมชัน (ระบบ)')
-
-                    barcode_id_to_save = None
-                    if barcode_id_from_excel and barcode_id_from_excel.lower() not in ['none', 'nan']:
-                        barcode_id_to_save = barcode_id_from_excel
-
-                    brand = str(row.get('ยี่ห้อ', '')).strip().lower()
-                    model = str(row.get('รุ่นยาง', '')).strip().lower()
-                    size = str(row.get('เบอร์ยาง', '')).strip()
-                    year_of_manufacture_raw = row.get('ปีผลิต')
-                    quantity = int(row['สต็อก']) if pd.notna(row['สต็อก']) else 0
-                    cost_sc_raw = row.get('ทุน')
-                    cost_dunlop_raw = row.get('ทุนล็อต')
-                    cost_online_raw = row.get('ทุนค้าส่ง 2 (ระบบ)')
-                    wholesale_price1_raw = row.get('ราคาส่ง 1')
-                    wholesale_price2_raw = row.get('ราคาส่งหน้าร้าน')
-                    price_per_item_raw = row.get('ราคาขาย')
-
-                    if not brand or not model or not size:
-                        raise ValueError("ข้อมูล 'ยี่ห้อ', 'รุ่นยาง', หรือ 'เบอร์ยาง' ไม่สามารถเว้นว่างได้")
-                    if pd.isna(price_per_item_raw):
-                         raise ValueError("ข้อมูล 'ราคาขาย' ไม่สามารถเว้นว่างได้")
-
-                    try:
-                        price_per_item = float(price_per_item_raw)
-                        cost_sc = float(cost_sc_raw) if pd.notna(cost_sc_raw) else None
-                        cost_dunlop = float(cost_dunlop_raw) if pd.notna(cost_dunlop_raw) else None
-                        cost_online = float(cost_online_raw) if pd.notna(cost_online_raw) else None
-                        wholesale_price1 = float(wholesale_price1_raw) if pd.notna(wholesale_price1_raw) else None
-                        wholesale_price2 = float(wholesale_price2_raw) if pd.notna(wholesale_price2_raw) else None
-                    except ValueError as ve:
-                        raise ValueError(f"ข้อมูลตัวเลขไม่ถูกต้องในคอลัมน์ราคาหรือทุน: {ve}")
-
-                    year_of_manufacture = None
-                    if pd.notna(year_of_manufacture_raw):
-                        try:
-                            year_of_manufacture = int(year_of_manufacture_raw)
-                        except ValueError:
-                            year_of_manufacture = str(year_of_manufacture_raw).strip()
-                            if year_of_manufacture.lower() == 'nan':
-                                year_of_manufacture = None
-
-                    promotion_id_db = int(promotion_id_from_excel_raw) if pd.notna(promotion_id_from_excel_raw) else None
-                    
-                    cursor = conn.cursor()
-                    existing_tire = None
-                    if tire_id_from_excel:
-                        existing_tire = database.get_tire(conn, tire_id_from_excel)
-
-                    if not existing_tire and barcode_id_to_save:
-                        existing_tire_id_by_barcode = database.get_tire_id_by_barcode(conn, barcode_id_to_save)
-                        if existing_tire_id_by_barcode:
-                            conn.rollback()
-                            existing_tire = database.get_tire(conn, existing_tire_id_by_barcode)
-                            if existing_tire and existing_tire['id'] != tire_id_from_excel and tire_id_from_excel is not None:
-                                raise ValueError(f"ID ({tire_id_from_excel}) ใน Excel ไม่ตรงกับ ID ที่พบจาก Barcode ({existing_tire_id_by_barcode}). กรุณาแก้ไข ID ใน Excel หรือลบออก.")
-
-                        existing_wheel_id_by_barcode = database.get_wheel_id_by_barcode(conn, barcode_id_to_save)
-                        if existing_wheel_id_by_barcode:
-                            conn.rollback()
-                            raise ValueError(f"Barcode ID '{barcode_id_to_save}' ซ้ำกับล้อแม็ก ID {existing_wheel_id_by_barcode}. Barcode ID ต้องไม่ซ้ำกันข้ามประเภทสินค้า.")
+        return redirect(url_for('stock.export_import', tab=tab))
+    if not allowed_excel_file(file.filename):
+        flash('ชนิดไฟล์ไม่ถูกต้อง อนุญาตเฉพาะ .xlsx และ .xls เท่านั้น', 'danger')
+        return redirect(url_for('stock.export_import', tab=tab))
 
-                    if not existing_tire:
-                        if "psycopg2" in str(type(conn)):
-                            cursor.execute("SELECT id, brand, model, size, quantity, cost_sc FROM tires WHERE brand = %s AND model = %s AND size = %s", (brand, model, size))
-                        else:
-                            cursor.execute("SELECT id, brand, model, size, quantity, cost_sc FROM tires WHERE brand = ? AND model = ? AND size = ?", (brand, model, size))
-                        
-                        found_tire_data = cursor.fetchone()
-                        if found_tire_data:
-                            existing_tire = dict(found_tire_data)
-                            if existing_tire and existing_tire['id'] != tire_id_from_excel and tire_id_from_excel is not None:
-                                raise ValueError(f"ID ({tire_id_from_excel}) ใน Excel ไม่ตรงกับสินค้าที่มีอยู่แล้วด้วย ยี่ห้อ/รุ่น/เบอร์ ({existing_tire['id']}). กรุณาแก้ไข ID ใน Excel หรือลบออก.")
-
-                    if existing_tire:
-                        tire_id = existing_tire['id']
-                        
-                        # --- START: ส่วนที่เพิ่มเข้ามาเพื่อบันทึกประวัติ ---
-                        old_cost_sc = existing_tire.get('cost_sc')
-                        
-                        if old_cost_sc != cost_sc:
-                            database.add_tire_cost_history(
-                                conn=conn,
-                                tire_id=tire_id,
-                                old_cost=old_cost_sc,
-                                new_cost=cost_sc,
-                                user_id=current_user.id,
-                                notes="แก้ไขผ่านการนำเข้า Excel"
-                            )
-                        # --- END: ส่วนที่เพิ่มเข้ามา ---
-                        
-                        if barcode_id_to_save and not database.get_tire_id_by_barcode(conn, barcode_id_to_save):
-                             database.add_tire_barcode(conn, tire_id, barcode_id_to_save, is_primary=False)
-                        
-                        database.update_tire_import(conn, tire_id, brand, model, size, quantity, cost_sc, cost_dunlop, cost_online, wholesale_price1, wholesale_price2, price_per_item,
-                                                    promotion_id_db, year_of_manufacture)
-                        
-                        old_quantity = existing_tire['quantity']
-                        if quantity != old_quantity:
-                            movement_type = 'IN' if quantity > old_quantity else 'OUT'
-                            quantity_change_diff = abs(quantity - old_quantity)
-                            database.add_tire_movement(conn, tire_id, movement_type, quantity_change_diff, quantity, "Import from Excel (Qty Update)", None, user_id=current_user.id)
-                        updated_count += 1
-                        
-                    else: # New tire
-                        new_tire_id = database.add_tire_import(conn, brand, model, size, quantity, cost_sc, cost_dunlop, cost_online, wholesale_price1, wholesale_price2, price_per_item,
-                                                                promotion_id_db, year_of_manufacture)
-                        if barcode_id_to_save:
-                            database.add_tire_barcode(conn, new_tire_id, barcode_id_to_save, is_primary=True)
-                        database.add_tire_movement(conn, new_tire_id, 'IN', quantity, quantity, "Import from Excel (initial stock)", None, user_id=current_user.id)
-                        imported_count += 1
-                
-                except Exception as row_e:
-                    error_rows.append(f"แถวที่ {index + 2}: {row_e} - {row.to_dict()}")
-            
-            conn.commit()
-            cache.delete_memoized(get_all_tires_list_cached)
-            cache.delete_memoized(get_cached_tire_brands)
-            cache.delete_memoized(get_cached_wholesale_summary)
-            cache.delete_memoized(get_cached_unread_notification_count)
+    import_mode = request.form.get('import_mode', 'apply')
 
-            message = f'นำเข้าข้อมูลยางสำเร็จ: เพิ่มใหม่ {imported_count} รายการ, อัปเดต {updated_count} รายการ.'
-            if error_rows:
-                message += f' พบข้อผิดพลาดใน {len(error_rows)} แถว: {"; ".join(error_rows[:5])}{"..." if len(error_rows) > 5 else ""}'
-                flash(message, 'warning')
-            else:
-                flash(message, 'success')
+    try:
+        df = excel_import.read_import_sheet(item_type, file)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('stock.export_import', tab=tab))
+    except Exception as e:
+        flash(f"เกิดข้อผิดพลาดร้ายแรงในการนำเข้าไฟล์ Excel ของ{spec['label']}: {e}", 'danger')
+        return redirect(url_for('stock.export_import', tab=tab))
 
-            return redirect(url_for('stock.export_import', tab='tires_excel'))
+    if import_mode == 'background':
+        job_id = excel_import.start_import_job(current_app._get_current_object(), item_type, df, current_user.id,
+                                               on_complete=_clear_import_caches)
+        flash(f"เริ่มนำเข้าข้อมูล{spec['label']} {len(df)} แถวเบื้องหลังแล้ว", 'info')
+        return redirect(url_for('stock.export_import', tab=tab, import_job=job_id))
 
-        except Exception as e:
-            flash(f'เกิดข้อผิดพลาดร้ายแรงในการนำเข้าไฟล์ Excel ของยาง: {e}', 'danger')
+    conn = get_db()
+    try:
+        result = excel_import.run_import(conn, item_type, df, user_id=current_user.id, dry_run=(import_mode == 'dry_run'))
+        if result['dry_run']:
             conn.rollback()
-            if 'db' in g and g.db is not None:
-                g.db.rollback()
-            return redirect(url_for('stock.export_import', tab='tires_excel'))
-    else:
-        flash('ชนิดไฟล์ไม่ถูกต้อง อนุญาตเฉพาะ .xlsx และ .xls เท่านั้น', 'danger')
+            return render_template('import_preview.html', result=result, spec=spec,
+                                   column_labels={field: column for field, column, _ in spec['fields']})
+        conn.commit()
+    except Exception as e:
         conn.rollback()
-        return redirect(url_for('stock.export_import', tab='tires_excel'))
+        flash(f"เกิดข้อผิดพลาดร้ายแรงในการนำเข้าไฟล์ Excel ของ{spec['label']}: {e}", 'danger')
+        return redirect(url_for('stock.export_import', tab=tab))
 
+    _clear_import_caches(item_type)
+    flash(excel_import.import_summary_message(result), 'warning' if result['errors'] else 'success')
+    return redirect(url_for('stock.export_import', tab=tab))
 
-@bp.route('/export_wheels_action')
+@bp.route('/import_job_status/<job_id>')
 @login_required
-def export_wheels_action():
-    # Check permission directly inside the route function
-    if not current_user.can_edit(): # Admin or Editor
-        flash('คุณไม่มีสิทธิ์ในการส่งออกข้อมูลแม็ก', 'danger')
-        return redirect(url_for('stock.export_import', tab='wheels_excel'))
-        
+def import_job_status(job_id):
     conn = get_db()
-    wheels = database.get_all_wheels(conn)
-    
-    if not wheels:
-        flash('ไม่มีข้อมูลแม็กให้ส่งออก', 'warning')
-        return redirect(url_for('stock.export_import', tab='wheels_excel'))
-
-    data = []
-    for wheel in wheels:
-        primary_barcode = ""
-        barcodes = database.get_barcodes_for_wheel(conn, wheel['id'])
-        for bc in barcodes:
-            if bc['is_primary_barcode']:
-                primary_barcode = bc['barcode_string']
-                break
-        if not primary_barcode and barcodes:
-            primary_barcode = barcodes[0]['barcode_string']
-
-        data.append({
-            'ยี่ห้อ': wheel['brand'],
-            'ลาย': wheel['model'],
-            'ขอบ': wheel['diameter'],
-            'รู': wheel['pcd'],
-            'กว้าง': wheel['width'],
-            'ET': wheel['et'],
-            'สี': wheel['color'],
-            'สต็อก': wheel['quantity'],
-            'ทุน': wheel['cost'],
-            'ทุน Online': wheel['cost_online'], 
-            'ราคาส่ง 1': wheel['wholesale_price1'], 
-            'ราคาส่งหน้าร้าน': wheel['wholesale_price2'], 
-            'ราคาขาย': wheel['retail_price'], 
-            'Barcode ID (ระบบ)': primary_barcode, 
-            'ID (ห้ามแก้ไข)': wheel['id'], 
-            'ไฟล์รูปภาพ (URL ระบบ)': wheel['image_filename'], 
-        })
-
-    df = pd.DataFrame(data)
-
-    # --- Sort DataFrame before writing to Excel ---
-    df['ยี่ห้อ'] = df['ยี่ห้อ'].str.lower()
-    df['ลาย'] = df['ลาย'].str.lower()
-    df = df.sort_values(by=['ยี่ห้อ', 'ลาย', 'ขอบ', 'ID (ห้ามแก้ไข)'], ascending=True)
-
-    output = BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    workbook = writer.book 
-
-    # --- Add an Instructions Sheet ---
-    instructions_sheet_name = 'คำแนะนำการใช้งาน'
-    instructions_ws = workbook.add_worksheet(instructions_sheet_name) 
-    instructions_ws.write('A1', 'คำแนะนำการใช้งานไฟล์นำเข้า/ส่งออกข้อมูลแม็ก', workbook.add_format({'bold': True, 'font_size': 14}))
-    instructions_ws.write('A3', 'วัตถุประสงค์:', workbook.add_format({'bold': True}))
-    instructions_ws.write('A4', 'ไฟล์นี้ใช้สำหรับ Export ข้อมูลสต็อกแม็กปัจจุบัน และสามารถใช้เป็นแม่แบบเพื่อนำเข้าข้อมูลใหม่หรือแก้ไขข้อมูลที่มีอยู่ได้', workbook.add_format({'text_wrap': True}))
-    instructions_ws.write('A6', 'ข้อควรระวัง:', workbook.add_format({'bold': True, 'font_color': 'red'}))
-    instructions_ws.write('A7', '1. ห้าม! เปลี่ยนชื่อชีท "Wheels Data" และห้าม! ลบ/ย้าย/เปลี่ยนชื่อคอลัมน์ในชีท "Wheels Data"', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A8', '2. ข้อมูลในคอลัมน์ที่มีคำว่า "(ห้ามแก้ไข)" หรือ "(ระบบ)" เป็นข้อมูลที่สร้าง/คำนวณโดยระบบ ไม่ควรแก้ไข', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A9', '3. การแก้ไขค่าในคอลัมน์ "สต็อก" จะถูกบันทึกเป็นการเคลื่อนไหว (รับเข้า/จ่ายออก)', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A10', '4. หากต้องการเพิ่มสินค้าใหม่ ไม่ต้องกรอก "ID (ห้ามแก้ไข)"', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A11', '5. "ไฟล์รูปภาพ (URL ระบบ)" คือ URL รูปภาพที่ระบบใช้ ไม่ควรแก้ไขโดยตรง หากต้องการเปลี่ยนรูป ให้ใช้ฟังก์ชันอัปโหลดในระบบ', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A12', '6. ตรวจสอบประเภทข้อมูลให้ถูกต้อง (ตัวเลข, ข้อความ)', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.set_column('A:A', 80) # Adjust width for instructions
-
-    # Write data to the main sheet
-    data_sheet_name = 'Wheels Data'
-    worksheet = workbook.add_worksheet(data_sheet_name) # Create worksheet manually
-
-    # Define formats
-    header_format = workbook.add_format({
-        'bold': True,
-        'text_wrap': True,
-        'valign': 'vcenter',
-        'fg_color': '#D7E4BC',
-        'border': 1,
-        'align': 'center'
-    })
-    read_only_header_format = workbook.add_format({
-        'bold': True,
-        'text_wrap': True,
-        'valign': 'vcenter',
-        'fg_color': '#D9D9D9',
-        'border': 1,
-        'font_color': '#5C5C5C',
-        'align': 'center'
-    })
-    read_only_cell_format = workbook.add_format({
-        'font_color': '#808080',
-        'italic': True,
-        'align': 'center',
-        'valign': 'vcenter'
-    })
-
-    # Number formats
-    integer_format = workbook.add_format({'num_format': '#,##0', 'align': 'center'})
-    decimal_format = workbook.add_format({'num_format': '#,##0.00', 'align': 'right'})
-    text_center_format = workbook.add_format({'align': 'center'})
-    text_left_format = workbook.add_format({'align': 'left'})
-    
-    # Apply header format and set column widths for main sheet
-    for col_num, value in enumerate(df.columns.values):
-        is_read_only_col = '(ห้ามแก้ไข)' in value or '(ระบบ)' in value or '(URL ระบบ)' in value
-        current_header_format = read_only_header_format if is_read_only_col else header_format
-        worksheet.write(0, col_num, value, current_header_format)
-
-        max_len = max(df[value].astype(str).apply(len).max(), len(value)) + 2
-
-        if value == 'ยี่ห้อ':
-            worksheet.set_column(col_num, col_num, max(max_len, 15), text_left_format)
-        elif value == 'ลาย':
-            worksheet.set_column(col_num, col_num, max(max_len, 20), text_left_format)
-        elif value in ['ขอบ', 'กว้าง', 'ET', 'รู']:
-            worksheet.set_column(col_num, col_num, max(max_len, 8), text_center_format)
-        elif value == 'สี':
-            worksheet.set_column(col_num, col_num, max(max_len, 15), text_center_format)
-        elif value == 'สต็อก':
-            worksheet.set_column(col_num, col_num, max(max_len, 10), integer_format)
-        elif value == 'Barcode ID (ระบบ)': 
-            worksheet.set_column(col_num, col_num, max(max_len, 20), read_only_cell_format, {'hidden': True})
-        elif value in ['ทุน', 'ทุน Online', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย']: 
-            worksheet.set_column(col_num, col_num, max(max_len, 12), decimal_format)
-        elif is_read_only_col:
-            worksheet.set_column(col_num, col_num, max(max_len, 25), read_only_cell_format)
-            if value in ['ID (ห้ามแก้ไข)', 'ไฟล์รูปภาพ (URL ระบบ)']:
-                worksheet.set_column(col_num, col_num, None, None, {'hidden': True})
-        else:
-            worksheet.set_column(col_num, col_num, max_len)
-    
-    # Write data rows with blank rows between brands for Wheels
-    current_row = 1
-    last_brand = None
-    
-    for index, row_data in df.iterrows():
-        current_brand = row_data['ยี่ห้อ']
-        if last_brand is not None and current_brand != last_brand:
-            current_row += 1 # Add a blank row between brands
-
-        for col_num, col_name in enumerate(df.columns.values):
-            cell_value = row_data[col_name]
-            cell_format = None
-
-            is_read_only_col = '(ห้ามแก้ไข)' in col_name or '(ระบบ)' in col_name or '(URL ระบบ)' in col_name
-            
-            if is_read_only_col:
-                cell_format = read_only_cell_format
-            elif col_name == 'สต็อก':
-                cell_format = integer_format
-            elif col_name in ['ทุน', 'ทุน Online', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย']:
-                cell_format = decimal_format
-            elif col_name == 'ยี่ห้อ':
-                cell_format = text_left_format
-            elif col_name == 'ลาย':
-                cell_format = text_left_format
-            elif col_name in ['ขอบ', 'กว้าง', 'ET', 'รู', 'สี']:
-                cell_format = text_center_format
-            
-            # --- Handle NaN values by writing None instead of np.nan ---
-            if pd.isna(cell_value):
-                worksheet.write(current_row, col_num, None, cell_format) # Write None to produce a blank cell
-            else:
-                worksheet.write(current_row, col_num, cell_value, cell_format)
-        current_row += 1
-        last_brand = current_brand
-
-    # --- Add Freeze Panes ---
-    worksheet.freeze_panes(1, 0) # Freeze the first row (headers)
-
-    # --- REMOVED: Create Summary by Brand Sheet (for Wheels) ---
-    # (Removed as per user request)
+    job = excel_import.get_import_job(conn, job_id)
+    conn.commit()
+    if not job or (job.get('user_id') != current_user.id and not current_user.is_admin()):
+        return jsonify({"status": "not_found"}), 404
+    return jsonify(job)
 
-    writer.close()
-    output.seek(0)
+@bp.route('/import_tires_action', methods=['POST'])
+@login_required
+def import_tires_action():
+    return _handle_excel_import('tire')
 
-    return send_file(output, download_name='wheel_stock_template.xlsx', as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+@bp.route('/export_wheels_action')
+@login_required
+def export_wheels_action():
+    return _export_items('wheel')
 
 @bp.route('/import_wheels_action', methods=['POST'])
 @login_required
 def import_wheels_action():
-    # Check permission directly inside the route function
-    if not current_user.can_edit(): # Admin or Editor
-        flash('คุณไม่มีสิทธิ์ในการนำเข้าข้อมูลแม็ก', 'danger')
-        return redirect(url_for('stock.export_import', tab='wheels_excel'))
-        
-    if 'file' not in request.files:
-        flash('ไม่พบไฟล์ที่อัปโหลด', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='wheels_excel'))
-    
-    file = request.files['file']
-    
-    if file.filename == '':
-        flash('ไม่ได้เลือกไฟล์', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='wheels_excel'))
-    
-    if file and allowed_excel_file(file.filename):
-        try:
-            xls = pd.ExcelFile(file)
-            if 'Wheels Data' not in xls.sheet_names:
-                flash('ไม่พบชีทชื่อ "Wheels Data" ในไฟล์. โปรดตรวจสอบว่าคุณใช้ไฟล์แม่แบบที่ถูกต้อง', 'danger')
-                conn.rollback()
-                return redirect(url_for('stock.export_import', tab='wheels_excel'))
-            
-            # Use original 'Barcode ID (ระบบ)' for parsing dtype (as it's the internal name)
-            df = xls.parse('Wheels Data', dtype={'Barcode ID (ระบบ)': str})
-            
-            conn = get_db()
-            imported_count = 0
-            updated_count = 0
-            error_rows = []
-
-            # UPDATED: Expected column names now match the export format
-            expected_wheel_cols = [
-                'ยี่ห้อ', 'ลาย', 'ขอบ', 'รู', 'กว้าง', 'ET', 'สี', 'สต็อก',
-                'ทุน', 'ทุน Online', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย' 
-            ]
-            
-            # Check if all required columns are present
-            if not all(col in df.columns for col in expected_wheel_cols):
-                missing_cols = [col for col in expected_wheel_cols if col not in df.columns]
-                flash(f'ไฟล์ Excel ขาดคอลัมน์ที่จำเป็น: {", ".join(missing_cols)}. โปรดดาวน์โหลดไฟล์ตัวอย่างเพื่อดูรูปแบบที่ถูกต้อง.', 'danger')
-                conn.rollback()
-                return redirect(url_for('stock.export_import', tab='wheels_excel'))
-
-            for index, row in df.iterrows():
-                # --- NEW: Skip blank rows ---
-                # Check if essential columns are NaN or empty strings
-                if pd.isna(row.get('ยี่ห้อ')) and \
-                   pd.isna(row.get('ลาย')) and \
-                   pd.isna(row.get('ขอบ')) and \
-                   pd.isna(row.get('สต็อก')):
-                    error_rows.append(f"แถวที่ {index + 2}: ข้อมูลหลัก (ยี่ห้อ, ลาย, ขอบ, สต็อก) ว่างเปล่า. แถวถูกข้าม.")
-                    continue # Skip this row
-
-                try:
-                    # Retrieve optional/system columns with their new names
-                    wheel_id_from_excel = int(row.get('ID (ห้ามแก้ไข)')) if pd.notna(row.get('ID (ห้ามแก้ไข)')) else None
-                    barcode_id_from_excel = str(row.get('Barcode ID (ระบบ)', '')).strip()
-
-                    # Clean barcode string
-                    barcode_id_to_save = None
-                    if barcode_id_from_excel and barcode_id_from_excel.lower() not in ['none', 'nan']:
-                        barcode_id_to_save = barcode_id_from_excel
-
-                    # Required fields (using their new names from export)
-                    brand = str(row.get('ยี่ห้อ', '')).strip().lower()
-                    model = str(row.get('ลาย', '')).strip().lower()
-                    diameter_raw = row.get('ขอบ')
-                    pcd = str(row.get('รู', '')).strip()
-                    width_raw = row.get('กว้าง')
-                    et_raw = row.get('ET')
-                    color = str(row.get('สี', '')).strip()
-                    quantity = int(row['สต็อก']) if pd.notna(row['สต็อก']) else 0
-                    cost_raw = row.get('ทุน')
-                    cost_online_raw = row.get('ทุน Online')
-                    wholesale_price1_raw = row.get('ราคาส่ง 1') 
-                    wholesale_price2_raw = row.get('ราคาส่งหน้าร้าน') 
-                    retail_price_raw = row.get('ราคาขาย') 
-
-
-                    # Validation for required fields for new/update
-                    if not brand or not model or not pcd:
-                            raise ValueError("ข้อมูล 'ยี่ห้อ', 'ลาย', หรือ 'รู' ไม่สามารถเว้นว่างได้")
-                    if pd.isna(diameter_raw) or pd.isna(width_raw) or pd.isna(retail_price_raw):
-                        raise ValueError("ข้อมูล 'ขอบ', 'กว้าง', หรือ 'ราคาขาย' ไม่สามารถเว้นว่างได้")
-
-
-                    # Type conversions
-                    try:
-                        diameter = float(diameter_raw)
-                        width = float(width_raw)
-                        retail_price = float(retail_price_raw)
-                        cost = float(cost_raw) if pd.notna(cost_raw) else None
-                        et = int(et_raw) if pd.notna(et_raw) else None
-                        cost_online = float(cost_online_raw) if pd.notna(cost_online_raw) else None
-                        wholesale_price1 = float(wholesale_price1_raw) if pd.notna(wholesale_price1_raw) else None 
-                        wholesale_price2 = float(wholesale_price2_raw) if pd.notna(wholesale_price2_raw) else None 
-                    except ValueError as ve:
-                        raise ValueError(f"ข้อมูลตัวเลขไม่ถูกต้องในคอลัมน์ราคา, ทุน, หรือขนาด: {ve}")
-
-                    cursor = conn.cursor()
-
-                    existing_wheel = None
-                    if wheel_id_from_excel:
-                        existing_wheel = database.get_wheel(conn, wheel_id_from_excel)
-                        
-                    # If not found by ID or no ID provided, try to find by Barcode ID
-                    if not existing_wheel and barcode_id_to_save:
-                        existing_wheel_id_by_barcode = database.get_wheel_id_by_barcode(conn, barcode_id_to_save)
-                        if existing_wheel_id_by_barcode:
-                            conn.rollback()
-                            existing_wheel = database.get_wheel(conn, existing_wheel_id_by_barcode)
-                            if existing_wheel and existing_wheel['id'] != wheel_id_from_excel and wheel_id_from_excel is not None:
-                                raise ValueError(f"ID ({wheel_id_from_excel}) ใน Excel ไม่ตรงกับ ID ที่พบจาก Barcode ({existing_wheel_id_by_barcode}). กรุณาแก้ไข ID ใน Excel หรือลบออก.")
-
-                        existing_tire_id_by_barcode = database.get_tire_id_by_barcode(conn, barcode_id_to_save)
-                        if existing_tire_id_by_barcode:
-                            conn.rollback()
-                            raise ValueError(f"Barcode ID '{barcode_id_to_save}' ซ้ำกับยาง ID {existing_tire_id_by_barcode}. Barcode ID ต้องไม่ซ้ำกันข้ามประเภทสินค้า.")
-
-                    # If still not found by ID or Barcode, try to find by Brand/Model/Diameter/PCD/Width
-                    if not existing_wheel:
-                        if "psycopg2" in str(type(conn)):
-                            cursor.execute("SELECT id, brand, model, diameter, pcd, width, quantity FROM wheels WHERE brand = %s AND model = %s AND diameter = %s AND pcd = %s AND width = %s", 
-                                        (brand, model, diameter, pcd, width))
-                        else:
-                            cursor.execute("SELECT id, brand, model, diameter, pcd, width, quantity FROM wheels WHERE brand = ? AND model = ? AND diameter = ? AND pcd = ? AND width = ?", 
-                                        (brand, model, diameter, pcd, width))
-                        
-                        found_wheel_data = cursor.fetchone()
-                        if found_wheel_data:
-                            existing_wheel = dict(found_wheel_data)
-                            if existing_wheel and existing_wheel['id'] != wheel_id_from_excel and wheel_id_from_excel is not None:
-                                raise ValueError(f"ID ({wheel_id_from_excel}) ใน Excel ไม่ตรงกับสินค้าที่มีอยู่แล้วด้วย ยี่ห้อ/ลาย/ขอบ/รู/กว้าง ({existing_wheel['id']}). กรุณาแก้ไข ID ใน Excel หรือลบออก.")
-
-
-                    if existing_wheel:
-                        wheel_id = existing_wheel['id']
-                        
-                        # Add or update barcode if provided and not already linked
-                        if barcode_id_to_save and not database.get_wheel_id_by_barcode(conn, barcode_id_to_save):
-                             database.add_wheel_barcode(conn, wheel_id, barcode_id_to_save, is_primary=False)
-                        
-                        database.update_wheel_import(conn, wheel_id, brand, model, diameter, pcd, width, et, color, quantity, cost, cost_online, wholesale_price1, wholesale_price2, retail_price, image_url)
-                        
-                        old_quantity = existing_wheel['quantity']
-                        if quantity != old_quantity:
-                            movement_type = 'IN' if quantity > old_quantity else 'OUT'
-                            quantity_change_diff = abs(quantity - old_quantity)
-                            database.add_wheel_movement(conn, wheel_id, movement_type, quantity_change_diff, quantity, "Import from Excel (Qty Update)", None, user_id=current_user.id)
-                        updated_count += 1
-                        
-                    else: # New wheel
-                        new_wheel_id = database.add_wheel_import(conn, brand, model, diameter, pcd, width, et, color, quantity, cost, cost_online, wholesale_price1, wholesale_price2, retail_price, image_url)
-                        if barcode_id_to_save:
-                            database.add_wheel_barcode(conn, new_wheel_id, barcode_id_to_save, is_primary=True)
-                        database.add_wheel_movement(conn, new_wheel_id, 'IN', quantity, quantity, "Import from Excel (initial stock)", None, user_id=current_user.id)
-                        imported_count += 1
-                except Exception as row_e:
-                    error_rows.append(f"แถวที่ {index + 2}: {row_e} - {row.to_dict()}")
-            
-            conn.commit()
-            cache.delete_memoized(get_all_wheels_list_cached)
-            cache.delete_memoized(get_cached_wheel_brands)
-            # Potentially clear wholesale_summary_cache and unread_notification_count if stock movements from import add notifications or affect wholesale
-            # (Assuming add_wheel_movement adds notifications, and wholesale_summary is tied to movements)
-            cache.delete_memoized(get_cached_wholesale_summary)
-            cache.delete_memoized(get_cached_unread_notification_count)
-            
-            message = f'นำเข้าข้อมูลแม็กสำเร็จ: เพิ่มใหม่ {imported_count} รายการ, อัปเดต {updated_count} รายการ.'
-            if error_rows:
-                message += f' พบข้อผิดพลาดใน {len(error_rows)} แถว: {"; ".join(error_rows[:5])}{"..." if len(error_rows) > 5 else ""}'
-                flash(message, 'warning')
-            else:
-                flash(message, 'success')
-            
-            return redirect(url_for('stock.export_import', tab='wheels_excel'))
-
-        except Exception as e:
-            flash(f'เกิดข้อผิดพลาดร้ายแรงในการนำเข้าไฟล์ Excel ของแม็ก: {e}', 'danger')
-            conn.rollback()
-            if 'db' in g and g.db is not None:
-                g.db.rollback()
-            return redirect(url_for('stock.export_import', tab='wheels_excel'))
-    else:
-        flash('ชนิดไฟล์ไม่ถูกต้อง อนุญาตเฉพาะ .xlsx และ .xls เท่านั้น', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='wheels_excel'))
+    return _handle_excel_import('wheel')
 
 @bp.route('/export_spare_parts_action')
 @login_required
 def export_spare_parts_action():
-    if not current_user.can_edit():
-        flash('คุณไม่มีสิทธิ์ในการส่งออกข้อมูลอะไหล่', 'danger')
-        return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
-    conn = get_db()
-    spare_parts = database.get_all_spare_parts(conn)
-
-    if not spare_parts:
-        flash('ไม่มีข้อมูลอะไหล่ให้ส่งออก', 'warning')
-        return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
-    data = []
-    for part in spare_parts:
-        primary_barcode = ""
-        barcodes = database.get_barcodes_for_spare_part(conn, part['id'])
-        for bc in barcodes:
-            if bc['is_primary_barcode']:
-                primary_barcode = bc['barcode_string']
-                break
-        if not primary_barcode and barcodes: # Fallback to first barcode if no primary is set
-            primary_barcode = barcodes[0]['barcode_string']
-
-        data.append({
-            'ชื่ออะไหล่': part['name'],
-            'Part Number': part['part_number'],
-            'ยี่ห้อ': part['brand'],
-            'หมวดหมู่': part['category_name'], # NEW: Export category name
-            'คำอธิบาย': part['description'],
-            'สต็อก': part['quantity'],
-            'ทุน': part['cost'],
-            'ราคาขายปลีก': part['retail_price'],
-            'ราคาส่ง 1': part['wholesale_price1'],
-            'ราคาส่ง 2': part['wholesale_price2'],
-            'ทุน Online': part['cost_online'],
-            'Barcode ID (ระบบ)': primary_barcode,
-            'ID (ห้ามแก้ไข)': part['id'],
-            'ID หมวดหมู่ (ระบบ)': part['category_id'], # NEW: Export category_id
-            'ไฟล์รูปภาพ (URL ระบบ)': part['image_filename'],
-        })
-
-    df = pd.DataFrame(data)
-
-    # Sort DataFrame before writing to Excel
-    df['หมวดหมู่_sort'] = df['หมวดหมู่'].str.lower()
-    df['ยี่ห้อ_sort'] = df['ยี่ห้อ'].str.lower()
-    df['ชื่ออะไหล่_sort'] = df['ชื่ออะไหล่'].str.lower()
-    df = df.sort_values(by=['หมวดหมู่_sort', 'ยี่ห้อ_sort', 'ชื่ออะไหล่_sort', 'ID (ห้ามแก้ไข)'], ascending=True)
-    df = df.drop(columns=['หมวดหมู่_sort', 'ยี่ห้อ_sort', 'ชื่ออะไหล่_sort'])
-
-    # Define column order for the main data sheet
-    main_sheet_cols = [
-        'ชื่ออะไหล่', 'Part Number', 'ยี่ห้อ', 'หมวดหมู่', 'คำอธิบาย', 'สต็อก',
-        'ทุน', 'ราคาขายปลีก', 'ราคาส่ง 1', 'ราคาส่ง 2', 'ทุน Online',
-        'Barcode ID (ระบบ)', 'ID (ห้ามแก้ไข)', 'ID หมวดหมู่ (ระบบ)', 'ไฟล์รูปภาพ (URL ระบบ)',
-    ]
-    df = df[main_sheet_cols]
-
-    output = BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    workbook = writer.book
-
-    # --- Add an Instructions Sheet ---
-    instructions_sheet_name = 'คำแนะนำการใช้งาน'
-    instructions_ws = workbook.add_worksheet(instructions_sheet_name)
-    instructions_ws.write('A1', 'คำแนะนำการใช้งานไฟล์นำเข้า/ส่งออกข้อมูลอะไหล่', workbook.add_format({'bold': True, 'font_size': 14}))
-    instructions_ws.write('A3', 'วัตถุประสงค์:', workbook.add_format({'bold': True}))
-    instructions_ws.write('A4', 'ไฟล์นี้ใช้สำหรับ Export ข้อมูลสต็อกอะไหล่ปัจจุบัน และสามารถใช้เป็นแม่แบบเพื่อนำเข้าข้อมูลใหม่หรือแก้ไขข้อมูลที่มีอยู่ได้', workbook.add_format({'text_wrap': True}))
-    instructions_ws.write('A6', 'ข้อควรระวัง:', workbook.add_format({'bold': True, 'font_color': 'red'}))
-    instructions_ws.write('A7', '1. ห้าม! เปลี่ยนชื่อชีท "Spare Parts Data" และห้าม! ลบ/ย้าย/เปลี่ยนชื่อคอลัมน์ในชีท "Spare Parts Data"', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A8', '2. ข้อมูลในคอลัมน์ที่มีคำว่า "(ห้ามแก้ไข)" หรือ "(ระบบ)" เป็นข้อมูลที่สร้าง/คำนวณโดยระบบ ไม่ควรแก้ไข', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A9', '3. การแก้ไขค่าในคอลัมน์ "สต็อก" จะถูกบันทึกเป็นการเคลื่อนไหว (รับเข้า/จ่ายออก)', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A10', '4. หากต้องการเพิ่มสินค้าใหม่ ไม่ต้องกรอก "ID (ห้ามแก้ไข)"', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A11', '5. "ไฟล์รูปภาพ (URL ระบบ)" คือ URL รูปภาพที่ระบบใช้ ไม่ควรแก้ไขโดยตรง หากต้องการเปลี่ยนรูป ให้ใช้ฟังก์ชันอัปโหลดในระบบ', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A12', '6. "หมวดหมู่" ต้องตรงกับหมวดหมู่ที่มีอยู่ในระบบ (สร้าง/จัดการได้ที่หน้าจัดการหมวดหมู่)', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.write('A13', '7. ตรวจสอบประเภทข้อมูลให้ถูกต้อง (ตัวเลข, ข้อความ)', workbook.add_format({'font_color': 'red', 'text_wrap': True}))
-    instructions_ws.set_column('A:A', 80)
-
-    # Write data to the main sheet
-    data_sheet_name = 'Spare Parts Data'
-    worksheet = workbook.add_worksheet(data_sheet_name)
-
-    # Define formats
-    header_format = workbook.add_format({
-        'bold': True, 'text_wrap': True, 'valign': 'vcenter',
-        'fg_color': '#D7E4BC', 'border': 1, 'align': 'center'
-    })
-    read_only_header_format = workbook.add_format({
-        'bold': True, 'text_wrap': True, 'valign': 'vcenter',
-        'fg_color': '#D9D9D9', 'border': 1, 'font_color': '#5C5C5C', 'align': 'center'
-    })
-    read_only_cell_format = workbook.add_format({
-        'font_color': '#808080', 'italic': True, 'align': 'center', 'valign': 'vcenter'
-    })
-    integer_format = workbook.add_format({'num_format': '#,##0', 'align': 'center'})
-    decimal_format = workbook.add_format({'num_format': '#,##0.00', 'align': 'right'})
-    text_center_format = workbook.add_format({'align': 'center'})
-    text_left_format = workbook.add_format({'align': 'left'})
-
-    # Write headers to the main sheet
-    for col_num, value in enumerate(df.columns.values):
-        is_read_only_col = '(ห้ามแก้ไข)' in value or '(ระบบ)' in value or '(URL ระบบ)' in value
-        current_header_format = read_only_header_format if is_read_only_col else header_format
-        worksheet.write(0, col_num, value, current_header_format)
-
-        # Set initial column widths
-        max_len = max(df[value].astype(str).apply(len).max(), len(value)) + 2
-
-        if value == 'ชื่ออะไหล่':
-            worksheet.set_column(col_num, col_num, max(max_len, 25), text_left_format)
-        elif value == 'Part Number':
-            worksheet.set_column(col_num, col_num, max(max_len, 15), text_center_format)
-        elif value == 'ยี่ห้อ':
-            worksheet.set_column(col_num, col_num, max(max_len, 15), text_left_format)
-        elif value == 'หมวดหมู่':
-            worksheet.set_column(col_num, col_num, max(max_len, 20), text_left_format)
-        elif value == 'คำอธิบาย':
-            worksheet.set_column(col_num, col_num, max(max_len, 30), text_left_format)
-        elif value == 'สต็อก':
-            worksheet.set_column(col_num, col_num, max(max_len, 10), integer_format)
-        elif value in ['ทุน', 'ราคาขายปลีก', 'ราคาส่ง 1', 'ราคาส่ง 2', 'ทุน Online']:
-            worksheet.set_column(col_num, col_num, max(max_len, 12), decimal_format)
-        elif is_read_only_col:
-            worksheet.set_column(col_num, col_num, max(max_len, 25), read_only_cell_format)
-            if value in ['ID (ห้ามแก้ไข)', 'Barcode ID (ระบบ)', 'ID หมวดหมู่ (ระบบ)', 'ไฟล์รูปภาพ (URL ระบบ)']:
-                worksheet.set_column(col_num, col_num, None, None, {'hidden': True})
-        else:
-            worksheet.set_column(col_num, col_num, max_len)
-
-    # Write data rows with blank rows between categories for Spare Parts
-    current_row = 1
-    last_category = None
-
-    for index, row_data in df.iterrows():
-        current_category = row_data['หมวดหมู่']
-        if last_category is not None and current_category != last_category:
-            current_row += 1 # Add a blank row between categories
-
-        for col_num, col_name in enumerate(df.columns.values):
-            cell_value = row_data[col_name]
-            cell_format = None
-
-            is_read_only_col = '(ห้ามแก้ไข)' in col_name or '(ระบบ)' in col_name or '(URL ระบบ)' in col_name
-
-            if is_read_only_col:
-                cell_format = read_only_cell_format
-            elif col_name == 'สต็อก':
-                cell_format = integer_format
-            elif col_name in ['ทุน', 'ราคาขายปลีก', 'ราคาส่ง 1', 'ราคาส่ง 2', 'ทุน Online']:
-                cell_format = decimal_format
-            elif col_name in ['ชื่ออะไหล่', 'คำอธิบาย', 'ยี่ห้อ', 'หมวดหมู่']:
-                cell_format = text_left_format
-            elif col_name == 'Part Number':
-                cell_format = text_center_format
-
-
-            # Handle NaN values by writing None instead of np.nan
-            if pd.isna(cell_value):
-                worksheet.write(current_row, col_num, None, cell_format) # Write None to produce a blank cell
-            else:
-                worksheet.write(current_row, col_num, cell_value, cell_format)
-        current_row += 1
-        last_category = current_category
-
-    # --- Add Freeze Panes ---
-    worksheet.freeze_panes(1, 0) # Freeze the first row (headers)
-
-    writer.close()
-    output.seek(0)
-
-    return send_file(output, download_name='spare_parts_stock_template.xlsx', as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return _export_items('spare_part')
 
 
 @bp.route('/import_spare_parts_action', methods=['POST'])
 @login_required
 def import_spare_parts_action():
-    if not current_user.can_edit():
-        flash('คุณไม่มีสิทธิ์ในการนำเข้าข้อมูลอะไหล่', 'danger')
-        return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
-    if 'file' not in request.files:
-        flash('ไม่พบไฟล์ที่อัปโหลด', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
-    file = request.files['file']
-
-    if file.filename == '':
-        flash('ไม่ได้เลือกไฟล์', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
-    if file and allowed_excel_file(file.filename):
-        try:
-            xls = pd.ExcelFile(file)
-            if 'Spare Parts Data' not in xls.sheet_names:
-                flash('ไม่พบชีทชื่อ "Spare Parts Data" ในไฟล์. โปรดตรวจสอบว่าคุณใช้ไฟล์แม่แบบที่ถูกต้อง', 'danger')
-                conn.rollback()
-                return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
-            df = xls.parse('Spare Parts Data', dtype={'Barcode ID (ระบบ)': str})
-
-            conn = get_db()
-            imported_count = 0
-            updated_count = 0
-            error_rows = []
-
-            # Expected column names now match the export format
-            expected_spare_part_cols = [
-                'ชื่ออะไหล่', 'Part Number', 'ยี่ห้อ', 'หมวดหมู่', 'คำอธิบาย', 'สต็อก',
-                'ทุน', 'ราคาขายปลีก', 'ราคาส่ง 1', 'ราคาส่ง 2', 'ทุน Online'
-            ]
-
-            # Check if all required columns are present
-            if not all(col in df.columns for col in expected_spare_part_cols):
-                missing_cols = [col for col in expected_spare_part_cols if col not in df.columns]
-                flash(f'ไฟล์ Excel ขาดคอลัมน์ที่จำเป็น: {", ".join(missing_cols)}. โปรดดาวน์โหลดไฟล์ตัวอย่างเพื่อดูรูปแบบที่ถูกต้อง.', 'danger')
-                conn.rollback()
-                return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
-            # Cache categories for faster lookup
-            cached_categories = {cat['name'].lower(): cat['id'] for cat in database.get_all_spare_part_categories(conn)}
-            # Also need reverse lookup for id to name if category_id is provided directly but name is preferred for error messages
-            cached_category_names = {cat['id']: cat['name'] for cat in database.get_all_spare_part_categories(conn)}
-
-
-            for index, row in df.iterrows():
-                # Skip blank rows
-                if pd.isna(row.get('ชื่ออะไหล่')) and \
-                   pd.isna(row.get('สต็อก')) and \
-                   pd.isna(row.get('ราคาขายปลีก')):
-                    error_rows.append(f"แถวที่ {index + 2}: ข้อมูลหลัก (ชื่ออะไหล่, สต็อก, ราคาขายปลีก) ว่างเปล่า. แถวถูกข้าม.")
-                    continue
-
-                try:
-                    spare_part_id_from_excel = int(row.get('ID (ห้ามแก้ไข)')) if pd.notna(row.get('ID (ห้ามแก้ไข)')) else None
-                    barcode_id_from_excel = str(row.get('Barcode ID (ระบบ)', '')).strip()
-                    category_id_from_excel_raw = row.get('ID หมวดหมู่ (ระบบ)') # From system
-                    category_name_from_excel = str(row.get('หมวดหมู่', '')).strip().lower() # From user input
-
-                    barcode_id_to_save = None
-                    if barcode_id_from_excel and barcode_id_from_excel.lower() not in ['none', 'nan']:
-                        barcode_id_to_save = barcode_id_from_excel
-
-                    name = str(row.get('ชื่ออะไหล่', '')).strip()
-                    part_number = str(row.get('Part Number', '')).strip()
-                    brand = str(row.get('ยี่ห้อ', '')).strip().lower()
-                    description = str(row.get('คำอธิบาย', '')).strip()
-                    quantity = int(row['สต็อก']) if pd.notna(row['สต็อก']) else 0
-                    retail_price_raw = row.get('ราคาขายปลีก')
-                    cost_raw = row.get('ทุน')
-                    wholesale_price1_raw = row.get('ราคาส่ง 1')
-                    wholesale_price2_raw = row.get('ราคาส่ง 2')
-                    cost_online_raw = row.get('ทุน Online')
-
-                    if not name or pd.isna(retail_price_raw):
-                         raise ValueError("ข้อมูล 'ชื่ออะไหล่' หรือ 'ราคาขายปลีก' ไม่สามารถเว้นว่างได้")
-
-                    # Resolve category_id
-                    category_id_to_use = None
-                    if pd.notna(category_id_from_excel_raw):
-                        try:
-                            category_id_to_use = int(category_id_from_excel_raw)
-                            # Verify if ID matches name for consistency, or just use ID if provided by system
-                            if category_id_to_use not in cached_category_names:
-                                raise ValueError(f"ID หมวดหมู่ (ระบบ) '{category_id_to_use}' ไม่ถูกต้องหรือไม่มีในระบบ")
-                        except ValueError:
-                            raise ValueError(f"ID หมวดหมู่ (ระบบ) '{category_id_from_excel_raw}' ไม่ใช่ตัวเลขที่ถูกต้อง")
-                    elif category_name_from_excel:
-                        category_id_to_use = cached_categories.get(category_name_from_excel)
-                        if category_id_to_use is None:
-                            raise ValueError(f"หมวดหมู่ '{category_name_from_excel}' ไม่มีในระบบ. โปรดสร้างหมวดหมู่นี้ก่อน หรือใช้หมวดหมู่ที่มีอยู่แล้ว.")
-
-                    try:
-                        retail_price = float(retail_price_raw)
-                        cost = float(cost_raw) if pd.notna(cost_raw) else None
-                        wholesale_price1 = float(wholesale_price1_raw) if pd.notna(wholesale_price1_raw) else None
-                        wholesale_price2 = float(wholesale_price2_raw) if pd.notna(wholesale_price2_raw) else None
-                        cost_online = float(cost_online_raw) if pd.notna(cost_online_raw) else None
-                    except ValueError as ve:
-                        raise ValueError(f"ข้อมูลตัวเลขไม่ถูกต้องในคอลัมน์ราคาหรือทุน: {ve}")
-
-                    cursor = conn.cursor()
-                    is_postgres = "psycopg2" in str(type(conn))
-
-                    existing_spare_part = None
-                    if spare_part_id_from_excel:
-                        existing_spare_part = database.get_spare_part(conn, spare_part_id_from_excel)
-
-                    if not existing_spare_part and barcode_id_to_save:
-                        existing_spare_part_id_by_barcode = database.get_spare_part_id_by_barcode(conn, barcode_id_to_save)
-                        if existing_spare_part_id_by_barcode:
-                            conn.rollback()
-                            existing_spare_part = database.get_spare_part(conn, existing_spare_part_id_by_barcode)
-                            if existing_spare_part and existing_spare_part['id'] != spare_part_id_from_excel and spare_part_id_from_excel is not None:
-                                raise ValueError(f"ID ({spare_part_id_from_excel}) ใน Excel ไม่ตรงกับ ID ที่พบจาก Barcode ({existing_spare_part_id_by_barcode}).")
-                        # Check against tires and wheels too
-                        if database.get_tire_id_by_barcode(conn, barcode_id_to_save):
-                            raise ValueError(f"Barcode ID '{barcode_id_to_save}' ซ้ำกับยาง. Barcode ID ต้องไม่ซ้ำกันข้ามประเภทสินค้า.")
-                        if database.get_wheel_id_by_barcode(conn, barcode_id_to_save):
-                            raise ValueError(f"Barcode ID '{barcode_id_to_save}' ซ้ำกับล้อแม็ก. Barcode ID ต้องไม่ซ้ำกันข้ามประเภทสินค้า.")
-
-
-                    # Try to find by name, part_number, and brand as last resort for existing item
-                    if not existing_spare_part:
-                        if part_number:
-                            if is_postgres:
-                                cursor.execute("SELECT id, quantity FROM spare_parts WHERE name = %s AND part_number = %s", (name, part_number))
-                            else:
-                                cursor.execute("SELECT id, quantity FROM spare_parts WHERE name = ? AND part_number = ?", (name, part_number))
-                        else: # Fallback to name and brand if no part number
-                            if is_postgres:
-                                cursor.execute("SELECT id, quantity FROM spare_parts WHERE name = %s AND brand = %s", (name, brand))
-                            else:
-                                cursor.execute("SELECT id, quantity FROM spare_parts WHERE name = ? AND brand = ?", (name, brand))
-
-                        found_spare_part_data = cursor.fetchone()
-                        if found_spare_part_data:
-                            existing_spare_part = dict(found_spare_part_data)
-                            if existing_spare_part and existing_spare_part['id'] != spare_part_id_from_excel and spare_part_id_from_excel is not None:
-                                raise ValueError(f"ID ({spare_part_id_from_excel}) ใน Excel ไม่ตรงกับสินค้าที่มีอยู่แล้วด้วย ชื่อ/Part Number/ยี่ห้อ ({existing_spare_part['id']}).")
-
-
-                    if existing_spare_part:
-                        spare_part_id = existing_spare_part['id']
-                        if barcode_id_to_save and not database.get_spare_part_id_by_barcode(conn, barcode_id_to_save):
-                            database.add_spare_part_barcode(conn, spare_part_id, barcode_id_to_save, is_primary=False)
-
-                        database.update_spare_part_import(conn, spare_part_id, name, part_number, brand, description,
-                                                           quantity, cost, retail_price, wholesale_price1, wholesale_price2,
-                                                           cost_online, row.get('ไฟล์รูปภาพ (URL ระบบ)'), category_id_to_use) # Use existing image URL from excel
-
-                        old_quantity = existing_spare_part['quantity']
-                        if quantity != old_quantity:
-                            movement_type = 'IN' if quantity > old_quantity else 'OUT'
-                            quantity_change_diff = abs(quantity - old_quantity)
-                            database.add_spare_part_movement(conn, spare_part_id, movement_type, quantity_change_diff, quantity, "Import from Excel (Qty Update)", None, user_id=current_user.id)
-                        updated_count += 1
-
-                    else: # New spare part
-                        new_spare_part_id = database.add_spare_part_import(conn, name, part_number, brand, description, quantity,
-                                                                            cost, retail_price, wholesale_price1, wholesale_price2,
-                                                                            cost_online, row.get('ไฟล์รูปภาพ (URL ระบบ)'), category_id_to_use)
-                        if barcode_id_to_save:
-                            database.add_spare_part_barcode(conn, new_spare_part_id, barcode_id_to_save, is_primary=True)
-                        database.add_spare_part_movement(conn, new_spare_part_id, 'IN', quantity, quantity, "Import from Excel (initial stock)", None, user_id=current_user.id)
-                        imported_count += 1
-
-                except Exception as row_e:
-                    error_rows.append(f"แถวที่ {index + 2}: {row_e} - {row.to_dict()}")
-
-            conn.commit()
-            cache.delete_memoized(get_all_spare_parts_cached)
-            cache.delete_memoized(get_cached_spare_part_brands)
-            cache.delete_memoized(get_cached_spare_part_categories_hierarchical) # New categories might be referenced
-            cache.delete_memoized(get_cached_unread_notification_count) # Notifications from movements
-
-            message = f'นำเข้าข้อมูลอะไหล่สำเร็จ: เพิ่มใหม่ {imported_count} รายการ, อัปเดต {updated_count} รายการ.'
-            if error_rows:
-                message += f' พบข้อผิดพลาดใน {len(error_rows)} แถว: {"; ".join(error_rows[:5])}{"..." if len(error_rows) > 5 else ""}'
-                flash(message, 'warning')
-            else:
-                flash(message, 'success')
-
-            return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
-        except Exception as e:
-            flash(f'เกิดข้อผิดพลาดร้ายแรงในการนำเข้าไฟล์ Excel ของอะไหล่: {e}', 'danger')
-            if 'db' in g and g.db is not None:
-                g.db.rollback()
-            return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-    else:
-        flash('ชนิดไฟล์ไม่ถูกต้อง อนุญาตเฉพาะ .xlsx และ .xls เท่านั้น', 'danger')
-        conn.rollback()
-        return redirect(url_for('stock.export_import', tab='spare_parts_excel'))
-
+    return _handle_excel_import('spare_part')
 
 # --- User management routes (assuming these are already in your app.py) ---
 @bp.route('/manage_users')
@@ -6049,6 +4699,13 @@ def admin_dashboard():
     # --- END: Logic ใหม่ ---
     return render_template('admin_dashboard.html', current_user=current_user)
 
+@bp.route('/admin/db_pool_stats')
+@login_required
+def db_pool_stats():
+    if not current_user.is_admin():
+        return jsonify({"error": "Permission denied"}), 403
+    return jsonify(database.get_pool_stats())
+
 @bp.route('/admin_deleted_items')
 @login_required
 def admin_deleted_items():
@@ -6084,7 +4741,7 @@ def restore_tire_action(tire_id):
         database.restore_tire(conn, tire_id)
         flash(f'กู้คืนยาง ID {tire_id} สำเร็จ!', 'success')
         conn.commit()
-        cache.delete_memoized(get_all_tires_list_cached)
+        catalog_cache.refresh_catalog_items('tire', [tire_id])
         cache.delete_memoized(get_cached_tire_brands)
     except Exception as e:
         flash(f'เกิดข้อผิดพลาดในการกู้คืนยาง: {e}', 'danger')
@@ -6104,7 +4761,7 @@ def restore_wheel_action(wheel_id):
         database.restore_wheel(conn, wheel_id)
         flash(f'กู้คืนแม็ก ID {wheel_id} สำเร็จ!', 'success')
         conn.commit()
-        cache.delete_memoized(get_all_wheels_list_cached)
+        catalog_cache.refresh_catalog_items('wheel', [wheel_id])
         cache.delete_memoized(get_cached_wheel_brands)
     except Exception as e:
         flash(f'เกิดข้อผิดพลาดในการกู้คืนแม็ก: {e}', 'danger')
@@ -6123,7 +4780,7 @@ def restore_spare_part_action(spare_part_id):
         database.restore_spare_part(conn, spare_part_id)
         flash(f'กู้คืนอะไหล่ ID {spare_part_id} สำเร็จ!', 'success')
         conn.commit()
-        cache.delete_memoized(get_all_spare_parts_cached)
+        catalog_cache.refresh_catalog_items('spare_part', [spare_part_id])
         cache.delete_memoized(get_cached_spare_part_brands)
     except Exception as e:
         flash(f'เกิดข้อผิดพลาดในการกู้คืนอะไหล่: {e}', 'danger')
@@ -6361,9 +5018,8 @@ def api_process_stock_transaction():
                 final_wholesale_customer_id = int(wholesale_customer_id_str)
             return_customer_type = None
         
-        # --- Process each item in the list ---
-        tires_moved, wheels_moved, spare_parts_moved = False, False, False
-
+        # --- ตัด/เพิ่มสต็อกทั้งตะกร้าใน transaction เดียว (สต็อกไม่พอจะ raise ValueError) ---
+        lines = []
         for item_data in items_to_process:
             item_id = item_data.get('id')
             item_type = item_data.get('item_type')
@@ -6371,48 +5027,18 @@ def api_process_stock_transaction():
 
             if not all([item_id, item_type, quantity_change, isinstance(quantity_change, int), quantity_change > 0]):
                 raise ValueError(f"ข้อมูลสินค้าไม่สมบูรณ์สำหรับรายการ ID: {item_id}")
+            lines.append((item_type, item_id, quantity_change))
 
-            if item_type == 'tire':
-                db_item = database.get_tire(conn, item_id)
-                update_quantity_func = database.update_tire_quantity
-                add_movement_func = database.add_tire_movement
-                tires_moved = True
-            elif item_type == 'wheel':
-                db_item = database.get_wheel(conn, item_id)
-                update_quantity_func = database.update_wheel_quantity
-                add_movement_func = database.add_wheel_movement
-                wheels_moved = True
-            elif item_type == 'spare_part':
-                db_item = database.get_spare_part(conn, item_id)
-                update_quantity_func = database.update_spare_part_quantity
-                add_movement_func = database.add_spare_part_movement
-                spare_parts_moved = True
-            else:
-                raise ValueError(f"ประเภทสินค้าไม่ถูกต้อง: {item_type}")
-
-            if not db_item:
-                raise ValueError(f"ไม่พบสินค้า ID {item_id} ประเภท {item_type} ในฐานข้อมูล")
-            
-            current_qty = db_item['quantity']
-            new_qty = current_qty
-            if transaction_type in ['IN', 'RETURN']:
-                new_qty += quantity_change
-            elif transaction_type == 'OUT':
-                if current_qty < quantity_change:
-                    item_name = db_item.get('name') or f"{db_item.get('brand')} {db_item.get('model')}"
-                    raise ValueError(f"สต็อกไม่พอสำหรับ {item_name} (มีอยู่: {current_qty}, ต้องการ: {quantity_change})")
-                new_qty -= quantity_change
-
-            update_quantity_func(conn, item_id, new_qty)
-            add_movement_func(conn, item_id, transaction_type, quantity_change, new_qty, notes, 
-                              bill_image_url_to_db, user_id, final_channel_id,
-                              final_online_platform_id, final_wholesale_customer_id, return_customer_type)
+        results = database.apply_stock_movements(conn, transaction_type, lines, notes,
+                                                 bill_image_url_to_db, user_id, final_channel_id,
+                                                 final_online_platform_id, final_wholesale_customer_id, return_customer_type)
+        moved_item_ids = defaultdict(set)
+        for result in results:
+            moved_item_ids[result['item_type']].add(result['item_id'])
 
         conn.commit()
-        if tires_moved: cache.delete_memoized(get_all_tires_list_cached)
-        if wheels_moved: cache.delete_memoized(get_all_wheels_list_cached)
-        if spare_parts_moved: 
-            cache.delete_memoized(get_all_spare_parts_cached)
+        for moved_type, item_ids in moved_item_ids.items():
+            catalog_cache.refresh_catalog_items(moved_type, item_ids)
         
         return jsonify({"success": True, "message": f"ทำรายการ {transaction_type} สำเร็จสำหรับ {len(items_to_process)} ประเภทสินค้า"}), 200
 
@@ -6431,87 +5057,19 @@ def api_search_items_for_link():
     if not query:
         return jsonify({"success": False, "message": "กรุณาใส่คำค้นหา"}), 400
 
-    conn = get_db()
-
-    cursor = conn.cursor() # Use cursor for all DB types for consistency with psycopg2.DictCursor
-
+    # ค้นหาจาก search index ในหน่วยความจำแทนการ query LIKE ทีละตาราง
     items = []
+    for tire in search_index.search_catalog('tire', query, limit=20):
+        items.append({'id': tire['id'], 'brand': tire['brand'], 'model': tire['model'], 'size': tire['size'],
+                      'current_quantity': tire['quantity'], 'type': 'tire'})
 
-    # Search in Tires
-    tire_search_query = f"""
-        SELECT id, brand, model, size, quantity AS current_quantity
-        FROM tires
-        WHERE is_deleted = FALSE AND (
-            LOWER(brand) LIKE %s OR
-            LOWER(model) LIKE %s OR
-            LOWER(size) LIKE %s
-        )
-        ORDER BY brand, model, size
-        LIMIT 20
-    """
-    if "psycopg2" in str(type(conn)):
-        cursor.execute(tire_search_query, (f"%{query}%", f"%{query}%", f"%{query}%"))
-    else:
-        tire_search_query_sqlite = tire_search_query.replace('%s', '?').replace('ILIKE', 'LIKE')
-        cursor.execute(tire_search_query_sqlite, (f"%{query}%", f"%{query}%", f"%{query}%"))
-
-    for row in cursor.fetchall():
-        item = dict(row)
-        item['type'] = 'tire'
-        items.append(item)
-
-    # Search in Wheels
-    wheel_size_search_col = "(w.diameter || 'x' || w.width || ' ' || w.pcd)"
-    if "psycopg2" in str(type(conn)):
-        wheel_size_search_col = "CONCAT(w.diameter, 'x', w.width, ' ', w.pcd)" # For PostgreSQL
-
-    wheel_search_query = f"""
-        SELECT id, brand, model, diameter, pcd, width, quantity AS current_quantity
-        FROM wheels w
-        WHERE is_deleted = FALSE AND (
-            LOWER(brand) LIKE %s OR
-            LOWER(model) LIKE %s OR
-            LOWER(pcd) LIKE %s OR
-            {wheel_size_search_col} LIKE %s
-        )
-        ORDER BY brand, model, diameter
-        LIMIT 20
-    """
-    if "psycopg2" in str(type(conn)):
-        cursor.execute(wheel_search_query, (f"%{query}%", f"%{query}%", f"%{query}%", f"%{query}%"))
-    else:
-        wheel_search_query_sqlite = wheel_search_query.replace('%s', '?').replace('ILIKE', 'LIKE')
-        cursor.execute(wheel_search_query_sqlite, (f"%{query}%", f"%{query}%", f"%{query}%", f"%{query}%"))
-
-    for row in cursor.fetchall():
-        item = dict(row)
-        item['type'] = 'wheel'
-        items.append(item)
-
-    # NEW: Search in Spare Parts
-    spare_part_search_query = f"""
-        SELECT sp.id, sp.name, sp.part_number, sp.brand, sp.quantity AS current_quantity
-        FROM spare_parts sp
-        WHERE is_deleted = FALSE AND (
-            LOWER(sp.name) LIKE %s OR
-            LOWER(sp.part_number) LIKE %s OR
-            LOWER(sp.brand) LIKE %s
-        )
-        ORDER BY sp.name, sp.brand
-        LIMIT 20
-    """
-    if "psycopg2" in str(type(conn)):
-        cursor.execute(spare_part_search_query, (f"%{query}%", f"%{query}%", f"%{query}%"))
-    else:
-        spare_part_search_query_sqlite = spare_part_search_query.replace('%s', '?').replace('ILIKE', 'LIKE')
-        cursor.execute(spare_part_search_query_sqlite, (f"%{query}%", f"%{query}%", f"%{query}%"))
+    for wheel in search_index.search_catalog('wheel', query, limit=20):
+        items.append({'id': wheel['id'], 'brand': wheel['brand'], 'model': wheel['model'], 'diameter': wheel['diameter'],
+                      'pcd': wheel['pcd'], 'width': wheel['width'], 'current_quantity': wheel['quantity'], 'type': 'wheel'})
 
-    for row in cursor.fetchall():
-        item = dict(row)
-        item['type'] = 'spare_part'
-        items.append(item)
-
-    cursor.close()
+    for part in search_index.search_catalog('spare_part', query, limit=20):
+        items.append({'id': part['id'], 'name': part['name'], 'part_number': part['part_number'], 'brand': part['brand'],
+                      'current_quantity': part['quantity'], 'type': 'spare_part'})
 
     return jsonify({"success": True, "items": items}), 200
 
@@ -6609,7 +5167,7 @@ def edit_wholesale_customer(customer_id):
     
     # Get customer data as a dictionary
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if database.is_postgres_conn(conn):
         cursor.execute("SELECT id, name FROM wholesale_customers WHERE id = %s", (customer_id,))
     else:
         cursor.execute("SELECT id, name FROM wholesale_customers WHERE id = ?", (customer_id,))
@@ -6631,7 +5189,7 @@ def edit_wholesale_customer(customer_id):
                 # Assuming you need a function to update customer name in database.py
                 # You might need to add a function like database.update_wholesale_customer_name
                 # For now, directly executing SQL
-                if "psycopg2" in str(type(conn)):
+                if database.is_postgres_conn(conn):
                     cursor.execute("UPDATE wholesale_customers SET name = %s WHERE id = %s", (new_name, customer_id))
                 else:
                     cursor.execute("UPDATE wholesale_customers SET name = ? WHERE id = ?", (new_name, customer_id))
@@ -6663,7 +5221,7 @@ def delete_wholesale_customer(customer_id):
         # Before deleting a customer, it's good practice to unlink any movements.
         # Setting wholesale_customer_id to NULL in related movements
         cursor = conn.cursor()
-        is_postgres = "psycopg2" in str(type(conn))
+        is_postgres = database.is_postgres_conn(conn)
 
         if is_postgres:
             cursor.execute("UPDATE tire_movements SET wholesale_customer_id = NULL WHERE wholesale_customer_id = %s", (customer_id,))
@@ -6699,8 +5257,35 @@ def fix_history():
             # --- START: ส่วนที่แก้ไข ---
             # ตรวจสอบว่าผู้ใช้กดปุ่มไหน
             if 'recalculate_stock' in request.form:
-                result = database.recalculate_all_stock_histories(conn)
-                flash(f'ซ่อมแซมข้อมูลประวัติสต็อกทั้งหมดสำเร็จ! ({result})', 'success')
+                item_type = request.form.get('scope_item_type', 'all')
+                item_id = request.form.get('scope_item_id', type=int)
+                start_date_str = request.form.get('scope_start_date')
+                end_date_str = request.form.get('scope_end_date')
+
+                if item_type not in ('all', 'tire', 'wheel', 'spare_part'):
+                    raise ValueError("ประเภทสินค้าไม่ถูกต้อง")
+                if item_id is not None and item_type == 'all':
+                    raise ValueError("กรุณาเลือกประเภทสินค้าเมื่อระบุรหัสสินค้า")
+                start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date() if start_date_str else None
+                end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date() if end_date_str else None
+
+                progress_messages = []
+                def report_progress(message):
+                    print(f"FIX HISTORY: {message}")
+                    progress_messages.append(message)
+
+                result = database.recalculate_all_stock_histories(
+                    conn,
+                    item_types=None if item_type == 'all' else [item_type],
+                    item_id=item_id,
+                    start_date=start_date,
+                    end_date=end_date,
+                    progress=report_progress
+                )
+                total_updated = sum(result['updated_rows'].values())
+                flash(f"ซ่อมแซมข้อมูลประวัติสต็อกสำเร็จ! แก้ไข {total_updated} รายการ ใช้เวลา {result['elapsed_seconds']:.2f} วินาที", 'success')
+                for message in progress_messages:
+                    flash(message, 'info')
             
             elif 'fix_commissions' in request.form:
                 fixed_count = database.fix_historical_commission_data(conn)
@@ -6730,7 +5315,6 @@ def mark_notifications_read():
     try:
         database.mark_all_notifications_as_read(conn)
         conn.commit()
-        cache.delete_memoized(get_cached_unread_notification_count)
     except Exception as e:
         conn.rollback()
     return redirect(url_for('stock.notifications'))
@@ -6799,80 +5383,38 @@ def bulk_stock_movement():
                 else:
                     return jsonify({"success": False, "message": "ชนิดไฟล์รูปภาพบิลไม่ถูกต้อง"}), 400
 
-        tires_moved, wheels_moved, spare_parts_moved = False, False, False
         items = json.loads(items_json)
-
-        # --- เริ่ม Transaction ---
-        for item_data in items:
-            item_id = item_data['id']
-            quantity_change = item_data['quantity']
-
-            item_name_for_notif = ""
-            unit_for_notif = ""
-
+        if item_type not in ('tire', 'wheel', 'spare_part'):
+            raise ValueError(f"ประเภทสินค้าไม่ถูกต้อง: {item_type}")
+
+        # --- ตัด/เพิ่มสต็อกทุกรายการใน transaction เดียว (สต็อกไม่พอจะ raise ValueError) ---
+        results = database.apply_stock_movements(conn, move_type, [(item_type, item_data['id'], item_data['quantity']) for item_data in items],
+                                                 notes, bill_image_url_to_db, user_id, final_channel_id,
+                                                 final_online_platform_id, final_wholesale_customer_id, return_customer_type)
+        moved_item_ids = set()
+        for result in results:
+            current_item = result['item']
             if item_type == 'tire':
-                tires_moved = True
-                current_item = database.get_tire(conn, item_id)
-                update_quantity_func = database.update_tire_quantity
-                add_movement_func = database.add_tire_movement
                 item_name_for_notif = f"ยาง: {current_item['brand'].title()} {current_item['model'].title()} ({current_item['size']})"
                 unit_for_notif = "เส้น"
             elif item_type == 'wheel':
-                wheels_moved = True
-                current_item = database.get_wheel(conn, item_id)
-                update_quantity_func = database.update_wheel_quantity
-                add_movement_func = database.add_wheel_movement
                 item_name_for_notif = f"แม็ก: {current_item['brand'].title()} {current_item['model'].title()}"
                 unit_for_notif = "วง"
-            elif item_type == 'spare_part': # NEW
-                spare_parts_moved = True
-                current_item = database.get_spare_part(conn, item_id)
-                update_quantity_func = database.update_spare_part_quantity
-                add_movement_func = database.add_spare_part_movement
-                item_name_for_notif = f"อะไหล่: {current_item['name']} ({current_item.get('brand', 'ไม่ระบุยี่ห้อ')})"
+            else:
+                item_name_for_notif = f"อะไหล่: {current_item['name']} ({current_item.get('brand') or 'ไม่ระบุยี่ห้อ'})"
                 unit_for_notif = "ชิ้น"
-
-            if not current_item:
-                raise ValueError(f"ไม่พบสินค้า ID {item_id} ในระบบ")
-
-            current_quantity = current_item['quantity']
-            new_quantity = current_quantity
-            if move_type in ['IN', 'RETURN']:
-                new_quantity += quantity_change
-            elif move_type == 'OUT':
-                if current_quantity < quantity_change:
-                    item_name = f"{current_item['brand']} {current_item['model']}"
-                    raise ValueError(f"สต็อกไม่พอสำหรับ {item_name} (มี: {current_quantity}, ต้องการ: {quantity_change})")
-                new_quantity -= quantity_change
-
-            update_quantity_func(conn, item_id, new_quantity)
-            add_movement_func(conn, item_id, move_type, quantity_change, new_quantity, notes, 
-                              bill_image_url_to_db, user_id, final_channel_id,
-                              final_online_platform_id, final_wholesale_customer_id, return_customer_type)
+            moved_item_ids.add(result['item_id'])
 
             message = (
                 f"สต็อก [{move_type}] {item_name_for_notif} "
-                f"จำนวน {quantity_change} {unit_for_notif} (คงเหลือ: {new_quantity}) "
+                f"จำนวน {result['quantity']} {unit_for_notif} (คงเหลือ: {result['remaining_quantity']}) "
                 f"โดย {current_user.username}"
             )
             database.add_notification(conn, message, user_id)
 
-        if tires_moved:
-            cache.delete_memoized(get_all_tires_list_cached)
-            print("--- CACHE CLEARED for Tires ---")
-
-        if wheels_moved:
-            cache.delete_memoized(get_all_wheels_list_cached)
-            print("--- CACHE CLEARED for Wheels ---")
-
-        if spare_parts_moved:
-            cache.delete_memoized(get_all_spare_parts_cached)
-            print("--- CACHE CLEARED for Spare Parts ---")
-
         conn.commit()
-        if tires_moved or wheels_moved or spare_parts_moved:
-            cache.delete_memoized(get_cached_unread_notification_count)
-            print("--- CACHE CLEARED for Unread Notification Count ---")
+        if moved_item_ids:
+            catalog_cache.refresh_catalog_items(item_type, moved_item_ids)
 
         return jsonify({"success": True, "message": f"บันทึกการทำรายการ {len(items)} รายการสำเร็จ!"})
 
@@ -7153,6 +5695,7 @@ def view_activity_logs():
         flash('คุณไม่มีสิทธิ์เข้าถึงหน้านี้', 'danger')
         return redirect(url_for('stock.index'))
 
+    activity_log.writer.flush() # เขียน log ที่ยังค้างใน queue ก่อน ให้หน้านี้เห็นรายการล่าสุด
     conn = get_db()
     
     page = request.args.get('page', 1, type=int)
@@ -7165,11 +5708,11 @@ def view_activity_logs():
 
     start_date = None
     if start_date_str:
-        start_date = BKK_TZ.localize(datetime.strptime(start_date_str, '%Y-%m-%d')).replace(hour=0, minute=0, second=0).isoformat()
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
     
     end_date = None
     if end_date_str:
-        end_date = BKK_TZ.localize(datetime.strptime(end_date_str, '%Y-%m-%d')).replace(hour=23, minute=59, second=59).isoformat()
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date() # database กรองถึงก่อนเริ่มวันถัดไป
 
     logs_raw = database.get_activity_logs(conn, limit=per_page, page=page, 
                                      start_date=start_date, end_date=end_date,
@@ -7282,7 +5825,7 @@ def reconciliation():
         return redirect(url_for('stock.index'))
 
     # --- UPGRADED QUERIES ---
-    is_psycopg2_conn = "psycopg2" in str(type(conn))
+    is_psycopg2_conn = database.is_postgres_conn(conn)
     sql_date_filter = report_date.strftime('%Y-%m-%d')
     placeholder = "%s" if is_psycopg2_conn else "?"
 
@@ -7407,6 +5950,7 @@ def api_correct_movement():
 
     try:
         conn = get_db()
+        moved_item_id = database.get_movement_item_id(conn, item_type, movement_id) if item_type in database.MOVEMENT_TABLES else None
         if item_type == 'tire':
             database.update_tire_movement(
                 conn, movement_id,
@@ -7444,12 +5988,8 @@ def api_correct_movement():
                 new_return_customer_type=data.get('return_customer_type')
             )
         conn.commit()
-        if item_type == 'tire':
-            cache.delete_memoized(get_all_tires_list_cached)
-        elif item_type == 'wheel':
-            cache.delete_memoized(get_all_wheels_list_cached)
-        elif item_type == 'spare_part':
-            cache.delete_memoized(get_all_spare_parts_cached)
+        if item_type in database.MOVEMENT_TABLES:
+            catalog_cache.refresh_catalog_items(item_type, [moved_item_id])
         return jsonify({"success": True, "message": "แก้ไขรายการสำเร็จ!"})
     except Exception as e:
         conn.rollback()
@@ -7513,66 +6053,22 @@ def api_search_all_items():
         # current_app.logger.debug("API Search All Items - Empty query, returning empty results.") # DEBUG
         return jsonify({'results': []})
 
-    conn = get_db()
-    search_term = f"%{query.lower()}%"
-    # current_app.logger.debug(f"API Search All Items - Search term: '{search_term}'") # DEBUG
-
-    is_postgres = "psycopg2" in str(type(conn))
-    placeholder = "%s" if is_postgres else "?"
-    like_op = "ILIKE" if is_postgres else "LIKE"
-
-    # For PostgreSQL, CONCAT is standard. For SQLite, use ||
-    # COALESCE handles NULL values, replacing them with empty strings for concatenation
-    wheel_size_search_col_sql = f"LOWER(COALESCE(w.diameter, '') || 'x' || COALESCE(w.width, '') || ' ' || COALESCE(w.pcd, '') || ' ET' || COALESCE(w.et, '') || ' ' || COALESCE(w.color, ''))"
-    if is_postgres:
-        wheel_size_search_col_sql = f"LOWER(CONCAT(w.diameter::TEXT, 'x', w.width::TEXT, ' ', COALESCE(w.pcd, ''), ' ET', COALESCE(w.et::TEXT, ''), ' ', COALESCE(w.color, '')))"
-
-
-    tire_query = f"""
-        SELECT t.id, t.brand, t.model, t.size, t.quantity AS current_quantity, 'tire' as item_type_str
-        FROM tires t
-        WHERE t.is_deleted = { 'FALSE' if is_postgres else '0' }
-        AND (LOWER(t.brand) {like_op} {placeholder} OR LOWER(t.model) {like_op} {placeholder} OR LOWER(t.size) {like_op} {placeholder})
-        LIMIT 30
-    """
-
-    # For wheels, explicitly select all relevant columns for formatting in Python
-    wheel_query = f"""
-        SELECT w.id, w.brand, w.model, w.diameter, w.pcd, w.width, w.et, w.color, w.quantity AS current_quantity, 'wheel' as item_type_str
-        FROM wheels w
-        WHERE w.is_deleted = { 'FALSE' if is_postgres else '0' }
-        AND (LOWER(w.brand) {like_op} {placeholder} OR LOWER(w.model) {like_op} {placeholder} OR LOWER(w.pcd) {like_op} {placeholder} OR {wheel_size_search_col_sql} {like_op} {placeholder})
-        LIMIT 30
-    """
-
-    # For spare parts, select all relevant original column names
-    spare_part_query = f"""
-        SELECT sp.id, sp.name, sp.part_number, sp.brand, sp.quantity AS current_quantity, 'spare_part' as item_type_str
-        FROM spare_parts sp
-        WHERE sp.is_deleted = { 'FALSE' if is_postgres else '0' }
-        AND (LOWER(sp.name) {like_op} {placeholder} OR LOWER(sp.part_number) {like_op} {placeholder} OR LOWER(sp.brand) {like_op} {placeholder})
-        LIMIT 30
-    """
-
     results_raw = []
     try:
-        cursor = conn.cursor()
-
-        cursor.execute(tire_query, (search_term, search_term, search_term))
-        results_raw.extend([dict(row) for row in cursor.fetchall()])
-        # current_app.logger.debug(f"API Search All Items - Tire results count: {len(results_raw) - len(results_raw_before_tire)}") # DEBUG
+        # ค้นหาจาก search index ในหน่วยความจำ (ไม่ต้อง query LIKE ทุกครั้งที่พิมพ์)
+        for tire in search_index.search_catalog('tire', query, limit=30):
+            results_raw.append({'id': tire['id'], 'brand': tire['brand'], 'model': tire['model'], 'size': tire['size'],
+                                'current_quantity': tire['quantity'], 'item_type_str': 'tire'})
 
-        results_raw_before_wheel = len(results_raw)
-        cursor.execute(wheel_query, (search_term, search_term, search_term, search_term))
-        results_raw.extend([dict(row) for row in cursor.fetchall()])
-        # current_app.logger.debug(f"API Search All Items - Wheel results count: {len(results_raw) - results_raw_before_wheel}") # DEBUG
+        for wheel in search_index.search_catalog('wheel', query, limit=30):
+            results_raw.append({'id': wheel['id'], 'brand': wheel['brand'], 'model': wheel['model'],
+                                'diameter': wheel['diameter'], 'pcd': wheel['pcd'], 'width': wheel['width'],
+                                'et': wheel['et'], 'color': wheel['color'],
+                                'current_quantity': wheel['quantity'], 'item_type_str': 'wheel'})
 
-        results_raw_before_spare_part = len(results_raw)
-        cursor.execute(spare_part_query, (search_term, search_term, search_term))
-        results_raw.extend([dict(row) for row in cursor.fetchall()])
-        # current_app.logger.debug(f"API Search All Items - Spare Part results count: {len(results_raw) - results_raw_before_spare_part}") # DEBUG
-
-        cursor.close()
+        for part in search_index.search_catalog('spare_part', query, limit=30):
+            results_raw.append({'id': part['id'], 'name': part['name'], 'part_number': part['part_number'],
+                                'brand': part['brand'], 'current_quantity': part['quantity'], 'item_type_str': 'spare_part'})
 
         formatted_results = []
         for item in results_raw:
@@ -7761,7 +6257,7 @@ def edit_spare_part_category(category_id):
             conn.commit()
             flash(f'แก้ไขหมวดหมู่ "{new_name}" สำเร็จ!', 'success')
             cache.delete_memoized(get_cached_spare_part_categories_hierarchical)
-            cache.delete_memoized(get_all_spare_parts_cached)
+            catalog_cache.invalidate_catalog('spare_part')
         except ValueError as e:
             conn.rollback()
             flash(f'เกิดข้อผิดพลาด: {e}', 'danger')
@@ -7789,8 +6285,7 @@ def delete_spare_part_category(category_id):
         conn.commit()
         flash('ลบหมวดหมู่สำเร็จ!', 'success')
         cache.delete_memoized(get_cached_spare_part_categories_hierarchical)
-        cache.delete_memoized(get_all_spare_parts_cached)
-        cache.delete_memoized(get_cached_spare_parts)
+        catalog_cache.invalidate_catalog('spare_part')
     except ValueError as e:
         conn.rollback()
         flash(f'ไม่สามารถลบหมวดหมู่ได้: {e}', 'danger')
@@ -7807,7 +6302,7 @@ def delete_spare_part_category(category_id):
 def print_barcodes(item_type, item_id):
     if not current_user.can_edit():
         flash('คุณไม่มีสิทธิ์ในการพิมพ์บาร์โค้ด', 'danger')
-        return redirect(request.referrer or url_for('index'))
+        return redirect(request.referrer or url_for('stock.index'))
 
     conn = get_db()
     item_info = {}
@@ -7854,7 +6349,7 @@ def print_barcodes(item_type, item_id):
 
         if not barcode_strings_all:
             flash('สินค้านี้ยังไม่มีรหัสบาร์โค้ดให้พิมพ์', 'warning')
-            return redirect(request.referrer or url_for('index'))
+            return redirect(request.referrer or url_for('stock.index'))
 
         if request.method == 'POST':
             selected_barcodes = request.form.getlist('selected_barcodes')
@@ -7868,24 +6363,9 @@ def print_barcodes(item_type, item_id):
                                        presets=presets,
                                        is_printing=False)
 
-            barcodes_data = [] # สร้างรายการสำหรับ SVG
-            writer_options = {'module_height': 10.0, 'font_size': 10, 'text_distance': 3.0, 'quiet_zone': 2.0}
-            for bc_string in selected_barcodes:
-                code128 = barcode.get('code128', bc_string, writer=SVGWriter())
-                svg_buffer_barcode = BytesIO()
-                code128.write(svg_buffer_barcode, options=writer_options)
-                svg_string_barcode = svg_buffer_barcode.getvalue().decode('utf-8')
-
-                qr_img = qrcode.make(bc_string, image_factory=qrcode.image.svg.SvgPathImage, box_size=20)
-                svg_buffer_qr = BytesIO()
-                qr_img.save(svg_buffer_qr)
-                svg_string_qrcode = svg_buffer_qr.getvalue().decode('utf-8')
-
-                barcodes_data.append({
-                    'svg_barcode': svg_string_barcode,
-                    'svg_qrcode': svg_string_qrcode,
-                    'text': bc_string
-                })
+            # SVG มาจาก cache ของ barcode_renderer (template ใช้เฉพาะบาร์โค้ด จึงไม่สร้าง QR)
+            svgs = barcode_renderer.get_svgs('code128', selected_barcodes)
+            barcodes_data = [{'svg_barcode': svg, 'text': bc_string} for bc_string, svg in zip(selected_barcodes, svgs)]
 
             return render_template('print_barcodes.html',
                                    barcodes_all=barcode_strings_all,
@@ -7897,7 +6377,7 @@ def print_barcodes(item_type, item_id):
     except ValueError as e:
         flash(str(e), 'danger')
         conn.rollback()
-        return redirect(request.referrer or url_for('index'))
+        return redirect(request.referrer or url_for('stock.index'))
 
     # สำหรับ GET request (แสดงหน้าเลือก)
     return render_template('print_barcodes.html',
@@ -7907,11 +6387,95 @@ def print_barcodes(item_type, item_id):
                            presets=presets,
                            is_printing=False)
 
+MAX_LABELS_PER_SHEET = 2000
+
+def _label_name(item_type, item):
+    if item_type == 'tire':
+        return f"{item['brand'].title()} {item['model'].title()} {item['size']}"
+    if item_type == 'wheel':
+        return f"{item['brand'].title()} {item['model'].title()} {item['pcd']}"
+    return f"{item['name']} ({item.get('part_number') or ''})"
+
+@bp.route('/print_barcode_sheet', methods=['POST'])
+@login_required
+def print_barcode_sheet():
+    """
+    พิมพ์สติกเกอร์ของหลายสินค้า (เช่น ทั้งล็อตที่รับเข้า) เป็น PDF ไฟล์เดียวตาม label preset
+    items_json: [{"item_type": "tire", "id": 1, "quantity": 4, "barcode": "..."}] ไม่ระบุ barcode = ใช้บาร์โค้ดหลักของสินค้า
+    barcode ที่ระบุต้องเป็นบาร์โค้ดของสินค้านั้นในตารางบาร์โค้ด ไม่งั้นรายการนั้นจะถูกข้าม (เช่นเดียวกับสินค้าที่ถูกลบแล้ว)
+    """
+    if not current_user.can_edit():
+        flash('คุณไม่มีสิทธิ์ในการพิมพ์บาร์โค้ด', 'danger')
+        return redirect(request.referrer or url_for('stock.index'))
+
+    conn = get_db()
+    try:
+        entries = json.loads(request.form.get('items_json') or '[]')
+        preset_id = request.form.get('preset_id', type=int)
+        requested = [(entry['item_type'], int(entry['id']), max(int(entry.get('quantity', 1)), 0), entry.get('barcode'))
+                     for entry in entries]
+    except (TypeError, ValueError, KeyError):
+        flash('ข้อมูลรายการสติกเกอร์ไม่ถูกต้อง', 'danger')
+        return redirect(request.referrer or url_for('stock.index'))
+
+    if preset_id:
+        preset = database.get_label_preset(conn, preset_id)
+    else:
+        presets = database.get_all_label_presets(conn)
+        preset = dict(presets[0]) if presets else None
+    if not preset:
+        flash('ไม่พบโปรไฟล์การพิมพ์ กรุณาเพิ่มโปรไฟล์ก่อน', 'warning')
+        return redirect(request.referrer or url_for('stock.index'))
+
+    # ดึงข้อมูลสินค้าทีละประเภท (query เดียวต่อประเภท) แทนการดึงทีละรายการ
+    ids_by_type = defaultdict(set)
+    for item_type, item_id, _, _ in requested:
+        if item_type in database.ITEM_TABLES:
+            ids_by_type[item_type].add(item_id)
+    items_by_type = {item_type: database.get_label_items(conn, item_type, ids) for item_type, ids in ids_by_type.items()}
+    barcodes_by_type = {item_type: database.get_item_barcodes(conn, item_type, ids) for item_type, ids in ids_by_type.items()}
+
+    labels = []
+    skipped_count = 0
+    for item_type, item_id, quantity, barcode_string in requested:
+        item = items_by_type.get(item_type, {}).get(item_id)
+        if barcode_string:
+            # ไม่พิมพ์บาร์โค้ดที่ไม่ได้เป็นของสินค้านี้ (ป้องกันสติกเกอร์ชื่อ/ราคาสินค้าหนึ่งแต่สแกนได้อีกสินค้า)
+            if str(barcode_string) not in barcodes_by_type.get(item_type, {}).get(item_id, ()):
+                barcode_string = None
+        else:
+            barcode_string = item and item['primary_barcode']
+        if not item or not barcode_string:
+            skipped_count += 1
+            continue
+        label = {'name': _label_name(item_type, item), 'price': item['label_price'], 'barcode': str(barcode_string)}
+        labels.extend([label] * quantity)
+
+    if not labels:
+        flash('ไม่มีสติกเกอร์ที่พิมพ์ได้ (ไม่พบสินค้า สินค้าถูกลบแล้ว ยังไม่มีบาร์โค้ด หรือบาร์โค้ดไม่ใช่ของสินค้านั้น)', 'warning')
+        return redirect(request.referrer or url_for('stock.index'))
+    if len(labels) > MAX_LABELS_PER_SHEET:
+        flash(f'พิมพ์ได้ครั้งละไม่เกิน {MAX_LABELS_PER_SHEET} ดวง', 'warning')
+        return redirect(request.referrer or url_for('stock.index'))
+    if skipped_count:
+        print(f"WARNING: print_barcode_sheet skipped {skipped_count} entries (missing/deleted item, no barcode or a barcode of another item)")
+        flash(f'ข้ามสติกเกอร์ {skipped_count} รายการ (ไม่พบสินค้า สินค้าถูกลบแล้ว ยังไม่มีบาร์โค้ด หรือบาร์โค้ดไม่ใช่ของสินค้านั้น)', 'warning')
+
+    try:
+        pdf_bytes = pdf_renderer.get_pdf('label_sheet', labels, preset)
+    except pdf_renderer.PdfRenderBusy as e:
+        flash(str(e), 'warning')
+        return redirect(request.referrer or url_for('stock.index'))
+    if pdf_bytes is None:
+        flash('เกิดข้อผิดพลาดในการสร้าง PDF สติกเกอร์', 'danger')
+        return redirect(request.referrer or url_for('stock.index'))
+    return send_file(BytesIO(pdf_bytes), mimetype='application/pdf', as_attachment=False, download_name='barcode_labels.pdf')
+
 def add_tire_cost_history(conn, tire_id, old_cost, new_cost, user_id, notes=""):
     """บันทึกการเปลี่ยนแปลงราคาทุนของยาง"""
     changed_at = get_bkk_time().isoformat()
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = database.is_postgres_conn(conn)
     
     query = "INSERT INTO tire_cost_history (tire_id, changed_at, old_cost_sc, new_cost_sc, user_id, notes) VALUES (?, ?, ?, ?, ?, ?)"
     params = (tire_id, changed_at, old_cost, new_cost, user_id, notes)
@@ -7925,7 +6489,7 @@ def add_tire_cost_history(conn, tire_id, old_cost, new_cost, user_id, notes=""):
 def get_tire_cost_history(conn, tire_id):
     """ดึงประวัติการเปลี่ยนแปลงราคาทุนของยางที่ระบุ"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = database.is_postgres_conn(conn)
     
     query = """
         SELECT h.*, u.username
@@ -7984,7 +6548,7 @@ def api_update_tire_cost():
         conn.commit()
 
         # เคลียร์ Cache ที่เกี่ยวข้องเพื่อให้ข้อมูลหน้าเว็บอัปเดต
-        cache.delete_memoized(get_all_tires_list_cached)
+        catalog_cache.refresh_catalog_items('tire', [tire_id])
 
         return jsonify({"success": True, "message": "อัปเดตราคาทุนสำเร็จ"})
 
@@ -8020,7 +6584,7 @@ def api_update_tire_price():
     conn = get_db()
     try:
         # 4. อัปเดตข้อมูลในฐานข้อมูล (เนื่องจากเช็ค is_admin() แล้ว จึงไม่จำเป็นต้องเช็คสิทธิ์รายคอลัมน์อีก)
-        is_postgres = "psycopg2" in str(type(conn))
+        is_postgres = database.is_postgres_conn(conn)
         placeholder = "%s" if is_postgres else "?"
         
         cursor = conn.cursor()
@@ -8041,7 +6605,7 @@ def api_update_tire_price():
         conn.commit()
 
         # 5. เคลียร์ Cache เพื่อให้ข้อมูลหน้าเว็บอัปเดต
-        cache.delete_memoized(get_all_tires_list_cached)
+        catalog_cache.refresh_catalog_items('tire', [tire_id])
 
         return jsonify({"success": True, "message": "อัปเดตราคาสำเร็จ"})
 
@@ -8143,7 +6707,7 @@ def api_update_item_from_modal():
             
             # เคลียร์ Cache ที่เกี่ยวข้อง
             cache.delete_memoized(get_cached_tire_brands)
-            cache.delete_memoized(get_all_tires_list_cached)
+            catalog_cache.refresh_catalog_items('tire', [item_id])
 
         # --- Logic for Wheel (สามารถเพิ่มได้ในอนาคต) ---
         elif item_type == 'wheel':
@@ -8493,38 +7057,32 @@ def manage_label_presets():
     presets = [dict(row) for row in raw_presets]
     return render_template('manage_label_presets.html', presets=presets, current_user=current_user)
 
-def calculate_ean13_check_digit(number_str):
-    """คำนวณ Check Digit สำหรับ EAN-13"""
-    if not number_str.isdigit() or len(number_str) != 12:
-        raise ValueError("ต้องเป็นตัวเลข 12 หลักเท่านั้น")
-    
-    # ผลรวมเลขตำแหน่งคี่ (1, 3, 5, ...)
-    odd_sum = sum(int(digit) for digit in number_str[0::2])
-    # ผลรวมเลขตำแหน่งคู่ (2, 4, 6, ...)
-    even_sum = sum(int(digit) for digit in number_str[1::2])
-    
-    total_sum = odd_sum + (even_sum * 3)
-    
-    # หาเลขที่บวกแล้วจะครบ 10 พอดี
-    check_digit = (10 - (total_sum % 10)) % 10
-    return str(check_digit)
-
 @bp.route('/api/generate_unique_barcode/<item_type>') # Route ยังคงเดิม
 @login_required
 def api_generate_unique_barcode(item_type):
     try:
-        timestamp_part = get_bkk_time().strftime('%y%m%d%H%M%S') # YYMMDDHHMMSS -> 12 หลัก
-        unique_part = timestamp_part[3:] # เอา 9 ตัวหลัง
-        base_12_digits = f"885{unique_part}"
-        check_digit = calculate_ean13_check_digit(base_12_digits)
-        new_barcode = f"{base_12_digits}{check_digit}"
-
+        new_barcode = barcode_sequence.generate_barcodes(get_db())[0]
         return jsonify({"success": True, "new_barcode": new_barcode})
 
     except Exception as e:
         current_app.logger.error(f"Error generating unique EAN-13 barcode: {e}", exc_info=True)
         return jsonify({"success": False, "message": "เกิดข้อผิดพลาดในเซิร์ฟเวอร์"}), 500
 
+@bp.route('/api/generate_unique_barcodes/<item_type>')
+@login_required
+def api_generate_unique_barcodes(item_type):
+    """สร้างรหัส EAN-13 ใหม่หลายรหัสในครั้งเดียว (?count=N) สำหรับติดสติกเกอร์ทั้งล็อต"""
+    count = request.args.get('count', 1, type=int)
+    if not 1 <= count <= barcode_sequence.MAX_BARCODES_PER_REQUEST:
+        return jsonify({"success": False, "message": f"จำนวนต้องอยู่ระหว่าง 1 ถึง {barcode_sequence.MAX_BARCODES_PER_REQUEST}"}), 400
+    try:
+        new_barcodes = barcode_sequence.generate_barcodes(get_db(), count)
+        return jsonify({"success": True, "new_barcodes": new_barcodes})
+
+    except Exception as e:
+        current_app.logger.error(f"Error generating unique EAN-13 barcodes: {e}", exc_info=True)
+        return jsonify({"success": False, "message": "เกิดข้อผิดพลาดในเซิร์ฟเวอร์"}), 500
+
 @bp.route('/change_password/<int:user_id>', methods=['POST'])
 @login_required
 def change_password(user_id):
@@ -8568,9 +7126,8 @@ def get_tires_for_botnoi():
         return jsonify({"error": "Missing tire_query parameter"}), 400
     
     try:
-        conn = get_db()
-        # เรียกใช้ฟังก์ชันที่เราสร้างใน database.py
-        found_tires = database.find_tires(conn, tire_query)
+        # ค้นผ่าน tire_offers (cache ตามเบอร์ยาง) ตัวเดียวกับที่ webhook ใช้
+        found_tires = tire_offers.find_tire_offers(tire_query)
         
         # จัดรูปแบบผลลัพธ์ให้อยู่ใน JSON ที่บอทสามารถอ่านได้ง่าย
         if found_tires:
@@ -8601,6 +7158,13 @@ def product_analysis():
     end_date_str = request.args.get('end_date')
     search_query = request.args.get('search_query', '').strip()
     brand_filter = request.args.get('brand_filter', 'all').strip()
+    item_type_filter = request.args.get('item_type', 'tire').strip()
+    if item_type_filter == 'all':
+        item_types = tuple(database.ANALYSIS_ITEM_CONFIG)
+    elif item_type_filter in database.ANALYSIS_ITEM_CONFIG:
+        item_types = (item_type_filter,)
+    else:
+        item_type_filter, item_types = 'tire', ('tire',)
 
     try:
         end_date_filter = datetime.strptime(end_date_str, '%Y-%m-%d').date() if end_date_str else get_bkk_time().date()
@@ -8622,7 +7186,8 @@ def product_analysis():
             start_date=start_date_filter, 
             end_date=end_date_filter,
             search_query=search_query,
-            brand_filter=brand_filter
+            brand_filter=brand_filter,
+            item_types=item_types
         )
         
         total_visible_items = len(all_tire_recommendations)
@@ -8653,6 +7218,7 @@ def product_analysis():
                            end_date_filter=end_date_filter.strftime('%Y-%m-%d'),
                            search_query_filter=search_query,
                            brand_filter=brand_filter,
+                           item_type_filter=item_type_filter,
                            available_tire_brands=available_tire_brands,
                            total_visible_items=total_visible_items,
                            current_user=current_user)
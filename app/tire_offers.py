@@ -0,0 +1,141 @@
+# tire_offers.py
+# ค้นหายางตามเบอร์ (มีสต็อก) สำหรับแชทบอท ใช้ร่วมกันระหว่าง /api/tires และ Dialogflow webhook
+# - ค้นจากฐานข้อมูลใน process เดียวกัน แทนการให้ webhook ยิง HTTP กลับมาที่ /api/tires ของเซิร์ฟเวอร์ตัวเอง
+# - cache ตามเบอร์ยาง โดยมีเวอร์ชัน catalogue ของยางอยู่ใน key: การขาย/รับเข้า/แก้ไขยางที่ patch catalogue
+#   จะเพิ่มเวอร์ชัน ผลเดิมจึงไม่ถูกใช้อีก (ปล่อยให้หมดอายุเอง ไม่ต้องไล่ลบทีละเบอร์)
+# - ถ้าตั้ง TIRE_API_URL ไว้ และค้นในฐานข้อมูลไม่สำเร็จ จะถาม API ภายนอกแทน ผ่าน requests.Session (keep-alive) ที่มี timeout
+# - ตารางราคาขาย/กำไรของทุกรุ่นในเบอร์นั้นที่ 1, 2, 4 เส้น คำนวณครั้งเดียวด้วย NumPy และ cache ตามเบอร์ + เวอร์ชันเดียวกัน
+#   webhook อ่านราคาจากตารางนี้แทนการคำนวณทีละเส้นทีละจำนวนในทุกขั้นของบทสนทนา
+import os
+import re
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+import database
+from . import cache, catalog_cache, get_db
+
+TIRE_OFFER_CACHE_TIMEOUT = 300 # วินาที
+TIRE_API_URL = os.environ.get('TIRE_API_URL') # เช่น http://scstock.duckdns.org/api/tires (ไม่ตั้ง = ไม่มี fallback)
+TIRE_API_TIMEOUT = (3, 10) # (connect, read) วินาที
+
+# เงื่อนไขราคาขายออนไลน์: ราคาชุด 4 เส้น = ราคาต่อเส้น x 4 - 600, ซื้อ 1 หรือ 2 เส้น บวกเพิ่มเส้นละ 50
+PACK_QUANTITIES = (1, 2, 4)
+MIN_PROFIT_BY_QUANTITY = {1: 150, 2: 300, 4: 600}
+SET_DISCOUNT = 600
+PARTIAL_SET_MARKUP = 50 # ต่อเส้น
+COD_FEE_RATE = 0.01
+RIM_SIZE_PATTERN = re.compile(r'R(\d{2})')
+
+_session = None
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        session.headers['X-Api-Key'] = os.environ.get('API_SECRET_KEY') or ''
+        _session = session
+    return _session
+
+
+def _size_key(prefix, tire_size):
+    return f"{prefix}:{catalog_cache.get_catalog_version('tire')}:{''.join(tire_size.split()).upper()}"
+
+
+def find_tire_offers(tire_size):
+    """
+    ยางเบอร์ tire_size ที่มีสต็อก (id, brand, model, size, quantity, cost_sc, price_per_item) เรียงตามยี่ห้อ/รุ่น
+    ค้นในฐานข้อมูลไม่สำเร็จจะ raise ต่อ (ไม่ cache) ผลว่างที่ cache ไว้จึงหมายถึงไม่มีสต็อกจริงเท่านั้น
+    """
+    key = _size_key('tire_offers', tire_size)
+    tires = cache.get(key)
+    if tires is None:
+        tires = database.find_tires(get_db(), tire_size)
+        cache.set(key, tires, timeout=TIRE_OFFER_CACHE_TIMEOUT)
+    return tires
+
+
+def fetch_remote_tire_offers(tire_size):
+    """ถาม /api/tires ของเซิร์ฟเวอร์ที่ตั้งไว้ใน TIRE_API_URL (raise requests.exceptions.RequestException ถ้าไม่สำเร็จ)"""
+    response = _get_session().get(TIRE_API_URL, params={'tire_query': tire_size}, timeout=TIRE_API_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+    return (data.get('results') or []) if data.get('status') == 'success' else []
+
+
+def get_tire_offers(tire_size):
+    """ใช้ใน webhook: ค้นใน process ก่อน ถ้าฐานข้อมูลใช้ไม่ได้และมี TIRE_API_URL จึงถาม API ภายนอก"""
+    try:
+        return find_tire_offers(tire_size)
+    except Exception as e:
+        if not TIRE_API_URL:
+            raise
+        print(f"WARNING: In-process tire lookup failed ({e}), falling back to {TIRE_API_URL}")
+        try:
+            # PostgreSQL: ล้าง transaction ที่ error ค้างอยู่ ให้ request นี้ยังใช้ g.db ต่อได้
+            get_db().rollback()
+        except Exception:
+            pass
+        return fetch_remote_tire_offers(tire_size)
+
+
+def _float_array(values):
+    # ค่าที่ว่างหรือแปลงเป็นตัวเลขไม่ได้เป็น NaN (เทียบเงื่อนไขแล้วได้ False เสมอ)
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+    return np.array([to_float(value) for value in values], dtype=float)
+
+
+def _rim_size(tire_size):
+    match = RIM_SIZE_PATTERN.search(tire_size or '')
+    return int(match.group(1)) if match else 0
+
+
+def compute_offer_table(tires):
+    """
+    ราคาขายรวมของแต่ละรุ่นที่ 1, 2, 4 เส้น (None = สต็อกไม่พอหรือกำไรไม่ถึงเกณฑ์) คำนวณทุกแถวพร้อมกัน
+    คืน list ของ dict (id, brand, model, size, quantity, offers: {จำนวนเส้น: ราคารวม}) ไม่มีต้นทุนติดไปด้วย
+    """
+    if not tires:
+        return []
+    prices = _float_array(tire.get('price_per_item') for tire in tires)
+    costs = np.nan_to_num(_float_array(tire.get('cost_sc') for tire in tires), nan=0.0)
+    stock = np.nan_to_num(_float_array(tire.get('qty_balance', tire.get('quantity')) for tire in tires), nan=0.0)
+    rims = np.array([_rim_size(tire.get('size')) for tire in tires])
+    shipping = np.select([(rims >= 16) & (rims <= 20), rims == 15], [130, 100], default=0)
+
+    set_unit_price = (prices * 4 - SET_DISCOUNT) / 4
+    totals = {}
+    for quantity in PACK_QUANTITIES:
+        unit_price = set_unit_price if quantity == 4 else set_unit_price + PARTIAL_SET_MARKUP
+        total_price = unit_price * quantity
+        profit = total_price * (1 - COD_FEE_RATE) - (costs + shipping) * quantity
+        is_offered = (stock >= quantity) & (profit >= MIN_PROFIT_BY_QUANTITY[quantity])
+        totals[quantity] = np.where(is_offered, total_price, np.nan)
+
+    return [{
+        'id': tire.get('id'),
+        'brand': tire.get('brand'),
+        'model': (tire.get('model') or '').strip(),
+        'size': tire.get('size'),
+        'quantity': int(stock[index]),
+        'offers': {quantity: (None if np.isnan(totals[quantity][index]) else float(totals[quantity][index]))
+                   for quantity in PACK_QUANTITIES},
+    } for index, tire in enumerate(tires)]
+
+
+def get_offer_table(tire_size):
+    """ตารางราคาของเบอร์ tire_size จาก cache (key มีเวอร์ชัน catalogue ของยาง) หรือคำนวณใหม่"""
+    key = _size_key('tire_offer_table', tire_size)
+    table = cache.get(key)
+    if table is None:
+        table = compute_offer_table(get_tire_offers(tire_size))
+        cache.set(key, table, timeout=TIRE_OFFER_CACHE_TIMEOUT)
+    return table
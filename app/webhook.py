@@ -1,69 +1,21 @@
 from flask import Blueprint, request, jsonify, current_app
-import requests
-import re
-from app import api_key_required
-import database
-import json
+from app import api_key_required, dialogflow_sessions, tire_offers
 
 bp = Blueprint('webhook', __name__, url_prefix='/webhook')
 
-# --- ส่วนนี้ไม่ต้องแก้ไข ---
-TIRE_API_URL = "http://scstock.duckdns.org/api/tires"
-API_KEY = database.os.getenv("API_SECRET_KEY")
-
 def normalize_string(s):
     """Clean and normalize a string by removing all whitespace and converting to lowercase."""
     if not isinstance(s, str):
         return ""
     return ''.join(s.split()).lower()
 
-def check_stock_and_profit(tire, quantity_to_check):
-    try:
-        qty_balance = int(tire.get('qty_balance', 0))
-        if qty_balance < quantity_to_check:
-            return False, None
-
-        price_per_item = float(tire['price_per_item'])
-        cost_sc = float(tire['cost_sc']) if tire.get('cost_sc') is not None else 0.0
-        tire_size_str = tire.get('size', '')
-
-        rim_size_match = re.search(r'R(\d{2})', tire_size_str)
-        rim_size = int(rim_size_match.group(1)) if rim_size_match else 0
-
-        if 16 <= rim_size <= 20:
-            shipping_cost_per_tire = 130
-        elif rim_size == 15:
-            shipping_cost_per_tire = 100
-        else:
-            shipping_cost_per_tire = 0
-
-        base_price = (price_per_item * 4) - 600
-        if quantity_to_check == 1:
-            unit_sale_price = (base_price / 4) + 50
-        elif quantity_to_check == 2:
-            unit_sale_price = ((base_price / 2) + 100) / 2
-        elif quantity_to_check == 4:
-            unit_sale_price = base_price / 4
-        else:
-            unit_sale_price = (base_price / 4) + 50  # default กรณีอื่น
-
-        total_sale_price = unit_sale_price * quantity_to_check
-        cod_service_charge = total_sale_price * 0.01
-        total_cost = (cost_sc + shipping_cost_per_tire) * quantity_to_check
-
-        profit = total_sale_price - total_cost - cod_service_charge
-
-        # ✅ เช็คเกณฑ์ใหม่
-        if (quantity_to_check == 1 and profit >= 150) or \
-           (quantity_to_check == 2 and profit >= 300) or \
-           (quantity_to_check == 4 and profit >= 600):
-            return True, total_sale_price
-        else:
-            return False, None
+def find_context(dialogflow_request, context_name):
+    contexts = dialogflow_request.get('queryResult', {}).get('outputContexts', [])
+    return next((c for c in contexts if c['name'].endswith(f'/contexts/{context_name}')), None)
 
-    except (KeyError, ValueError, TypeError) as e:
-        current_app.logger.error(f"Error checking stock and profit for {tire.get('model')}: {e}")
-        return False, None
+def make_context(dialogflow_request, context_name, lifespan_count):
+    # สถานะจริงอยู่ใน dialogflow_sessions ส่ง context กลับไปแค่ให้ Dialogflow ใช้เลือก intent ถัดไป
+    return {"name": f"{dialogflow_request['session']}/contexts/{context_name}", "lifespanCount": lifespan_count}
 
 @api_key_required
 @bp.route('/dialogflow', methods=['POST'])
@@ -72,7 +24,7 @@ def handle_dialogflow_request():
     intent_name = req.get('queryResult', {}).get('intent', {}).get('displayName')
     
     current_app.logger.info(f"Received intent: {intent_name}")
-    current_app.logger.info(f"Full request: {json.dumps(req, indent=2)}")
+    current_app.logger.debug("Full request: %s", req) # format เฉพาะตอนเปิด debug log
 
     if intent_name == 'TirePriceCheck':
         return handle_tire_price_check(req)
@@ -99,24 +51,12 @@ def handle_tire_price_check(dialogflow_request):
         return jsonify({"fulfillmentText": "ขออภัยค่ะ ไม่พบข้อมูลเบอร์ยางที่ถูกต้อง"})
 
     try:
-        headers = {'X-Api-Key': API_KEY}
-        api_params = {'tire_query': tire_size}
-        response = requests.get(TIRE_API_URL, params=api_params, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-
-        if data.get('status') == 'success' and data.get('results'):
-            all_tires = data['results']
+        all_tires = tire_offers.get_offer_table(tire_size)
+
+        if all_tires:
             
-            # Filter tires to only show brands that have at least one profitable model with sufficient stock (for 4 tires as a standard)
-            profitable_and_in_stock_brands = set()
-            for tire in all_tires:
-                ok_1, _ = check_stock_and_profit(tire, 1)
-                ok_2, _ = check_stock_and_profit(tire, 2)
-                ok_4, _ = check_stock_and_profit(tire, 4)
-
-                if ok_1 or ok_2 or ok_4:
-                    profitable_and_in_stock_brands.add(tire['brand'])
+            # Filter tires to only show brands that have at least one profitable model with sufficient stock (1, 2 or 4 tires)
+            profitable_and_in_stock_brands = {tire['brand'] for tire in all_tires if any(price is not None for price in tire['offers'].values())}
             
             if not profitable_and_in_stock_brands:
                 return jsonify({"fulfillmentText": f"ขออภัยค่ะ ไม่พบยางเบอร์ {tire_size} ที่พร้อมจำหน่ายในสต็อกและทำกำไรได้ค่ะ"})
@@ -144,32 +84,34 @@ def handle_tire_price_check(dialogflow_request):
                 }
             ]
 
-            output_contexts = [{
-                "name": f"{dialogflow_request['session']}/contexts/tireinfo",
-                "lifespanCount": 5,
-                "parameters": {
-                    "tires_found": all_tires,
-                    "original_tire_size": tire_size
-                }
-            }]
+            # เริ่มบทสนทนาใหม่: เก็บแค่เบอร์ยางและ id ของยางที่พร้อมขาย (ราคาอ่านจากตารางราคาทุกครั้ง)
+            dialogflow_sessions.save_state(dialogflow_request['session'], {
+                'tire_size': tire_size,
+                'tire_ids': [tire['id'] for tire in all_tires if tire['brand'] in profitable_and_in_stock_brands],
+            })
+            output_contexts = [make_context(dialogflow_request, 'tireinfo', 5)]
             return jsonify({
                 "fulfillmentMessages": fulfillment_messages,
                 "outputContexts": output_contexts
             })
         else:
             return jsonify({"fulfillmentText": f"ขออภัยค่ะ ไม่พบยางเบอร์ {tire_size} ในสต็อกค่ะ"})
-    except requests.exceptions.RequestException as e:
-        current_app.logger.error(f"Webhook API call failed: {e}")
+    except Exception as e:
+        current_app.logger.error(f"Webhook tire lookup failed: {e}")
         return jsonify({"fulfillmentText": "ขออภัยค่ะ ระบบสต็อกขัดข้องชั่วคราว"})
 
+def get_offered_tires(state):
+    """ยางที่เคยเสนอในบทสนทนานี้ พร้อมราคา/สต็อกล่าสุดจากตารางราคาของเบอร์นั้น"""
+    tire_ids = set(state.get('tire_ids', []))
+    return [tire for tire in tire_offers.get_offer_table(state['tire_size']) if tire['id'] in tire_ids]
+
 def handle_brand_selection(dialogflow_request):
-    contexts = dialogflow_request.get('queryResult', {}).get('outputContexts', [])
-    tire_info_context = next((c for c in contexts if c['name'].endswith('/contexts/tireinfo')), None)
+    state = dialogflow_sessions.get_state(dialogflow_request['session'])
 
-    if not tire_info_context or 'parameters' not in tire_info_context or 'tires_found' not in tire_info_context['parameters']:
+    if not find_context(dialogflow_request, 'tireinfo') or not state.get('tire_size'):
         return jsonify({"fulfillmentText": "ขออภัยค่ะ ข้อมูลยางเดิมหายไป กรุณาเริ่มต้นค้นหาใหม่อีกครั้งค่ะ"})
 
-    all_tires = tire_info_context['parameters']['tires_found']
+    all_tires = get_offered_tires(state)
     parameters = dialogflow_request.get('queryResult', {}).get('parameters', {})
 
     selected_brand_param = parameters.get('brand_entity')
@@ -191,11 +133,11 @@ def handle_brand_selection(dialogflow_request):
     
     available_tires_for_context = []
     for tire in matching_tires:
-        is_profitable, total_price = check_stock_and_profit(tire, quantity)
-        if is_profitable:
+        total_price = tire['offers'].get(quantity)
+        if total_price is not None:
             available_tires_for_context.append({
                 "brand": tire.get('brand'),
-                "model": tire.get('model', '').strip(),
+                "model": tire.get('model', ''),
                 "size": tire.get('size'),
                 "quantity": quantity,
                 "total_price": total_price
@@ -213,22 +155,20 @@ def handle_brand_selection(dialogflow_request):
             f"ยังไม่มีรุ่นที่พร้อมจำหน่ายในขณะนี้ค่ะ"
         )
     
-    tire_info_context['parameters']['quantity_selected'] = quantity
-    tire_info_context['lifespanCount'] = 5
+    dialogflow_sessions.update_state(dialogflow_request['session'], quantity=quantity)
 
     return jsonify({
         "fulfillmentText": response_text,
-        "outputContexts": [tire_info_context]
+        "outputContexts": [make_context(dialogflow_request, 'tireinfo', 5)]
     })
 
 def handle_model_selection(dialogflow_request):
-    contexts = dialogflow_request.get('queryResult', {}).get('outputContexts', [])
-    tire_info_context = next((c for c in contexts if c['name'].endswith('/contexts/tireinfo')), None)
+    state = dialogflow_sessions.get_state(dialogflow_request['session'])
 
-    if not tire_info_context or 'parameters' not in tire_info_context or 'tires_found' not in tire_info_context['parameters']:
+    if not find_context(dialogflow_request, 'tireinfo') or not state.get('tire_size'):
         return jsonify({"fulfillmentText": "ขออภัยค่ะ ข้อมูลยางเดิมหายไป กรุณาเริ่มต้นค้นหาใหม่อีกครั้งค่ะ"})
 
-    tires_found = tire_info_context['parameters']['tires_found']
+    tires_found = get_offered_tires(state)
     parameters = dialogflow_request.get('queryResult', {}).get('parameters', {})
     
     selected_model_param = parameters.get('model_entity.original', parameters.get('model_entity', ''))
@@ -240,14 +180,15 @@ def handle_model_selection(dialogflow_request):
     if not matching_model:
         return jsonify({"fulfillmentText": f"ขออภัยค่ะ ไม่พบรุ่น {selected_model_param} ในรายการค่ะ"})
     
-    quantity = tire_info_context['parameters'].get('quantity_selected', 4)
+    quantity = state.get('quantity', 4)
 
-    is_profitable, total_price = check_stock_and_profit(matching_model, quantity)
+    total_price = matching_model['offers'].get(quantity)
 
-    if not is_profitable:
+    if total_price is None:
         return jsonify({"fulfillmentText": "ขออภัยค่ะ มีข้อผิดพลาดในการคำนวณราคาหรือสต็อกหมด กรุณาลองใหม่อีกครั้ง"})
 
     last_selection = {
+        "tire_id": matching_model['id'],
         "brand": matching_model.get('brand'),
         "model": matching_model.get('model'),
         "size": matching_model.get('size'),
@@ -255,8 +196,7 @@ def handle_model_selection(dialogflow_request):
         "total_price": total_price
     }
     
-    tire_info_context['parameters']['last_selection'] = last_selection
-    tire_info_context['lifespanCount'] = 5
+    dialogflow_sessions.update_state(dialogflow_request['session'], last_selection=last_selection)
 
     fulfillment_text = (
         f"คุณเลือกรุ่น {last_selection['model']} ({last_selection['size']}) จำนวน {last_selection['quantity']} เส้น "
@@ -266,21 +206,16 @@ def handle_model_selection(dialogflow_request):
 
     return jsonify({
         "fulfillmentText": fulfillment_text,
-        "outputContexts": [tire_info_context]
+        "outputContexts": [make_context(dialogflow_request, 'tireinfo', 5)]
     })
 
 def handle_order_confirmation(dialogflow_request):
-    contexts = dialogflow_request.get('queryResult', {}).get('outputContexts', [])
-    tire_info_context = next((c for c in contexts if c['name'].endswith('/contexts/tireinfo')), None)
+    state = dialogflow_sessions.get_state(dialogflow_request['session'])
 
-    if not tire_info_context or 'parameters' not in tire_info_context or 'last_selection' not in tire_info_context['parameters']:
+    if not find_context(dialogflow_request, 'tireinfo') or 'last_selection' not in state:
         return jsonify({"fulfillmentText": "ขออภัยค่ะ ไม่พบข้อมูลการสั่งซื้อล่าสุด กรุณาเลือกสินค้าอีกครั้งค่ะ"})
 
-    order_in_progress_context = {
-        "name": f"{dialogflow_request['session']}/contexts/order_in_progress",
-        "lifespanCount": 10,
-        "parameters": tire_info_context['parameters']
-    }
+    order_in_progress_context = make_context(dialogflow_request, 'order_in_progress', 10)
     
     fulfillment_text = "ได้รับคำยืนยันแล้วค่ะ! กรุณาแจ้งชื่อ, ที่อยู่, และเบอร์โทรศัพท์สำหรับจัดส่งสินค้าได้เลยค่ะ"
 
@@ -294,10 +229,9 @@ def handle_order_decline(dialogflow_request):
     return jsonify({"fulfillmentText": "รับทราบค่ะ หากต้องการค้นหายางใหม่แจ้งได้เลยนะคะ"})
 
 def handle_collect_customer_info(dialogflow_request):
-    contexts = dialogflow_request.get('queryResult', {}).get('outputContexts', [])
-    order_in_progress_context = next((c for c in contexts if c['name'].endswith('/contexts/order_in_progress')), None)
+    state = dialogflow_sessions.get_state(dialogflow_request['session'])
 
-    if not order_in_progress_context:
+    if not find_context(dialogflow_request, 'order_in_progress') or 'last_selection' not in state:
         return jsonify({"fulfillmentText": "ขออภัยค่ะ ข้อมูลการสั่งซื้อหายไป กรุณาเริ่มต้นใหม่อีกครั้ง"})
 
     parameters = dialogflow_request.get('queryResult', {}).get('parameters', {})
@@ -309,11 +243,10 @@ def handle_collect_customer_info(dialogflow_request):
     if not all([customer_name, address, phone_number]):
         return jsonify({"fulfillmentText": "ขออภัยค่ะ กรุณาแจ้งข้อมูล ชื่อ, ที่อยู่, และเบอร์โทรศัพท์ให้ครบถ้วนนะคะ"})
 
-    order_in_progress_context['parameters']['customer_name'] = customer_name
-    order_in_progress_context['parameters']['customer_address'] = address
-    order_in_progress_context['parameters']['customer_phone'] = phone_number
+    dialogflow_sessions.update_state(dialogflow_request['session'], customer_name=customer_name,
+                                     customer_address=address, customer_phone=phone_number)
     
-    last_selection = order_in_progress_context['parameters']['last_selection']
+    last_selection = state['last_selection']
     
     order_summary_text = (
         f"--- สรุปรายการสั่งซื้อ ---\n"
@@ -333,25 +266,22 @@ def handle_collect_customer_info(dialogflow_request):
         f"หากข้อมูลถูกต้องทั้งหมด สามารถยืนยันคำสั่งซื้อได้เลยค่ะ"
     )
 
-    order_in_progress_context['lifespanCount'] = 10
-    
     return jsonify({
         "fulfillmentText": fulfillment_text,
-        "outputContexts": [order_in_progress_context]
+        "outputContexts": [make_context(dialogflow_request, 'order_in_progress', 10)]
     })
     
 def handle_final_summary(dialogflow_request):
     """Finalizes the order and notifies the admin."""
-    contexts = dialogflow_request.get('queryResult', {}).get('outputContexts', [])
-    order_in_progress_context = next((c for c in contexts if c['name'].endswith('/contexts/order_in_progress')), None)
+    state = dialogflow_sessions.get_state(dialogflow_request['session'])
     
-    if not order_in_progress_context or 'customer_name' not in order_in_progress_context['parameters']:
+    if not find_context(dialogflow_request, 'order_in_progress') or 'customer_name' not in state:
         return jsonify({"fulfillmentText": "ขออภัยค่ะ ไม่พบข้อมูลการสั่งซื้อล่าสุด กรุณาเริ่มต้นใหม่อีกครั้ง"})
     
-    last_selection = order_in_progress_context['parameters']['last_selection']
-    customer_name = order_in_progress_context['parameters']['customer_name']
-    customer_address = order_in_progress_context['parameters']['customer_address']
-    customer_phone = order_in_progress_context['parameters']['customer_phone']
+    last_selection = state['last_selection']
+    customer_name = state['customer_name']
+    customer_address = state['customer_address']
+    customer_phone = state['customer_phone']
     
     final_summary_text = (
         f"--- สรุปคำสั่งซื้อสุดท้าย ---\n"
@@ -370,9 +300,9 @@ def handle_final_summary(dialogflow_request):
         f"เดี๋ยวแอดมินจะรีบติดต่อกลับเพื่อยืนยันการจัดส่งอีกครั้งนะคะ ขอบคุณที่ใช้บริการค่ะ"
     )
     
-    order_in_progress_context['lifespanCount'] = 0
+    dialogflow_sessions.clear_state(dialogflow_request['session'])
     
     return jsonify({
         "fulfillmentText": fulfillment_text,
-        "outputContexts": [order_in_progress_context]
+        "outputContexts": [make_context(dialogflow_request, 'order_in_progress', 0)]
     })
\ No newline at end of file
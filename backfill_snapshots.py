@@ -0,0 +1,29 @@
+import sys
+import time
+import database
+from dotenv import load_dotenv
+
+load_dotenv() # Load environment variables for local testing
+
+# สร้างตาราง daily_stock_snapshots ใหม่ทั้งหมดจากตาราง movement
+# ใช้ครั้งแรกหลัง deploy และเมื่อต้องการซ่อมข้อมูล snapshot (ควรรันช่วงที่ไม่มีการขาย/รับสินค้า)
+# ตัวอย่าง: python backfill_snapshots.py            -> ทุกประเภทสินค้า
+#          python backfill_snapshots.py tire wheel -> เฉพาะประเภทที่ระบุ
+item_types = sys.argv[1:] or None
+unknown_types = [item_type for item_type in (item_types or []) if item_type not in database.MOVEMENT_TABLES]
+if unknown_types:
+    sys.exit(f"Unknown item type(s): {', '.join(unknown_types)}. Use: {', '.join(database.MOVEMENT_TABLES)}")
+
+conn = database.get_db_connection()
+try:
+    print(f"Rebuilding daily stock snapshots ({'all item types' if not item_types else ', '.join(item_types)})...")
+    started_at = time.monotonic()
+    total_rows = database.rebuild_daily_stock_snapshots(conn, item_types=item_types)
+    conn.commit()
+    print(f"Done. {total_rows} snapshot rows written in {time.monotonic() - started_at:.1f}s.")
+except Exception as e:
+    print(f"Error during snapshot backfill: {e}")
+    conn.rollback()
+    raise
+finally:
+    database.release_db_connection(conn)
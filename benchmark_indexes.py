@@ -0,0 +1,94 @@
+import sys
+import time
+from datetime import timedelta
+import database
+from dotenv import load_dotenv
+
+load_dotenv() # Load environment variables for local testing
+
+# เปรียบเทียบ query plan / เวลา ของ query รายงานหลัก ก่อนและหลังมี index จาก migration 2 (movement tables)
+# ทำทั้งหมดใน transaction เดียว: วัดแบบมี index -> DROP index ชั่วคราว -> วัดอีกครั้ง -> ROLLBACK (ไม่มีอะไรเปลี่ยนในฐานข้อมูล)
+# บน PostgreSQL การ DROP INDEX จะล็อกตาราง movement ระหว่างรัน ควรรันช่วงที่ไม่มีการขาย/รับสินค้า
+# ตัวอย่าง: python benchmark_indexes.py        -> รันแต่ละ query 5 รอบ
+#          python benchmark_indexes.py 20     -> รันแต่ละ query 20 รอบ
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+def build_queries(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT tire_id FROM tire_movements GROUP BY tire_id ORDER BY COUNT(*) DESC LIMIT 1")
+    row = cursor.fetchone()
+    tire_id = row[0] if row else 0
+    now = database.get_bkk_time()
+    start_iso = (now - timedelta(days=30)).isoformat()
+    analysis_start_iso = (now - timedelta(days=90)).isoformat()
+    end_iso = now.isoformat()
+    timestamp_param = database.get_dialect(conn).cast_timestamp('?')
+    return [
+        ('ประวัติ movement ของสินค้า (ลบ/แก้ movement)',
+         f"SELECT id, type, quantity_change FROM tire_movements WHERE tire_id = ? AND timestamp >= {timestamp_param} ORDER BY timestamp, id",
+         (tire_id, start_iso)),
+        ('ยอดขายรายวันของสินค้า (วิเคราะห์สต็อก)',
+         f"SELECT SUBSTR(CAST(timestamp AS TEXT), 1, 10), SUM(quantity_change) FROM tire_movements WHERE tire_id = ? AND type = 'OUT' AND timestamp >= {timestamp_param} GROUP BY 1",
+         (tire_id, analysis_start_iso)),
+        ('สินค้าขายช้า (NOT EXISTS)',
+         f"""SELECT t.id FROM tires t WHERE t.quantity > 0 AND NOT EXISTS (
+                 SELECT 1 FROM tire_movements tm WHERE tm.tire_id = t.id AND tm.type = 'OUT'
+                 AND tm.timestamp BETWEEN {timestamp_param} AND {timestamp_param})""",
+         (start_iso, end_iso)),
+        ('ยอดขายตามช่องทาง 30 วัน',
+         f"SELECT channel_id, SUM(quantity_change) FROM tire_movements WHERE type = 'OUT' AND timestamp >= {timestamp_param} AND timestamp < {timestamp_param} GROUP BY channel_id",
+         (start_iso, end_iso)),
+        ('รายงานค่าคอมมิชชั่น 30 วัน',
+         f"SELECT tire_id, SUM(commission_amount) FROM tire_movements WHERE timestamp >= {timestamp_param} AND timestamp < {timestamp_param} AND commission_amount > 0 GROUP BY tire_id",
+         (start_iso, end_iso)),
+    ]
+
+def explain(conn, sql, params):
+    cursor = conn.cursor()
+    dialect = database.get_dialect(conn)
+    prefix = "EXPLAIN (ANALYZE, BUFFERS) " if dialect.is_postgres else "EXPLAIN QUERY PLAN "
+    cursor.execute(dialect.compile(prefix + sql), params)
+    rows = cursor.fetchall()
+    return [row[0] if dialect.is_postgres else row[-1] for row in rows]
+
+def time_query(conn, sql, params):
+    cursor = conn.cursor()
+    compiled = database.get_dialect(conn).compile(sql)
+    started_at = time.perf_counter()
+    for _ in range(RUNS):
+        cursor.execute(compiled, params)
+        cursor.fetchall()
+    return (time.perf_counter() - started_at) / RUNS * 1000
+
+def measure(conn, queries, phase):
+    # ใส่ชื่อรอบเป็น comment ให้ SQL ไม่ซ้ำกัน sqlite3 จะได้ไม่ใช้ statement ที่ cache ไว้ (plan ของ EXPLAIN ถูกสร้างตอน prepare)
+    return [(explain(conn, f"{sql} -- {phase}", params), time_query(conn, f"{sql} -- {phase}", params)) for _, sql, params in queries]
+
+conn = database.get_db_connection()
+try:
+    applied = database.get_applied_migrations(conn)
+    if 2 not in applied:
+        sys.exit("Migration 2 (movement indexes) ยังไม่ถูกรัน ให้รัน python init_db.py ก่อน")
+
+    queries = build_queries(conn)
+    after = measure(conn, queries, 'with_indexes')
+
+    cursor = conn.cursor()
+    if not database.is_postgres_conn(conn) and not conn.in_transaction:
+        cursor.execute("BEGIN") # sqlite3 ไม่เปิด transaction ให้ DDL เอง
+    for statement in database.get_movement_index_statements():
+        index_name = statement.split(' ON ')[0].split()[-1]
+        cursor.execute(f"DROP INDEX {index_name}")
+    before = measure(conn, queries, 'without_indexes')
+
+    for (label, _, _), (plan_before, ms_before), (plan_after, ms_after) in zip(queries, before, after):
+        print(f"=== {label}: {ms_before:.2f} ms -> {ms_after:.2f} ms (เฉลี่ย {RUNS} รอบ)")
+        print("  ก่อน:")
+        for line in plan_before:
+            print(f"    {line}")
+        print("  หลัง:")
+        for line in plan_after:
+            print(f"    {line}")
+finally:
+    conn.rollback() # คืน index ที่ DROP ไปทั้งหมด
+    database.release_db_connection(conn)
@@ -7,6 +7,9 @@ from werkzeug.security import generate_password_hash, check_password_hash
 import os
 from urllib.parse import urlparse
 import json
+import threading
+import time
+import weakref
 import numpy as np
 
 BKK_TZ = pytz.timezone('Asia/Bangkok')
@@ -14,6 +17,8 @@ BKK_TZ = pytz.timezone('Asia/Bangkok')
 # Import psycopg2 (ต้องติดตั้ง pip install psycopg2-binary)
 try:
     import psycopg2
+    import psycopg2.pool
+    import psycopg2.extensions
     # Optional: for fetching rows as dictionaries, similar to sqlite3.Row
     from psycopg2.extras import DictCursor
 except ImportError:
@@ -50,34 +55,364 @@ def convert_to_bkk_time(timestamp_obj):
     # Convert to BKK timezone
     return dt_obj.astimezone(BKK_TZ)    
 
+# --- Connection Pool ---
+# ใช้ pool ร่วมกันทั้ง process แทนการเปิด connection ใหม่ทุก request
+# (TLS handshake + backend startup ของ PostgreSQL กินเวลามากเมื่อโหลดสูง)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10)) # วินาทีที่รอ connection ว่างได้สูงสุด
+DB_POOL_PING_INTERVAL = float(os.environ.get('DB_POOL_PING_INTERVAL', 30)) # ตรวจสุขภาพ connection ที่ว่างนานเกินนี้
+
+_pool = None
+_pool_pid = None
+_pool_semaphore = None
+_pool_lock = threading.Lock()
+_pool_last_used = {} # id(conn) -> เวลาที่คืนเข้า pool ล่าสุด (เฉพาะ connection ที่ pool ยังเก็บไว้)
+_pool_checked_out = {} # id(conn) -> conn ที่จ่ายออกไปจาก pool ปัจจุบันและยังไม่คืน
+_pool_stats_lock = threading.Lock() # gthread worker แก้สถิติ/รายการข้างบนจากหลาย thread
+_sqlite_local = threading.local()
+
+_pool_stats = {
+    'checkouts': 0,
+    'releases': 0,
+    'wait_time_total': 0.0,
+    'wait_time_max': 0.0,
+    'timeouts': 0,
+    'health_check_failures': 0,
+}
+
+def _pg_connect_kwargs(database_url):
+    url = urlparse(database_url)
+    return dict(
+        database=url.path[1:],
+        user=url.username,
+        password=url.password,
+        host=url.hostname,
+        port=url.port,
+        sslmode='require', # For Render, usually requires SSL
+        cursor_factory=DictCursor
+    )
+
+def _create_pg_pool(database_url):
+    return psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **_pg_connect_kwargs(database_url))
+
+def _get_pg_pool(database_url):
+    global _pool, _pool_pid, _pool_semaphore
+    # หลัง gunicorn fork worker ห้ามใช้ socket ของ process แม่ร่วมกัน ให้สร้าง pool ใหม่
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = _create_pg_pool(database_url)
+            _pool_pid = os.getpid()
+            _pool_semaphore = threading.BoundedSemaphore(DB_POOL_MAX)
+            _pool_last_used.clear()
+            _pool_checked_out.clear()
+            print(f"PostgreSQL connection pool created (pid={_pool_pid}, min={DB_POOL_MIN}, max={DB_POOL_MAX})")
+    return _pool
+
+def _reset_pool_after_fork():
+    """ทิ้ง pool ที่สืบทอดมาจาก process แม่ (ไม่ปิด socket เพราะแม่ยังใช้งานอยู่)"""
+    global _pool, _pool_pid, _pool_semaphore
+    _pool = None
+    _pool_pid = None
+    _pool_semaphore = None
+    _pool_last_used.clear()
+    _pool_checked_out.clear()
+    _sqlite_local.__dict__.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+def _is_pg_connection_healthy(conn):
+    if conn.closed:
+        return False
+    status = conn.get_transaction_status()
+    if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    last_used = _pool_last_used.get(id(conn))
+    if last_used is None or (time.monotonic() - last_used) > DB_POOL_PING_INTERVAL:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            conn.rollback()
+        except Exception:
+            return False
+    return True
+
+def _checkout_pg_connection(database_url):
+    pool = _get_pg_pool(database_url)
+    semaphore = _pool_semaphore
+    started = time.monotonic()
+    if not semaphore.acquire(timeout=DB_POOL_TIMEOUT):
+        with _pool_stats_lock:
+            _pool_stats['timeouts'] += 1
+        raise psycopg2.pool.PoolError(f"Timed out after {DB_POOL_TIMEOUT}s waiting for a database connection")
+    waited = time.monotonic() - started
+
+    try:
+        # หลังฐานข้อมูล restart connection ที่ว่างอยู่ตัวถัดไปก็มักจะเสียด้วย
+        # ทิ้งไปเรื่อยๆ จนได้ตัวที่ใช้ได้ หรือ pool เปิด connection ใหม่ (ตัวใหม่ก็ถูก ping ก่อนเหมือนกัน)
+        for _ in range(DB_POOL_MAX + 1):
+            conn = pool.getconn()
+            if _is_pg_connection_healthy(conn):
+                break
+            with _pool_stats_lock:
+                _pool_stats['health_check_failures'] += 1
+                _pool_last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+        else:
+            raise psycopg2.pool.PoolError("Could not get a healthy database connection")
+    except Exception:
+        semaphore.release()
+        raise
+
+    with _pool_stats_lock:
+        _pool_checked_out[id(conn)] = conn
+        _pool_stats['checkouts'] += 1
+        _pool_stats['wait_time_total'] += waited
+        _pool_stats['wait_time_max'] = max(_pool_stats['wait_time_max'], waited)
+    return conn
+
+def _get_sqlite_connection():
+    # SQLite: เก็บ connection ไว้ใช้ซ้ำต่อ thread
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is not None:
+        try:
+            conn.execute("SELECT 1")
+            return conn
+        except sqlite3.ProgrammingError: # ถูกปิดไปแล้ว
+            pass
+    conn = sqlite3.connect('inventory.db')
+    conn.row_factory = sqlite3.Row # This allows accessing columns by name (e.g., row['column_name'])
+    _sqlite_local.conn = conn
+    print("Connected to SQLite database (local development)!")
+    return conn
+
+def open_dedicated_connection():
+    """
+    connection แยกที่ไม่ผ่าน pool และไม่ใช่ connection ของ request (g.db) ผู้เรียกต้องปิดเอง
+    ทุกคำสั่ง commit ทันที (PostgreSQL: autocommit, SQLite: connection ใหม่ของตัวเอง isolation_level=None)
+    ใช้กับงานสั้นๆ ที่ต้องไม่ขึ้นกับ transaction ของ request เช่น จองเลขลำดับบาร์โค้ด
+    """
+    DATABASE_URL = os.environ.get('DATABASE_URL')
+    if DATABASE_URL and psycopg2:
+        conn = psycopg2.connect(**_pg_connect_kwargs(DATABASE_URL))
+        conn.autocommit = True
+        return conn
+    conn = sqlite3.connect('inventory.db', isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
 def get_db_connection():
     # ตรวจสอบว่ามี DATABASE_URL Environment Variable หรือไม่ (สำหรับ Production บน Render)
     DATABASE_URL = os.environ.get('DATABASE_URL')
-    
+
     if DATABASE_URL and psycopg2:
-        # Connect to PostgreSQL
+        # Check out a connection from the PostgreSQL pool
         try:
-            url = urlparse(DATABASE_URL)
-            conn = psycopg2.connect(
-                database=url.path[1:],
-                user=url.username,
-                password=url.password,
-                host=url.hostname,
-                port=url.port,
-                sslmode='require', # For Render, usually requires SSL
-                cursor_factory=DictCursor # <--- เพิ่มบรรทัดนี้เข้ามา
-            )
-            print("Connected to PostgreSQL database!")
-            return conn
+            return _checkout_pg_connection(DATABASE_URL)
         except Exception as e:
             print(f"Error connecting to PostgreSQL: {e}")
             raise # Re-raise error if PostgreSQL is expected
     else:
         # Connect to SQLite (for Local Development)
-        print("Connected to SQLite database (local development)!")
-        conn = sqlite3.connect('inventory.db')
-        conn.row_factory = sqlite3.Row # This allows accessing columns by name (e.g., row['column_name'])
-        return conn
+        return _get_sqlite_connection()
+
+def release_db_connection(conn):
+    """
+    คืน connection ที่ได้จาก get_db_connection()
+    PostgreSQL: rollback งานที่ค้างแล้วคืนเข้า pool, SQLite: rollback แล้วเก็บไว้ใช้ซ้ำใน thread เดิม
+    """
+    if conn is None:
+        return
+    if isinstance(conn, sqlite3.Connection):
+        try:
+            conn.rollback()
+        except sqlite3.ProgrammingError:
+            _sqlite_local.__dict__.pop('conn', None)
+        return
+
+    # connection ที่ไม่ได้มาจาก pool ปัจจุบัน (เช่น ของ process แม่ก่อน fork) ไม่ต้องคืน
+    with _pool_stats_lock:
+        if _pool is None or _pool_checked_out.pop(id(conn), None) is not conn:
+            return
+
+    close = conn.closed != 0
+    if not close:
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            close = True
+    try:
+        _pool.putconn(conn, close=close)
+    finally:
+        with _pool_stats_lock:
+            # pool เก็บไว้แค่ DB_POOL_MIN ตัว ที่เกินจะถูกปิดตอนคืน
+            if conn.closed:
+                _pool_last_used.pop(id(conn), None)
+            else:
+                _pool_last_used[id(conn)] = time.monotonic()
+            _pool_stats['releases'] += 1
+        _pool_semaphore.release()
+
+def get_pool_stats():
+    """สถิติของ connection pool สำหรับ monitoring"""
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+        in_use = len(_pool_checked_out)
+        idle = sum(1 for conn_id in _pool_last_used if conn_id not in _pool_checked_out)
+    stats['backend'] = 'postgresql' if _pool is not None else 'sqlite'
+    stats['pid'] = os.getpid()
+    stats['min_size'] = DB_POOL_MIN
+    stats['max_size'] = DB_POOL_MAX
+    if _pool is not None:
+        stats['in_use'] = in_use
+        stats['idle'] = idle
+    stats['wait_time_avg'] = (stats['wait_time_total'] / stats['checkouts']) if stats['checkouts'] else 0.0
+    return stats
+
+# --- SQL Dialect ---
+class Dialect:
+    """
+    รวมความต่างของ SQL ระหว่าง PostgreSQL และ SQLite ไว้ที่เดียว
+    resolve ครั้งเดียวต่อชนิดของ connection (ดู get_dialect) แทนการเช็ค str(type(conn)) ทุกครั้ง
+    คำสั่ง SQL เขียนด้วย '?' และ {true}/{false} แล้ว compile เก็บไว้ตามชื่อ query
+    """
+    def __init__(self, name, placeholder, true_literal, false_literal, like_operator, timestamp_cast):
+        self.name = name
+        self.is_postgres = name == 'postgresql'
+        self.placeholder = placeholder
+        self.true_literal = true_literal
+        self.false_literal = false_literal
+        self.like_operator = like_operator
+        self.timestamp_cast = timestamp_cast
+        self._statements = {}
+        self._prepared_statements = {}
+
+    def compile(self, sql):
+        sql = sql.replace('{true}', self.true_literal).replace('{false}', self.false_literal)
+        if self.is_postgres:
+            sql = sql.replace('?', '%s')
+        return sql
+
+    def query(self, name, sql):
+        """คืนคำสั่ง SQL ที่ compile แล้วจาก cache (compile ครั้งแรกที่เรียกด้วยชื่อนี้)"""
+        compiled = self._statements.get(name)
+        if compiled is None:
+            compiled = self.compile(sql)
+            self._statements[name] = compiled
+        return compiled
+
+    def date_trunc(self, column):
+        """ตัดเวลาออกเหลือเฉพาะวันที่"""
+        return f"({column})::date" if self.is_postgres else f"DATE({column})"
+
+    def date_format(self, column):
+        """แปลงเป็นข้อความ 'YYYY-MM-DD'"""
+        return f"TO_CHAR({column}, 'YYYY-MM-DD')" if self.is_postgres else f"STRFTIME('%Y-%m-%d', {column})"
+
+    def cast_timestamp(self, expression):
+        return f"{expression}{self.timestamp_cast}"
+
+    def local_date(self, column):
+        """วันที่ตามเวลาไทยของ timestamp (SQLite เก็บเป็น ISO string เวลาไทยอยู่แล้ว ตัด 10 ตัวแรกได้เลย)"""
+        return f"(({column}) AT TIME ZONE 'Asia/Bangkok')::date" if self.is_postgres else f"SUBSTR({column}, 1, 10)"
+
+    def timestamp_range(self, column):
+        """
+        เงื่อนไขช่วงเวลาแบบ [เริ่ม, สิ้นสุด) ใช้คู่กับ _bkk_date_range
+        เทียบกับคอลัมน์ตรงๆ (ไม่ครอบด้วย DATE()) จึงใช้ index ของ timestamp ได้
+        """
+        bound = self.cast_timestamp(self.placeholder)
+        return f"{column} >= {bound} AND {column} < {bound}"
+
+    def execute(self, cursor, name, sql, params=()):
+        """
+        รัน query ที่ตั้งชื่อไว้ บน PostgreSQL จะใช้ server-side prepared statement (PREPARE/EXECUTE)
+        ซึ่งอยู่ได้ตลอดอายุของ connection ใน pool จึงไม่ต้อง parse/plan ซ้ำทุก request
+        """
+        if not self.is_postgres:
+            cursor.execute(self.query(name, sql), params)
+            return cursor
+
+        conn = cursor.connection
+        prepare_sql, execute_sql = self._prepared_statements.get(name) or self._compile_prepared(name, sql)
+        prepared = _prepared_by_connection.get(conn)
+        if prepared is None:
+            prepared = _prepared_by_connection.setdefault(conn, {})
+        starts_transaction = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        if not prepared.get(name):
+            if name in prepared: # PREPARE ไว้แล้วแต่ plan ใช้ไม่ได้ (ดูด้านล่าง) ต้องลบของเดิมก่อน
+                cursor.execute(f"DEALLOCATE {name}")
+            cursor.execute(prepare_sql)
+            prepared[name] = True
+        try:
+            cursor.execute(execute_sql, params)
+        except psycopg2.errors.FeatureNotSupported as e:
+            # ตารางถูก ALTER (เช่น migration ของ release ใหม่) หลัง PREPARE: คำสั่งที่ผลลัพธ์เปลี่ยนรูปแบบ (SELECT t.*)
+            # จะ error "cached plan must not change result type" ทุกครั้งจนกว่าจะ PREPARE ใหม่
+            if 'cached plan must not change result type' not in str(e):
+                raise
+            # ALTER เดียวกันมักกระทบหลายคำสั่ง (ทุกคำสั่งที่อ่านตารางนั้น) ให้ทุกคำสั่งของ connection นี้ PREPARE ใหม่ตอนใช้ครั้งถัดไป
+            for prepared_name in prepared:
+                prepared[prepared_name] = False
+            if not starts_transaction:
+                # งานก่อนหน้าใน transaction นี้ถูก abort ไปแล้ว ให้ผู้เรียก rollback ตามปกติ ครั้งถัดไปจะ PREPARE ใหม่
+                raise
+            print(f"WARNING: Prepared statement {name} is stale after a schema change, preparing it again")
+            conn.rollback()
+            cursor.execute(f"DEALLOCATE {name}")
+            cursor.execute(prepare_sql)
+            prepared[name] = True
+            cursor.execute(execute_sql, params)
+        return cursor
+
+    def _compile_prepared(self, name, sql):
+        compiled = self.query(name, sql)
+        parts = compiled.split('%s')
+        numbered = parts[0] + ''.join(f"${i}{part}" for i, part in enumerate(parts[1:], start=1))
+        param_count = len(parts) - 1
+        prepare_sql = f"PREPARE {name} AS {numbered}"
+        execute_sql = f"EXECUTE {name}" + (f" ({', '.join(['%s'] * param_count)})" if param_count else "")
+        self._prepared_statements[name] = (prepare_sql, execute_sql)
+        return prepare_sql, execute_sql
+
+POSTGRES_DIALECT = Dialect('postgresql', '%s', 'TRUE', 'FALSE', 'ILIKE', '::timestamptz')
+SQLITE_DIALECT = Dialect('sqlite', '?', '1', '0', 'LIKE', '')
+
+_dialect_by_connection_type = {}
+# ชื่อ prepared statement ที่ PREPARE แล้วในแต่ละ connection -> ยังใช้ได้หรือไม่ (หายไปเองเมื่อ connection ถูกทิ้ง)
+_prepared_by_connection = weakref.WeakKeyDictionary()
+
+def get_dialect(conn):
+    connection_type = type(conn)
+    dialect = _dialect_by_connection_type.get(connection_type)
+    if dialect is None:
+        dialect = POSTGRES_DIALECT if "psycopg2" in str(connection_type) else SQLITE_DIALECT
+        _dialect_by_connection_type[connection_type] = dialect
+    return dialect
+
+def is_postgres_conn(conn):
+    return get_dialect(conn).is_postgres
+
+# --- Data change listeners ---
+# ชั้น app ลงทะเบียน callback ไว้ล้าง cache เมื่อข้อมูลที่ทุกหน้าใช้เปลี่ยน
+# topic: 'announcements', 'notifications', 'user' (ส่ง user_id ไปด้วย)
+_data_change_listeners = defaultdict(list)
+
+def on_data_change(topic, listener):
+    if listener not in _data_change_listeners[topic]:
+        _data_change_listeners[topic].append(listener)
+
+def _notify_data_change(topic, *args):
+    for listener in _data_change_listeners[topic]:
+        try:
+            listener(*args)
+        except Exception as e:
+            print(f"Error in data change listener for {topic}: {e}")
 
 # Helper function to get date format for SQL query based on DB type
 def get_sql_date_format_for_query(column_name):
@@ -89,7 +424,7 @@ def get_sql_date_format_for_query(column_name):
 def init_db(conn):
     cursor = conn.cursor()
     
-    is_postgres = "psycopg2" in str(type(conn)) # จะคืนค่า True หาก conn เป็น psycopg2 connection
+    is_postgres = is_postgres_conn(conn) # จะคืนค่า True หาก conn เป็น psycopg2 connection
 
     # Commission Programs Table (เปลี่ยนชื่อจาก daily_commissions)
     if is_postgres:
@@ -949,6 +1284,9 @@ def init_db(conn):
         );
     """)
 
+    # Daily Stock Snapshots (ยอดยกมา/รับ/จ่าย/คืน/คงเหลือ รายวันต่อสินค้า)
+    create_daily_stock_snapshots_table(conn)
+
      # Daily Reconciliations Table (NEW)
     if is_postgres:
         cursor.execute("""
@@ -1112,150 +1450,8 @@ def init_db(conn):
             );
         """)
 
-    # --- START: NEW INDEX CREATION CODE TO BE ADDED ---
-    print("Creating necessary indexes for performance...")
-
-    # activity_logs
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp ON activity_logs(timestamp);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp ON activity_logs(timestamp);")
-
-    # promotions
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_promotions_is_active_is_deleted ON promotions(is_active, is_deleted);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_promotions_is_active_is_deleted ON promotions(is_active, is_deleted);")
-
-    # tires
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tires_brand_model_size ON tires(brand, model, size);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tires_is_deleted ON tires(is_deleted);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tires_brand_model_size ON tires(brand, model, size);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tires_is_deleted ON tires(is_deleted);")
-
-    # tire_movements
-    # idx_tire_movements_tire_id is already in the original file
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tire_movements_timestamp ON tire_movements(timestamp);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tire_movements_wholesale_customer_id ON tire_movements(wholesale_customer_id);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tire_movements_timestamp ON tire_movements(timestamp);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tire_movements_wholesale_customer_id ON tire_movements(wholesale_customer_id);")
-
-    # wheels
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheels_brand_model_diameter_pcd_width_et_color ON wheels(brand, model, diameter, pcd, width, et, color);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheels_is_deleted ON wheels(is_deleted);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheels_brand_model_diameter_pcd_width_et_color ON wheels(brand, model, diameter, pcd, width, et, color);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheels_is_deleted ON wheels(is_deleted);")
-
-    # wheel_movements
-    # idx_wheel_movements_wheel_id is already in the original file
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheel_movements_timestamp ON wheel_movements(timestamp);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheel_movements_wholesale_customer_id ON wheel_movements(wholesale_customer_id);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheel_movements_timestamp ON wheel_movements(timestamp);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheel_movements_wholesale_customer_id ON wheel_movements(wholesale_customer_id);")
-
-    # wheel_fitments
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheel_fitments_wheel_id ON wheel_fitments(wheel_id);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheel_fitments_wheel_id ON wheel_fitments(wheel_id);")
-
-    # notifications
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_created_at ON notifications(created_at DESC);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_is_read ON notifications(is_read);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_created_at ON notifications(created_at DESC);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_is_read ON notifications(is_read);")
-
-    # tire_barcodes
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tire_barcodes_barcode_string ON tire_barcodes(barcode_string);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tire_barcodes_barcode_string ON tire_barcodes(barcode_string);")
-
-    # wheel_barcodes
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheel_barcodes_barcode_string ON wheel_barcodes(barcode_string);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wheel_barcodes_barcode_string ON wheel_barcodes(barcode_string);")
-
-    # spare_part_categories
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_categories_parent_id ON spare_part_categories(parent_id);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_categories_parent_id ON spare_part_categories(parent_id);")
-
-    # spare_parts
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_parts_name_part_number_brand ON spare_parts(name, part_number, brand);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_parts_category_id ON spare_parts(category_id);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_parts_is_deleted ON spare_parts(is_deleted);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_parts_name_part_number_brand ON spare_parts(name, part_number, brand);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_parts_category_id ON spare_parts(category_id);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_parts_is_deleted ON spare_parts(is_deleted);")
-
-    # spare_part_movements
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_movements_spare_part_id ON spare_part_movements(spare_part_id);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_movements_timestamp ON spare_part_movements(timestamp);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_movements_wholesale_customer_id ON spare_part_movements(wholesale_customer_id);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_movements_spare_part_id ON spare_part_movements(spare_part_id);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_movements_timestamp ON spare_part_movements(timestamp);")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_movements_wholesale_customer_id ON spare_part_movements(wholesale_customer_id);")
-
-    # spare_part_barcodes
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_barcodes_barcode_string ON spare_part_barcodes(barcode_string);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_spare_part_barcodes_barcode_string ON spare_part_barcodes(barcode_string);")
-
-    # feedback
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback(created_at DESC);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback(created_at DESC);")
-
-    # announcements
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_announcements_is_active_created_at ON announcements(is_active, created_at DESC);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_announcements_is_active_created_at ON announcements(is_active, created_at DESC);")
-
-    # sales_channels
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_channels_name ON sales_channels(name);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_channels_name ON sales_channels(name);")
-
-    # online_platforms
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_online_platforms_name ON online_platforms(name);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_online_platforms_name ON online_platforms(name);")
-
-    # wholesale_customers
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wholesale_customers_name ON wholesale_customers(name);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_wholesale_customers_name ON wholesale_customers(name);")
-
-    # daily_reconciliations
-    if is_postgres:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_daily_reconciliations_date ON daily_reconciliations(reconciliation_date);")
-    else:
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_daily_reconciliations_date ON daily_reconciliations(reconciliation_date);")
-
-    # --- END NEW INDEX CREATION CODE ---
+    # --- Indexes และการเปลี่ยน schema หลังสร้างตาราง: ใช้ migration runner (ดู MIGRATIONS) ---
+    run_migrations(conn)
     
     # --- INSERT DEFAULT DATA (MOVED HERE TO ENSURE COMMIT) ---
     # เพิ่มข้อมูลเริ่มต้นสำหรับ sales_channels (ถ้ายังไม่มี)
@@ -1312,6 +1508,152 @@ def init_db(conn):
     conn.commit() # <--- IMPORTANT: COMMIT ALL CHANGES AFTER CREATING TABLES AND INSERTING DEFAULTS
     print("Database schema and default data initialized successfully.")
 
+# --- Schema Migrations ---
+# การเปลี่ยน schema หลังสร้างตาราง (index, คอลัมน์ใหม่) เรียงตามเลข version
+# run_migrations จะรันเฉพาะ version ที่ยังไม่อยู่ใน schema_migrations ทุก statement เป็นแบบ IF NOT EXISTS
+# ฐานข้อมูลเดิมที่มี index บางตัวอยู่แล้วจึงรันซ้ำได้ปลอดภัย
+# เพิ่ม migration ใหม่ต่อท้ายเสมอ ห้ามแก้ version ที่ deploy ไปแล้ว
+
+def get_movement_index_statements():
+    statements = []
+    for item_type, (table_name, id_column) in MOVEMENT_TABLES.items():
+        statements += [
+            # ประวัติของสินค้าแต่ละชิ้นเรียงตามเวลา (ลบ/แก้ movement แล้วคำนวณคงเหลือใหม่, snapshot, history)
+            f"CREATE INDEX IF NOT EXISTS idx_{table_name}_item_timestamp ON {table_name}({id_column}, timestamp);",
+            # ยอดขายต่อสินค้า (วิเคราะห์สต็อก, slow moving NOT EXISTS) อ่านจาก index ได้เลยไม่ต้องเปิดตาราง
+            f"CREATE INDEX IF NOT EXISTS idx_{table_name}_item_out ON {table_name}({id_column}, timestamp, quantity_change) WHERE type = 'OUT';",
+            # รายงานที่กรองประเภทรายการ/ช่องทางในช่วงวันที่
+            f"CREATE INDEX IF NOT EXISTS idx_{table_name}_type_timestamp ON {table_name}(type, timestamp);",
+            f"CREATE INDEX IF NOT EXISTS idx_{table_name}_channel_timestamp ON {table_name}(channel_id, timestamp);",
+            # รายงานค่าคอมมิชชั่น (มีเฉพาะขายหน้าร้านที่มีโปรแกรมค่าคอม)
+            f"CREATE INDEX IF NOT EXISTS idx_{table_name}_commission_timestamp ON {table_name}(timestamp) WHERE commission_amount > 0;",
+        ]
+    return statements
+
+def _create_movement_indexes(conn, cursor, is_postgres):
+    for statement in get_movement_index_statements():
+        cursor.execute(statement)
+
+def _add_ignore_analysis_columns(conn, cursor, is_postgres):
+    # ใช้ในหน้าวิเคราะห์สต็อก (ซ่อนรายการ) แต่ยังไม่เคยอยู่ใน CREATE TABLE
+    for table_name in ('tires', 'wheels', 'spare_parts'):
+        if is_postgres:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS ignore_analysis BOOLEAN NOT NULL DEFAULT FALSE;")
+            continue
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        if 'ignore_analysis' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN ignore_analysis BOOLEAN NOT NULL DEFAULT 0;")
+
+# (version, คำอธิบาย, list ของ SQL หรือฟังก์ชัน (conn, cursor, is_postgres))
+MIGRATIONS = [
+    (1, 'baseline indexes', [
+        "CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp ON activity_logs(timestamp);",
+        "CREATE INDEX IF NOT EXISTS idx_promotions_is_active_is_deleted ON promotions(is_active, is_deleted);",
+        "CREATE INDEX IF NOT EXISTS idx_tires_brand_model_size ON tires(brand, model, size);",
+        "CREATE INDEX IF NOT EXISTS idx_tires_is_deleted ON tires(is_deleted);",
+        "CREATE INDEX IF NOT EXISTS idx_tire_movements_timestamp ON tire_movements(timestamp);",
+        "CREATE INDEX IF NOT EXISTS idx_tire_movements_wholesale_customer_id ON tire_movements(wholesale_customer_id);",
+        "CREATE INDEX IF NOT EXISTS idx_wheels_brand_model_diameter_pcd_width_et_color ON wheels(brand, model, diameter, pcd, width, et, color);",
+        "CREATE INDEX IF NOT EXISTS idx_wheels_is_deleted ON wheels(is_deleted);",
+        "CREATE INDEX IF NOT EXISTS idx_wheel_movements_timestamp ON wheel_movements(timestamp);",
+        "CREATE INDEX IF NOT EXISTS idx_wheel_movements_wholesale_customer_id ON wheel_movements(wholesale_customer_id);",
+        "CREATE INDEX IF NOT EXISTS idx_wheel_fitments_wheel_id ON wheel_fitments(wheel_id);",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_created_at ON notifications(created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_notifications_is_read ON notifications(is_read);",
+        "CREATE INDEX IF NOT EXISTS idx_tire_barcodes_barcode_string ON tire_barcodes(barcode_string);",
+        "CREATE INDEX IF NOT EXISTS idx_wheel_barcodes_barcode_string ON wheel_barcodes(barcode_string);",
+        "CREATE INDEX IF NOT EXISTS idx_spare_part_categories_parent_id ON spare_part_categories(parent_id);",
+        "CREATE INDEX IF NOT EXISTS idx_spare_parts_name_part_number_brand ON spare_parts(name, part_number, brand);",
+        "CREATE INDEX IF NOT EXISTS idx_spare_parts_category_id ON spare_parts(category_id);",
+        "CREATE INDEX IF NOT EXISTS idx_spare_parts_is_deleted ON spare_parts(is_deleted);",
+        "CREATE INDEX IF NOT EXISTS idx_spare_part_movements_spare_part_id ON spare_part_movements(spare_part_id);",
+        "CREATE INDEX IF NOT EXISTS idx_spare_part_movements_timestamp ON spare_part_movements(timestamp);",
+        "CREATE INDEX IF NOT EXISTS idx_spare_part_movements_wholesale_customer_id ON spare_part_movements(wholesale_customer_id);",
+        "CREATE INDEX IF NOT EXISTS idx_spare_part_barcodes_barcode_string ON spare_part_barcodes(barcode_string);",
+        "CREATE INDEX IF NOT EXISTS idx_feedback_created_at ON feedback(created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_announcements_is_active_created_at ON announcements(is_active, created_at DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_sales_channels_name ON sales_channels(name);",
+        "CREATE INDEX IF NOT EXISTS idx_online_platforms_name ON online_platforms(name);",
+        "CREATE INDEX IF NOT EXISTS idx_wholesale_customers_name ON wholesale_customers(name);",
+        "CREATE INDEX IF NOT EXISTS idx_daily_reconciliations_date ON daily_reconciliations(reconciliation_date);",
+    ]),
+    (2, 'movement table composite/partial indexes', [
+        _create_movement_indexes,
+        "CREATE INDEX IF NOT EXISTS idx_commission_programs_item ON commission_programs(item_type, item_id, start_date);",
+    ]),
+    (3, 'ignore_analysis columns for stock analysis', [_add_ignore_analysis_columns]),
+    (4, 'jobs created_at index for date-range filters', [
+        "CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs(created_at);",
+    ]),
+    (5, 'per-day job number counters', [
+        "CREATE TABLE IF NOT EXISTS job_number_counters (day_key VARCHAR(6) PRIMARY KEY, last_number INTEGER NOT NULL);",
+        # ตั้งค่าเริ่มต้นจากเลขใบงานที่มีอยู่แล้ว (JOB-yymmdd-NNNN) กันเลขซ้ำกับใบงานเดิมของวันนี้
+        """INSERT INTO job_number_counters (day_key, last_number)
+           SELECT SUBSTR(job_number, 5, 6), MAX(CAST(SUBSTR(job_number, 12) AS INTEGER))
+           FROM jobs WHERE job_number LIKE 'JOB-______-%'
+           GROUP BY SUBSTR(job_number, 5, 6);""",
+    ]),
+    # เลขที่ออกจากตัวนับเริ่มที่ 0 ไม่ต้องตั้งค่าจากบาร์โค้ดเดิม: บาร์โค้ดแบบเวลาเดิม (885 + M DD HHMMSS) มีส่วนกลางไม่ต่ำกว่า 1,000,000
+    # และผู้ออกเลขตรวจกับตารางบาร์โค้ดทุกครั้งอยู่แล้ว
+    (6, 'barcode sequences for generated EAN-13 codes', [
+        "CREATE TABLE IF NOT EXISTS barcode_sequences (name VARCHAR(32) PRIMARY KEY, last_value BIGINT NOT NULL);",
+    ]),
+    # สถานะงานนำเข้า Excel เบื้องหลัง (ดู app/excel_import.py) เก็บในฐานข้อมูลให้ทุก worker อ่านได้
+    # heartbeat_at ถูกอัปเดตเป็นระยะระหว่างที่งานยังรัน ถ้าหยุดอัปเดต (worker ถูก restart/kill) งานจะถูกปิดเป็น failed ตอน poll
+    (7, 'background import job status', [
+        """CREATE TABLE IF NOT EXISTS import_jobs (
+            id VARCHAR(32) PRIMARY KEY,
+            item_type VARCHAR(20) NOT NULL,
+            user_id INTEGER,
+            status VARCHAR(20) NOT NULL,
+            processed INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            owner VARCHAR(100),
+            created_at TEXT NOT NULL,
+            heartbeat_at TEXT NOT NULL
+        );""",
+    ]),
+]
+
+def create_schema_migrations_table(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        );
+    """)
+
+def get_applied_migrations(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+def run_migrations(conn):
+    """รัน migration ที่ยังไม่เคยรัน (ผู้เรียกเป็นคน commit) คืน list ของ version ที่รัน"""
+    create_schema_migrations_table(conn)
+    applied = get_applied_migrations(conn)
+    is_postgres = is_postgres_conn(conn)
+    cursor = conn.cursor()
+    dialect = get_dialect(conn)
+    newly_applied = []
+    for version, description, steps in MIGRATIONS:
+        if version in applied:
+            continue
+        print(f"Applying schema migration {version}: {description}")
+        for step in steps:
+            if callable(step):
+                step(conn, cursor, is_postgres)
+            else:
+                cursor.execute(step)
+        cursor.execute(dialect.compile("INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)"),
+                       (version, description, get_bkk_time().isoformat()))
+        newly_applied.append(version)
+    return newly_applied
+
 # --- User Model ---
 class User:
     def __init__(self, id, username, password, role):
@@ -1323,10 +1665,7 @@ class User:
     @staticmethod
     def get(conn, user_id):
         cursor = conn.cursor()
-        if "psycopg2" in str(type(conn)):
-            cursor.execute("SELECT id, username, password, role FROM users WHERE id = %s", (user_id,))
-        else:
-            cursor.execute("SELECT id, username, password, role FROM users WHERE id = ?", (user_id,))
+        get_dialect(conn).execute(cursor, 'user_by_id', "SELECT id, username, password, role FROM users WHERE id = ?", (user_id,))
         user_data = cursor.fetchone()
         if user_data:
             if isinstance(user_data, sqlite3.Row):
@@ -1337,7 +1676,7 @@ class User:
     @staticmethod
     def get_by_username(conn, username):
         cursor = conn.cursor()
-        if "psycopg2" in str(type(conn)):
+        if is_postgres_conn(conn):
             cursor.execute("SELECT id, username, password, role FROM users WHERE username = %s", (username,))
         else:
             cursor.execute("SELECT id, username, password, role FROM users WHERE username = ?", (username,))
@@ -1395,7 +1734,7 @@ def add_user(conn, username, password, role='viewer'):
     hashed_password = generate_password_hash(password)
     cursor = conn.cursor() 
     try:
-        if "psycopg2" in str(type(conn)):
+        if is_postgres_conn(conn):
             cursor.execute("INSERT INTO users (username, password, role) VALUES (%s, %s, %s) RETURNING id", (username, hashed_password, role))
             user_id = cursor.fetchone()['id']
         else: # สำหรับ SQLite
@@ -1409,7 +1748,7 @@ def add_user(conn, username, password, role='viewer'):
             raise
 
 def get_all_users(conn):
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor = conn.cursor() 
         cursor.execute("SELECT id, username, role FROM users")
         users = cursor.fetchall()
@@ -1426,11 +1765,12 @@ def get_all_users_for_assignment(conn):
 
 def update_user_role(conn, user_id, new_role):
     try:
-        if "psycopg2" in str(type(conn)):
+        if is_postgres_conn(conn):
             cursor = conn.cursor() 
             cursor.execute("UPDATE users SET role = %s WHERE id = %s", (new_role, user_id))
         else: # สำหรับ SQLite
             conn.execute("UPDATE users SET role = ? WHERE id = ?", (new_role, user_id))
+        _notify_data_change('user', user_id)
         return True
     except Exception as e:
         print(f"Error updating user role: {e}")
@@ -1438,15 +1778,16 @@ def update_user_role(conn, user_id, new_role):
 
 def delete_user(conn, user_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
     else:
         cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    _notify_data_change('user', user_id)
 
 # --- Sales Channel, Online Platform, Wholesale Customer Functions (ใหม่) ---
 def get_sales_channel_id(conn, name):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT id FROM sales_channels WHERE name = %s", (name,))
     else:
         cursor.execute("SELECT id FROM sales_channels WHERE name = ?", (name,))
@@ -1460,10 +1801,7 @@ def get_sales_channel_id(conn, name):
 
 def get_sales_channel_name(conn, channel_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
-        cursor.execute("SELECT name FROM sales_channels WHERE id = %s", (channel_id,))
-    else:
-        cursor.execute("SELECT name FROM sales_channels WHERE id = ?", (channel_id,))
+    get_dialect(conn).execute(cursor, 'sales_channel_name', "SELECT name FROM sales_channels WHERE id = ?", (channel_id,))
     result = cursor.fetchone()
     if result and isinstance(result, dict):
         return result['name']
@@ -1473,7 +1811,7 @@ def get_sales_channel_name(conn, channel_id):
 
 def get_all_sales_channels(conn):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT id, name FROM sales_channels ORDER BY name")
     else:
         cursor.execute("SELECT id, name FROM sales_channels ORDER BY name")
@@ -1483,7 +1821,7 @@ def get_all_sales_channels(conn):
 def add_online_platform(conn, name):
     cursor = conn.cursor()
     try:
-        if "psycopg2" in str(type(conn)):
+        if is_postgres_conn(conn):
             cursor.execute("INSERT INTO online_platforms (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id;", (name,))
             platform_id = cursor.fetchone()
             return platform_id['id'] if platform_id else get_online_platform_id(conn, name)
@@ -1496,7 +1834,7 @@ def add_online_platform(conn, name):
 
 def get_online_platform_id(conn, name):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT id FROM online_platforms WHERE name = %s", (name,))
     else:
         cursor.execute("SELECT id FROM online_platforms WHERE name = ?", (name,))
@@ -1509,7 +1847,7 @@ def get_online_platform_id(conn, name):
 
 def get_online_platform_name(conn, platform_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT name FROM online_platforms WHERE id = %s", (platform_id,))
     else:
         cursor.execute("SELECT name FROM online_platforms WHERE id = ?", (platform_id,))
@@ -1522,7 +1860,7 @@ def get_online_platform_name(conn, platform_id):
 
 def get_all_online_platforms(conn):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT id, name FROM online_platforms ORDER BY name")
     else:
         cursor.execute("SELECT id, name FROM online_platforms ORDER BY name")
@@ -1531,7 +1869,7 @@ def get_all_online_platforms(conn):
 def add_wholesale_customer(conn, name):
     cursor = conn.cursor()
     try:
-        if "psycopg2" in str(type(conn)):
+        if is_postgres_conn(conn):
             cursor.execute("INSERT INTO wholesale_customers (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id;", (name,))
             customer_id = cursor.fetchone()
             return customer_id['id'] if customer_id else get_wholesale_customer_id(conn, name)
@@ -1544,7 +1882,7 @@ def add_wholesale_customer(conn, name):
 
 def get_wholesale_customer_id(conn, name):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT id FROM wholesale_customers WHERE name = %s", (name,))
     else:
         cursor.execute("SELECT id FROM wholesale_customers WHERE name = ?", (name,))
@@ -1557,7 +1895,7 @@ def get_wholesale_customer_id(conn, name):
 
 def get_wholesale_customer_name(conn, customer_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT name FROM wholesale_customers WHERE id = %s", (customer_id,))
     else:
         cursor.execute("SELECT name FROM wholesale_customers WHERE id = ?", (customer_id,))
@@ -1570,7 +1908,7 @@ def get_wholesale_customer_name(conn, customer_id):
 
 def get_all_wholesale_customers(conn):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT id, name FROM wholesale_customers ORDER BY name")
     else:
         cursor.execute("SELECT id, name FROM wholesale_customers ORDER BY name")
@@ -1578,7 +1916,7 @@ def get_all_wholesale_customers(conn):
 
 def add_spare_part_category(conn, name, parent_id=None):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     try:
         if is_postgres:
             cursor.execute("INSERT INTO spare_part_categories (name, parent_id) VALUES (%s, %s) RETURNING id", (name, parent_id))
@@ -1595,7 +1933,7 @@ def add_spare_part_category(conn, name, parent_id=None):
 
 def get_spare_part_category(conn, category_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("SELECT id, name, parent_id FROM spare_part_categories WHERE id = %s", (category_id,))
     else:
@@ -1605,7 +1943,7 @@ def get_spare_part_category(conn, category_id):
 
 def get_all_spare_part_categories(conn):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("SELECT id, name, parent_id FROM spare_part_categories ORDER BY name")
     else:
@@ -1666,7 +2004,7 @@ def get_all_spare_part_categories_hierarchical(conn, include_id=False):
 
 def update_spare_part_category(conn, category_id, new_name, new_parent_id=None):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     # ตรวจสอบว่าพยายามตั้งให้ตัวเองเป็น parent_id หรือไม่
     if new_parent_id is not None and category_id == new_parent_id:
@@ -1692,7 +2030,7 @@ def update_spare_part_category(conn, category_id, new_name, new_parent_id=None):
 
 def delete_spare_part_category(conn, category_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     # ตรวจสอบว่ามีอะไหล่ใดๆ ใช้หมวดหมู่นี้อยู่หรือไม่
     if is_postgres:
@@ -1722,7 +2060,7 @@ def add_spare_part(conn, name, part_number, brand, description, quantity, cost,
                    wholesale_price1=None, wholesale_price2=None, cost_online=None,
                    image_filename=None, category_id=None, user_id=None):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("""
@@ -1752,7 +2090,7 @@ def add_spare_part(conn, name, part_number, brand, description, quantity, cost,
 
 def get_spare_part(conn, spare_part_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("""
             SELECT sp.*, spc.name AS category_name, spc.parent_id AS category_parent_id
@@ -1773,7 +2111,7 @@ def get_spare_part(conn, spare_part_id):
 def update_spare_part(conn, spare_part_id, name, part_number, brand, description, cost, retail_price,
                       wholesale_price1, wholesale_price2, cost_online, image_filename, category_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("""
@@ -1800,7 +2138,7 @@ def update_spare_part(conn, spare_part_id, name, part_number, brand, description
 def add_spare_part_import(conn, name, part_number, brand, description, quantity, cost, retail_price,
                           wholesale_price1, wholesale_price2, cost_online, image_filename, category_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("""
@@ -1825,7 +2163,7 @@ def add_spare_part_import(conn, name, part_number, brand, description, quantity,
 def update_spare_part_import(conn, spare_part_id, name, part_number, brand, description, quantity, cost, retail_price,
                              wholesale_price1, wholesale_price2, cost_online, image_filename, category_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("""
@@ -1849,6 +2187,250 @@ def update_spare_part_import(conn, spare_part_id, name, part_number, brand, desc
               category_id, spare_part_id))
 
 
+# --- Bulk Import (Excel) ---
+# ใช้กับการนำเข้าไฟล์ Excel ทีละหลายพันแถว: โหลดข้อมูลที่ต้องใช้เทียบครั้งเดียว แล้วเขียนแบบ executemany
+# (ลำดับคอลัมน์ตรงกับ add_*_import / update_*_import)
+IMPORT_ITEM_COLUMNS = {
+    'tire': ('brand', 'model', 'size', 'quantity', 'cost_sc', 'cost_dunlop', 'cost_online', 'wholesale_price1',
+             'wholesale_price2', 'price_per_item', 'promotion_id', 'year_of_manufacture'),
+    'wheel': ('brand', 'model', 'diameter', 'pcd', 'width', 'et', 'color', 'quantity', 'cost', 'cost_online',
+              'wholesale_price1', 'wholesale_price2', 'retail_price', 'image_filename'),
+    'spare_part': ('name', 'part_number', 'brand', 'description', 'quantity', 'cost', 'retail_price',
+                   'wholesale_price1', 'wholesale_price2', 'cost_online', 'image_filename', 'category_id'),
+}
+
+ITEM_TABLES = {'tire': 'tires', 'wheel': 'wheels', 'spare_part': 'spare_parts'}
+
+BARCODE_TABLES = {
+    'tire': ('tire_barcodes', 'tire_id'),
+    'wheel': ('wheel_barcodes', 'wheel_id'),
+    'spare_part': ('spare_part_barcodes', 'spare_part_id'),
+}
+
+def get_import_items(conn, item_type):
+    """สินค้าทั้งหมดของประเภทนี้ (รวมที่ถูกลบ เหมือนการค้นหาตอน import) : {id: dict ของคอลัมน์ที่ import}"""
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT id, {', '.join(IMPORT_ITEM_COLUMNS[item_type])} FROM {ITEM_TABLES[item_type]}")
+    return {row['id']: dict(row) for row in cursor.fetchall()}
+
+def get_all_barcode_owners(conn):
+    """Barcode ทุกประเภทสินค้า : {barcode_string: (item_type, item_id)}"""
+    cursor = conn.cursor()
+    owners = {}
+    for item_type, (table_name, id_column) in BARCODE_TABLES.items():
+        cursor.execute(f"SELECT barcode_string, {id_column} AS item_id FROM {table_name}")
+        for row in cursor.fetchall():
+            owners[row['barcode_string']] = (item_type, row['item_id'])
+    return owners
+
+def get_existing_barcodes(conn, barcode_strings):
+    """barcode ใน barcode_strings ที่มีอยู่แล้วในตารางบาร์โค้ดประเภทใดก็ได้ : set"""
+    barcode_strings = list(barcode_strings)
+    if not barcode_strings:
+        return set()
+    placeholders = ', '.join(['?'] * len(barcode_strings))
+    query = " UNION ".join(f"SELECT barcode_string FROM {table_name} WHERE barcode_string IN ({placeholders})"
+                           for table_name, _ in BARCODE_TABLES.values())
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile(query), tuple(barcode_strings) * len(BARCODE_TABLES))
+    return {row[0] for row in cursor.fetchall()}
+
+def reserve_barcode_block(conn, sequence_name, size):
+    """
+    จองเลขลำดับ size ค่าต่อกันจาก barcode_sequences (ผู้เรียกเป็นคน commit) คืน (เลขแรก, เลขสุดท้าย)
+    ใช้ UPSERT ... RETURNING คำสั่งเดียวเหมือน next_job_number แต่ละ worker จึงได้ช่วงเลขที่ไม่ทับกัน
+    """
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile("""
+        INSERT INTO barcode_sequences (name, last_value) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET last_value = barcode_sequences.last_value + ?
+        RETURNING last_value
+    """), (sequence_name, size, size))
+    last_value = cursor.fetchone()[0]
+    return last_value - size + 1, last_value
+
+def bulk_insert_import_items(conn, item_type, rows):
+    """เพิ่มสินค้าหลายรายการ rows เป็น tuple ตามลำดับ IMPORT_ITEM_COLUMNS คืน list ของ id ตามลำดับเดียวกัน"""
+    if not rows:
+        return []
+    columns = IMPORT_ITEM_COLUMNS[item_type]
+    table_name = ITEM_TABLES[item_type]
+    cursor = conn.cursor()
+    if is_postgres_conn(conn):
+        from psycopg2.extras import execute_values
+        result = execute_values(cursor, f"""
+            INSERT INTO {table_name} ({', '.join(columns)}, is_deleted)
+            VALUES %s RETURNING id
+        """, rows, template=f"({', '.join(['%s'] * len(columns))}, FALSE)", page_size=len(rows), fetch=True)
+        return [row['id'] for row in result]
+
+    # SQLite: ต้องใช้ lastrowid ทีละแถว (ทำงานใน process เดียวกัน ไม่มี round trip)
+    query = f"INSERT INTO {table_name} ({', '.join(columns)}, is_deleted) VALUES ({', '.join(['?'] * len(columns))}, 0)"
+    new_ids = []
+    for row in rows:
+        cursor.execute(query, row)
+        new_ids.append(cursor.lastrowid)
+    return new_ids
+
+def bulk_update_import_items(conn, item_type, rows):
+    """อัปเดตสินค้าหลายรายการ rows เป็น tuple ตามลำดับ IMPORT_ITEM_COLUMNS ตามด้วย id"""
+    if not rows:
+        return
+    columns = IMPORT_ITEM_COLUMNS[item_type]
+    cursor = conn.cursor()
+    cursor.executemany(get_dialect(conn).compile(
+        f"UPDATE {ITEM_TABLES[item_type]} SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?"
+    ), rows)
+
+def bulk_add_barcodes(conn, item_type, rows):
+    """rows: (item_id, barcode_string, is_primary) ข้าม barcode ที่มีอยู่แล้ว"""
+    if not rows:
+        return
+    table_name, id_column = BARCODE_TABLES[item_type]
+    cursor = conn.cursor()
+    if is_postgres_conn(conn):
+        cursor.executemany(f"INSERT INTO {table_name} ({id_column}, barcode_string, is_primary_barcode) VALUES (%s, %s, %s) ON CONFLICT (barcode_string) DO NOTHING", rows)
+    else:
+        cursor.executemany(f"INSERT OR IGNORE INTO {table_name} ({id_column}, barcode_string, is_primary_barcode) VALUES (?, ?, ?)", rows)
+
+def bulk_add_import_movements(conn, item_type, rows, user_id=None):
+    """
+    บันทึก movement จากการ import หลายรายการ rows: (item_id, type, quantity_change, remaining_quantity, notes)
+    ไม่มีช่องทางขายจึงไม่มีค่าคอมมิชชั่น
+    """
+    if not rows:
+        return
+    timestamp = get_bkk_time()
+    table_name, id_column = MOVEMENT_TABLES[item_type]
+    cursor = conn.cursor()
+    cursor.executemany(get_dialect(conn).compile(f"""
+        INSERT INTO {table_name} ({id_column}, timestamp, type, quantity_change, remaining_quantity, notes, user_id, commission_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+    """), [(item_id, timestamp.isoformat(), move_type, quantity_change, remaining_quantity, notes, user_id)
+           for item_id, move_type, quantity_change, remaining_quantity, notes in rows])
+    if not daily_stock_snapshots_ready(conn):
+        return
+    movement_counts = defaultdict(int)
+    for row in rows:
+        movement_counts[row[0]] += 1
+    for item_id, move_type, quantity_change, _, _ in rows:
+        if movement_counts[item_id] == 1:
+            record_snapshot_movement(conn, item_type, item_id, timestamp, new=(move_type, quantity_change))
+    # สินค้าที่มีหลาย movement ในไฟล์เดียว (แถวซ้ำ) สร้าง snapshot ของสินค้านั้นใหม่จาก movement จริง
+    for item_id, count in movement_counts.items():
+        if count > 1:
+            rebuild_daily_stock_snapshots(conn, item_types=[item_type], item_id=item_id)
+
+def bulk_add_tire_cost_history(conn, rows, user_id, notes=""):
+    """rows: (tire_id, old_cost, new_cost)"""
+    if not rows:
+        return
+    changed_at = get_bkk_time().isoformat()
+    cursor = conn.cursor()
+    cursor.executemany(get_dialect(conn).compile(
+        "INSERT INTO tire_cost_history (tire_id, changed_at, old_cost_sc, new_cost_sc, user_id, notes) VALUES (?, ?, ?, ?, ?, ?)"
+    ), [(tire_id, changed_at, old_cost, new_cost, user_id, notes) for tire_id, old_cost, new_cost in rows])
+
+# --- Background import jobs ---
+IMPORT_JOB_FIELDS = ('status', 'processed', 'total', 'message', 'result')
+
+def create_import_job(conn, job_id, item_type, user_id, total, owner, message=None):
+    now = get_bkk_time().isoformat()
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile("""
+        INSERT INTO import_jobs (id, item_type, user_id, status, processed, total, message, owner, created_at, heartbeat_at)
+        VALUES (?, ?, ?, 'queued', 0, ?, ?, ?, ?, ?)
+    """), (job_id, item_type, user_id, total, message, owner, now, now))
+
+def update_import_job(conn, job_id, **fields):
+    """อัปเดตสถานะงานนำเข้า (fields ตาม IMPORT_JOB_FIELDS) พร้อมเวลา heartbeat ไม่ระบุ fields = อัปเดตแค่ heartbeat"""
+    unknown = set(fields) - set(IMPORT_JOB_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown import job fields: {', '.join(sorted(unknown))}")
+    assignments = [f"{field} = ?" for field in fields] + ['heartbeat_at = ?']
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile(f"UPDATE import_jobs SET {', '.join(assignments)} WHERE id = ?"),
+                   tuple(fields.values()) + (get_bkk_time().isoformat(), job_id))
+
+def get_import_job(conn, job_id):
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile("SELECT * FROM import_jobs WHERE id = ?"), (job_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+def fail_stale_import_job(conn, job_id, heartbeat_before, message):
+    """ปิดงานที่ยังค้างเป็น queued/running แต่ heartbeat ล่าสุดเก่ากว่า heartbeat_before (ผู้เรียกเป็นคน commit) คืน True ถ้าปิด"""
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile("""
+        UPDATE import_jobs SET status = 'failed', message = ?
+        WHERE id = ? AND status IN ('queued', 'running') AND heartbeat_at < ?
+    """), (message, job_id, heartbeat_before.isoformat()))
+    return cursor.rowcount > 0
+
+def delete_import_jobs_before(conn, created_before):
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile("DELETE FROM import_jobs WHERE created_at < ?"), (created_before.isoformat(),))
+
+
+# --- Export (Excel/CSV) ---
+# อ่านสินค้าทีละ batch ด้วย server-side cursor (PostgreSQL) เพื่อไม่ต้องโหลดทั้ง catalogue เข้าหน่วยความจำ
+EXPORT_BATCH_SIZE = 1000
+
+def _primary_barcode_select(item_type, item_alias):
+    table_name, id_column = BARCODE_TABLES[item_type]
+    return f"""(SELECT b.barcode_string FROM {table_name} b WHERE b.{id_column} = {item_alias}.id
+                ORDER BY b.is_primary_barcode DESC, b.barcode_string ASC LIMIT 1) AS primary_barcode"""
+
+# เรียงแบบเดียวกับไฟล์ export เดิม (ตัวพิมพ์เล็ก, ค่าว่างไว้ท้าย)
+EXPORT_QUERIES = {
+    'tire': f"""
+        SELECT t.*, p.name AS promo_name, p.type AS promo_type, p.value1 AS promo_value1, p.value2 AS promo_value2,
+               p.is_active AS promo_is_active, {_primary_barcode_select('tire', 't')}
+        FROM tires t
+        LEFT JOIN promotions p ON t.promotion_id = p.id
+        WHERE t.is_deleted = {{false}}
+        ORDER BY t.brand IS NULL, LOWER(t.brand), t.model IS NULL, LOWER(t.model), t.size IS NULL, LOWER(t.size), t.id
+    """,
+    'wheel': f"""
+        SELECT w.*, {_primary_barcode_select('wheel', 'w')}
+        FROM wheels w
+        WHERE w.is_deleted = {{false}}
+        ORDER BY w.brand IS NULL, LOWER(w.brand), w.model IS NULL, LOWER(w.model), w.diameter, w.id
+    """,
+    'spare_part': f"""
+        SELECT sp.*, spc.name AS category_name, {_primary_barcode_select('spare_part', 'sp')}
+        FROM spare_parts sp
+        LEFT JOIN spare_part_categories spc ON sp.category_id = spc.id
+        WHERE sp.is_deleted = {{false}}
+        ORDER BY spc.name IS NULL, LOWER(spc.name), sp.brand IS NULL, LOWER(sp.brand), sp.name IS NULL, LOWER(sp.name), sp.id
+    """,
+}
+
+def iter_export_rows(conn, item_type, batch_size=EXPORT_BATCH_SIZE):
+    """
+    generator คืนสินค้าที่ยังไม่ถูกลบทีละแถว (dict) เรียงตามลำดับของไฟล์ export
+    PostgreSQL ใช้ named cursor ให้ server ส่งมาทีละ batch ส่วน SQLite cursor อ่านทีละแถวอยู่แล้ว
+    """
+    if is_postgres_conn(conn):
+        cursor = conn.cursor(name=f"export_{item_type}_{os.urandom(4).hex()}", cursor_factory=DictCursor)
+        cursor.itersize = batch_size
+    else:
+        cursor = conn.cursor()
+    try:
+        cursor.execute(get_dialect(conn).compile(EXPORT_QUERIES[item_type]))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                row = dict(row)
+                if item_type == 'tire':
+                    row = _process_tire_listing_row(row)
+                yield row
+    finally:
+        cursor.close()
+
+
 def get_all_spare_parts(conn, query=None, brand_filter='all', category_filter='all', include_deleted=False):
     cursor = conn.cursor()
     sql_query_base = """
@@ -1858,7 +2440,7 @@ def get_all_spare_parts(conn, query=None, brand_filter='all', category_filter='a
     """
     params = []
     conditions = []
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if not include_deleted:
         conditions.append("sp.is_deleted = FALSE" if is_postgres else "sp.is_deleted = 0")
@@ -1906,11 +2488,29 @@ def get_all_spare_parts(conn, query=None, brand_filter='all', category_filter='a
     spare_parts = cursor.fetchall()
     return [dict(row) for row in spare_parts]
 
+def get_spare_parts_by_ids(conn, spare_part_ids):
+    """ดึงอะไหล่ตาม id (รวมที่ถูกลบ) ในรูปแบบเดียวกับ get_all_spare_parts"""
+    spare_part_ids = list(spare_part_ids)
+    if not spare_part_ids:
+        return []
+    cursor = conn.cursor()
+    placeholders = ', '.join(['?'] * len(spare_part_ids))
+    cursor.execute(get_dialect(conn).compile(f"""
+        SELECT sp.*, spc.name AS category_name, spc.parent_id AS category_parent_id
+        FROM spare_parts sp
+        LEFT JOIN spare_part_categories spc ON sp.category_id = spc.id
+        WHERE sp.id IN ({placeholders})
+    """), spare_part_ids)
+    return [dict(row) for row in cursor.fetchall()]
+
+def spare_part_listing_sort_key(spare_part_item):
+    return (spare_part_item.get('brand') or '', spare_part_item.get('category_name') or '', spare_part_item.get('name') or '')
+
 
 def update_spare_part_movement(conn, movement_id, new_notes, new_image_filename, new_type, new_quantity_change,
                                new_channel_id, new_online_platform_id, new_wholesale_customer_id, new_return_customer_type):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     query_old = f"SELECT spare_part_id, type, quantity_change, timestamp FROM spare_part_movements WHERE id = {placeholder}"
@@ -1953,6 +2553,7 @@ def update_spare_part_movement(conn, movement_id, new_notes, new_image_filename,
     cursor.execute(update_query, params)
 
     update_spare_part_quantity(conn, old_spare_part_id, current_quantity_in_stock)
+    record_snapshot_movement(conn, 'spare_part', old_spare_part_id, movement_timestamp, old=(old_type, old_quantity_change), new=(new_type, new_quantity_change))
 
     query_before = f"SELECT COALESCE(SUM(CASE WHEN type IN ('IN', 'RETURN') THEN quantity_change ELSE -quantity_change END), 0) FROM spare_part_movements WHERE spare_part_id = {placeholder} AND (timestamp < {placeholder} OR (timestamp = {placeholder} AND id < {placeholder}))"
     cursor.execute(query_before, (old_spare_part_id, movement_timestamp, movement_timestamp, movement_id))
@@ -1976,7 +2577,7 @@ def delete_spare_part_movement(conn, movement_id, deleted_by_user_id):
     ลบข้อมูลการเคลื่อนไหวสต็อกอะไหล่, บันทึกประวัติการลบ, และปรับยอดคงเหลือ
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     # 1. ดึงข้อมูลการเคลื่อนไหวที่จะลบ (รวมข้อมูล item)
     if is_postgres:
@@ -2037,6 +2638,7 @@ def delete_spare_part_movement(conn, movement_id, deleted_by_user_id):
         cursor.execute("DELETE FROM spare_part_movements WHERE id = %s", (movement_id,))
     else:
         cursor.execute("DELETE FROM spare_part_movements WHERE id = ?", (movement_id,))
+    record_snapshot_movement(conn, 'spare_part', spare_part_id, movement_timestamp, old=(move_type, quantity_change))
 
     # 5. อัปเดต remaining_quantity ของรายการที่ตามมา
     if is_postgres:
@@ -2069,63 +2671,20 @@ def delete_spare_part_movement(conn, movement_id, deleted_by_user_id):
 
 def update_spare_part_quantity(conn, spare_part_id, new_quantity):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("UPDATE spare_parts SET quantity = %s WHERE id = %s", (new_quantity, spare_part_id))
     else:
         cursor.execute("UPDATE spare_parts SET quantity = ? WHERE id = ?", (new_quantity, spare_part_id))
 
 def add_spare_part_movement(conn, spare_part_id, move_type, quantity_change, remaining_quantity, notes, image_filename=None, user_id=None,
-                      channel_id=None, online_platform_id=None, wholesale_customer_id=None, return_customer_type=None):
-    timestamp = get_bkk_time()
-    cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
-
-    commission_amount = 0.0
-
-    if move_type == 'OUT' and channel_id:
-        sales_channel_name = get_sales_channel_name(conn, channel_id)
-        
-        if sales_channel_name == 'หน้าร้าน':
-            date_str = timestamp.strftime('%Y-%m-%d')
-            # --- START: แก้ไขชื่อตารางตรงนี้ ---
-            comm_query = "SELECT commission_amount_per_item FROM commission_programs WHERE item_type = 'spare_part' AND item_id = ? AND start_date <= ? AND (end_date IS NULL OR end_date >= ?)"
-            # --- END: แก้ไขชื่อตารางตรงนี้ ---
-            comm_params = (spare_part_id, date_str, date_str)
-            
-            if is_postgres:
-                comm_query = comm_query.replace('?', '%s')
-            
-            cursor.execute(comm_query, comm_params)
-            commission_program = cursor.fetchone()
-
-            if commission_program:
-                commission_per_item = commission_program['commission_amount_per_item']
-                commission_amount = commission_per_item * quantity_change
-
-    # ... (ส่วน INSERT INTO ไม่ต้องแก้ไข) ...
-    if "psycopg2" in str(type(conn)):
-        cursor.execute("""
-            INSERT INTO spare_part_movements (spare_part_id, timestamp, type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-                                        channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-                                        commission_amount)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (spare_part_id, timestamp.isoformat(), move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-              channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-              commission_amount))
-    else:
-        cursor.execute("""
-            INSERT INTO spare_part_movements (spare_part_id, timestamp, type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-                                        channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-                                        commission_amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (spare_part_id, timestamp.isoformat(), move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-              channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-              commission_amount))
+                            channel_id=None, online_platform_id=None, wholesale_customer_id=None, return_customer_type=None):
+    _add_stock_movement(conn, 'spare_part', spare_part_id, move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
+                        channel_id, online_platform_id, wholesale_customer_id, return_customer_type)
 
 def delete_spare_part(conn, spare_part_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("UPDATE spare_parts SET is_deleted = TRUE WHERE id = %s", (spare_part_id,))
     else:
@@ -2133,7 +2692,7 @@ def delete_spare_part(conn, spare_part_id):
 
 def get_deleted_spare_parts(conn):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     sql_query = """
         SELECT sp.*, spc.name AS category_name
         FROM spare_parts sp
@@ -2150,7 +2709,7 @@ def get_deleted_spare_parts(conn):
 
 def restore_spare_part(conn, spare_part_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("UPDATE spare_parts SET is_deleted = FALSE WHERE id = %s", (spare_part_id,))
     else:
@@ -2158,7 +2717,7 @@ def restore_spare_part(conn, spare_part_id):
 
 def get_all_spare_part_brands(conn):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("SELECT DISTINCT brand FROM spare_parts WHERE is_deleted = FALSE AND brand IS NOT NULL AND brand != '' ORDER BY brand")
     else:
@@ -2169,7 +2728,7 @@ def get_all_spare_part_brands(conn):
 # --- Spare Part Barcode Functions ---
 def add_spare_part_barcode(conn, spare_part_id, barcode_string, is_primary=False):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("INSERT INTO spare_part_barcodes (spare_part_id, barcode_string, is_primary_barcode) VALUES (%s, %s, %s) ON CONFLICT (barcode_string) DO NOTHING",
                        (spare_part_id, barcode_string, is_primary))
@@ -2179,7 +2738,7 @@ def add_spare_part_barcode(conn, spare_part_id, barcode_string, is_primary=False
 
 def get_spare_part_id_by_barcode(conn, barcode_string):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("SELECT spare_part_id FROM spare_part_barcodes WHERE barcode_string = %s", (barcode_string,))
     else:
@@ -2189,7 +2748,7 @@ def get_spare_part_id_by_barcode(conn, barcode_string):
 
 def get_barcodes_for_spare_part(conn, spare_part_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("SELECT barcode_string, is_primary_barcode FROM spare_part_barcodes WHERE spare_part_id = %s ORDER BY is_primary_barcode DESC, barcode_string ASC", (spare_part_id,))
     else:
@@ -2198,7 +2757,7 @@ def get_barcodes_for_spare_part(conn, spare_part_id):
 
 def delete_spare_part_barcode(conn, barcode_string):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor.execute("DELETE FROM spare_part_barcodes WHERE barcode_string = %s", (barcode_string,))
     else:
@@ -2208,7 +2767,7 @@ def delete_spare_part_barcode(conn, barcode_string):
 def add_promotion(conn, name, promo_type, value1, value2, is_active):
     created_at = get_bkk_time().isoformat()
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             INSERT INTO promotions (name, type, value1, value2, is_active, created_at)
             VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
@@ -2224,7 +2783,7 @@ def add_promotion(conn, name, promo_type, value1, value2, is_active):
 
 def get_spare_part_movement(conn, movement_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             SELECT spm.*, sp.name AS spare_part_name, sp.part_number, sp.brand AS spare_part_brand, u.username,
                    sc.name AS channel_name,
@@ -2259,7 +2818,7 @@ def get_spare_part_movement(conn, movement_id):
 
 def get_promotion(conn, promo_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT * FROM promotions WHERE id = %s", (promo_id,))
     else:
         cursor.execute("SELECT * FROM promotions WHERE id = ?", (promo_id,))
@@ -2270,7 +2829,7 @@ def get_promotion(conn, promo_id):
 
 def get_all_promotions(conn, include_inactive=False):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         query = "SELECT id, name, type, value1, value2, is_active, created_at FROM promotions"
         if not include_inactive:
             query += " WHERE is_active = TRUE AND is_deleted = FALSE"
@@ -2286,7 +2845,7 @@ def get_all_promotions(conn, include_inactive=False):
     promotions = cursor.fetchall()
 
     # แก้ไขส่วนนี้: Convert created_at to datetime objects for SQLite using fromisoformat
-    if "sqlite3" in str(type(conn)):
+    if not is_postgres_conn(conn):
         bkk_tz = pytz.timezone('Asia/Bangkok') # Ensure BKK_TZ is defined or imported
         converted_promotions = []
         for promo in promotions:
@@ -2308,7 +2867,7 @@ def get_all_promotions(conn, include_inactive=False):
 
 def update_promotion(conn, promo_id, name, promo_type, value1, value2, is_active):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             UPDATE promotions SET
                 name = %s,
@@ -2331,7 +2890,7 @@ def update_promotion(conn, promo_id, name, promo_type, value1, value2, is_active
 
 def delete_promotion(conn, promo_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("UPDATE tires SET promotion_id = NULL WHERE promotion_id = %s", (promo_id,))
         cursor.execute("DELETE FROM promotions WHERE id = %s", (promo_id,))
     else:
@@ -2341,7 +2900,7 @@ def delete_promotion(conn, promo_id):
 # --- Tire Functions ---
 def add_tire(conn, brand, model, size, quantity, cost_sc, cost_dunlop, cost_online, wholesale_price1, wholesale_price2, price_per_item, promotion_id, year_of_manufacture, user_id=None):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("""
@@ -2362,32 +2921,20 @@ def add_tire(conn, brand, model, size, quantity, cost_sc, cost_dunlop, cost_onli
     
     return tire_id
 
+TIRE_WITH_PROMO_SELECT = """
+    SELECT t.*,
+           p.name AS promo_name,
+           p.type AS promo_type,
+           p.value1 AS promo_value1,
+           p.value2 AS promo_value2,
+           p.is_active AS promo_is_active
+    FROM tires t
+    LEFT JOIN promotions p ON t.promotion_id = p.id
+"""
+
 def get_tire(conn, tire_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
-        cursor.execute("""
-            SELECT t.*, 
-                   p.name AS promo_name, 
-                   p.type AS promo_type, 
-                   p.value1 AS promo_value1, 
-                   p.value2 AS promo_value2,
-                   p.is_active AS promo_is_active
-            FROM tires t
-            LEFT JOIN promotions p ON t.promotion_id = p.id
-            WHERE t.id = %s
-        """, (tire_id,))
-    else:
-        cursor.execute("""
-            SELECT t.*, 
-                   p.name AS promo_name, 
-                   p.type AS promo_type, 
-                   p.value1 AS promo_value1, 
-                   p.value2 AS promo_value2,
-                   p.is_active AS promo_is_active
-            FROM tires t
-            LEFT JOIN promotions p ON t.promotion_id = p.id
-            WHERE t.id = ?
-        """, (tire_id,))
+    get_dialect(conn).execute(cursor, 'tire_by_id', TIRE_WITH_PROMO_SELECT + " WHERE t.id = ?", (tire_id,))
     tire = cursor.fetchone()
     
     if tire:
@@ -2397,13 +2944,7 @@ def get_tire(conn, tire_id):
         tire_dict['display_price_for_4'] = tire_dict['price_per_item'] * 4 if tire_dict['price_per_item'] is not None else None
         tire_dict['display_promo_description'] = None
 
-        promo_active_check = tire_dict['promo_is_active']
-        if "psycopg2" in str(type(conn)):
-            promo_active_check = bool(promo_active_check)
-        else:
-            promo_active_check = (promo_active_check == 1)
-
-        if tire_dict['promotion_id'] is not None and promo_active_check:
+        if tire_dict['promotion_id'] is not None and bool(tire_dict['promo_is_active']):
             promo_calc_result = calculate_tire_promo_prices(
                 tire_dict['price_per_item'],
                 tire_dict['promo_type'],
@@ -2419,7 +2960,7 @@ def get_tire(conn, tire_id):
 
 def update_tire(conn, tire_id, brand, model, size, cost_sc, cost_dunlop, cost_online, wholesale_price1, wholesale_price2, price_per_item, promotion_id, year_of_manufacture):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             UPDATE tires SET
                 brand = %s,
@@ -2454,7 +2995,7 @@ def update_tire(conn, tire_id, brand, model, size, cost_sc, cost_dunlop, cost_on
 
 def add_tire_import(conn, brand, model, size, quantity, cost_sc, cost_dunlop, cost_online, wholesale_price1, wholesale_price2, price_per_item, promotion_id, year_of_manufacture): 
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             INSERT INTO tires (brand, model, size, quantity, cost_sc, cost_dunlop, cost_online, wholesale_price1, wholesale_price2, price_per_item, promotion_id, year_of_manufacture, is_deleted)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE) RETURNING id
@@ -2470,7 +3011,7 @@ def add_tire_import(conn, brand, model, size, quantity, cost_sc, cost_dunlop, co
 
 def update_tire_import(conn, tire_id, brand, model, size, quantity, cost_sc, cost_dunlop, cost_online, wholesale_price1, wholesale_price2, price_per_item, promotion_id, year_of_manufacture): 
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             UPDATE tires SET
                 brand = %s,
@@ -2564,95 +3105,95 @@ def calculate_tire_promo_prices(price_per_item, promo_type, promo_value1, promo_
     }
 
 
+_RIM_SIZE_R_PATTERN = re.compile(r'R(\d+)$')
+_TRAILING_DIGITS_PATTERN = re.compile(r'(\d+)$')
+
 def get_all_tires(conn, query=None, brand_filter='all', include_deleted=False): # ADDED include_deleted
     cursor = conn.cursor()
-    sql_query = """
-        SELECT t.*,
-               p.name AS promo_name,
-               p.type AS promo_type,
-               p.value1 AS promo_value1,
-               p.value2 AS promo_value2,
-               p.is_active AS promo_is_active
-        FROM tires t
-        LEFT JOIN promotions p ON t.promotion_id = p.id
-    """
-    params = []
-    conditions = []
+    dialect = get_dialect(conn)
 
-    if not include_deleted: # Conditionally add is_deleted filter
-        conditions.append("t.is_deleted = FALSE" if "psycopg2" in str(type(conn)) else "t.is_deleted = 0")
-
-    if query:
-        search_term = f"%{query}%"
-        conditions.append("(t.brand ILIKE %s OR t.model ILIKE %s OR t.size ILIKE %s)" if "psycopg2" in str(type(conn)) else "(t.brand LIKE ? OR t.model LIKE ? OR t.size LIKE ?)")
-        params.extend([search_term, search_term, search_term])
+    if not query and brand_filter == 'all':
+        # เส้นทางหลัก (โหลดทั้ง catalogue เข้า cache) ใช้ statement ที่ compile/prepare ไว้แล้ว
+        if include_deleted:
+            dialect.execute(cursor, 'all_tires_with_deleted', TIRE_WITH_PROMO_SELECT + " ORDER BY t.brand, t.model")
+        else:
+            dialect.execute(cursor, 'all_tires', TIRE_WITH_PROMO_SELECT + " WHERE t.is_deleted = {false} ORDER BY t.brand, t.model")
+    else:
+        params = []
+        conditions = []
 
-    if brand_filter != 'all':
-        conditions.append("t.brand = %s" if "psycopg2" in str(type(conn)) else "t.brand = ?")
-        params.append(brand_filter)
+        if not include_deleted: # Conditionally add is_deleted filter
+            conditions.append("t.is_deleted = {false}")
 
-    if conditions:
-        sql_query += " WHERE " + " AND ".join(conditions) # Changed WHERE to AND for filtering soft deleted items
+        if query:
+            search_term = f"%{query}%"
+            like = dialect.like_operator
+            conditions.append(f"(t.brand {like} ? OR t.model {like} ? OR t.size {like} ?)")
+            params.extend([search_term, search_term, search_term])
 
-    sql_query += " ORDER BY t.brand, t.model"
+        if brand_filter != 'all':
+            conditions.append("t.brand = ?")
+            params.append(brand_filter)
 
-    if "psycopg2" in str(type(conn)):
-        cursor.execute(sql_query, params)
-    else:
-        cursor.execute(sql_query, params)
+        sql_query = TIRE_WITH_PROMO_SELECT
+        if conditions:
+            sql_query += " WHERE " + " AND ".join(conditions)
+        sql_query += " ORDER BY t.brand, t.model"
+        cursor.execute(dialect.compile(sql_query), params)
 
     tires = cursor.fetchall()
 
-    processed_tires = []
-    for tire in tires:
-        tire_dict = dict(tire) 
-
-        promo_calc_result = {
-            'price_per_item_promo': None,
-            'price_for_4_promo': tire_dict['price_per_item'] * 4 if tire_dict['price_per_item'] is not None else None,
-            'promo_description_text': None
-        }
+    processed_tires = [_process_tire_listing_row(dict(tire)) for tire in tires]
+    return sorted(processed_tires, key=tire_listing_sort_key)
 
-        promo_active_check = tire_dict['promo_is_active']
-        if "psycopg2" in str(type(conn)):
-            promo_active_check = bool(promo_active_check)
-        else:
-            promo_active_check = (promo_active_check == 1)
+def get_tires_by_ids(conn, tire_ids):
+    """ดึงยางตาม id (รวมที่ถูกลบ) ในรูปแบบเดียวกับ get_all_tires"""
+    tire_ids = list(tire_ids)
+    if not tire_ids:
+        return []
+    cursor = conn.cursor()
+    placeholders = ', '.join(['?'] * len(tire_ids))
+    cursor.execute(get_dialect(conn).compile(TIRE_WITH_PROMO_SELECT + f" WHERE t.id IN ({placeholders})"), tire_ids)
+    return [_process_tire_listing_row(dict(tire)) for tire in cursor.fetchall()]
 
-        if tire_dict['promotion_id'] is not None and promo_active_check:
-            promo_calc_result = calculate_tire_promo_prices(
-                tire_dict['price_per_item'],
-                tire_dict['promo_type'],
-                tire_dict['promo_value1'],
-                tire_dict['promo_value2']
-            )
+def _process_tire_listing_row(tire_dict):
+    promo_calc_result = {
+        'price_per_item_promo': None,
+        'price_for_4_promo': tire_dict['price_per_item'] * 4 if tire_dict['price_per_item'] is not None else None,
+        'promo_description_text': None
+    }
 
-        tire_dict['display_promo_price_per_item'] = promo_calc_result['price_per_item_promo']
-        tire_dict['display_price_for_4'] = promo_calc_result['price_for_4_promo']
-        tire_dict['display_promo_description_text'] = promo_calc_result['promo_description_text']
+    if tire_dict['promotion_id'] is not None and bool(tire_dict['promo_is_active']):
+        promo_calc_result = calculate_tire_promo_prices(
+            tire_dict['price_per_item'],
+            tire_dict['promo_type'],
+            tire_dict['promo_value1'],
+            tire_dict['promo_value2']
+        )
 
-        processed_tires.append(tire_dict)
+    tire_dict['display_promo_price_per_item'] = promo_calc_result['price_per_item_promo']
+    tire_dict['display_price_for_4'] = promo_calc_result['price_for_4_promo']
+    tire_dict['display_promo_description_text'] = promo_calc_result['promo_description_text']
+    return tire_dict
 
-    def sort_key_for_tire_size(tire_item):
-        size_str = tire_item.get('size', '')
-        match = re.search(r'R(\d+)$', size_str)
-        if not match:
-            match = re.search(r'(\d+)$', size_str)
+def _rim_size_from_tire_size(size_str):
+    match = _RIM_SIZE_R_PATTERN.search(size_str)
+    if not match:
+        match = _TRAILING_DIGITS_PATTERN.search(size_str)
 
-        try:
-            rim_size = int(match.group(1)) if match else 0
-            return rim_size
-        except ValueError:
-            return 0
-    
-    sorted_processed_tires = sorted(processed_tires, key=lambda x: (x.get('brand', ''), x.get('model', ''), sort_key_for_tire_size(x)))
+    try:
+        rim_size = int(match.group(1)) if match else 0
+        return rim_size
+    except ValueError:
+        return 0
 
-    return sorted_processed_tires
+def tire_listing_sort_key(tire_item):
+    return (tire_item.get('brand', ''), tire_item.get('model', ''), _rim_size_from_tire_size(tire_item.get('size', '')))
 
 def get_tire_movement(conn, movement_id):
     cursor = conn.cursor()
     # เพิ่มการดึงข้อมูล channel, platform, customer, return_customer_type
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             SELECT tm.*, t.brand, t.model, t.size, u.username,
                    sc.name AS channel_name,
@@ -2688,7 +3229,7 @@ def get_tire_movement(conn, movement_id):
 def get_wheel_movement(conn, movement_id):
     cursor = conn.cursor()
     # เพิ่มการดึงข้อมูล channel, platform, customer, return_customer_type
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             SELECT wm.*, w.brand, w.model, w.diameter, u.username,
                    sc.name AS channel_name,
@@ -2724,7 +3265,7 @@ def get_wheel_movement(conn, movement_id):
 def update_wheel_movement(conn, movement_id, new_notes, new_image_filename, new_type, new_quantity_change, 
                           new_channel_id, new_online_platform_id, new_wholesale_customer_id, new_return_customer_type):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     query_old = f"SELECT wheel_id, type, quantity_change, timestamp FROM wheel_movements WHERE id = {placeholder}"
@@ -2767,6 +3308,7 @@ def update_wheel_movement(conn, movement_id, new_notes, new_image_filename, new_
     cursor.execute(update_query, params)
 
     update_wheel_quantity(conn, old_wheel_id, current_quantity_in_stock)
+    record_snapshot_movement(conn, 'wheel', old_wheel_id, movement_timestamp, old=(old_type, old_quantity_change), new=(new_type, new_quantity_change))
 
     query_before = f"SELECT COALESCE(SUM(CASE WHEN type IN ('IN', 'RETURN') THEN quantity_change ELSE -quantity_change END), 0) FROM wheel_movements WHERE wheel_id = {placeholder} AND (timestamp < {placeholder} OR (timestamp = {placeholder} AND id < {placeholder}))"
     cursor.execute(query_before, (old_wheel_id, movement_timestamp, movement_timestamp, movement_id))
@@ -2788,7 +3330,7 @@ def update_wheel_movement(conn, movement_id, new_notes, new_image_filename, new_
 def update_tire_movement(conn, movement_id, new_notes, new_image_filename, new_type, new_quantity_change,
                          new_channel_id, new_online_platform_id, new_wholesale_customer_id, new_return_customer_type):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     # 1. ดึงข้อมูล movement เดิมทั้งหมดที่จำเป็น
@@ -2840,6 +3382,7 @@ def update_tire_movement(conn, movement_id, new_notes, new_image_filename, new_t
 
     # 5. อัปเดตสต็อกคงเหลือล่าสุดในตารางสินค้าหลัก
     update_tire_quantity(conn, old_tire_id, current_quantity_in_stock)
+    record_snapshot_movement(conn, 'tire', old_tire_id, movement_timestamp, old=(old_type, old_quantity_change), new=(new_type, new_quantity_change))
 
     # 6. --- [โค้ดฉบับเต็ม] คำนวณ remaining_quantity ใหม่ทั้งหมดตั้งแต่จุดที่แก้ไข ---
     # คำนวณสต็อกเริ่มต้น ณ ก่อนเวลาของรายการที่แก้ไข
@@ -2868,7 +3411,7 @@ def delete_tire_movement(conn, movement_id, deleted_by_user_id):
     ลบข้อมูลการเคลื่อนไหวสต็อกยาง, บันทึกประวัติการลบ, และปรับยอดคงเหลือ
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     # 1. ดึงข้อมูลการเคลื่อนไหวที่จะลบ (รวมข้อมูล item)
     if is_postgres:
@@ -2930,6 +3473,7 @@ def delete_tire_movement(conn, movement_id, deleted_by_user_id):
         cursor.execute("DELETE FROM tire_movements WHERE id = %s", (movement_id,))
     else:
         cursor.execute("DELETE FROM tire_movements WHERE id = ?", (movement_id,))
+    record_snapshot_movement(conn, 'tire', tire_id, movement_timestamp, old=(move_type, quantity_change))
 
     # 5. อัปเดต remaining_quantity ของรายการที่ตามมา (เหมือนเดิม)
     # ... (ส่วนนี้ไม่ต้องแก้ไข) ...
@@ -2966,7 +3510,7 @@ def delete_wheel_movement(conn, movement_id, deleted_by_user_id):
     ลบข้อมูลการเคลื่อนไหวสต็อกแม็ก, บันทึกประวัติการลบ, และปรับยอดคงเหลือ
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     # 1. ดึงข้อมูลการเคลื่อนไหวที่จะลบ (รวมข้อมูล item)
     if is_postgres:
@@ -3027,6 +3571,7 @@ def delete_wheel_movement(conn, movement_id, deleted_by_user_id):
         cursor.execute("DELETE FROM wheel_movements WHERE id = %s", (movement_id,))
     else:
         cursor.execute("DELETE FROM wheel_movements WHERE id = ?", (movement_id,))
+    record_snapshot_movement(conn, 'wheel', wheel_id, movement_timestamp, old=(move_type, quantity_change))
 
     # 5. อัปเดต remaining_quantity ของรายการที่ตามมา
     if is_postgres:
@@ -3059,76 +3604,520 @@ def delete_wheel_movement(conn, movement_id, deleted_by_user_id):
 
 def update_tire_quantity(conn, tire_id, new_quantity):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("UPDATE tires SET quantity = %s WHERE id = %s", (new_quantity, tire_id))
     else:
         cursor.execute("UPDATE tires SET quantity = ? WHERE id = ?", (new_quantity, tire_id))
     
 def update_wheel_quantity(conn, wheel_id, new_quantity):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("UPDATE wheels SET quantity = %s WHERE id = %s", (new_quantity, wheel_id))
     else:
         cursor.execute("UPDATE wheels SET quantity = ? WHERE id = ?", (new_quantity, wheel_id))
 
-def add_tire_movement(conn, tire_id, move_type, quantity_change, remaining_quantity, notes, image_filename=None, user_id=None,
-                      channel_id=None, online_platform_id=None, wholesale_customer_id=None, return_customer_type=None):
+# ตาราง movement และคอลัมน์ id ของสินค้าแต่ละประเภท
+MOVEMENT_TABLES = {
+    'tire': ('tire_movements', 'tire_id'),
+    'wheel': ('wheel_movements', 'wheel_id'),
+    'spare_part': ('spare_part_movements', 'spare_part_id'),
+}
+
+def get_movement_item_id(conn, item_type, movement_id):
+    """คืน id ของสินค้าที่ movement นี้อ้างถึง"""
+    table_name, id_column = MOVEMENT_TABLES[item_type]
+    cursor = conn.cursor()
+    get_dialect(conn).execute(cursor, f"{item_type}_movement_item_id", f"SELECT {id_column} FROM {table_name} WHERE id = ?", (movement_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+# --- Daily Stock Snapshots ---
+# daily_stock_snapshots เก็บยอดรายวันต่อสินค้า (เฉพาะวันที่มี movement) ทำให้รายงานย้อนหลังอ่านเป็นช่วงวันที่ได้เลย
+# ไม่ต้อง SUM movement ตั้งแต่วันแรก ยอดยกมาของวันที่ไม่มี movement = closing ของ snapshot ล่าสุดก่อนหน้า
+SNAPSHOTS_READY_SETTING = 'daily_stock_snapshots_ready'
+SNAPSHOT_BATCH_SIZE = 1000
+_snapshots_ready = False
+
+def _movement_quantities(move_type, quantity_change):
+    """คืน (in, out, return) ของ movement หนึ่งรายการ"""
+    if move_type == 'IN':
+        return (quantity_change, 0, 0)
+    if move_type == 'OUT':
+        return (0, quantity_change, 0)
+    if move_type == 'RETURN':
+        return (0, 0, quantity_change)
+    return (0, 0, 0)
+
+def _bkk_day_bounds(day):
+    """คืน (เริ่มวัน, เริ่มวันถัดไป) ของวันที่ใน BKK timezone เป็น iso string"""
+    start_of_day = BKK_TZ.localize(datetime.combine(day, datetime.min.time()))
+    start_of_next_day = BKK_TZ.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return start_of_day.isoformat(), start_of_next_day.isoformat()
+
+def _to_bkk_date(value):
+    """date / datetime -> วันที่ตามเวลาไทย (datetime ที่ไม่มี timezone ถือว่าเป็นเวลาไทยอยู่แล้ว)"""
+    if isinstance(value, datetime):
+        return value.astimezone(BKK_TZ).date() if value.tzinfo else value.date()
+    return value
+
+def _bkk_date_range(start_date, end_date):
+    """
+    ช่วงวันที่ (รวมวันสุดท้าย) -> (เริ่มวันแรก, เริ่มวันถัดจากวันสุดท้าย) เวลาไทย เป็น iso string
+    ใช้กับ Dialect.timestamp_range แทน DATE(timestamp) BETWEEN ... หรือ <= 23:59:59
+    """
+    return _bkk_day_bounds(_to_bkk_date(start_date))[0], _bkk_day_bounds(_to_bkk_date(end_date))[1]
+
+def create_daily_stock_snapshots_table(conn):
+    cursor = conn.cursor()
+    is_postgres = is_postgres_conn(conn)
+    if is_postgres:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_stock_snapshots (
+                item_type VARCHAR(20) NOT NULL,
+                item_id INTEGER NOT NULL,
+                snapshot_date DATE NOT NULL,
+                opening_quantity INTEGER NOT NULL DEFAULT 0,
+                in_quantity INTEGER NOT NULL DEFAULT 0,
+                out_quantity INTEGER NOT NULL DEFAULT 0,
+                return_quantity INTEGER NOT NULL DEFAULT 0,
+                closing_quantity INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (item_type, item_id, snapshot_date)
+            );
+        """)
+    else: # SQLite
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_stock_snapshots (
+                item_type TEXT NOT NULL,
+                item_id INTEGER NOT NULL,
+                snapshot_date TEXT NOT NULL,
+                opening_quantity INTEGER NOT NULL DEFAULT 0,
+                in_quantity INTEGER NOT NULL DEFAULT 0,
+                out_quantity INTEGER NOT NULL DEFAULT 0,
+                return_quantity INTEGER NOT NULL DEFAULT 0,
+                closing_quantity INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (item_type, item_id, snapshot_date)
+            );
+        """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_daily_stock_snapshots_type_date ON daily_stock_snapshots(item_type, snapshot_date);")
+
+def record_snapshot_movement(conn, item_type, item_id, movement_timestamp, old=None, new=None):
+    """
+    ปรับ daily_stock_snapshots ตาม movement ที่เพิ่ม (new) / ลบ (old) / แก้ไข (ทั้ง old และ new)
+    old, new เป็น tuple (type, quantity_change) เรียกหลังจากแก้ตาราง movement แล้ว (ใน transaction เดียวกัน)
+    """
+    old_quantities = _movement_quantities(*old) if old else (0, 0, 0)
+    new_quantities = _movement_quantities(*new) if new else (0, 0, 0)
+    in_delta, out_delta, return_delta = (n - o for n, o in zip(new_quantities, old_quantities))
+    net_delta = in_delta + return_delta - out_delta
+    if not (in_delta or out_delta or return_delta):
+        return
+    if not daily_stock_snapshots_ready(conn):
+        # ยังไม่ได้ backfill (ตารางอาจยังไม่มี) ข้อมูลทั้งหมดจะถูกสร้างตอนรัน backfill_snapshots.py
+        return
+
+    snapshot_date = convert_to_bkk_time(movement_timestamp).date()
+    snapshot_date_str = snapshot_date.isoformat()
+    cursor = conn.cursor()
+    dialect = get_dialect(conn)
+
+    dialect.execute(cursor, "snapshot_update_day", """
+        UPDATE daily_stock_snapshots
+        SET in_quantity = in_quantity + ?, out_quantity = out_quantity + ?, return_quantity = return_quantity + ?,
+            closing_quantity = closing_quantity + ?
+        WHERE item_type = ? AND item_id = ? AND snapshot_date = ?
+    """, (in_delta, out_delta, return_delta, net_delta, item_type, item_id, snapshot_date_str))
+
+    if cursor.rowcount == 0:
+        # ยังไม่มีแถวของวันนั้น สร้างจาก movement จริงของสินค้านี้ (ซึ่งรวมการเปลี่ยนแปลงครั้งนี้แล้ว)
+        _insert_snapshot_day_from_movements(conn, item_type, item_id, snapshot_date)
+    elif old and not new:
+        # ลบ movement สุดท้ายของวันนั้นออกไปแล้ว ไม่ต้องเก็บแถวที่ว่าง (ยอดยกมาของวันถัดไปยังคำนวณได้จากแถวก่อนหน้า)
+        dialect.execute(cursor, "snapshot_delete_empty_day", """
+            DELETE FROM daily_stock_snapshots
+            WHERE item_type = ? AND item_id = ? AND snapshot_date = ? AND in_quantity = 0 AND out_quantity = 0 AND return_quantity = 0
+        """, (item_type, item_id, snapshot_date_str))
+
+    dialect.execute(cursor, "snapshot_shift_later_days", """
+        UPDATE daily_stock_snapshots
+        SET opening_quantity = opening_quantity + ?, closing_quantity = closing_quantity + ?
+        WHERE item_type = ? AND item_id = ? AND snapshot_date > ?
+    """, (net_delta, net_delta, item_type, item_id, snapshot_date_str))
+
+def _insert_snapshot_day_from_movements(conn, item_type, item_id, snapshot_date):
+    table_name, id_column = MOVEMENT_TABLES[item_type]
+    start_of_day_iso, start_of_next_day_iso = _bkk_day_bounds(snapshot_date)
+    cursor = conn.cursor()
+    dialect = get_dialect(conn)
+    start_param = dialect.cast_timestamp('?')
+    next_day_param = dialect.cast_timestamp('?')
+
+    dialect.execute(cursor, f"snapshot_day_from_{table_name}", f"""
+        SELECT
+            COALESCE(SUM(CASE WHEN timestamp < {start_param}
+                              THEN (CASE WHEN type IN ('IN', 'RETURN') THEN quantity_change ELSE -quantity_change END)
+                              ELSE 0 END), 0) AS opening_quantity,
+            COALESCE(SUM(CASE WHEN timestamp >= {start_param} AND type = 'IN' THEN quantity_change ELSE 0 END), 0) AS in_quantity,
+            COALESCE(SUM(CASE WHEN timestamp >= {start_param} AND type = 'OUT' THEN quantity_change ELSE 0 END), 0) AS out_quantity,
+            COALESCE(SUM(CASE WHEN timestamp >= {start_param} AND type = 'RETURN' THEN quantity_change ELSE 0 END), 0) AS return_quantity
+        FROM {table_name}
+        WHERE {id_column} = ? AND timestamp < {next_day_param}
+    """, (start_of_day_iso, start_of_day_iso, start_of_day_iso, start_of_day_iso, item_id, start_of_next_day_iso))
+    row = cursor.fetchone()
+    opening, in_qty, out_qty, return_qty = (int(row[0] or 0), int(row[1] or 0), int(row[2] or 0), int(row[3] or 0))
+
+    dialect.execute(cursor, "snapshot_insert_day", """
+        INSERT INTO daily_stock_snapshots (item_type, item_id, snapshot_date, opening_quantity, in_quantity, out_quantity, return_quantity, closing_quantity)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (item_type, item_id, snapshot_date.isoformat(), opening, in_qty, out_qty, return_qty, opening + in_qty + return_qty - out_qty))
+
+def rebuild_daily_stock_snapshots(conn, item_types=None, item_id=None):
+    """
+    สร้าง daily_stock_snapshots ใหม่จากตาราง movement (backfill)
+    item_types: list ของประเภทสินค้า (None = ทุกประเภท), item_id: สร้างใหม่เฉพาะสินค้าชิ้นเดียว
+    เมื่อสร้างใหม่ครบทุกประเภทจะตั้งค่า SNAPSHOTS_READY_SETTING ให้รายงานเริ่มอ่านจาก snapshot
+    คืนจำนวนแถว snapshot ที่สร้าง
+    """
+    global _snapshots_ready
+    item_types = list(item_types or MOVEMENT_TABLES.keys())
+    create_daily_stock_snapshots_table(conn)
+    cursor = conn.cursor()
+    dialect = get_dialect(conn)
+    insert_sql = dialect.compile("""
+        INSERT INTO daily_stock_snapshots (item_type, item_id, snapshot_date, opening_quantity, in_quantity, out_quantity, return_quantity, closing_quantity)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """)
+    total_rows = 0
+
+    for item_type in item_types:
+        table_name, id_column = MOVEMENT_TABLES[item_type]
+        item_filter = f" WHERE {id_column} = ?" if item_id is not None else ""
+        filter_params = (item_id,) if item_id is not None else ()
+
+        cursor.execute(dialect.compile("DELETE FROM daily_stock_snapshots WHERE item_type = ?" + (" AND item_id = ?" if item_id is not None else "")),
+                       (item_type,) + filter_params)
+        cursor.execute(dialect.compile(f"SELECT {id_column} AS item_id, timestamp, type, quantity_change FROM {table_name}{item_filter} ORDER BY {id_column}, timestamp, id"),
+                       filter_params)
+
+        batch = []
+        current_item = None
+        day = None
+        running_closing = 0
+
+        while True:
+            rows = cursor.fetchmany(SNAPSHOT_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                row_date = convert_to_bkk_time(row['timestamp']).date().isoformat()
+                if row['item_id'] != current_item or row_date != day[2]:
+                    if day is not None:
+                        batch.append(tuple(day[:7]) + (running_closing,))
+                    if row['item_id'] != current_item:
+                        current_item = row['item_id']
+                        running_closing = 0
+                    day = [item_type, current_item, row_date, running_closing, 0, 0, 0]
+                in_qty, out_qty, return_qty = _movement_quantities(row['type'], row['quantity_change'])
+                day[4] += in_qty
+                day[5] += out_qty
+                day[6] += return_qty
+                running_closing += in_qty + return_qty - out_qty
+        if day is not None:
+            batch.append(tuple(day) + (running_closing,))
+
+        # ใช้ cursor แยกสำหรับ insert เพื่อไม่ให้ทับผลของ SELECT ที่กำลังอ่านอยู่
+        insert_cursor = conn.cursor()
+        for start in range(0, len(batch), SNAPSHOT_BATCH_SIZE):
+            insert_cursor.executemany(insert_sql, batch[start:start + SNAPSHOT_BATCH_SIZE])
+        total_rows += len(batch)
+        print(f"Rebuilt {len(batch)} daily stock snapshot rows for {item_type}")
+
+    if item_id is None and set(item_types) == set(MOVEMENT_TABLES.keys()):
+        set_setting(conn, SNAPSHOTS_READY_SETTING, '1')
+        _snapshots_ready = True
+    return total_rows
+
+def daily_stock_snapshots_ready(conn):
+    """snapshot ใช้ได้หลังจาก backfill ครบแล้วเท่านั้น (ก่อนหน้านั้นรายงานจะคำนวณจาก movement)"""
+    global _snapshots_ready
+    if not _snapshots_ready:
+        _snapshots_ready = get_setting(conn, SNAPSHOTS_READY_SETTING) == '1'
+    return _snapshots_ready
+
+def get_stock_period_balances(conn, item_type, start_date, end_date):
+    """
+    คืน {item_id: {opening_quantity, in_quantity, out_quantity, return_quantity, closing_quantity}}
+    ของสินค้าทุกชิ้นที่มีประวัติถึง end_date (รวมสินค้าที่ถูกลบ) สำหรับช่วงวันที่ start_date ถึง end_date (BKK)
+    """
+    if not daily_stock_snapshots_ready(conn):
+        return _get_stock_period_balances_from_movements(conn, item_type, start_date, end_date)
+
+    cursor = conn.cursor()
+    dialect = get_dialect(conn)
+    balances = {}
+
+    dialect.execute(cursor, "snapshot_opening_balances", """
+        SELECT s.item_id, s.closing_quantity
+        FROM daily_stock_snapshots s
+        JOIN (
+            SELECT item_id, MAX(snapshot_date) AS last_date
+            FROM daily_stock_snapshots
+            WHERE item_type = ? AND snapshot_date < ?
+            GROUP BY item_id
+        ) last_snapshot ON s.item_id = last_snapshot.item_id AND s.snapshot_date = last_snapshot.last_date
+        WHERE s.item_type = ?
+    """, (item_type, start_date.isoformat(), item_type))
+    for row in cursor.fetchall():
+        balances[row['item_id']] = {'opening_quantity': row['closing_quantity'], 'in_quantity': 0, 'out_quantity': 0, 'return_quantity': 0}
+
+    dialect.execute(cursor, "snapshot_period_totals", """
+        SELECT item_id, SUM(in_quantity) AS in_quantity, SUM(out_quantity) AS out_quantity, SUM(return_quantity) AS return_quantity
+        FROM daily_stock_snapshots
+        WHERE item_type = ? AND snapshot_date BETWEEN ? AND ?
+        GROUP BY item_id
+    """, (item_type, start_date.isoformat(), end_date.isoformat()))
+    for row in cursor.fetchall():
+        balance = balances.setdefault(row['item_id'], {'opening_quantity': 0})
+        balance['in_quantity'] = int(row['in_quantity'] or 0)
+        balance['out_quantity'] = int(row['out_quantity'] or 0)
+        balance['return_quantity'] = int(row['return_quantity'] or 0)
+    cursor.close()
+
+    for balance in balances.values():
+        balance['closing_quantity'] = balance['opening_quantity'] + balance['in_quantity'] + balance['return_quantity'] - balance['out_quantity']
+    return balances
+
+def _get_stock_period_balances_from_movements(conn, item_type, start_date, end_date):
+    table_name, id_column = MOVEMENT_TABLES[item_type]
+    start_iso, end_iso = _bkk_date_range(start_date, end_date)
+    dialect = get_dialect(conn)
+    start_param = dialect.cast_timestamp('?')
+    end_param = dialect.cast_timestamp('?')
+
+    cursor = conn.cursor()
+    cursor.execute(dialect.compile(f"""
+        SELECT {id_column} AS item_id,
+               COALESCE(SUM(CASE WHEN timestamp < {start_param}
+                                 THEN (CASE WHEN type IN ('IN', 'RETURN') THEN quantity_change ELSE -quantity_change END)
+                                 ELSE 0 END), 0) AS opening_quantity,
+               COALESCE(SUM(CASE WHEN timestamp >= {start_param} AND type = 'IN' THEN quantity_change ELSE 0 END), 0) AS in_quantity,
+               COALESCE(SUM(CASE WHEN timestamp >= {start_param} AND type = 'OUT' THEN quantity_change ELSE 0 END), 0) AS out_quantity,
+               COALESCE(SUM(CASE WHEN timestamp >= {start_param} AND type = 'RETURN' THEN quantity_change ELSE 0 END), 0) AS return_quantity
+        FROM {table_name}
+        WHERE timestamp < {end_param}
+        GROUP BY {id_column}
+    """), (start_iso,) * 4 + (end_iso,))
+
+    balances = {}
+    for row in cursor.fetchall():
+        balance = {key: int(row[key] or 0) for key in ('opening_quantity', 'in_quantity', 'out_quantity', 'return_quantity')}
+        balance['closing_quantity'] = balance['opening_quantity'] + balance['in_quantity'] + balance['return_quantity'] - balance['out_quantity']
+        balances[row['item_id']] = balance
+    cursor.close()
+    return balances
+
+# คอลัมน์ข้อมูลสินค้าที่ใช้แสดงในรายงานสต็อก
+STOCK_REPORT_ITEM_COLUMNS = {
+    'tire': ("tires", "i.brand, i.model, i.size", ""),
+    'wheel': ("wheels", "i.brand, i.model, i.diameter, i.pcd, i.width", ""),
+    'spare_part': ("spare_parts", "i.name, i.brand, i.part_number, i.category_id, spc.name AS category_name",
+                   "LEFT JOIN spare_part_categories spc ON i.category_id = spc.id"),
+}
+
+def get_stock_report_items(conn, item_type):
+    """คืน {item_id: row} ข้อมูลสินค้าทั้งหมดของประเภทนี้ (รวมที่ถูกลบ) สำหรับใช้ประกอบรายงานสต็อก"""
+    item_table, item_columns, item_joins = STOCK_REPORT_ITEM_COLUMNS[item_type]
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT i.id AS item_id, {item_columns}, i.is_deleted FROM {item_table} i {item_joins}")
+    items = {row['item_id']: dict(row) for row in cursor.fetchall()}
+    cursor.close()
+    return items
+
+def get_daily_stock_balances(conn, item_type, report_date):
+    """
+    ยอดยกมา / รับเข้า / จ่ายออก / รับคืน / คงเหลือ ของวันที่ report_date สำหรับสินค้าทุกชิ้นที่มีประวัติถึงสิ้นวัน
+    คืน dict {item_id: row} โดย row มีข้อมูลสินค้า (STOCK_REPORT_ITEM_COLUMNS), is_deleted และยอดจาก get_stock_period_balances
+    """
+    balances = get_stock_period_balances(conn, item_type, report_date, report_date)
+    items = get_stock_report_items(conn, item_type)
+    return {item_id: {**items[item_id], **balance} for item_id, balance in balances.items() if item_id in items}
+
+def _add_stock_movement(conn, item_type, item_id, move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
+                        channel_id, online_platform_id, wholesale_customer_id, return_customer_type):
     timestamp = get_bkk_time()
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    dialect = get_dialect(conn)
+    table_name, id_column = MOVEMENT_TABLES[item_type]
 
     commission_amount = 0.0
 
     if move_type == 'OUT' and channel_id:
         sales_channel_name = get_sales_channel_name(conn, channel_id)
-        
+
         if sales_channel_name == 'หน้าร้าน':
             date_str = timestamp.strftime('%Y-%m-%d')
-            # --- START: แก้ไขชื่อตารางตรงนี้ ---
-            comm_query = "SELECT commission_amount_per_item FROM commission_programs WHERE item_type = 'tire' AND item_id = ? AND start_date <= ? AND (end_date IS NULL OR end_date >= ?)"
-            # --- END: แก้ไขชื่อตารางตรงนี้ ---
-            comm_params = (tire_id, date_str, date_str)
-
-            if is_postgres:
-                comm_query = comm_query.replace('?', '%s')
-            
-            cursor.execute(comm_query, comm_params)
+            dialect.execute(cursor, f"commission_for_{item_type}",
+                            f"SELECT commission_amount_per_item FROM commission_programs WHERE item_type = '{item_type}' AND item_id = ? AND start_date <= ? AND (end_date IS NULL OR end_date >= ?)",
+                            (item_id, date_str, date_str))
             commission_program = cursor.fetchone()
 
             if commission_program:
                 commission_per_item = commission_program['commission_amount_per_item']
                 commission_amount = commission_per_item * quantity_change
 
-    # ... (ส่วน INSERT INTO ไม่ต้องแก้ไข) ...
-    if is_postgres:
-        cursor.execute("""
-            INSERT INTO tire_movements (tire_id, timestamp, type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-                                        channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-                                        commission_amount)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (tire_id, timestamp.isoformat(), move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-              channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-              commission_amount))
-    else:
-        cursor.execute("""
-            INSERT INTO tire_movements (tire_id, timestamp, type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-                                        channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-                                        commission_amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (tire_id, timestamp.isoformat(), move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-              channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-              commission_amount))
+    dialect.execute(cursor, f"insert_{table_name}", f"""
+        INSERT INTO {table_name} ({id_column}, timestamp, type, quantity_change, remaining_quantity, notes, image_filename, user_id,
+                                  channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
+                                  commission_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (item_id, timestamp.isoformat(), move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
+          channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
+          commission_amount))
+    record_snapshot_movement(conn, item_type, item_id, timestamp, new=(move_type, quantity_change))
+
+def add_tire_movement(conn, tire_id, move_type, quantity_change, remaining_quantity, notes, image_filename=None, user_id=None,
+                      channel_id=None, online_platform_id=None, wholesale_customer_id=None, return_customer_type=None):
+    _add_stock_movement(conn, 'tire', tire_id, move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
+                        channel_id, online_platform_id, wholesale_customer_id, return_customer_type)
+
+# --- Stock Ledger ---
+# ทำรายการรับเข้า/จ่ายออก/รับคืนหลายรายการใน transaction เดียว
+# ตัดสต็อกด้วย UPDATE แบบมีเงื่อนไข (quantity >= จำนวนที่ตัด) ให้ฐานข้อมูลตัดสินเองเมื่อหลายเครื่องสแกนพร้อมกัน
+# แทนการอ่านค่า -> คำนวณใน Python -> เขียนกลับ ซึ่งทำให้สต็อกติดลบได้
+
+def _apply_quantity_deltas(conn, item_type, deltas, move_type):
+    """
+    deltas: {item_id: quantity} เพิ่ม (IN/RETURN) หรือลด (OUT) quantity ของสินค้า
+    คืน {item_id: แถวสินค้าหลังอัปเดต} เฉพาะรายการที่อัปเดตได้ (ไม่พบสินค้า/สต็อกไม่พอ จะไม่อยู่ในผลลัพธ์)
+    """
+    table_name = ITEM_TABLES[item_type]
+    sign = '-' if move_type == 'OUT' else '+'
+    cursor = conn.cursor()
+    if is_postgres_conn(conn):
+        # PostgreSQL: UPDATE ทุกรายการของประเภทนี้ใน statement เดียว
+        from psycopg2.extras import execute_values
+        stock_condition = "AND i.quantity >= v.quantity" if move_type == 'OUT' else ""
+        rows = execute_values(cursor, f"""
+            UPDATE {table_name} i SET quantity = i.quantity {sign} v.quantity
+            FROM (VALUES %s) AS v(id, quantity)
+            WHERE i.id = v.id {stock_condition}
+            RETURNING i.*
+        """, list(deltas.items()), page_size=len(deltas), fetch=True)
+        return {row['id']: dict(row) for row in rows}
+
+    stock_condition = " AND quantity >= ?" if move_type == 'OUT' else ""
+    updated = {}
+    for item_id, quantity in deltas.items():
+        params = (quantity, item_id, quantity) if move_type == 'OUT' else (quantity, item_id)
+        cursor.execute(f"UPDATE {table_name} SET quantity = quantity {sign} ? WHERE id = ?{stock_condition} RETURNING *", params)
+        row = cursor.fetchone()
+        if row:
+            updated[item_id] = dict(row)
+    return updated
+
+def _raise_stock_ledger_error(conn, item_type, item_id, requested_quantity):
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile(f"SELECT * FROM {ITEM_TABLES[item_type]} WHERE id = ?"), (item_id,))
+    item = cursor.fetchone()
+    if not item:
+        raise ValueError(f"ไม่พบสินค้า ID {item_id} ประเภท {item_type} ในฐานข้อมูล")
+    item = dict(item)
+    item_name = item.get('name') or f"{item.get('brand')} {item.get('model')}"
+    raise ValueError(f"สต็อกไม่พอสำหรับ {item_name} (มีอยู่: {item['quantity']}, ต้องการ: {requested_quantity})")
+
+def _get_commission_per_item(conn, item_type, item_ids, date_str):
+    cursor = conn.cursor()
+    placeholders = ', '.join(['?'] * len(item_ids))
+    cursor.execute(get_dialect(conn).compile(f"""
+        SELECT item_id, commission_amount_per_item FROM commission_programs
+        WHERE item_type = ? AND item_id IN ({placeholders}) AND start_date <= ? AND (end_date IS NULL OR end_date >= ?)
+    """), (item_type, *item_ids, date_str, date_str))
+    commissions = {}
+    for row in cursor.fetchall():
+        commissions.setdefault(row['item_id'], row['commission_amount_per_item'])
+    return commissions
+
+def apply_stock_movements(conn, move_type, lines, notes, image_filename=None, user_id=None,
+                          channel_id=None, online_platform_id=None, wholesale_customer_id=None, return_customer_type=None):
+    """
+    บันทึกรายการสต็อกทั้งตะกร้า lines: list ของ (item_type, item_id, quantity)
+    ปรับ quantity ด้วย UPDATE หนึ่งครั้งต่อประเภทสินค้า แล้วเพิ่ม movement ทั้งหมดแบบหลายแถว
+    คืน list ของ dict (item_type, item_id, quantity, remaining_quantity, item) ตามลำดับ lines
+    ถ้าไม่พบสินค้าหรือสต็อกไม่พอจะ raise ValueError ผู้เรียกต้อง rollback (รายการที่อัปเดตไปแล้วจะถูกยกเลิกด้วย)
+    """
+    if move_type not in ('IN', 'OUT', 'RETURN'):
+        raise ValueError(f"ประเภทการทำรายการไม่ถูกต้อง: {move_type}")
+
+    normalized_lines = []
+    totals = defaultdict(lambda: defaultdict(int)) # {item_type: {item_id: quantity รวม}}
+    for item_type, item_id, quantity in lines:
+        if item_type not in ITEM_TABLES:
+            raise ValueError(f"ประเภทสินค้าไม่ถูกต้อง: {item_type}")
+        item_id, quantity = int(item_id), int(quantity)
+        if quantity <= 0:
+            raise ValueError(f"จำนวนไม่ถูกต้องสำหรับรายการ ID: {item_id}")
+        normalized_lines.append((item_type, item_id, quantity))
+        totals[item_type][item_id] += quantity
+
+    updated_items = {}
+    for item_type, deltas in totals.items():
+        rows = _apply_quantity_deltas(conn, item_type, deltas, move_type)
+        for item_id, quantity in deltas.items():
+            if item_id not in rows:
+                _raise_stock_ledger_error(conn, item_type, item_id, quantity)
+            updated_items[(item_type, item_id)] = rows[item_id]
+
+    # คงเหลือของแต่ละบรรทัด: ไล่ย้อนจากยอดสุดท้าย (สินค้าเดียวกันอาจอยู่หลายบรรทัด)
+    sign = -1 if move_type == 'OUT' else 1
+    running_quantity = {key: item['quantity'] for key, item in updated_items.items()}
+    results = [None] * len(normalized_lines)
+    for index in range(len(normalized_lines) - 1, -1, -1):
+        item_type, item_id, quantity = normalized_lines[index]
+        key = (item_type, item_id)
+        results[index] = {'item_type': item_type, 'item_id': item_id, 'quantity': quantity,
+                          'remaining_quantity': running_quantity[key], 'item': updated_items[key]}
+        running_quantity[key] -= sign * quantity
+
+    timestamp = get_bkk_time()
+    commissions = {}
+    if move_type == 'OUT' and channel_id and get_sales_channel_name(conn, channel_id) == 'หน้าร้าน':
+        date_str = timestamp.strftime('%Y-%m-%d')
+        for item_type, deltas in totals.items():
+            commissions[item_type] = _get_commission_per_item(conn, item_type, list(deltas), date_str)
+
+    cursor = conn.cursor()
+    for item_type in totals:
+        table_name, id_column = MOVEMENT_TABLES[item_type]
+        item_commissions = commissions.get(item_type, {})
+        movement_rows = [
+            (result['item_id'], timestamp.isoformat(), move_type, result['quantity'], result['remaining_quantity'], notes,
+             image_filename, user_id, channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
+             (item_commissions.get(result['item_id']) or 0.0) * result['quantity'])
+            for result in results if result['item_type'] == item_type
+        ]
+        columns = f"""{id_column}, timestamp, type, quantity_change, remaining_quantity, notes, image_filename, user_id,
+                      channel_id, online_platform_id, wholesale_customer_id, return_customer_type, commission_amount"""
+        if is_postgres_conn(conn):
+            from psycopg2.extras import execute_values
+            execute_values(cursor, f"INSERT INTO {table_name} ({columns}) VALUES %s", movement_rows, page_size=len(movement_rows))
+        else:
+            cursor.executemany(f"INSERT INTO {table_name} ({columns}) VALUES ({', '.join(['?'] * 13)})", movement_rows)
+
+        for item_id, quantity in totals[item_type].items():
+            record_snapshot_movement(conn, item_type, item_id, timestamp, new=(move_type, quantity))
+
+    return results
+
 
 def delete_tire(conn, tire_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("UPDATE tires SET is_deleted = TRUE WHERE id = %s", (tire_id,)) # SOFT DELETE
     else:
         cursor.execute("UPDATE tires SET is_deleted = 1 WHERE id = ?", (tire_id,)) # SOFT DELETE
 
 def get_all_tire_brands(conn):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT DISTINCT brand FROM tires WHERE is_deleted = FALSE ORDER BY brand") # Filter soft deleted
     else:
         cursor.execute("SELECT DISTINCT brand FROM tires WHERE is_deleted = 0 ORDER BY brand") # Filter soft deleted
@@ -3150,7 +4139,7 @@ def get_deleted_tires(conn):
         WHERE t.is_deleted = TRUE
         ORDER BY t.brand, t.model
     """
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute(sql_query)
     else:
         cursor.execute(sql_query.replace('TRUE', '1')) # SQLite boolean
@@ -3168,7 +4157,7 @@ def get_deleted_tires(conn):
 # เพิ่มฟังก์ชันสำหรับกู้คืนยาง (restore_tire)
 def restore_tire(conn, tire_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("UPDATE tires SET is_deleted = FALSE WHERE id = %s", (tire_id,))
     else:
         cursor.execute("UPDATE tires SET is_deleted = 0 WHERE id = ?", (tire_id,))
@@ -3183,9 +4172,9 @@ def get_all_wheels(conn, query=None, brand_filter='all', include_deleted=False):
     conditions = []
 
     if not include_deleted: # Conditionally add is_deleted filter
-        conditions.append("is_deleted = FALSE" if "psycopg2" in str(type(conn)) else "is_deleted = 0")
+        conditions.append("is_deleted = FALSE" if is_postgres_conn(conn) else "is_deleted = 0")
 
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         if query:
             search_term = f"%{query}%"
             conditions.append("(brand ILIKE %s OR model ILIKE %s OR pcd ILIKE %s OR color ILIKE %s)")
@@ -3209,7 +4198,7 @@ def get_all_wheels(conn, query=None, brand_filter='all', include_deleted=False):
     
     sql_query += " ORDER BY brand, model, diameter"
     
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute(sql_query, params)
     else:
         cursor.execute(sql_query, params)
@@ -3221,9 +4210,22 @@ def get_all_wheels(conn, query=None, brand_filter='all', include_deleted=False):
         processed_wheels = wheels_data
     return processed_wheels
 
+def get_wheels_by_ids(conn, wheel_ids):
+    """ดึงแม็กตาม id (รวมที่ถูกลบ) ในรูปแบบเดียวกับ get_all_wheels"""
+    wheel_ids = list(wheel_ids)
+    if not wheel_ids:
+        return []
+    cursor = conn.cursor()
+    placeholders = ', '.join(['?'] * len(wheel_ids))
+    cursor.execute(get_dialect(conn).compile(f"SELECT * FROM wheels WHERE id IN ({placeholders})"), wheel_ids)
+    return [dict(row) for row in cursor.fetchall()]
+
+def wheel_listing_sort_key(wheel_item):
+    return (wheel_item.get('brand') or '', wheel_item.get('model') or '', wheel_item.get('diameter') or 0)
+
 def get_wheel(conn, wheel_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT * FROM wheels WHERE id = %s", (wheel_id,))
     else:
         cursor.execute("SELECT * FROM wheels WHERE id = ?", (wheel_id,))
@@ -3234,7 +4236,7 @@ def get_wheel(conn, wheel_id):
 
 def add_wheel(conn, brand, model, diameter, pcd, width, et, color, quantity, cost, cost_online, wholesale_price1, wholesale_price2, retail_price, image_url, user_id=None):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("""
@@ -3257,7 +4259,7 @@ def add_wheel(conn, brand, model, diameter, pcd, width, et, color, quantity, cos
     
 def update_wheel(conn, wheel_id, brand, model, diameter, pcd, width, et, color, quantity, cost, cost_online, wholesale_price1, wholesale_price2, retail_price, image_url):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             UPDATE wheels SET
                 brand = %s,
@@ -3292,54 +4294,12 @@ def update_wheel(conn, wheel_id, brand, model, diameter, pcd, width, et, color,
 
 def add_wheel_movement(conn, wheel_id, move_type, quantity_change, remaining_quantity, notes, image_filename=None, user_id=None,
                        channel_id=None, online_platform_id=None, wholesale_customer_id=None, return_customer_type=None):
-    timestamp = get_bkk_time()
-    cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
-
-    commission_amount = 0.0
-
-    if move_type == 'OUT' and channel_id:
-        sales_channel_name = get_sales_channel_name(conn, channel_id)
-        
-        if sales_channel_name == 'หน้าร้าน':
-            date_str = timestamp.strftime('%Y-%m-%d')
-            # --- START: แก้ไขชื่อตารางตรงนี้ ---
-            comm_query = "SELECT commission_amount_per_item FROM commission_programs WHERE item_type = 'wheel' AND item_id = ? AND start_date <= ? AND (end_date IS NULL OR end_date >= ?)"
-            # --- END: แก้ไขชื่อตารางตรงนี้ ---
-            comm_params = (wheel_id, date_str, date_str)
-            if is_postgres:
-                comm_query = comm_query.replace('?', '%s')
-            
-            cursor.execute(comm_query, comm_params)
-            commission_program = cursor.fetchone()
-
-            if commission_program:
-                commission_per_item = commission_program['commission_amount_per_item']
-                commission_amount = commission_per_item * quantity_change
-
-    # ... (ส่วน INSERT INTO ไม่ต้องแก้ไข) ...
-    if is_postgres:
-        cursor.execute("""
-            INSERT INTO wheel_movements (wheel_id, timestamp, type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-                                         channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-                                         commission_amount)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (wheel_id, timestamp.isoformat(), move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-              channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-              commission_amount))
-    else:
-        cursor.execute("""
-            INSERT INTO wheel_movements (wheel_id, timestamp, type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-                                         channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-                                         commission_amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (wheel_id, timestamp.isoformat(), move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
-              channel_id, online_platform_id, wholesale_customer_id, return_customer_type,
-              commission_amount))
+    _add_stock_movement(conn, 'wheel', wheel_id, move_type, quantity_change, remaining_quantity, notes, image_filename, user_id,
+                        channel_id, online_platform_id, wholesale_customer_id, return_customer_type)
 
 def add_wheel_import(conn, brand, model, diameter, pcd, width, et, color, quantity, cost, cost_online, wholesale_price1, wholesale_price2, retail_price, image_url):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             INSERT INTO wheels (brand, model, diameter, pcd, width, et, color, quantity, cost, cost_online, wholesale_price1, wholesale_price2, retail_price, image_filename, is_deleted)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE) RETURNING id
@@ -3355,7 +4315,7 @@ def add_wheel_import(conn, brand, model, diameter, pcd, width, et, color, quanti
 
 def update_wheel_import(conn, wheel_id, brand, model, diameter, pcd, width, et, color, quantity, cost, cost_online, wholesale_price1, wholesale_price2, retail_price, image_url):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             UPDATE wheels SET
                 brand = %s,
@@ -3396,14 +4356,14 @@ def update_wheel_import(conn, wheel_id, brand, model, diameter, pcd, width, et,
 
 def delete_wheel(conn, wheel_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("UPDATE wheels SET is_deleted = TRUE WHERE id = %s", (wheel_id,)) # SOFT DELETE
     else:
         cursor.execute("UPDATE wheels SET is_deleted = 1 WHERE id = ?", (wheel_id,)) # SOFT DELETE
 
 def get_all_wheel_brands(conn):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT DISTINCT brand FROM wheels WHERE is_deleted = FALSE ORDER BY brand") # Filter soft deleted
     else:
         cursor.execute("SELECT DISTINCT brand FROM wheels WHERE is_deleted = 0 ORDER BY brand") # Filter soft deleted
@@ -3419,7 +4379,7 @@ def get_deleted_wheels(conn):
         WHERE w.is_deleted = TRUE
         ORDER BY w.brand, w.model
     """
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute(sql_query)
     else:
         cursor.execute(sql_query.replace('TRUE', '1')) # SQLite boolean
@@ -3432,14 +4392,14 @@ def get_deleted_wheels(conn):
 # เพิ่มฟังก์ชันสำหรับกู้คืนแม็ก (restore_wheel)
 def restore_wheel(conn, wheel_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("UPDATE wheels SET is_deleted = FALSE WHERE id = %s", (wheel_id,))
     else:
         cursor.execute("UPDATE wheels SET is_deleted = 0 WHERE id = ?", (wheel_id,))
 
 def add_wheel_fitment(conn, wheel_id, brand, model, year_start, year_end):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("""
             INSERT INTO wheel_fitments (wheel_id, brand, model, year_start, year_end)
             VALUES (%s, %s, %s, %s, %s)
@@ -3452,7 +4412,7 @@ def add_wheel_fitment(conn, wheel_id, brand, model, year_start, year_end):
 
 def get_wheel_fitments(conn, wheel_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT * FROM wheel_fitments WHERE wheel_id = %s ORDER BY brand, model, year_start", (wheel_id,))
     else:
         cursor.execute("SELECT * FROM wheel_fitments WHERE wheel_id = ? ORDER BY brand, model, year_start", (wheel_id,))
@@ -3465,7 +4425,7 @@ def get_wheel_fitments(conn, wheel_id):
 
 def delete_wheel_fitment(conn, fitment_id):
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("DELETE FROM wheel_fitments WHERE id = %s", (fitment_id,))
     else:
         cursor.execute("DELETE FROM wheel_fitments WHERE id = ?", (fitment_id,))
@@ -3478,7 +4438,7 @@ def add_tire_barcode(conn, tire_id, barcode_string, is_primary=False):
     is_primary: True ถ้าต้องการให้เป็นบาร์โค้ดหลักสำหรับยางนี้
     """
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("INSERT INTO tire_barcodes (tire_id, barcode_string, is_primary_barcode) VALUES (%s, %s, %s) ON CONFLICT (barcode_string) DO NOTHING",
                        (tire_id, barcode_string, is_primary))
     else:
@@ -3491,7 +4451,7 @@ def get_tire_id_by_barcode(conn, barcode_string):
     ค้นหา tire_id จาก barcode_string ที่ระบุ
     """
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT tire_id FROM tire_barcodes WHERE barcode_string = %s", (barcode_string,))
     else:
         cursor.execute("SELECT tire_id FROM tire_barcodes WHERE barcode_string = ?", (barcode_string,))
@@ -3503,7 +4463,7 @@ def get_barcodes_for_tire(conn, tire_id):
     ดึง Barcode ID ทั้งหมดสำหรับยางที่ระบุ
     """
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT barcode_string, is_primary_barcode FROM tire_barcodes WHERE tire_id = %s ORDER BY is_primary_barcode DESC, barcode_string ASC", (tire_id,))
     else:
         cursor.execute("SELECT barcode_string, is_primary_barcode FROM tire_barcodes WHERE tire_id = ? ORDER BY is_primary_barcode DESC, barcode_string ASC", (tire_id,))
@@ -3519,7 +4479,7 @@ def add_wheel_barcode(conn, wheel_id, barcode_string, is_primary=False):
     is_primary: True ถ้าต้องการให้เป็นบาร์โค้ดหลักสำหรับแม็กนี้
     """
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("INSERT INTO wheel_barcodes (wheel_id, barcode_string, is_primary_barcode) VALUES (%s, %s, %s) ON CONFLICT (barcode_string) DO NOTHING",
                        (wheel_id, barcode_string, is_primary))
     else:
@@ -3532,7 +4492,7 @@ def delete_tire_barcode(conn, barcode_string):
     ลบ Barcode ID ที่ระบุออกจากตาราง tire_barcodes
     """
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("DELETE FROM tire_barcodes WHERE barcode_string = %s", (barcode_string,))
     else:
         cursor.execute("DELETE FROM tire_barcodes WHERE barcode_string = ?", (barcode_string,))
@@ -3542,7 +4502,7 @@ def delete_wheel_barcode(conn, barcode_string):
     ลบ Barcode ID ที่ระบุออกจากตาราง wheel_barcodes
     """
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("DELETE FROM wheel_barcodes WHERE barcode_string = %s", (barcode_string,))
     else:
         cursor.execute("DELETE FROM wheel_barcodes WHERE barcode_string = ?", (barcode_string,))
@@ -3552,7 +4512,7 @@ def get_wheel_id_by_barcode(conn, barcode_string):
     ค้นหา wheel_id จาก barcode_string ที่ระบุ
     """
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT wheel_id FROM wheel_barcodes WHERE barcode_string = %s", (barcode_string,))
     else:
         cursor.execute("SELECT wheel_id FROM wheel_barcodes WHERE barcode_string = ?", (barcode_string,))
@@ -3564,105 +4524,73 @@ def get_barcodes_for_wheel(conn, wheel_id):
     ดึง Barcode ID ทั้งหมดสำหรับแม็กที่ระบุ
     """
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("SELECT barcode_string, is_primary_barcode FROM wheel_barcodes WHERE wheel_id = %s ORDER BY is_primary_barcode DESC, barcode_string ASC", (wheel_id,))
     else:
         cursor.execute("SELECT barcode_string, is_primary_barcode FROM wheel_barcodes WHERE wheel_id = ? ORDER BY is_primary_barcode DESC, barcode_string ASC", (wheel_id,))
     return [dict(row) for row in cursor.fetchall()]
 
-def recalculate_all_stock_histories(conn):
+def recalculate_all_stock_histories(conn, item_types=None, item_id=None, start_date=None, end_date=None, progress=None):
     """
-    Recalculates the entire history of remaining_quantity for ALL tires and wheels.
-    This is a one-time fix for corrupted historical data.
+    คำนวณ remaining_quantity ของประวัติการเคลื่อนไหวใหม่แบบ set-based
+    ยอดสะสมคำนวณด้วย window function (SUM() OVER PARTITION BY สินค้า ORDER BY timestamp, id) แล้ว UPDATE ทีเดียวต่อประเภทสินค้า
+    ขอบเขต: item_types (None = ทุกประเภท), item_id (สินค้าชิ้นเดียว), start_date/end_date (แก้เฉพาะรายการในช่วงวันที่
+    แต่ยอดสะสมยังนับจากประวัติทั้งหมด) และ progress(message) สำหรับรายงานความคืบหน้า
+    คืน dict {'updated_rows', 'item_types', 'elapsed_seconds'}
     """
-    cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
-    print("Starting recalculation for all items...")
-
-    # --- Recalculate for all TIRES ---
-    print("Processing tires...")
-    cursor.execute("SELECT DISTINCT tire_id FROM tire_movements")
-    all_tire_ids = [row['tire_id'] for row in cursor.fetchall()]
-
-    for tire_id in all_tire_ids:
-        print(f"  Recalculating for tire_id: {tire_id}")
-        # ดึงประวัติทั้งหมดของยางเส้นนี้ เรียงตามเวลา
-        sql_get_movements = f"""
-            SELECT id, type, quantity_change FROM tire_movements
-            WHERE tire_id = ? ORDER BY timestamp ASC, id ASC
-        """
-        cursor.execute(sql_get_movements.replace('?','%s') if is_postgres else sql_get_movements, (tire_id,))
-        movements = cursor.fetchall()
-
-        # เริ่มคำนวณใหม่จาก 0
-        running_stock = 0
-        for move in movements:
-            if move['type'] in ('IN', 'RETURN'):
-                running_stock += move['quantity_change']
-            elif move['type'] == 'OUT':
-                running_stock -= move['quantity_change']
-
-            # อัปเดตค่า remaining_quantity ของทุกรายการให้ถูกต้อง
-            sql_update_remaining = f"UPDATE tire_movements SET remaining_quantity = ? WHERE id = ?"
-            cursor.execute(sql_update_remaining.replace('?','%s') if is_postgres else sql_update_remaining, (running_stock, move['id']))
-
-    # --- Recalculate for all WHEELS ---
-    print("Processing wheels...")
-    cursor.execute("SELECT DISTINCT wheel_id FROM wheel_movements")
-    all_wheel_ids = [row['wheel_id'] for row in cursor.fetchall()]
-
-    for wheel_id in all_wheel_ids:
-        print(f"  Recalculating for wheel_id: {wheel_id}")
-        # ดึงประวัติทั้งหมดของแม็กวงนี้ เรียงตามเวลา
-        sql_get_movements = f"""
-            SELECT id, type, quantity_change FROM wheel_movements
-            WHERE wheel_id = ? ORDER BY timestamp ASC, id ASC
-        """
-        cursor.execute(sql_get_movements.replace('?','%s') if is_postgres else sql_get_movements, (wheel_id,))
-        movements = cursor.fetchall()
-
-        running_stock = 0
-        for move in movements:
-            if move['type'] in ('IN', 'RETURN'):
-                running_stock += move['quantity_change']
-            elif move['type'] == 'OUT':
-                running_stock -= move['quantity_change']
-
-            sql_update_remaining = f"UPDATE wheel_movements SET remaining_quantity = ? WHERE id = ?"
-            cursor.execute(sql_update_remaining.replace('?','%s') if is_postgres else sql_update_remaining, (running_stock, move['id']))
-
-    # --- NEW: Recalculate for all SPARE PARTS ---
-    print("Processing spare parts...")
-    cursor.execute("SELECT DISTINCT spare_part_id FROM spare_part_movements")
-    all_spare_part_ids = [row['spare_part_id'] for row in cursor.fetchall()]
-
-    for spare_part_id in all_spare_part_ids:
-        print(f"  Recalculating for spare_part_id: {spare_part_id}")
-        sql_get_movements = f"""
-            SELECT id, type, quantity_change FROM spare_part_movements
-            WHERE spare_part_id = ? ORDER BY timestamp ASC, id ASC
-        """
-        cursor.execute(sql_get_movements.replace('?','%s') if is_postgres else sql_get_movements, (spare_part_id,))
-        movements = cursor.fetchall()
-
-        running_stock = 0
-        for move in movements:
-            if move['type'] in ('IN', 'RETURN'):
-                running_stock += move['quantity_change']
-            elif move['type'] == 'OUT':
-                running_stock -= move['quantity_change']
-
-            sql_update_remaining = f"UPDATE spare_part_movements SET remaining_quantity = ? WHERE id = ?"
-            cursor.execute(sql_update_remaining.replace('?','%s') if is_postgres else sql_update_remaining, (running_stock, move['id']))
-
-    print("Recalculation complete!")
-    return "Recalculation complete for all items."
+    item_types = list(item_types or MOVEMENT_TABLES.keys())
+    report = progress or print
+    dialect = get_dialect(conn)
+    cursor = conn.cursor()
+    started_at = time.monotonic()
+    updated_rows = {}
+
+    for item_type in item_types:
+        table_name, id_column = MOVEMENT_TABLES[item_type]
+        type_started_at = time.monotonic()
+
+        partition_filter = ""
+        params = []
+        if item_id is not None:
+            partition_filter = f"WHERE {id_column} = ?"
+            params.append(item_id)
+
+        range_filter = ""
+        if start_date is not None:
+            range_filter += f" AND {table_name}.timestamp >= {dialect.cast_timestamp('?')}"
+            params.append(_bkk_day_bounds(start_date)[0])
+        if end_date is not None:
+            range_filter += f" AND {table_name}.timestamp < {dialect.cast_timestamp('?')}"
+            params.append(_bkk_day_bounds(end_date)[1])
+
+        cursor.execute(dialect.compile(f"""
+            UPDATE {table_name}
+            SET remaining_quantity = running.running_quantity
+            FROM (
+                SELECT id,
+                       SUM(CASE WHEN type IN ('IN', 'RETURN') THEN quantity_change
+                                WHEN type = 'OUT' THEN -quantity_change
+                                ELSE 0 END) OVER (PARTITION BY {id_column} ORDER BY timestamp, id) AS running_quantity
+                FROM {table_name}
+                {partition_filter}
+            ) running
+            WHERE {table_name}.id = running.id
+              AND ({table_name}.remaining_quantity IS NULL OR {table_name}.remaining_quantity <> running.running_quantity)
+              {range_filter}
+        """), tuple(params))
+
+        updated_rows[item_type] = cursor.rowcount
+        report(f"{item_type}: updated {cursor.rowcount} movement rows in {time.monotonic() - type_started_at:.2f}s")
+
+    elapsed_seconds = time.monotonic() - started_at
+    report(f"Recalculation complete in {elapsed_seconds:.2f}s")
+    return {'updated_rows': updated_rows, 'item_types': item_types, 'elapsed_seconds': elapsed_seconds}
 
 def add_notification(conn, message, user_id=None):
     """บันทึกข้อความแจ้งเตือนใหม่ลงในฐานข้อมูล"""
     created_at = get_bkk_time().isoformat()
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute(
             "INSERT INTO notifications (message, user_id, created_at, is_read) VALUES (%s, %s, %s, FALSE)",
             (message, user_id, created_at)
@@ -3672,6 +4600,7 @@ def add_notification(conn, message, user_id=None):
             "INSERT INTO notifications (message, user_id, created_at, is_read) VALUES (?, ?, ?, 0)",
             (message, user_id, created_at)
         )
+    _notify_data_change('notifications')
 
 def get_all_notifications(conn):
     """ดึงการแจ้งเตือนทั้งหมด เรียงจากใหม่ไปเก่า"""
@@ -3696,10 +4625,7 @@ def get_all_notifications(conn):
 def get_unread_notification_count(conn):
     """นับจำนวนการแจ้งเตือนที่ยังไม่ได้อ่าน"""
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
-        cursor.execute("SELECT COUNT(id) FROM notifications WHERE is_read = FALSE")
-    else:
-        cursor.execute("SELECT COUNT(id) FROM notifications WHERE is_read = 0")
+    get_dialect(conn).execute(cursor, 'unread_notification_count', "SELECT COUNT(id) FROM notifications WHERE is_read = {false}")
 
     # ดึงข้อมูลจาก cursor และปิดการใช้งาน
     count = cursor.fetchone()[0]
@@ -3710,7 +4636,7 @@ def mark_all_notifications_as_read(conn):
     """อัปเดตการแจ้งเตือนทั้งหมดให้เป็น 'อ่านแล้ว'"""
     try:
         cursor = conn.cursor()
-        if "psycopg2" in str(type(conn)):
+        if is_postgres_conn(conn):
             cursor.execute("UPDATE notifications SET is_read = TRUE WHERE is_read = FALSE")
         else: # SQLite
             cursor.execute("UPDATE notifications SET is_read = 1 WHERE is_read = 0")
@@ -3723,6 +4649,7 @@ def mark_all_notifications_as_read(conn):
         # --- END DEBUGGING ---
 
         cursor.close()
+        _notify_data_change('notifications')
         print("DEBUG: Transaction committed successfully.")
 
     except Exception as e:
@@ -3732,7 +4659,7 @@ def add_feedback(conn, user_id, feedback_type, message):
     """Adds a new feedback record to the database."""
     created_at = get_bkk_time().isoformat()
     status = 'ใหม่'  # Default status for new feedback
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor = conn.cursor()
@@ -3748,7 +4675,7 @@ def add_feedback(conn, user_id, feedback_type, message):
 
 def get_all_feedback(conn):
     """Retrieves all feedback, joining with usernames."""
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = """
         SELECT f.id, f.feedback_type, f.message, f.status, f.created_at, u.username
         FROM feedback f
@@ -3771,7 +4698,7 @@ def get_all_feedback(conn):
 
 def update_feedback_status(conn, feedback_id, new_status):
     """Updates the status of a specific feedback item."""
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     if is_postgres:
         cursor = conn.cursor()
         cursor.execute("UPDATE feedback SET status = %s WHERE id = %s", (new_status, feedback_id))
@@ -3781,7 +4708,7 @@ def update_feedback_status(conn, feedback_id, new_status):
 def get_latest_active_announcement(conn):
     """Fetches the most recent active announcement."""
     query = "SELECT id, title, content FROM announcements WHERE is_active = ? ORDER BY created_at DESC LIMIT 1"
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         query = query.replace('?', '%s')
         cursor = conn.cursor()
         cursor.execute(query, (True,))
@@ -3792,7 +4719,7 @@ def get_latest_active_announcement(conn):
 def get_all_announcements(conn):
     """Fetches all announcements for the admin page."""
     # --- START: ส่วนที่แก้ไข ---
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "SELECT id, title, content, is_active, created_at FROM announcements ORDER BY created_at DESC"
     
     if is_postgres:
@@ -3813,7 +4740,7 @@ def get_all_announcements(conn):
 def add_announcement(conn, title, content, is_active):
     """Adds a new announcement."""
     created_at = get_bkk_time().isoformat()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "INSERT INTO announcements (title, content, is_active, created_at) VALUES (?, ?, ?, ?)"
     
     if is_postgres:
@@ -3822,10 +4749,11 @@ def add_announcement(conn, title, content, is_active):
         cursor.execute(query, (title, content, is_active, created_at))
     else: # SQLite
         conn.execute(query, (title, content, is_active, created_at))
+    _notify_data_change('announcements')
 
 def update_announcement_status(conn, announcement_id, is_active):
     """Activates or deactivates an announcement."""
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "UPDATE announcements SET is_active = ? WHERE id = ?"
     
     if is_postgres:
@@ -3834,10 +4762,11 @@ def update_announcement_status(conn, announcement_id, is_active):
         cursor.execute(query, (is_active, announcement_id))
     else: # SQLite
         conn.execute(query, (is_active, announcement_id))
+    _notify_data_change('announcements')
 
 def deactivate_all_announcements(conn):
     """Deactivates all other announcements."""
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "UPDATE announcements SET is_active = ?"
     
     if is_postgres:
@@ -3846,6 +4775,7 @@ def deactivate_all_announcements(conn):
         cursor.execute(query, (False,))
     else: # SQLite
         conn.execute(query, (False,))
+    _notify_data_change('announcements')
 
 # แทนที่ฟังก์ชันเดิมด้วยฟังก์ชันนี้
 def get_wholesale_customers_with_summary(conn, query=None, start_date=None, end_date=None, limit=None, offset=None, sort_by='last_purchase_date', order='desc'):
@@ -3853,7 +4783,7 @@ def get_wholesale_customers_with_summary(conn, query=None, start_date=None, end_
     เวอร์ชันอัปเกรด 4 (Final): แยกยอดซื้อตามประเภทสินค้า และอัปเดตการเรียงข้อมูล
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     # SQL query ที่ลบคอมเมนต์ที่ผิดพลาดออกแล้ว
@@ -3880,8 +4810,8 @@ def get_wholesale_customers_with_summary(conn, query=None, start_date=None, end_
         
     params = []
     
-    where_clauses = [f"m.timestamp BETWEEN {placeholder} AND {placeholder}"]
-    params.extend([start_date.isoformat(), end_date.isoformat()])
+    where_clauses = [get_dialect(conn).timestamp_range('m.timestamp')]
+    params.extend(_bkk_date_range(start_date, end_date))
 
     if query:
         like_operator = "ILIKE" if is_postgres else "LIKE"
@@ -3925,7 +4855,7 @@ def get_wholesale_customer_details_with_breakdown(conn, customer_id):
     ฟังก์ชันใหม่: ดึงข้อมูลสรุปลูกค้า พร้อมแยกยอดซื้อตามประเภทสินค้า
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     
     sql = f"""
@@ -3965,7 +4895,7 @@ def get_wholesale_customers_count(conn, query=None, start_date=None, end_date=No
     และมีกิจกรรมในช่วงวันที่ที่กำหนด
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     # สร้าง Query หลักที่ซับซ้อนขึ้นเพื่อให้นับได้ถูกต้อง
@@ -3990,8 +4920,8 @@ def get_wholesale_customers_count(conn, query=None, start_date=None, end_date=No
         
     params = []
     
-    where_clauses = [f"m.timestamp BETWEEN {placeholder} AND {placeholder}"]
-    params.extend([start_date.isoformat(), end_date.isoformat()])
+    where_clauses = [get_dialect(conn).timestamp_range('m.timestamp')]
+    params.extend(_bkk_date_range(start_date, end_date))
 
     if query:
         like_operator = "ILIKE" if is_postgres else "LIKE"
@@ -4008,7 +4938,7 @@ def get_wholesale_customer_details(conn, customer_id):
     """
     ดึงข้อมูลชื่อลูกค้าและข้อมูลสรุป (ยอดซื้อรวม, วันที่ซื้อล่าสุด)
     """
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     sql = f"""
@@ -4044,9 +4974,10 @@ def get_wholesale_customer_purchase_history(conn, customer_id, start_date=None,
     ดึงประวัติการซื้อ (OUT) ทั้งหมดของลูกค้า สามารถกรองตามช่วงวันที่ได้
     เวอร์ชันอัปเดต: เพิ่ม image_filename
     """
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
-    timestamp_cast = "::timestamptz" if is_postgres else ""
+    dialect = get_dialect(conn)
+    date_range = _bkk_date_range(start_date, end_date) if start_date and end_date else None
 
     sql_parts = []
     params = []
@@ -4061,8 +4992,8 @@ def get_wholesale_customer_purchase_history(conn, customer_id, start_date=None,
     """)
     params.append(customer_id)
     if start_date and end_date:
-        sql_parts[-1] += f" AND tm.timestamp BETWEEN {placeholder}{timestamp_cast} AND {placeholder}{timestamp_cast}"
-        params.extend([start_date.isoformat(), end_date.isoformat()])
+        sql_parts[-1] += f" AND {dialect.timestamp_range('tm.timestamp')}"
+        params.extend(date_range)
 
     # Wheel Movements
     wheel_size_concat = "CONCAT(w.diameter, 'x', w.width, ' ', w.pcd)" if is_postgres else "(w.diameter || 'x' || w.width || ' ' || w.pcd)"
@@ -4076,8 +5007,8 @@ def get_wholesale_customer_purchase_history(conn, customer_id, start_date=None,
     """)
     params.append(customer_id)
     if start_date and end_date:
-        sql_parts[-1] += f" AND wm.timestamp BETWEEN {placeholder}{timestamp_cast} AND {placeholder}{timestamp_cast}"
-        params.extend([start_date.isoformat(), end_date.isoformat()])
+        sql_parts[-1] += f" AND {dialect.timestamp_range('wm.timestamp')}"
+        params.extend(date_range)
 
     # Spare Part Movements
     spare_part_details_concat = "CONCAT(sp.name, ' (', COALESCE(sp.brand, 'N/A'), ')')" if is_postgres else "(sp.name || ' (' || COALESCE(sp.brand, 'N/A') || ')')"
@@ -4091,14 +5022,13 @@ def get_wholesale_customer_purchase_history(conn, customer_id, start_date=None,
     """)
     params.append(customer_id)
     if start_date and end_date:
-        sql_parts[-1] += f" AND spm.timestamp BETWEEN {placeholder}{timestamp_cast} AND {placeholder}{timestamp_cast}"
-        params.extend([start_date.isoformat(), end_date.isoformat()])
+        sql_parts[-1] += f" AND {dialect.timestamp_range('spm.timestamp')}"
+        params.extend(date_range)
 
     full_sql = " UNION ALL ".join(sql_parts)
     full_sql += " ORDER BY timestamp DESC"
 
     if not is_postgres:
-        full_sql = full_sql.replace(timestamp_cast, "")
         full_sql = full_sql.replace(placeholder, '?')
 
     cursor = conn.cursor()
@@ -4114,7 +5044,7 @@ def get_wholesale_customer_purchase_history(conn, customer_id, start_date=None,
 def add_activity_log(conn, user_id, endpoint, method, url):
     """บันทึกกิจกรรมของผู้ใช้ลงฐานข้อมูล"""
     timestamp = get_bkk_time().isoformat()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "INSERT INTO activity_logs (user_id, timestamp, endpoint, method, url) VALUES (?, ?, ?, ?, ?)"
     params = (user_id, timestamp, endpoint, method, url)
 
@@ -4124,12 +5054,24 @@ def add_activity_log(conn, user_id, endpoint, method, url):
     cursor = conn.cursor()
     cursor.execute(query, params)
 
+def bulk_add_activity_logs(conn, rows):
+    """บันทึก activity log หลายรายการในครั้งเดียว rows: (user_id, timestamp, endpoint, method, url)"""
+    if not rows:
+        return
+    cursor = conn.cursor()
+    if is_postgres_conn(conn):
+        from psycopg2.extras import execute_values
+        execute_values(cursor, "INSERT INTO activity_logs (user_id, timestamp, endpoint, method, url) VALUES %s",
+                       rows, page_size=len(rows))
+    else:
+        cursor.executemany("INSERT INTO activity_logs (user_id, timestamp, endpoint, method, url) VALUES (?, ?, ?, ?, ?)", rows)
+
 def get_activity_logs(conn, limit=50, page=1, start_date=None, end_date=None, user_id=None, method=None):
     """
     เวอร์ชันอัปเกรด: ดึงประวัติการใช้งานแบบมีการกรองและแบ่งหน้า
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     offset = (page - 1) * limit
     
@@ -4142,12 +5084,13 @@ def get_activity_logs(conn, limit=50, page=1, start_date=None, end_date=None, us
     conditions = []
     params = []
     
+    # start_date / end_date เป็นวันที่ (รวมวันสุดท้าย) กรองแบบ [เริ่มวันแรก, เริ่มวันถัดไป) ให้ใช้ index ของ timestamp ได้
     if start_date:
         conditions.append("a.timestamp >= ?")
-        params.append(start_date)
+        params.append(_bkk_day_bounds(_to_bkk_date(start_date))[0])
     if end_date:
-        conditions.append("a.timestamp <= ?")
-        params.append(end_date)
+        conditions.append("a.timestamp < ?")
+        params.append(_bkk_day_bounds(_to_bkk_date(end_date))[1])
     if user_id:
         conditions.append("a.user_id = ?")
         params.append(user_id)
@@ -4176,7 +5119,7 @@ def get_activity_logs(conn, limit=50, page=1, start_date=None, end_date=None, us
 def get_activity_logs_count(conn, start_date=None, end_date=None, user_id=None, method=None):
     """นับจำนวนผลลัพธ์ของ activity_logs ทั้งหมดตามเงื่อนไขการกรอง"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     query = "SELECT COUNT(*) as total FROM activity_logs a"
     
@@ -4185,10 +5128,10 @@ def get_activity_logs_count(conn, start_date=None, end_date=None, user_id=None,
 
     if start_date:
         conditions.append("a.timestamp >= ?")
-        params.append(start_date)
+        params.append(_bkk_day_bounds(_to_bkk_date(start_date))[0])
     if end_date:
-        conditions.append("a.timestamp <= ?")
-        params.append(end_date)
+        conditions.append("a.timestamp < ?")
+        params.append(_bkk_day_bounds(_to_bkk_date(end_date))[1])
     if user_id:
         conditions.append("a.user_id = ?")
         params.append(user_id)
@@ -4208,7 +5151,7 @@ def get_activity_logs_count(conn, start_date=None, end_date=None, user_id=None,
 def delete_old_activity_logs(conn, days=7):
     """ลบ Log ที่เก่ากว่าวันที่กำหนด"""
     cutoff_date = get_bkk_time() - timedelta(days=days)
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     query = f"DELETE FROM activity_logs WHERE timestamp < {placeholder}"
 
@@ -4222,7 +5165,7 @@ def get_setting(conn, key):
     cursor = conn.cursor()
     query = "SELECT value FROM app_settings WHERE key = ?"
     params = (key,)
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         query = query.replace('?', '%s')
 
     cursor.execute(query, params)
@@ -4233,7 +5176,7 @@ def get_setting(conn, key):
 def set_setting(conn, key, value):
     """เพิ่มหรืออัปเดตค่าการตั้งค่าในตาราง app_settings"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         # ใช้ ON CONFLICT เพื่อทำ UPSERT (UPDATE or INSERT)
@@ -4251,7 +5194,7 @@ def get_reconciliation_for_date(conn, report_date):
     ดึงข้อมูลการกระทบยอดสำหรับวันที่ระบุ
     report_date: ต้องเป็นอ็อบเจกต์ date ของ Python
     """
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     # แปลง date object เป็น string 'YYYY-MM-DD' สำหรับ query
     date_str = report_date.strftime('%Y-%m-%d')
@@ -4292,7 +5235,7 @@ def get_or_create_reconciliation_for_date(conn, report_date, manager_id):
         return existing_rec
 
     # ถ้าไม่มี ให้สร้างใหม่
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     date_str = report_date.strftime('%Y-%m-%d')
     created_at_iso = get_bkk_time().isoformat()
     
@@ -4314,7 +5257,7 @@ def update_manager_ledger(conn, reconciliation_id, ledger_data):
     อัปเดตข้อมูลในฝั่ง 'สมุดบันทึกของผู้จัดการ'
     ledger_data: ต้องเป็น list/dict ของ Python
     """
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     # แปลง Python object เป็น JSON string
     ledger_json = json.dumps(ledger_data, ensure_ascii=False)
@@ -4333,7 +5276,7 @@ def update_manager_ledger(conn, reconciliation_id, ledger_data):
 def complete_reconciliation(conn, reconciliation_id):
     """Updates the status of a reconciliation to 'completed' and sets the completed_at timestamp."""
     completed_at_iso = get_bkk_time().isoformat()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     query = "UPDATE daily_reconciliations SET status = ?, completed_at = ? WHERE id = ?"
     params = ('completed', completed_at_iso, reconciliation_id)
@@ -4346,7 +5289,7 @@ def complete_reconciliation(conn, reconciliation_id):
 
 def get_reconciliation_by_id(conn, reconciliation_id):
     """Fetches a single reconciliation record by its ID."""
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "SELECT * FROM daily_reconciliations WHERE id = ?"
     if is_postgres:
         query = query.replace('?', '%s')
@@ -4359,7 +5302,7 @@ def add_tire_cost_history(conn, tire_id, old_cost, new_cost, user_id, notes=""):
     """บันทึกการเปลี่ยนแปลงราคาทุนของยาง"""
     changed_at = get_bkk_time().isoformat()
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     query = "INSERT INTO tire_cost_history (tire_id, changed_at, old_cost_sc, new_cost_sc, user_id, notes) VALUES (?, ?, ?, ?, ?, ?)"
     params = (tire_id, changed_at, old_cost, new_cost, user_id, notes)
@@ -4373,7 +5316,7 @@ def add_tire_cost_history(conn, tire_id, old_cost, new_cost, user_id, notes=""):
 def get_tire_cost_history(conn, tire_id):
     """ดึงประวัติการเปลี่ยนแปลงราคาทุนของยางที่ระบุ"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     query = """
         SELECT h.*, u.username
@@ -4407,7 +5350,7 @@ def update_single_tire_cost(conn, tire_id, cost_type, new_cost, user_id):
         raise ValueError("ประเภทของราคาทุนไม่ถูกต้อง")
 
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     # 1. ดึงข้อมูลราคาทุนเดิม
@@ -4447,7 +5390,7 @@ def update_single_tire_cost(conn, tire_id, cost_type, new_cost, user_id):
 def get_commission_programs_for_date(conn, for_date):
     """ดึงโปรแกรมคอมมิชชั่นที่ Active ทั้งหมดสำหรับวันที่ระบุ"""
     date_str = for_date.strftime('%Y-%m-%d')
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     # Logic: วันที่ที่ต้องการ ต้องอยู่ระหว่าง start_date และ end_date (หรือ end_date เป็น NULL)
     query = f"""
@@ -4484,7 +5427,7 @@ def set_commission_program(conn, start_date, end_date, item_type, item_id, amoun
     end_date_str = end_date.strftime('%Y-%m-%d') if end_date else None
     now_iso = get_bkk_time().isoformat()
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     # Logic: เราจะลบโปรแกรมเก่าที่อาจจะทับซ้อนกันออกก่อน แล้วสร้างใหม่
     # (นี่เป็นวิธีที่ง่ายที่สุดในการจัดการช่วงเวลาทับซ้อน)
@@ -4506,7 +5449,7 @@ def delete_commission_program(conn, program_id):
     """ลบโปรแกรมคอมมิชชั่น"""
     cursor = conn.cursor()
     query = "DELETE FROM commission_programs WHERE id = ?"
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         query = query.replace('?', '%s')
     cursor.execute(query, (program_id,))
 
@@ -4515,14 +5458,15 @@ def get_live_commission_summary(conn, start_date, end_date):
     """
     UPGRADED: Calculates a live commission summary for a given DATE RANGE.
     """
-    start_date_str = start_date.strftime('%Y-%m-%d')
-    end_date_str = end_date.strftime('%Y-%m-%d')
+    start_iso, end_iso = _bkk_date_range(start_date, end_date)
     
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
-    placeholder = "%s" if is_postgres else "?"
+    dialect = get_dialect(conn)
 
-    # แก้ไข Query ให้รองรับการค้นหาแบบช่วงวันที่ (BETWEEN)
+    # กรองช่วงเวลาในแต่ละตาราง (ไม่ครอบ timestamp ด้วย DATE()) เพื่อใช้ index commission ของ movement ได้
+    tm_range = dialect.timestamp_range('tm.timestamp')
+    wm_range = dialect.timestamp_range('wm.timestamp')
+    spm_range = dialect.timestamp_range('spm.timestamp')
     query = f"""
         SELECT 
             m.item_type,
@@ -4531,20 +5475,17 @@ def get_live_commission_summary(conn, start_date, end_date):
             SUM(m.quantity_change) as total_units_sold,
             SUM(m.commission_amount) as total_commission
         FROM (
-            SELECT 'tire' as item_type, tm.tire_id as item_id, t.brand || ' ' || t.model || ' ' || t.size as item_description, tm.quantity_change, tm.commission_amount, tm.timestamp FROM tire_movements tm JOIN tires t ON tm.tire_id = t.id
+            SELECT 'tire' as item_type, tm.tire_id as item_id, t.brand || ' ' || t.model || ' ' || t.size as item_description, tm.quantity_change, tm.commission_amount FROM tire_movements tm JOIN tires t ON tm.tire_id = t.id WHERE {tm_range} AND tm.commission_amount > 0
             UNION ALL
-            SELECT 'wheel' as item_type, wm.wheel_id as item_id, w.brand || ' ' || w.model || ' ' || w.pcd as item_description, wm.quantity_change, wm.commission_amount, wm.timestamp FROM wheel_movements wm JOIN wheels w ON wm.wheel_id = w.id
+            SELECT 'wheel' as item_type, wm.wheel_id as item_id, w.brand || ' ' || w.model || ' ' || w.pcd as item_description, wm.quantity_change, wm.commission_amount FROM wheel_movements wm JOIN wheels w ON wm.wheel_id = w.id WHERE {wm_range} AND wm.commission_amount > 0
             UNION ALL
-            SELECT 'spare_part' as item_type, spm.spare_part_id as item_id, sp.name || ' (' || sp.part_number || ')' as item_description, spm.quantity_change, spm.commission_amount, spm.timestamp FROM spare_part_movements spm JOIN spare_parts sp ON spm.spare_part_id = sp.id
+            SELECT 'spare_part' as item_type, spm.spare_part_id as item_id, sp.name || ' (' || sp.part_number || ')' as item_description, spm.quantity_change, spm.commission_amount FROM spare_part_movements spm JOIN spare_parts sp ON spm.spare_part_id = sp.id WHERE {spm_range} AND spm.commission_amount > 0
         ) m
-        WHERE DATE(m.timestamp) BETWEEN {placeholder} AND {placeholder} AND m.commission_amount > 0
         GROUP BY m.item_type, m.item_id, m.item_description
         ORDER BY total_commission DESC
     """
-    if is_postgres:
-        query = query.replace("||", "||").replace('?', '%s')
     
-    cursor.execute(query, (start_date_str, end_date_str))
+    cursor.execute(query, (start_iso, end_iso) * 3)
     summary_details = [dict(row) for row in cursor.fetchall()]
     return summary_details
 
@@ -4555,7 +5496,7 @@ def get_tire_sales_history(conn, tire_id):
     including customer details.
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     query = f"""
@@ -4597,7 +5538,7 @@ def search_tires_by_keyword(conn, query):
     Returns a list of matching tires with their ID.
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     like_op = "ILIKE" if is_postgres else "LIKE"
     
@@ -4631,7 +5572,7 @@ def search_sales_history(conn, tire_id=None, customer_keyword=None, start_date=N
     Now uses tire_id for a direct, reliable search.
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     like_op = "ILIKE" if is_postgres else "LIKE"
     
@@ -4698,7 +5639,7 @@ def search_customers_by_keyword(conn, keyword, limit=10):
     Returns a list of dictionaries with customer names.
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     like_op = "ILIKE" if is_postgres else "LIKE"
 
@@ -4737,7 +5678,7 @@ def get_all_label_presets(conn):
 
 def get_label_preset(conn, preset_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     if is_postgres:
         cursor.execute("SELECT * FROM label_presets WHERE id = %s", (preset_id,))
@@ -4749,7 +5690,7 @@ def get_label_preset(conn, preset_id):
 
 def add_label_preset(conn, data):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("""
@@ -4764,7 +5705,7 @@ def add_label_preset(conn, data):
 
 def update_label_preset(conn, preset_id, data):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("""
@@ -4781,7 +5722,7 @@ def update_label_preset(conn, preset_id, data):
 
 def delete_label_preset(conn, preset_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     if is_postgres:
         cursor.execute("DELETE FROM label_presets WHERE id = %s", (preset_id,))
@@ -4791,22 +5732,16 @@ def delete_label_preset(conn, preset_id):
 def change_user_password(conn, user_id, new_password):
     hashed_password = generate_password_hash(new_password)
     cursor = conn.cursor()
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         cursor.execute("UPDATE users SET password = %s WHERE id = %s", (hashed_password, user_id))
     else: # SQLite
         cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hashed_password, user_id))
 
 def create_new_job(conn, job_data, job_items_data, user_id, salesperson_id=None, technician_ids=None):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
-    today_str = get_bkk_time().strftime('%y%m%d')
-    if is_postgres:
-        cursor.execute("SELECT COUNT(*) FROM jobs WHERE CAST(created_at AS DATE) = %s", (get_bkk_time().date(),))
-    else:
-        cursor.execute("SELECT COUNT(*) FROM jobs WHERE DATE(created_at) = ?", (get_bkk_time().date(),))
-    count = cursor.fetchone()[0]
-    job_number = f"JOB-{today_str}-{count + 1:04d}"
+    job_number = next_job_number(conn)
 
     job_query = """
     INSERT INTO jobs (job_number, customer_name, customer_phone, car_plate, car_brand, 
@@ -4837,24 +5772,90 @@ def create_new_job(conn, job_data, job_items_data, user_id, salesperson_id=None,
     cursor.execute(job_query, params)
     job_id = cursor.fetchone()['id'] if is_postgres else cursor.lastrowid
 
-    if technician_ids:
-        tech_query = "INSERT INTO job_technicians (job_id, technician_id) VALUES (?, ?)"
-        if is_postgres: tech_query = tech_query.replace('?', '%s')
-        for tech_id in technician_ids:
-            cursor.execute(tech_query, (job_id, tech_id))
-
-    item_query = "INSERT INTO job_items (job_id, description, item_type, unit_price, quantity, total_price, notes, item_id, stock_updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-    if is_postgres: item_query = item_query.replace('?', '%s')
-    for item in job_items_data:
-        item_params = (job_id, item['description'], item.get('item_type'), item['unit_price'], item['quantity'], item['total_price'], item.get('notes'), item.get('item_id'), False)
-        cursor.execute(item_query, item_params)
+    _insert_job_technicians(conn, job_id, technician_ids)
+    _insert_job_items(conn, job_id, job_items_data)
 
     return job_id
 
+def next_job_number(conn, day=None):
+    """
+    ออกเลขใบงาน JOB-yymmdd-NNNN จากตัวนับรายวัน (job_number_counters)
+    UPSERT ... RETURNING เป็นคำสั่งเดียว แถวของวันนั้นถูกล็อกจนจบ transaction
+    ใบงานที่สร้างพร้อมกันจึงไม่ได้เลขซ้ำ และไม่ต้องนับใบงานทั้งตาราง
+    """
+    day_key = (day or get_bkk_time()).strftime('%y%m%d')
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile("""
+        INSERT INTO job_number_counters (day_key, last_number) VALUES (?, 1)
+        ON CONFLICT (day_key) DO UPDATE SET last_number = job_number_counters.last_number + 1
+        RETURNING last_number
+    """), (day_key,))
+    return f"JOB-{day_key}-{cursor.fetchone()[0]:04d}"
+
+def _insert_job_technicians(conn, job_id, technician_ids):
+    if not technician_ids:
+        return
+    cursor = conn.cursor()
+    cursor.executemany(get_dialect(conn).compile("INSERT INTO job_technicians (job_id, technician_id) VALUES (?, ?)"),
+                       [(job_id, tech_id) for tech_id in technician_ids])
+
+def _insert_job_items(conn, job_id, items):
+    if not items:
+        return
+    cursor = conn.cursor()
+    cursor.executemany(get_dialect(conn).compile(
+        "INSERT INTO job_items (job_id, description, item_type, unit_price, quantity, total_price, notes, item_id, stock_updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    ), [(job_id, item['description'], item.get('item_type'), item['unit_price'], item['quantity'], item['total_price'], item.get('notes'), item.get('item_id'), False)
+        for item in items])
+
+
+# คอลัมน์ราคาเต็ม (ราคาขายปลีก) ของสินค้าแต่ละประเภท ใช้แสดงส่วนลดในใบงาน
+JOB_ITEM_PRICE_COLUMNS = {'tire': 'price_per_item', 'wheel': 'retail_price', 'spare_part': 'retail_price'}
+
+def get_catalogue_prices(conn, item_type, item_ids):
+    """ราคาเต็มของสินค้าหลายรายการในครั้งเดียว : {item_id: price}"""
+    item_ids = list(item_ids)
+    if not item_ids:
+        return {}
+    price_column = JOB_ITEM_PRICE_COLUMNS[item_type]
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile(
+        f"SELECT id, {price_column} AS price FROM {ITEM_TABLES[item_type]} WHERE id IN ({', '.join(['?'] * len(item_ids))})"
+    ), tuple(item_ids))
+    return {row['id']: row['price'] for row in cursor.fetchall()}
+
+def get_label_items(conn, item_type, item_ids):
+    """ข้อมูลสำหรับพิมพ์สติกเกอร์ของสินค้าหลายรายการ (ราคาเต็ม + บาร์โค้ดหลัก) : {item_id: dict} ไม่รวมสินค้าที่ถูกลบ"""
+    item_ids = list(item_ids)
+    if not item_ids:
+        return {}
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile(f"""
+        SELECT i.*, i.{JOB_ITEM_PRICE_COLUMNS[item_type]} AS label_price, {_primary_barcode_select(item_type, 'i')}
+        FROM {ITEM_TABLES[item_type]} i
+        WHERE i.id IN ({', '.join(['?'] * len(item_ids))}) AND i.is_deleted = {{false}}
+    """), tuple(item_ids))
+    return {row['id']: dict(row) for row in cursor.fetchall()}
+
+def get_item_barcodes(conn, item_type, item_ids):
+    """บาร์โค้ดทั้งหมดของสินค้าหลายรายการ : {item_id: set ของ barcode_string}"""
+    item_ids = list(item_ids)
+    if not item_ids:
+        return {}
+    table_name, id_column = BARCODE_TABLES[item_type]
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile(f"""
+        SELECT {id_column}, barcode_string FROM {table_name}
+        WHERE {id_column} IN ({', '.join(['?'] * len(item_ids))})
+    """), tuple(item_ids))
+    barcodes = defaultdict(set)
+    for row in cursor.fetchall():
+        barcodes[row[0]].add(row[1])
+    return barcodes
 
 def get_job_by_id(conn, job_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     if is_postgres:
         query = """
@@ -4898,33 +5899,20 @@ def get_job_by_id(conn, job_id):
     # --- START: แก้ไขส่วนการดึงข้อมูล Job Items ---
     query_items = "SELECT * FROM job_items WHERE job_id = %s ORDER BY id" if is_postgres else "SELECT * FROM job_items WHERE job_id = ? ORDER BY id"
     cursor.execute(query_items, (job_id,))
-    
-    job_items_list = []
-    for item_row in cursor.fetchall():
-        item_dict = dict(item_row)
-        
-        # 1. ตั้งค่าเริ่มต้นให้ราคาเต็ม = ราคาที่ขายจริง
-        item_dict['original_unit_price'] = item_dict['unit_price']
-        
-        # 2. ถ้าเป็นสินค้าจากสต็อก ให้ไปค้นหาราคาเต็มจริงๆ มาใส่ทับ
-        if item_dict.get('item_id') and item_dict.get('item_type'):
-            original_item_data = None
-            if item_dict['item_type'] == 'tire':
-                original_item_data = get_tire(conn, item_dict['item_id'])
-                if original_item_data:
-                    item_dict['original_unit_price'] = original_item_data.get('price_per_item', item_dict['unit_price'])
-            
-            elif item_dict['item_type'] == 'wheel':
-                original_item_data = get_wheel(conn, item_dict['item_id'])
-                if original_item_data:
-                    item_dict['original_unit_price'] = original_item_data.get('retail_price', item_dict['unit_price'])
-            
-            elif item_dict['item_type'] == 'spare_part':
-                original_item_data = get_spare_part(conn, item_dict['item_id'])
-                if original_item_data:
-                    item_dict['original_unit_price'] = original_item_data.get('retail_price', item_dict['unit_price'])
+    job_items_list = [dict(item_row) for item_row in cursor.fetchall()]
 
-        job_items_list.append(item_dict)
+    # ราคาเต็มของสินค้าจากสต็อก: ดึงทีละประเภทสินค้าด้วย IN (...) แทนการเรียก get_tire/get_wheel/get_spare_part ทีละรายการ
+    item_ids_by_type = {}
+    for item_dict in job_items_list:
+        if item_dict.get('item_id') and item_dict.get('item_type') in JOB_ITEM_PRICE_COLUMNS:
+            item_ids_by_type.setdefault(item_dict['item_type'], set()).add(item_dict['item_id'])
+    original_prices = {item_type: get_catalogue_prices(conn, item_type, item_ids)
+                       for item_type, item_ids in item_ids_by_type.items()}
+
+    for item_dict in job_items_list:
+        # ตั้งค่าเริ่มต้นให้ราคาเต็ม = ราคาที่ขายจริง ถ้าเป็นสินค้าจากสต็อกให้ใช้ราคาเต็มจริงๆ ใส่ทับ
+        prices = original_prices.get(item_dict.get('item_type'), {})
+        item_dict['original_unit_price'] = prices.get(item_dict.get('item_id'), item_dict['unit_price'])
 
     job['job_items_list'] = job_items_list
     # --- END: สิ้นสุดการแก้ไข ---
@@ -4938,7 +5926,7 @@ def get_job_by_id(conn, job_id):
 
 def get_all_jobs(conn, search_query='', status_filter='', start_date=None, end_date=None):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     # --- START: แก้ไข SQL Query ทั้งหมดในฟังก์ชันนี้ ---
     if is_postgres:
@@ -5011,16 +5999,16 @@ def get_all_jobs(conn, search_query='', status_filter='', start_date=None, end_d
 
 def find_tires(conn, query):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     # ▼▼▼ แก้ไข SQL ตรงนี้ ▼▼▼
     tire_query_sql = """
-    SELECT brand, model, size, quantity, cost_sc, price_per_item
+    SELECT id, brand, model, size, quantity, cost_sc, price_per_item
     FROM tires
     WHERE size = %s AND quantity > 0 AND is_deleted = FALSE
     ORDER BY brand, model
     """ if is_postgres else """
-    SELECT brand, model, size, quantity, cost_sc, price_per_item
+    SELECT id, brand, model, size, quantity, cost_sc, price_per_item
     FROM tires
     WHERE size = ? AND quantity > 0 AND is_deleted = 0
     ORDER BY brand, model
@@ -5035,13 +6023,14 @@ def find_tires(conn, query):
         return results
 
     except Exception as e:
+        # ส่งต่อให้ผู้เรียกรู้ว่าค้นไม่สำเร็จ (ไม่ใช่ "ไม่มีสต็อก") จะได้ไม่ cache ผลว่าง
         print(f"Error querying tires: {e}")
-        return []
+        raise
 
 def add_service(conn, name, description, default_price):
     """เพิ่มรายการค่าบริการใหม่"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "INSERT INTO services (name, description, default_price) VALUES (?, ?, ?)"
     if is_postgres:
         query = query.replace('?', '%s') + " RETURNING id"
@@ -5057,7 +6046,7 @@ def add_service(conn, name, description, default_price):
 def get_all_services(conn, include_deleted=False):
     """ดึงรายการค่าบริการทั้งหมด"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "SELECT * FROM services"
     if not include_deleted:
         query += " WHERE is_deleted = FALSE" if is_postgres else " WHERE is_deleted = 0"
@@ -5068,7 +6057,7 @@ def get_all_services(conn, include_deleted=False):
 
 def update_job_with_items(conn, job_id, job_details, items, user_id, salesperson_id=None, technician_ids=None):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
 
     update_job_query = f"""
@@ -5090,24 +6079,29 @@ def update_job_with_items(conn, job_id, job_details, items, user_id, salesperson
     cursor.execute(update_job_query, job_params)
 
     cursor.execute(f"DELETE FROM job_technicians WHERE job_id = {placeholder}", (job_id,))
-    if technician_ids:
-        tech_query = f"INSERT INTO job_technicians (job_id, technician_id) VALUES ({placeholder}, {placeholder})"
-        for tech_id in technician_ids:
-            cursor.execute(tech_query, (job_id, tech_id))
+    _insert_job_technicians(conn, job_id, technician_ids)
             
     delete_items_query = f"DELETE FROM job_items WHERE job_id = {placeholder}"
     cursor.execute(delete_items_query, (job_id,))
-    item_query = f"INSERT INTO job_items (job_id, description, item_type, unit_price, quantity, total_price, notes, item_id, stock_updated) VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})"
-    for item in items:
-        item_params = (job_id, item['description'], item.get('item_type'), item['unit_price'], item['quantity'], item['total_price'], item.get('notes'), item.get('item_id'), False)
-        cursor.execute(item_query, item_params)
+    _insert_job_items(conn, job_id, items)
+
+def get_completed_job_ids(conn, day):
+    """id ของใบงานที่ปิดงาน (completed) ในวันที่กำหนด เรียงตามเวลาปิดงาน ใช้พิมพ์ใบเสร็จรวมสิ้นวัน"""
+    dialect = get_dialect(conn)
+    cursor = conn.cursor()
+    cursor.execute(dialect.compile(f"""
+        SELECT id FROM jobs
+        WHERE status = 'completed' AND {dialect.timestamp_range('completed_at')}
+        ORDER BY completed_at, id
+    """), _bkk_date_range(day, day))
+    return [row['id'] for row in cursor.fetchall()]
 
 def update_job_status(conn, job_id, new_status):
     """
     อัปเดตสถานะของใบงาน และบันทึกเวลาที่เสร็จสิ้น (ถ้ามี)
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     
     # ตรวจสอบสถานะที่อนุญาต
@@ -5130,7 +6124,7 @@ def update_job_status(conn, job_id, new_status):
 def get_all_technicians(conn):
     """ดึงรายชื่อช่างทั้งหมดที่ยังใช้งานอยู่ (is_active = true)"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "SELECT id, name FROM technicians WHERE is_active = TRUE ORDER BY name" if is_postgres else "SELECT id, name FROM technicians WHERE is_active = 1 ORDER BY name"
     cursor.execute(query)
     return [dict(row) for row in cursor.fetchall()]
@@ -5138,7 +6132,7 @@ def get_all_technicians(conn):
 def get_template_by_name(conn, template_name):
     cursor = conn.cursor()
     query = "SELECT * FROM document_templates WHERE template_name = ?"
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         query = query.replace('?', '%s')
 
     cursor.execute(query, (template_name,))
@@ -5171,7 +6165,7 @@ def update_template(conn, template_name, data):
         logo_url = ?, template_options = ?
         WHERE template_name = ?
     """
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         query = query.replace('?', '%s')
 
     params = (
@@ -5186,7 +6180,7 @@ def update_template(conn, template_name, data):
 def update_template_layout(conn, template_name, layout_json_string):
     cursor = conn.cursor()
     query = "UPDATE document_templates SET layout_json = ? WHERE template_name = ?"
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         query = query.replace('?', '%s')
     cursor.execute(query, (layout_json_string, template_name))
 
@@ -5196,7 +6190,7 @@ def get_all_personnel(conn):
     พร้อมระบุประเภทของแต่ละคน
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     # ใช้ UNION ALL เพื่อรวมข้อมูลจากสองตาราง
     query = """
@@ -5215,7 +6209,7 @@ def add_personnel(conn, name, personnel_type):
     เพิ่มพนักงานใหม่ลงในตารางที่ถูกต้องตามประเภท (technician หรือ salesperson)
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     table_name = ''
     if personnel_type == 'technician':
@@ -5245,7 +6239,7 @@ def update_personnel(conn, personnel_id, personnel_type, name, is_active):
     อัปเดตข้อมูลพนักงานในตารางที่ถูกต้อง
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     table_name = ''
     if personnel_type == 'technician':
@@ -5270,7 +6264,7 @@ def update_personnel(conn, personnel_id, personnel_type, name, is_active):
 def get_all_salespersons(conn):
     """ดึงรายชื่อพนักงานขายทั้งหมดที่ยังใช้งานอยู่ (is_active = true)"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     query = "SELECT id, name FROM salespersons WHERE is_active = TRUE ORDER BY name" if is_postgres else "SELECT id, name FROM salespersons WHERE is_active = 1 ORDER BY name"
     cursor.execute(query)
     return [dict(row) for row in cursor.fetchall()]
@@ -5282,7 +6276,7 @@ def get_best_selling_items_with_details(conn, start_date, end_date, item_type_fi
     เวอร์ชันอัปเกรด: เพิ่มการกรองตามประเภทสินค้า (item_type_filter)
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     duration = end_date - start_date
     previous_period_end = start_date - timedelta(microseconds=1)
@@ -5370,7 +6364,7 @@ def get_slow_moving_items(conn, start_date, end_date, item_type_filter=None):
     เวอร์ชันอัปเกรด: เพิ่มการกรองตามประเภทสินค้า (item_type_filter)
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     start_date_iso = start_date.isoformat()
     end_date_iso = end_date.isoformat()
@@ -5443,12 +6437,10 @@ def get_commission_movements_by_period(conn, start_date, end_date):
     """
     เวอร์ชันแก้ไข: เขียน Query ใหม่ทั้งหมดให้เรียบง่ายและถูกต้องแม่นยำ
     """
-    start_date_str = start_date.strftime('%Y-%m-%d')
-    end_date_str = end_date.strftime('%Y-%m-%d')
+    start_iso, end_iso = _bkk_date_range(start_date, end_date)
     
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
-    placeholder = "%s" if is_postgres else "?"
+    dialect = get_dialect(conn)
 
     # สร้าง Query แยกสำหรับแต่ละประเภทสินค้า แล้วค่อย UNION กัน
     tire_query = f"""
@@ -5462,7 +6454,7 @@ def get_commission_movements_by_period(conn, start_date, end_date):
         FROM tire_movements tm
         JOIN tires t ON tm.tire_id = t.id
         LEFT JOIN sales_channels sc ON tm.channel_id = sc.id
-        WHERE DATE(tm.timestamp) BETWEEN {placeholder} AND {placeholder} AND tm.commission_amount > 0
+        WHERE {dialect.timestamp_range('tm.timestamp')} AND tm.commission_amount > 0
     """
 
     wheel_query = f"""
@@ -5476,7 +6468,7 @@ def get_commission_movements_by_period(conn, start_date, end_date):
         FROM wheel_movements wm
         JOIN wheels w ON wm.wheel_id = w.id
         LEFT JOIN sales_channels sc ON wm.channel_id = sc.id
-        WHERE DATE(wm.timestamp) BETWEEN {placeholder} AND {placeholder} AND wm.commission_amount > 0
+        WHERE {dialect.timestamp_range('wm.timestamp')} AND wm.commission_amount > 0
     """
 
     spare_part_query = f"""
@@ -5490,7 +6482,7 @@ def get_commission_movements_by_period(conn, start_date, end_date):
         FROM spare_part_movements spm
         JOIN spare_parts sp ON spm.spare_part_id = sp.id
         LEFT JOIN sales_channels sc ON spm.channel_id = sc.id
-        WHERE DATE(spm.timestamp) BETWEEN {placeholder} AND {placeholder} AND spm.commission_amount > 0
+        WHERE {dialect.timestamp_range('spm.timestamp')} AND spm.commission_amount > 0
     """
     
     # รวม Query ทั้งหมด
@@ -5502,14 +6494,9 @@ def get_commission_movements_by_period(conn, start_date, end_date):
         {spare_part_query}
         ORDER BY timestamp DESC
     """
-    
-    if is_postgres:
-        full_query = full_query.replace("||", "||").replace('?', '%s')
 
     # พารามิเตอร์สำหรับแต่ละส่วนของ UNION
-    params = (start_date_str, end_date_str, 
-              start_date_str, end_date_str, 
-              start_date_str, end_date_str)
+    params = (start_iso, end_iso) * 3
 
     cursor.execute(full_query, params)
     
@@ -5526,7 +6513,7 @@ def fix_historical_commission_data(conn):
     โดยจะตั้งค่า commission_amount ให้เป็น 0 สำหรับทุกรายการที่ไม่ได้ขายผ่าน 'หน้าร้าน'
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     
     total_fixed = 0
@@ -5556,7 +6543,7 @@ def fix_historical_commission_data(conn):
 def save_brand_lead_time(conn, brand_identifier, lead_time_days):
     """บันทึกหรืออัปเดต Lead Time สำหรับยี่ห้อที่ระบุ"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     if is_postgres:
         query = """
@@ -5573,7 +6560,7 @@ def get_lead_time_for_product(conn, item_type, brand):
     cursor = conn.cursor()
     brand_identifier = brand.lower() if brand else None
     default_identifier = f"default_{item_type}"
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     # Logic: ค้นหา brand ก่อน ถ้าไม่เจอให้ใช้ default
     query = """
@@ -5591,195 +6578,266 @@ def get_lead_time_for_product(conn, item_type, brand):
     result = cursor.fetchone()
     return result['lead_time_days'] if result else 7
 
+# --- การวิเคราะห์สต็อกและคำแนะนำการสั่งซื้อ ---
+# คำนวณทุกสินค้าพร้อมกันด้วย NumPy: ดึงยอด OUT รายวันของทุกสินค้าด้วย query เดียวต่อประเภท
+# มาเป็น matrix (สินค้า x วัน) แล้วคำนวณ safety stock / reorder point / จำนวนที่ควรสั่ง ทั้ง matrix ในครั้งเดียว
+MAX_ANALYSIS_DAYS = 180
+DEFAULT_ANALYSIS_DAYS = 90 # ใช้เมื่อไม่พบประวัติการรับเข้า
+DEFAULT_LEAD_TIME_DAYS = 7
+SAFETY_STOCK_Z_SCORE = 1.65 # Service Level 95%
+ORDER_COVERAGE_DAYS = 14
+
+def _describe_wheel_for_analysis(row):
+    return f"{(row['model'] or '').title()} ({row['diameter']}x{row['width']} {row['pcd'] or ''})".replace(' )', ')')
+
+ANALYSIS_ITEM_CONFIG = {
+    'tire': {
+        'table': 'tires',
+        'columns': "i.brand, i.model, i.size, i.quantity, i.year_of_manufacture",
+        'search_columns': ('brand', 'model', 'size'),
+        'describe': lambda row: f"{(row['model'] or '').title()} ({row['size']})",
+    },
+    'wheel': {
+        'table': 'wheels',
+        'columns': "i.brand, i.model, i.diameter, i.width, i.pcd, i.quantity, NULL AS year_of_manufacture",
+        'search_columns': ('brand', 'model', 'pcd'),
+        'describe': _describe_wheel_for_analysis,
+    },
+    'spare_part': {
+        'table': 'spare_parts',
+        'columns': "i.brand, i.name, i.part_number, i.quantity, NULL AS year_of_manufacture",
+        'search_columns': ('brand', 'name', 'part_number'),
+        'describe': lambda row: f"{row['name']} ({row['part_number']})" if row['part_number'] else row['name'],
+    },
+}
+
+def _get_lead_time_map(conn):
+    """โหลด Lead Time ทั้งหมดครั้งเดียว (identifier -> วัน)"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT identifier, lead_time_days FROM product_lead_times")
+    return {row['identifier']: row['lead_time_days'] for row in cursor.fetchall()}
+
+def _resolve_lead_time(lead_times, item_type, brand):
+    """Brand -> default ของประเภทสินค้า -> 7 วัน (ลำดับเดียวกับ get_lead_time_for_product)"""
+    brand_identifier = brand.lower() if brand else None
+    if brand_identifier in lead_times:
+        return lead_times[brand_identifier]
+    return lead_times.get(f"default_{item_type}", DEFAULT_LEAD_TIME_DAYS)
+
+def _id_filter(id_column, item_ids):
+    if item_ids is None:
+        return "", []
+    item_ids = list(item_ids)
+    return f" AND {id_column} IN ({', '.join(['?'] * len(item_ids))})", item_ids
+
+def _get_first_in_dates(conn, item_type, item_ids=None):
+    """วันที่รับเข้าครั้งแรกของสินค้า (เวลาไทย) : {item_id: date}"""
+    move_table, id_column = MOVEMENT_TABLES[item_type]
+    id_filter, params = _id_filter(id_column, item_ids)
+    cursor = conn.cursor()
+    cursor.execute(get_dialect(conn).compile(f"""
+        SELECT {id_column} AS item_id, MIN(timestamp) AS first_in_date
+        FROM {move_table}
+        WHERE type = 'IN'{id_filter}
+        GROUP BY {id_column}
+    """), tuple(params))
+    return {row['item_id']: convert_to_bkk_time(row['first_in_date']).date()
+            for row in cursor.fetchall() if row['first_in_date']}
+
+def _get_daily_out_totals(conn, item_type, since_date, item_ids=None):
+    """ยอด OUT รวมรายวัน (ตามวันที่เวลาไทย) ตั้งแต่ since_date : list ของ (item_id, date, total)"""
+    move_table, id_column = MOVEMENT_TABLES[item_type]
+    dialect = get_dialect(conn)
+    sale_date = dialect.local_date('timestamp')
+    id_filter, id_params = _id_filter(id_column, item_ids)
+    cursor = conn.cursor()
+    cursor.execute(dialect.compile(f"""
+        SELECT {id_column} AS item_id, {sale_date} AS sale_date, SUM(quantity_change) AS daily_total
+        FROM {move_table}
+        WHERE type = 'OUT' AND timestamp >= {dialect.cast_timestamp('?')}{id_filter}
+        GROUP BY {id_column}, {sale_date}
+    """), tuple([_bkk_day_bounds(since_date)[0]] + id_params))
+    totals = []
+    for row in cursor.fetchall():
+        day = row['sale_date']
+        if isinstance(day, str): # SQLite คืนเป็นข้อความ 'YYYY-MM-DD'
+            day = datetime.strptime(day[:10], '%Y-%m-%d').date()
+        totals.append((row['item_id'], day, row['daily_total'] or 0))
+    return totals
+
+def _round_up_to_multiple_of_4(values):
+    """ปัดขึ้นให้เป็นจำนวนที่หาร 4 ลงตัว (ค่าที่ <= 0 ให้เป็น 0)"""
+    return np.where(values > 0, np.ceil(values / 4.0) * 4, 0).astype(int)
+
+def compute_stock_recommendations(conn, item_type, items, lead_times=None, today=None):
+    """
+    คำนวณคำแนะนำการสั่งซื้อของสินค้าหลายชิ้นพร้อมกัน
+    items: list ของ dict ที่มี 'id', 'brand', 'quantity' (และ 'lead_time' ถ้าต้องการกำหนดเอง)
+    คืน list ของ dict ตามลำดับเดียวกับ items
+    """
+    if not items:
+        return []
+    if today is None:
+        today = get_bkk_time().date()
+    if lead_times is None:
+        lead_times = _get_lead_time_map(conn)
+
+    item_ids = [item['id'] for item in items]
+    # ถ้าสินค้าไม่กี่ชิ้นให้กรองด้วย id ไม่ต้องดึงยอดขายของทั้งประเภท
+    filter_ids = item_ids if len(item_ids) <= 100 else None
+    row_by_id = {item_id: row for row, item_id in enumerate(item_ids)}
+
+    # จำนวนวันที่ใช้วิเคราะห์: นับจากวันรับเข้าครั้งแรก (สูงสุด 180 วัน) ถ้าไม่มีประวัติรับเข้าใช้ 90 วัน
+    first_in_dates = _get_first_in_dates(conn, item_type, filter_ids)
+    analysis_days = np.array([
+        min(MAX_ANALYSIS_DAYS, (today - first_in_dates[item_id]).days + 1) if item_id in first_in_dates else DEFAULT_ANALYSIS_DAYS
+        for item_id in item_ids
+    ])
+    analysis_days = np.maximum(analysis_days, 1)
+
+    # matrix ยอดขาย: แถว = สินค้า, คอลัมน์ j = วันที่ today - j
+    sales = np.zeros((len(item_ids), MAX_ANALYSIS_DAYS))
+    since_date = today - timedelta(days=MAX_ANALYSIS_DAYS - 1)
+    for item_id, day, total in _get_daily_out_totals(conn, item_type, since_date, filter_ids):
+        row = row_by_id.get(item_id)
+        day_offset = (today - day).days
+        if row is not None and 0 <= day_offset < MAX_ANALYSIS_DAYS:
+            sales[row, day_offset] += total
+
+    window = np.arange(MAX_ANALYSIS_DAYS)[np.newaxis, :] < analysis_days[:, np.newaxis]
+    sales = np.where(window, sales, 0)
+    has_sales = sales.any(axis=1)
+
+    # ค่าเฉลี่ย/ส่วนเบี่ยงเบนมาตรฐาน (population) เฉพาะช่วงวันของแต่ละสินค้า
+    avg_sales = sales.sum(axis=1) / analysis_days
+    deviations = np.where(window, sales - avg_sales[:, np.newaxis], 0)
+    sales_std_dev = np.sqrt((deviations ** 2).sum(axis=1) / analysis_days)
+
+    lead_time_days = np.array([
+        item['lead_time'] if item.get('lead_time') is not None else _resolve_lead_time(lead_times, item_type, item.get('brand'))
+        for item in items
+    ])
+    current_stock = np.array([item.get('quantity') or 0 for item in items])
+
+    safety_stock = _round_up_to_multiple_of_4(SAFETY_STOCK_Z_SCORE * sales_std_dev * np.sqrt(lead_time_days))
+    reorder_point = _round_up_to_multiple_of_4(avg_sales * lead_time_days + safety_stock)
+    order_qty_raw = (reorder_point - current_stock) + avg_sales * ORDER_COVERAGE_DAYS
+    order_qty = _round_up_to_multiple_of_4(order_qty_raw)
+
+    # ไม่มียอดขายในช่วงวิเคราะห์ ค่าทั้งหมดเป็น 0
+    safety_stock = np.where(has_sales, safety_stock, 0)
+    reorder_point = np.where(has_sales, reorder_point, 0)
+    avg_sales = np.where(has_sales, avg_sales, 0.0)
+
+    urgency = np.where(current_stock <= safety_stock, 'critical',
+                       np.where(current_stock <= reorder_point, 'warning', 'normal'))
+    days_left = np.where(avg_sales > 0, current_stock / np.where(avg_sales > 0, avg_sales, 1), 999).astype(int)
+
+    results = []
+    for row, item in enumerate(items):
+        if not has_sales[row]:
+            recommendation_msg = 'ไม่มีประวัติการขาย'
+        elif current_stock[row] <= safety_stock[row]:
+            recommendation_msg = f"แนะนำให้สั่ง! ~{order_qty[row]} ชิ้น (สินค้าใกล้หมด)"
+        elif current_stock[row] <= reorder_point[row]:
+            recommendation_msg = f"แนะนำให้สั่งเพิ่ม ~{order_qty[row]} ชิ้น"
+        else:
+            recommendation_msg = ''
+        results.append({
+            'item_id': item['id'],
+            'safety_stock': int(safety_stock[row]),
+            'reorder_point': int(reorder_point[row]),
+            'recommendation_msg': recommendation_msg,
+            'avg_sales': float(avg_sales[row]),
+            'days_of_stock_left': int(days_left[row]),
+            'urgency': str(urgency[row]),
+            'lead_time_used': int(lead_time_days[row]),
+        })
+    return results
+
 def calculate_single_item_recommendation(conn, item_id, item_type, lead_time_days):
     """
-    เวอร์ชันปรับปรุงล่าสุด:
+    คำนวณคำแนะนำของสินค้าชิ้นเดียวด้วย Lead Time ที่กำหนด (ใช้ตอนแก้ Lead Time ในหน้าวิเคราะห์)
     - ปัดค่า Safety Stock, Reorder Point, และ Order Quantity ขึ้นให้เป็นจำนวนที่หาร 4 ลงตัว
     """
-    cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
-    
-    # --- ส่วนของการหา "วันเริ่มต้น" และดึงข้อมูลการขาย (เหมือนเดิม) ---
-    table_map = {
-        'tire': ('tire_movements', 'tire_id'),
-        'wheel': ('wheel_movements', 'wheel_id'),
-        'spare_part': ('spare_part_movements', 'spare_part_id')
+    getters = {'tire': get_tire, 'wheel': get_wheel, 'spare_part': get_spare_part}
+    product_info = getters[item_type](conn, item_id) or {}
+    item = {'id': int(item_id), 'brand': product_info.get('brand'),
+            'quantity': product_info.get('quantity', 0), 'lead_time': lead_time_days}
+    rec_data = compute_stock_recommendations(conn, item_type, [item])[0]
+    return {
+        'safety_stock': rec_data['safety_stock'],
+        'reorder_point': rec_data['reorder_point'],
+        'recommendation_msg': rec_data['recommendation_msg'],
+        'avg_sales': rec_data['avg_sales']
     }
-    move_table, id_column = table_map[item_type]
-    
-    first_in_query = f"SELECT MIN(timestamp) as first_in_date FROM {move_table} WHERE {id_column} = ? AND type = 'IN'"
-    if is_postgres: first_in_query = first_in_query.replace('?', '%s')
-    cursor.execute(first_in_query, (item_id,))
-    result = cursor.fetchone()
-    first_in_date = None
-    if result and result['first_in_date']:
-        first_in_date = convert_to_bkk_time(result['first_in_date']).date()
-
-    today = get_bkk_time().date()
-    max_analysis_days = 180 
 
-    if first_in_date:
-        days_since_first_in = (today - first_in_date).days + 1
-        analysis_days = min(max_analysis_days, days_since_first_in)
-    else:
-        analysis_days = 90 
-    analysis_days = max(1, analysis_days)
+def _get_analysis_candidates(conn, item_type, start_date, end_date, search_query=None, brand_filter=None):
+    """สินค้าที่มีการขาย (OUT) ในช่วงวันที่ ไม่ถูกลบ และไม่ถูกซ่อนจากการวิเคราะห์"""
+    config = ANALYSIS_ITEM_CONFIG[item_type]
+    move_table, id_column = MOVEMENT_TABLES[item_type]
+    dialect = get_dialect(conn)
 
-    start_date_for_query = (today - timedelta(days=analysis_days))
-    
-    placeholder = "%s" if is_postgres else "?"
-    date_function_call = "timestamp::date" if is_postgres else "DATE(timestamp)"
+    conditions = [
+        "i.is_deleted = {false}",
+        "i.ignore_analysis = {false}",
+        f"""EXISTS (SELECT 1 FROM {move_table} m
+                    WHERE m.{id_column} = i.id AND m.type = 'OUT'
+                      AND {dialect.timestamp_range('m.timestamp')})""",
+    ]
+    params = list(_bkk_date_range(start_date, end_date))
 
-    query = f"SELECT {date_function_call} as sale_date, SUM(quantity_change) as daily_total FROM {move_table} WHERE {id_column} = {placeholder} AND type = 'OUT' AND {date_function_call} >= {placeholder} GROUP BY {date_function_call}"
-    params = (item_id, start_date_for_query)
-    cursor.execute(query, params)
-    sales_data = cursor.fetchall()
-    
-    sales_dict = {row['sale_date']: row['daily_total'] for row in sales_data}
-    
-    daily_sales_history = []
-    for i in range(analysis_days):
-        day = (today - timedelta(days=i))
-        sales_key = day
-        if not is_postgres: sales_key = str(day)
-        daily_sales_history.append(sales_dict.get(sales_key, 0))
-
-    if not any(daily_sales_history):
-        return { 'safety_stock': 0, 'reorder_point': 0, 'recommendation_msg': 'ไม่มีประวัติการขาย', 'avg_sales': 0 }
-    
-    # --- ★★★ START: ส่วนที่แก้ไขตรรกะการคำนวณและปัดเศษ ★★★ ---
-    
-    # ฟังก์ชันช่วยสำหรับปัดเศษเป็นจำนวนที่หาร 4 ลงตัว
-    def round_up_to_multiple_of_4(n):
-        if n <= 0:
-            return 0
-        return int(np.ceil(n / 4.0)) * 4
-
-    # คำนวณค่าทางสถิติ (เหมือนเดิม)
-    avg_sales = np.mean(daily_sales_history)
-    sales_std_dev = np.std(daily_sales_history)
-    
-    # คำนวณ Safety Stock และ Reorder Point (แบบเดิม)
-    Z_SCORE = 1.65 # Service Level 95%
-    safety_stock_raw = Z_SCORE * sales_std_dev * np.sqrt(lead_time_days)
-    demand_during_lead_time = avg_sales * lead_time_days
-    
-    # ปัดค่า Safety Stock ขึ้นให้เป็นเลขที่หาร 4 ลงตัว
-    safety_stock = round_up_to_multiple_of_4(safety_stock_raw)
-    
-    # คำนวณ Reorder Point โดยใช้ Safety Stock ที่ปัดเศษแล้ว และปัดค่า Reorder Point อีกครั้ง
-    reorder_point_raw = demand_during_lead_time + safety_stock
-    reorder_point = round_up_to_multiple_of_4(reorder_point_raw)
-    
-    # ดึงข้อมูลสต็อกปัจจุบัน
-    product_info = {}
-    if item_type == 'tire': product_info = get_tire(conn, item_id)
-    # ... (สามารถเพิ่ม wheel, spare_part ได้ถ้าต้องการกลับมาใช้) ...
-    current_stock = product_info.get('quantity', 0)
-
-    recommendation_msg = ''
-    if current_stock <= reorder_point:
-        # คำนวณจำนวนที่ควรสั่ง (แบบเดิม)
-        order_qty_raw = (reorder_point - current_stock) + (avg_sales * 14) 
-        
-        # ปัดจำนวนที่ควรสั่งขึ้นให้เป็นเลขที่หาร 4 ลงตัว
-        order_qty = round_up_to_multiple_of_4(order_qty_raw)
-        
-        # กรณีที่คำนวณแล้วได้ 0 แต่ควรสั่ง ให้ปรับเป็น 4
-        if order_qty == 0 and order_qty_raw > 0:
-            order_qty = 4
+    if search_query:
+        search_term = f"%{search_query.lower()}%"
+        conditions.append("(" + " OR ".join(f"LOWER(i.{column}) {dialect.like_operator} ?" for column in config['search_columns']) + ")")
+        params.extend([search_term] * len(config['search_columns']))
 
-        recommendation_msg = f"แนะนำให้สั่งเพิ่ม ~{order_qty} ชิ้น"
-        if current_stock <= safety_stock:
-            recommendation_msg = f"แนะนำให้สั่ง! ~{order_qty} ชิ้น (สินค้าใกล้หมด)"
-            
-    # --- ★★★ END: ส่วนที่แก้ไข ★★★ ---
+    if brand_filter and brand_filter != 'all':
+        conditions.append("i.brand = ?")
+        params.append(brand_filter)
 
-    return {
-        'safety_stock': safety_stock,
-        'reorder_point': reorder_point,
-        'recommendation_msg': recommendation_msg,
-        'avg_sales': avg_sales 
-    }
+    cursor = conn.cursor()
+    cursor.execute(dialect.compile(f"""
+        SELECT i.id, {config['columns']}
+        FROM {config['table']} i
+        WHERE {' AND '.join(conditions)}
+    """), tuple(params))
+    return [dict(row) for row in cursor.fetchall()]
 
-def generate_stock_recommendations(conn, start_date=None, end_date=None, search_query=None, brand_filter=None):
+def generate_stock_recommendations(conn, start_date=None, end_date=None, search_query=None, brand_filter=None, item_types=('tire',)):
     """
-    เวอร์ชันปรับปรุง: วิเคราะห์เฉพาะ "ยาง", รองรับการค้นหาและกรองตามยี่ห้อ
+    วิเคราะห์สินค้าที่มียอดขายในช่วงวันที่ รองรับการค้นหาและกรองตามยี่ห้อ
     ★★★ กรองรายการที่ถูกซ่อน (ignore_analysis = TRUE) ออกตั้งแต่ใน Query ★★★
+    item_types: ประเภทสินค้าที่ต้องการวิเคราะห์ ('tire', 'wheel', 'spare_part')
     """
-    cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
-
     if end_date is None: end_date = get_bkk_time().date()
     if start_date is None: start_date = end_date - timedelta(days=180)
 
-    start_date_iso = start_date.isoformat()
-    end_date_iso = end_date.isoformat()
-
-    base_query = f"""
-        SELECT 'tire' as item_type, tm.tire_id as item_id 
-        FROM tire_movements tm 
-        JOIN tires t ON tm.tire_id = t.id 
-    """
-    
-    conditions = [
-        "tm.type = 'OUT'",
-        "t.is_deleted = FALSE" if is_postgres else "t.is_deleted = 0",
-        "t.ignore_analysis = FALSE" if is_postgres else "t.ignore_analysis = 0", # ★★★ เพิ่มเงื่อนไขนี้ ★★★
-        "DATE(tm.timestamp) BETWEEN ? AND ?" if not is_postgres else "tm.timestamp::date BETWEEN %s AND %s"
-    ]
-    params = [start_date_iso, end_date_iso]
-
-    if search_query:
-        search_term = f"%{search_query.lower()}%"
-        like_op = "ILIKE" if is_postgres else "LIKE"
-        placeholder = "%s" if is_postgres else "?"
-        conditions.append(f"(LOWER(t.brand) {like_op} {placeholder} OR LOWER(t.model) {like_op} {placeholder} OR LOWER(t.size) {like_op} {placeholder})")
-        params.extend([search_term, search_term, search_term])
-
-    if brand_filter and brand_filter != 'all':
-        placeholder = "%s" if is_postgres else "?"
-        conditions.append(f"t.brand = {placeholder}")
-        params.append(brand_filter)
+    lead_times = _get_lead_time_map(conn)
+    today = get_bkk_time().date()
 
-    get_sold_items_query = base_query + " WHERE " + " AND ".join(conditions)
-    
-    cursor.execute(get_sold_items_query, tuple(params))
-    
-    sold_items = { (row['item_type'], row['item_id']) for row in cursor.fetchall() }
-    
     recommendations = []
-    # (ส่วนที่เหลือของฟังก์ชันเหมือนเดิมทุกอย่าง)
-    for item_type, item_id in sold_items:
-        try:
-            product_info = get_tire(conn, item_id)
-            if not product_info: continue
-            brand = product_info.get('brand') or 'N/A'
-            lead_time = get_lead_time_for_product(conn, item_type, brand)
-            rec_data = calculate_single_item_recommendation(conn, item_id, item_type, lead_time)
-            avg_sales = rec_data.get('avg_sales', 0)
-            days_left = product_info['quantity'] / avg_sales if avg_sales > 0 else 999
-            desc = f"{product_info['model'].title()} ({product_info['size']})"
-            urgency = 'normal'
-            if product_info['quantity'] <= rec_data['safety_stock']: urgency = 'critical'
-            elif product_info['quantity'] <= rec_data['reorder_point']: urgency = 'warning'
+    for item_type in item_types:
+        config = ANALYSIS_ITEM_CONFIG[item_type]
+        items = _get_analysis_candidates(conn, item_type, start_date, end_date, search_query, brand_filter)
+        results = compute_stock_recommendations(conn, item_type, items, lead_times=lead_times, today=today)
+        for item, rec_data in zip(items, results):
             recommendations.append({
-                'item_id': item_id, 'item_type': item_type, 'item_description': desc,
-                'brand': brand, 'current_stock': product_info['quantity'],
-                'wma_velocity': rec_data.get('avg_sales', 0),
+                'item_id': item['id'], 'item_type': item_type, 'item_description': config['describe'](item),
+                'brand': item.get('brand') or 'N/A', 'current_stock': item['quantity'],
+                'wma_velocity': rec_data['avg_sales'],
                 'safety_stock': rec_data['safety_stock'], 'reorder_point': rec_data['reorder_point'],
-                'days_of_stock_left': int(days_left), 'recommendation_msg': rec_data['recommendation_msg'],
-                'urgency': urgency, 'lead_time_used': lead_time,
-                'year_of_manufacture': product_info.get('year_of_manufacture')
+                'days_of_stock_left': rec_data['days_of_stock_left'], 'recommendation_msg': rec_data['recommendation_msg'],
+                'urgency': rec_data['urgency'], 'lead_time_used': rec_data['lead_time_used'],
+                'year_of_manufacture': item.get('year_of_manufacture')
             })
-        except Exception as e:
-            print(f"Could not generate recommendation for {item_type} ID {item_id}: {e}")
-            
+
+    recommendations.sort(key=lambda rec: (rec['brand'].lower(), rec['item_type'], rec['item_description'] or ''))
     return recommendations
 
 def is_item_ignored(conn, item_type, item_id):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     placeholder = "%s" if is_postgres else "?"
     query = f"SELECT id FROM ignored_analysis_items WHERE item_type = {placeholder} AND item_id = {placeholder}"
     cursor.execute(query, (item_type, item_id))
@@ -5789,7 +6847,7 @@ def is_item_ignored(conn, item_type, item_id):
 def get_all_tire_brands(conn):
     cursor = conn.cursor()
     query = "SELECT DISTINCT brand FROM tires WHERE is_deleted = FALSE ORDER BY brand ASC"
-    if "psycopg2" in str(type(conn)):
+    if is_postgres_conn(conn):
         query = "SELECT DISTINCT brand FROM tires WHERE is_deleted = FALSE ORDER BY brand ASC"
     cursor.execute(query)
     brands = [row['brand'] for row in cursor.fetchall()]
@@ -5805,7 +6863,7 @@ def get_all_ignored_items(conn):
         ORDER BY brand, model
     """
     # สำหรับ SQLite, TRUE คือ 1
-    if "sqlite3" in str(type(conn)):
+    if not is_postgres_conn(conn):
         query = query.replace("TRUE", "1")
         
     cursor.execute(query)
@@ -5814,7 +6872,7 @@ def get_all_ignored_items(conn):
 def restore_item_to_analysis(conn, item_type, item_id):
     """ตั้งค่า ignore_analysis ของรายการให้เป็น FALSE เพื่อนำกลับไปวิเคราะห์ใหม่"""
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     
     # ปัจจุบันรองรับแค่ 'tire'
     if item_type == 'tire':
@@ -5838,7 +6896,7 @@ def toggle_item_analysis_status(conn, item_type, item_id, ignore_status):
     อัปเดตสถานะ ignore_analysis ของสินค้าสำหรับฟังก์ชัน "ซ่อน"
     """
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
 
     table_map = {
         'tire': 'tires',
@@ -5858,7 +6916,7 @@ def toggle_item_analysis_status(conn, item_type, item_id, ignore_status):
 
 def search_wholesale_customer_names(conn, term):
     cursor = conn.cursor()
-    is_postgres = "psycopg2" in str(type(conn))
+    is_postgres = is_postgres_conn(conn)
     like_op = "ILIKE" if is_postgres else "LIKE"
     placeholder = "%s" if is_postgres else "?"
 
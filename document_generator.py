@@ -1,8 +1,10 @@
 import os
 import json
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import cm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
+from reportlab.lib.units import cm, mm
+from reportlab.pdfgen import canvas
+from reportlab.graphics.barcode.code128 import Code128
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_LEFT
 from reportlab.lib.colors import black, grey, lightgrey, whitesmoke
@@ -93,135 +95,242 @@ def _build_items_table(options, job_items_list):
     return items_table
 
 
+def _build_pdf(story):
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=1.5*cm, leftMargin=1.5*cm, topMargin=1.5*cm, bottomMargin=1.5*cm)
+    doc.build(story)
+    buffer.seek(0)
+    return buffer
+
+
 ### ฟังก์ชันสำหรับ "ใบรับรถ" (Layout มาตรฐาน) ###
 def generate_job_order_pdf(job_data, template_data):
     try:
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=1.5*cm, leftMargin=1.5*cm, topMargin=1.5*cm, bottomMargin=1.5*cm)
-        Story = []
-        
-        options = template_data.get('options', {})
-
-        shop_info = f"<b>{template_data.get('shop_name') or 'ชื่อร้านของคุณ'}</b><br/><font size='9'>{template_data.get('shop_details') or 'ที่อยู่และเบอร์โทรศัพท์'}</font>"
-        header_title = template_data.get('header_text') or 'ใบรับรถ / ใบแจ้งซ่อม'
-
-        header_data = [[Paragraph(shop_info, styles['NormalCenter']), Paragraph(f"<b>{header_title}</b><br/>Job Order", styles['TitleStyle'])]]
-        header_table = Table(header_data, colWidths=[9*cm, 9*cm], style=[('VALIGN', (0,0), (-1,-1), 'TOP'), ('ALIGN', (1,0), (1,0), 'RIGHT')])
-        Story.append(header_table)
-
-        customer_info = f"<b>ลูกค้า:</b> {job_data.get('customer_name') or '-'}<br/><b>เบอร์โทร:</b> {job_data.get('customer_phone') or '-'}<br/><b>ทะเบียนรถ:</b> {job_data.get('car_plate') or '-'}<br/><b>รุ่นรถ:</b> {job_data.get('car_brand') or '-'}"
-        doc_info = f"<b>เลขที่เอกสาร:</b> {job_data['job_number']}<br/><b>วันที่:</b> {job_data['created_at'].strftime('%d/%m/%Y %H:%M')}<br/><b>พนักงาน:</b> {job_data.get('created_by_username') or '-'}<br/><b>ช่างผู้รับผิดชอบ:</b> {job_data.get('technician_name') or 'ยังไม่ระบุ'}"
-        info_table = Table([[Paragraph(customer_info, styles['SmallText']), Paragraph(doc_info, styles['SmallText'])]], colWidths=[9*cm, 9*cm], spaceBefore=10)
-        info_table.setStyle(TableStyle([
-            ('BOX', (0,0), (-1,-1), 1, grey), ('LEFTPADDING', (0,0), (-1,-1), 10), ('RIGHTPADDING', (0,0), (-1,-1), 10),
-            ('TOPPADDING', (0,0), (-1,-1), 10), ('BOTTOMPADDING', (0,0), (-1,-1), 10), ('VALIGN', (0,0), (-1,-1), 'TOP'),
-        ]))
-        Story.append(info_table)
-        Story.append(Spacer(1, 0.5*cm))
-        Story.append(Paragraph("<b><u>รายการบริการ / สินค้า</u></b>", styles['Normal']))
-        Story.append(Spacer(1, 0.2*cm))
-        
-        items_table = _build_items_table(options, job_data['job_items_list'])
-        Story.append(items_table)
-
-        notes_and_terms_data = [
-            [Paragraph(f"<b>หมายเหตุ / อาการที่ลูกค้าแจ้ง:</b><br/>{job_data.get('notes') or 'ไม่มี'}", styles['SmallText'])],
-            [Paragraph("<b>ข้อตกลงและเงื่อนไข:</b><br/><font size='8'>1. ทางร้านจะไม่รับผิดชอบทรัพย์สินมีค่าที่ไม่ได้นำฝากไว้กับพนักงาน<br/>2. กรุณาตรวจสอบสภาพรถยนต์และรายการซ่อมก่อนออกจากร้าน</font>", styles['SmallText'])]
-        ]
-        notes_and_terms_table = Table(notes_and_terms_data, colWidths=[18*cm], spaceBefore=10, style=[
-            ('BOX', (0,0), (-1,-1), 1, grey), ('LEFTPADDING', (0,0), (-1,-1), 10), ('RIGHTPADDING', (0,0), (-1,-1), 10),
-            ('TOPPADDING', (0,0), (-1,-1), 10), ('BOTTOMPADDING', (0,0), (-1,-1), 10),
-        ])
-        Story.append(notes_and_terms_table)
-        Story.append(Spacer(1, 1*cm))
-
-        footer_sig_1 = template_data.get('footer_signature_1') or '(ลูกค้า)'
-        footer_sig_2 = template_data.get('footer_signature_2') or '(พนักงานรับรถ)'
-        footer_data = [
-            [Paragraph("", styles['NormalCenter']), Paragraph("", styles['NormalCenter'])],
-            [Paragraph('.......................................', styles['NormalCenter']), Paragraph('.......................................', styles['NormalCenter'])],
-            [Paragraph(footer_sig_1, styles['NormalCenter']), Paragraph(footer_sig_2 , styles['NormalCenter'])]
-        ]
-        footer_table = Table(footer_data, colWidths=[9*cm, 9*cm], rowHeights=[1*cm, 0.5*cm, 0.5*cm])
-        Story.append(footer_table)
-
-        doc.build(Story)
-        buffer.seek(0)
-        return buffer
+        return _build_pdf(_job_order_story(job_data, template_data))
     except Exception as e:
         print(f"!!! PDF Generation FAILED for Job Order {job_data.get('job_number')} !!!")
         print(e)
         return None
 
+def _job_order_story(job_data, template_data):
+    Story = []
+    
+    options = template_data.get('options', {})
+
+    shop_info = f"<b>{template_data.get('shop_name') or 'ชื่อร้านของคุณ'}</b><br/><font size='9'>{template_data.get('shop_details') or 'ที่อยู่และเบอร์โทรศัพท์'}</font>"
+    header_title = template_data.get('header_text') or 'ใบรับรถ / ใบแจ้งซ่อม'
+
+    header_data = [[Paragraph(shop_info, styles['NormalCenter']), Paragraph(f"<b>{header_title}</b><br/>Job Order", styles['TitleStyle'])]]
+    header_table = Table(header_data, colWidths=[9*cm, 9*cm], style=[('VALIGN', (0,0), (-1,-1), 'TOP'), ('ALIGN', (1,0), (1,0), 'RIGHT')])
+    Story.append(header_table)
+
+    customer_info = f"<b>ลูกค้า:</b> {job_data.get('customer_name') or '-'}<br/><b>เบอร์โทร:</b> {job_data.get('customer_phone') or '-'}<br/><b>ทะเบียนรถ:</b> {job_data.get('car_plate') or '-'}<br/><b>รุ่นรถ:</b> {job_data.get('car_brand') or '-'}"
+    doc_info = f"<b>เลขที่เอกสาร:</b> {job_data['job_number']}<br/><b>วันที่:</b> {job_data['created_at'].strftime('%d/%m/%Y %H:%M')}<br/><b>พนักงาน:</b> {job_data.get('created_by_username') or '-'}<br/><b>ช่างผู้รับผิดชอบ:</b> {job_data.get('technician_name') or 'ยังไม่ระบุ'}"
+    info_table = Table([[Paragraph(customer_info, styles['SmallText']), Paragraph(doc_info, styles['SmallText'])]], colWidths=[9*cm, 9*cm], spaceBefore=10)
+    info_table.setStyle(TableStyle([
+        ('BOX', (0,0), (-1,-1), 1, grey), ('LEFTPADDING', (0,0), (-1,-1), 10), ('RIGHTPADDING', (0,0), (-1,-1), 10),
+        ('TOPPADDING', (0,0), (-1,-1), 10), ('BOTTOMPADDING', (0,0), (-1,-1), 10), ('VALIGN', (0,0), (-1,-1), 'TOP'),
+    ]))
+    Story.append(info_table)
+    Story.append(Spacer(1, 0.5*cm))
+    Story.append(Paragraph("<b><u>รายการบริการ / สินค้า</u></b>", styles['Normal']))
+    Story.append(Spacer(1, 0.2*cm))
+    
+    items_table = _build_items_table(options, job_data['job_items_list'])
+    Story.append(items_table)
+
+    notes_and_terms_data = [
+        [Paragraph(f"<b>หมายเหตุ / อาการที่ลูกค้าแจ้ง:</b><br/>{job_data.get('notes') or 'ไม่มี'}", styles['SmallText'])],
+        [Paragraph("<b>ข้อตกลงและเงื่อนไข:</b><br/><font size='8'>1. ทางร้านจะไม่รับผิดชอบทรัพย์สินมีค่าที่ไม่ได้นำฝากไว้กับพนักงาน<br/>2. กรุณาตรวจสอบสภาพรถยนต์และรายการซ่อมก่อนออกจากร้าน</font>", styles['SmallText'])]
+    ]
+    notes_and_terms_table = Table(notes_and_terms_data, colWidths=[18*cm], spaceBefore=10, style=[
+        ('BOX', (0,0), (-1,-1), 1, grey), ('LEFTPADDING', (0,0), (-1,-1), 10), ('RIGHTPADDING', (0,0), (-1,-1), 10),
+        ('TOPPADDING', (0,0), (-1,-1), 10), ('BOTTOMPADDING', (0,0), (-1,-1), 10),
+    ])
+    Story.append(notes_and_terms_table)
+    Story.append(Spacer(1, 1*cm))
+
+    footer_sig_1 = template_data.get('footer_signature_1') or '(ลูกค้า)'
+    footer_sig_2 = template_data.get('footer_signature_2') or '(พนักงานรับรถ)'
+    footer_data = [
+        [Paragraph("", styles['NormalCenter']), Paragraph("", styles['NormalCenter'])],
+        [Paragraph('.......................................', styles['NormalCenter']), Paragraph('.......................................', styles['NormalCenter'])],
+        [Paragraph(footer_sig_1, styles['NormalCenter']), Paragraph(footer_sig_2 , styles['NormalCenter'])]
+    ]
+    footer_table = Table(footer_data, colWidths=[9*cm, 9*cm], rowHeights=[1*cm, 0.5*cm, 0.5*cm])
+    Story.append(footer_table)
+
+    return Story
+
 
 ### ฟังก์ชันสำหรับ "ใบเสร็จรับเงิน" ###
 def generate_receipt_pdf(job_data, template_data):
     try:
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=1.5*cm, leftMargin=1.5*cm, topMargin=1.5*cm, bottomMargin=1.5*cm)
+        return _build_pdf(_receipt_story(job_data, template_data))
+    except Exception as e:
+        print(f"!!! PDF Generation FAILED for Receipt {job_data.get('job_number')} !!!")
+        print(e)
+        return None
+
+def _receipt_story(job_data, template_data):
+    Story = []
+    
+    options = template_data.get('options', {})
+
+    shop_info = f"<b>{template_data.get('shop_name') or 'ชื่อร้านของคุณ'}</b><br/><font size='9'>{template_data.get('shop_details') or 'ที่อยู่และเบอร์โทรศัพท์'}</font>"
+    header_title = template_data.get('header_text') or 'ใบเสร็จรับเงิน'
+    
+    header_data = [[Paragraph(shop_info, styles['NormalCenter']), Paragraph(f"<b>{header_title}</b><br/>Receipt", styles['TitleStyle'])]]
+    header_table = Table(header_data, colWidths=[9*cm, 9*cm], style=[('VALIGN', (0,0), (-1,-1), 'TOP'), ('ALIGN', (1,0), (1,0), 'RIGHT')])
+    Story.append(header_table)
+
+    completed_date_str = job_data['completed_at'].strftime('%d/%m/%Y') if job_data.get('completed_at') else 'N/A'
+    
+    customer_info = f"<b>ลูกค้า:</b> {job_data.get('customer_name') or '-'}<br/><b>เบอร์โทร:</b> {job_data.get('customer_phone') or '-'}<br/><b>ทะเบียนรถ:</b> {job_data.get('car_plate') or '-'}<br/><b>รุ่นรถ:</b> {job_data.get('car_brand') or '-'}"
+    doc_info = f"<b>เลขที่เอกสาร:</b> {job_data['job_number']}<br/><b>วันที่ชำระเงิน:</b> {completed_date_str}<br/><b>ผู้รับเงิน:</b> {job_data.get('created_by_username') or '-'}"
+    info_table = Table([[Paragraph(customer_info, styles['SmallText']), Paragraph(doc_info, styles['SmallText'])]], colWidths=[9*cm, 9*cm], spaceBefore=10)
+    info_table.setStyle(TableStyle([
+        ('BOX', (0,0), (-1,-1), 1, grey), ('LEFTPADDING', (0,0), (-1,-1), 10), ('RIGHTPADDING', (0,0), (-1,-1), 10),
+        ('TOPPADDING', (0,0), (-1,-1), 10), ('BOTTOMPADDING', (0,0), (-1,-1), 10), ('VALIGN', (0,0), (-1,-1), 'TOP'),
+    ]))
+    Story.append(info_table)
+    Story.append(Spacer(1, 0.5*cm))
+
+    Story.append(Paragraph("<b><u>รายการ</u></b>", styles['Normal']))
+    Story.append(Spacer(1, 0.2*cm))
+
+    items_table = _build_items_table(options, job_data['job_items_list'])
+    Story.append(items_table)
+    Story.append(Spacer(1, 0.2*cm))
+
+    summary_data = [['', Paragraph('<b>ยอดรวมก่อนภาษี</b>', styles['NormalRight']), f"{job_data['sub_total']:,.2f}"]]
+    if job_data['vat'] > 0:
+        summary_data.append(['', Paragraph('<b>ภาษีมูลค่าเพิ่ม (7%)</b>', styles['NormalRight']), f"{job_data['vat']:,.2f}"])
+    summary_data.append(['', Paragraph('<b>ยอดชำระทั้งสิ้น</b>', styles['BoldSmallText']), Paragraph(f"<b>{job_data['grand_total']:,.2f}</b>", styles['NormalRight'])])
+    
+    available_page_width = A4[0] - 3*cm
+    summary_label_width = 3.5*cm
+    summary_value_width = 3.5*cm
+    summary_spacer_width = available_page_width - summary_label_width - summary_value_width
+    
+    summary_table = Table(summary_data, colWidths=[summary_spacer_width, summary_label_width, summary_value_width])
+    summary_table.setStyle(TableStyle([
+        ('ALIGN', (1,0), (-1,-1), 'RIGHT'), ('FONTNAME', (0,0), (-1,-1), normal_font),
+        ('GRID', (1,-1), (-1,-1), 1, black), ('BACKGROUND', (1,-1), (-1,-1), lightgrey),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 6), ('TOPPADDING', (0, 0), (-1, -1), 6),
+    ]))
+    Story.append(summary_table)
+    Story.append(Spacer(1, 1*cm))
+
+    footer_sig_1 = template_data.get('footer_signature_1') or '(ลูกค้า)'
+    footer_sig_2 = template_data.get('footer_signature_2') or '(ผู้รับเงิน)'
+    footer_data = [
+        [Paragraph("", styles['NormalCenter']), Paragraph("", styles['NormalCenter'])],
+        [Paragraph('.......................................', styles['NormalCenter']), Paragraph('.......................................', styles['NormalCenter'])],
+        [Paragraph(footer_sig_1, styles['NormalCenter']), Paragraph(footer_sig_2 , styles['NormalCenter'])]
+    ]
+    footer_table = Table(footer_data, colWidths=[9*cm, 9*cm], rowHeights=[1*cm, 0.5*cm, 0.5*cm])
+    Story.append(footer_table)
+
+    return Story
+
+
+### ฟังก์ชันสำหรับพิมพ์ "ใบเสร็จรับเงิน" หลายใบเป็นไฟล์เดียว (สรุปสิ้นวัน) ###
+def generate_receipts_batch_pdf(jobs, template_data):
+    """ใบเสร็จของทุกใบงานใน jobs ต่อกันเป็น PDF หลายหน้า (ขึ้นหน้าใหม่ทุกใบ)"""
+    try:
         Story = []
-        
-        options = template_data.get('options', {})
-
-        shop_info = f"<b>{template_data.get('shop_name') or 'ชื่อร้านของคุณ'}</b><br/><font size='9'>{template_data.get('shop_details') or 'ที่อยู่และเบอร์โทรศัพท์'}</font>"
-        header_title = template_data.get('header_text') or 'ใบเสร็จรับเงิน'
-        
-        header_data = [[Paragraph(shop_info, styles['NormalCenter']), Paragraph(f"<b>{header_title}</b><br/>Receipt", styles['TitleStyle'])]]
-        header_table = Table(header_data, colWidths=[9*cm, 9*cm], style=[('VALIGN', (0,0), (-1,-1), 'TOP'), ('ALIGN', (1,0), (1,0), 'RIGHT')])
-        Story.append(header_table)
-
-        completed_date_str = job_data['completed_at'].strftime('%d/%m/%Y') if job_data.get('completed_at') else 'N/A'
-        
-        customer_info = f"<b>ลูกค้า:</b> {job_data.get('customer_name') or '-'}<br/><b>เบอร์โทร:</b> {job_data.get('customer_phone') or '-'}<br/><b>ทะเบียนรถ:</b> {job_data.get('car_plate') or '-'}<br/><b>รุ่นรถ:</b> {job_data.get('car_brand') or '-'}"
-        doc_info = f"<b>เลขที่เอกสาร:</b> {job_data['job_number']}<br/><b>วันที่ชำระเงิน:</b> {completed_date_str}<br/><b>ผู้รับเงิน:</b> {job_data.get('created_by_username') or '-'}"
-        info_table = Table([[Paragraph(customer_info, styles['SmallText']), Paragraph(doc_info, styles['SmallText'])]], colWidths=[9*cm, 9*cm], spaceBefore=10)
-        info_table.setStyle(TableStyle([
-            ('BOX', (0,0), (-1,-1), 1, grey), ('LEFTPADDING', (0,0), (-1,-1), 10), ('RIGHTPADDING', (0,0), (-1,-1), 10),
-            ('TOPPADDING', (0,0), (-1,-1), 10), ('BOTTOMPADDING', (0,0), (-1,-1), 10), ('VALIGN', (0,0), (-1,-1), 'TOP'),
-        ]))
-        Story.append(info_table)
-        Story.append(Spacer(1, 0.5*cm))
-
-        Story.append(Paragraph("<b><u>รายการ</u></b>", styles['Normal']))
-        Story.append(Spacer(1, 0.2*cm))
-
-        items_table = _build_items_table(options, job_data['job_items_list'])
-        Story.append(items_table)
-        Story.append(Spacer(1, 0.2*cm))
-
-        summary_data = [['', Paragraph('<b>ยอดรวมก่อนภาษี</b>', styles['NormalRight']), f"{job_data['sub_total']:,.2f}"]]
-        if job_data['vat'] > 0:
-            summary_data.append(['', Paragraph('<b>ภาษีมูลค่าเพิ่ม (7%)</b>', styles['NormalRight']), f"{job_data['vat']:,.2f}"])
-        summary_data.append(['', Paragraph('<b>ยอดชำระทั้งสิ้น</b>', styles['BoldSmallText']), Paragraph(f"<b>{job_data['grand_total']:,.2f}</b>", styles['NormalRight'])])
-        
-        available_page_width = A4[0] - 3*cm
-        summary_label_width = 3.5*cm
-        summary_value_width = 3.5*cm
-        summary_spacer_width = available_page_width - summary_label_width - summary_value_width
-        
-        summary_table = Table(summary_data, colWidths=[summary_spacer_width, summary_label_width, summary_value_width])
-        summary_table.setStyle(TableStyle([
-            ('ALIGN', (1,0), (-1,-1), 'RIGHT'), ('FONTNAME', (0,0), (-1,-1), normal_font),
-            ('GRID', (1,-1), (-1,-1), 1, black), ('BACKGROUND', (1,-1), (-1,-1), lightgrey),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 6), ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ]))
-        Story.append(summary_table)
-        Story.append(Spacer(1, 1*cm))
-
-        footer_sig_1 = template_data.get('footer_signature_1') or '(ลูกค้า)'
-        footer_sig_2 = template_data.get('footer_signature_2') or '(ผู้รับเงิน)'
-        footer_data = [
-            [Paragraph("", styles['NormalCenter']), Paragraph("", styles['NormalCenter'])],
-            [Paragraph('.......................................', styles['NormalCenter']), Paragraph('.......................................', styles['NormalCenter'])],
-            [Paragraph(footer_sig_1, styles['NormalCenter']), Paragraph(footer_sig_2 , styles['NormalCenter'])]
-        ]
-        footer_table = Table(footer_data, colWidths=[9*cm, 9*cm], rowHeights=[1*cm, 0.5*cm, 0.5*cm])
-        Story.append(footer_table)
-
-        doc.build(Story)
+        for job_data in jobs:
+            if Story:
+                Story.append(PageBreak())
+            Story.extend(_receipt_story(job_data, template_data))
+        return _build_pdf(Story)
+    except Exception as e:
+        print(f"!!! PDF Generation FAILED for Receipt batch ({len(jobs)} jobs) !!!")
+        print(e)
+        return None
+
+
+### ฟังก์ชันสำหรับ "สติกเกอร์บาร์โค้ด" หลายรายการในไฟล์เดียว (ตามขนาดใน label_presets) ###
+def _fit_text(text, font_name, font_size, max_width):
+    """ตัดข้อความให้พอดีความกว้าง (เติม … ท้ายข้อความที่ถูกตัด)"""
+    text = text or ''
+    if pdfmetrics.stringWidth(text, font_name, font_size) <= max_width:
+        return text
+    while text and pdfmetrics.stringWidth(text + '…', font_name, font_size) > max_width:
+        text = text[:-1]
+    return text + '…'
+
+def _draw_label(c, x, y, width, height, label):
+    """วาดสติกเกอร์หนึ่งดวงที่มุมล่างซ้าย (x, y): ชื่อสินค้า / บาร์โค้ด Code128 / ราคา + รหัส"""
+    padding = 1.5*mm
+    inner_width = width - 2*padding
+    name_size, price_size, code_size = 7, 8, 6
+
+    c.setFont(bold_font, name_size)
+    c.drawCentredString(x + width/2, y + height - padding - name_size, _fit_text(label.get('name'), bold_font, name_size, inner_width))
+
+    bottom = y + padding
+    c.setFont('Courier', code_size)
+    c.drawCentredString(x + width/2, bottom, label['barcode'])
+    bottom += code_size + 1
+    if label.get('price') is not None:
+        c.setFont(bold_font, price_size)
+        c.drawCentredString(x + width/2, bottom, f"฿{float(label['price']):,.2f}")
+        bottom += price_size + 1
+
+    bar_top = y + height - padding - name_size - 2
+    bar_height = max(bar_top - bottom - 1, 2*mm)
+    # ขนาดแท่งคำนวณจากความกว้างที่ barWidth = 1 แล้วย่อ/ขยายให้เต็มความกว้างสติกเกอร์
+    unit_width = Code128(label['barcode'], barWidth=1, barHeight=bar_height, quiet=0).width
+    bar_code = Code128(label['barcode'], barWidth=inner_width / unit_width, barHeight=bar_height, quiet=0)
+    bar_code.drawOn(c, x + padding, bottom + 1)
+
+def generate_label_sheet_pdf(labels, preset):
+    """
+    labels: list ของ dict ('name', 'price', 'barcode') หนึ่งดวงต่อหนึ่งรายการ (ซ้ำรายการตามจำนวนที่ต้องการเอง)
+    preset: แถวจาก label_presets (หน่วย มม.)
+    จัดหน้าแบบเดียวกับ print_barcodes.html: กว้างเท่ากระดาษ สูงหนึ่งแถวสติกเกอร์ต่อหน้า (กระดาษม้วน)
+    """
+    try:
+        label_width = float(preset['label_width'])*mm
+        label_height = float(preset['label_height'])*mm
+        column_gap = float(preset.get('column_gap') or 0)*mm
+        row_gap = float(preset.get('row_gap') or 0)*mm
+        margin_left = float(preset.get('margin_left') or 0)*mm
+        columns = max(int(preset.get('columns') or 1), 1)
+        page_size = (float(preset['paper_width'])*mm, label_height + row_gap)
+
+        buffer = BytesIO()
+        c = canvas.Canvas(buffer, pagesize=page_size)
+        for index, label in enumerate(labels):
+            column = index % columns
+            if index and column == 0:
+                c.showPage()
+            _draw_label(c, margin_left + column*(label_width + column_gap), row_gap, label_width, label_height, label)
+        c.showPage()
+        c.save()
         buffer.seek(0)
         return buffer
     except Exception as e:
-        print(f"!!! PDF Generation FAILED for Receipt {job_data.get('job_number')} !!!")
+        print(f"!!! PDF Generation FAILED for label sheet ({len(labels)} labels) !!!")
         print(e)
-        return None
\ No newline at end of file
+        return None
+
+
+PDF_GENERATORS = {
+    'job_order': generate_job_order_pdf,
+    'receipt': generate_receipt_pdf,
+    'receipt_batch': generate_receipts_batch_pdf,
+    'label_sheet': generate_label_sheet_pdf,
+}
+
+def render_pdf_bytes(kind, data, template_data):
+    """
+    จุดเรียกสำหรับ process pool (app/pdf_renderer.py): คืน bytes ของ PDF หรือ None ถ้าสร้างไม่สำเร็จ
+    data คือ job_data (list ของ job_data สำหรับ 'receipt_batch', list ของสติกเกอร์สำหรับ 'label_sheet')
+    template_data คือ template ของใบงาน หรือ label preset สำหรับ 'label_sheet'
+    ฟอนต์ลงทะเบียนครั้งเดียวตอน worker import โมดูลนี้ ไม่ใช่ทุกครั้งที่สร้างเอกสาร
+    """
+    buffer = PDF_GENERATORS[kind](data, template_data)
+    return buffer.getvalue() if buffer is not None else None
\ No newline at end of file
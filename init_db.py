@@ -40,5 +40,5 @@ with app.app_context():
         raise # Re-raise the exception to indicate failure
     finally:
         if conn:
-            conn.close()
-            print("Database connection closed.")
\ No newline at end of file
+            database.release_db_connection(conn)
+            print("Database connection released.")
\ No newline at end of file
@@ -0,0 +1,25 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# ให้ import database / app จาก root ของ repo ได้ ไม่ว่าจะรัน pytest จากที่ไหน
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db_conn(tmp_path, monkeypatch):
+    """ฐานข้อมูล SQLite ใหม่ใน tmp_path (ทำงานใน tmp_path ด้วย connection อื่นของโค้ดจึงเปิดไฟล์เดียวกัน) มีผู้ใช้ admin id 1"""
+    import database
+
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, '_snapshots_ready', False) # ค่าที่ cache ไว้จากฐานข้อมูลของ test ก่อนหน้า
+    conn = sqlite3.connect(str(tmp_path / 'inventory.db'))
+    conn.row_factory = sqlite3.Row
+    database.init_db(conn)
+    database.add_user(conn, 'tester', 'pw', role='admin')
+    conn.commit()
+    yield conn
+    conn.close()
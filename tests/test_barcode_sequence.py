@@ -0,0 +1,56 @@
+# ตรวจการออกรหัส EAN-13 (app/barcode_sequence.py): check digit, การจองช่วงเลขจาก barcode_sequences
+# ของหลาย worker ไม่ทับกัน และรหัสที่มีอยู่แล้วในตารางบาร์โค้ดถูกข้าม
+import pytest
+
+import database
+from app import barcode_sequence
+from app.barcode_sequence import BarcodeSequence, format_ean13
+
+
+def _is_valid_ean13(code):
+    weighted = sum(int(digit) * (3 if position % 2 else 1) for position, digit in enumerate(code))
+    return len(code) == 13 and weighted % 10 == 0
+
+
+@pytest.mark.parametrize('number,check_digit', [
+    ('400638133393', '1'),
+    ('978030640615', '7'),
+    ('885000000001', '0'),
+    ('885123456789', '8'),
+])
+def test_check_digit(number, check_digit):
+    assert barcode_sequence.calculate_ean13_check_digit(number) == check_digit
+
+
+def test_format_ean13():
+    assert format_ean13(1) == '8850000000010'
+    assert format_ean13(123456789) == '8851234567898'
+    assert all(_is_valid_ean13(format_ean13(value)) for value in range(1, 200))
+    for value in (0, barcode_sequence.MAX_BARCODE_VALUE + 1):
+        with pytest.raises(ValueError):
+            format_ean13(value)
+
+
+def test_instances_reserve_blocks_that_do_not_overlap(db_conn):
+    # เหมือน worker สอง process ที่ใช้ตาราง barcode_sequences เดียวกัน
+    first, second = BarcodeSequence(block_size=5), BarcodeSequence(block_size=5)
+    taken = first.take_values(3) + second.take_values(4) + first.take_values(4) + second.take_values(12)
+
+    assert len(set(taken)) == len(taken)
+    assert taken[:3] == [1, 2, 3] and taken[3:7] == [6, 7, 8, 9]
+    assert taken[7:11] == [4, 5, 11, 12] # ใช้ช่วงที่เหลือของตัวเองก่อนจองช่วงใหม่
+    last_value = db_conn.execute("SELECT last_value FROM barcode_sequences WHERE name = ?",
+                                 (barcode_sequence.BARCODE_SEQUENCE_NAME,)).fetchone()[0]
+    assert max(taken) <= last_value
+
+
+def test_generate_skips_existing_barcodes(db_conn):
+    tire_id = database.add_tire(db_conn, 'michelin', 'primacy', '205/55R16', 4, 2000, None, None, 2500, 2400, 3000, None, '2024', user_id=1)
+    wheel_id = database.add_wheel(db_conn, 'lenso', 'project d', 15, '4x100', 7, 35, 'black', 2, 3000, None, 3500, 3400, 4000, None, user_id=1)
+    database.add_tire_barcode(db_conn, tire_id, format_ean13(2))
+    database.add_wheel_barcode(db_conn, wheel_id, format_ean13(3))
+    db_conn.commit()
+
+    barcodes = BarcodeSequence(block_size=2).generate(db_conn, 3)
+
+    assert barcodes == [format_ean13(1), format_ean13(4), format_ean13(5)]
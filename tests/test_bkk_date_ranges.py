@@ -0,0 +1,92 @@
+# ตรวจว่า query รายงานที่กรองช่วงวันที่แบบ [เริ่มวัน, เริ่มวันถัดไป) ตามเวลาไทย (_bkk_date_range / Dialect.timestamp_range)
+# ได้ผลเดียวกับการกรองตามวันที่ไทยของแต่ละแถวใน Python โดยเฉพาะแถวที่อยู่ตรงขอบวัน
+# (00:00, 06:59:59 ซึ่ง DATE() เดิมนับเป็นวันก่อนหน้าตามเวลา UTC และ 23:59:59.9 ซึ่ง <= 23:59:59 เดิมตกหล่น)
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import database
+
+DAY = date(2024, 3, 15)
+BOUNDARY_TIMES = [(0, 0, 0, 0), (6, 59, 59, 0), (23, 59, 59, 900000)]
+
+
+def _bkk_timestamps():
+    timestamps = []
+    for day in (DAY - timedelta(days=1), DAY, DAY + timedelta(days=1)):
+        for hour, minute, second, microsecond in BOUNDARY_TIMES:
+            naive = datetime(day.year, day.month, day.day, hour, minute, second, microsecond)
+            timestamps.append(database.BKK_TZ.localize(naive))
+    return timestamps
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    monkeypatch.chdir(tmp_path)
+    conn = sqlite3.connect(str(tmp_path / 'inventory.db'))
+    conn.row_factory = sqlite3.Row
+    database.init_db(conn)
+    database.add_user(conn, 'tester', 'pw', role='admin')
+    tire_id = database.add_tire(conn, 'michelin', 'primacy', '205/55R16', 100, 2000, None, None, 2500, 2400, 3000, None, '2024', user_id=1)
+
+    cursor = conn.cursor()
+    for quantity, timestamp in enumerate(_bkk_timestamps(), start=1):
+        cursor.execute("""
+            INSERT INTO tire_movements (tire_id, timestamp, type, quantity_change, remaining_quantity, notes, user_id, commission_amount)
+            VALUES (?, ?, 'OUT', ?, 0, '', 1, 10)
+        """, (tire_id, timestamp.isoformat(), quantity))
+        cursor.execute("INSERT INTO activity_logs (user_id, timestamp, endpoint, method, url) VALUES (1, ?, 'stock.index', 'GET', '/')",
+                       (timestamp.isoformat(),))
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def _expected_rows(start_date, end_date):
+    """(timestamp, จำนวน) ของแถวที่วันที่ตามเวลาไทยอยู่ในช่วง [start_date, end_date]"""
+    return [(timestamp, quantity) for quantity, timestamp in enumerate(_bkk_timestamps(), start=1)
+            if start_date <= timestamp.astimezone(database.BKK_TZ).date() <= end_date]
+
+
+RANGES = [
+    (DAY, DAY),
+    (DAY - timedelta(days=1), DAY),
+    (DAY + timedelta(days=1), DAY + timedelta(days=1)),
+    (DAY - timedelta(days=3), DAY - timedelta(days=2)),
+]
+
+
+@pytest.mark.parametrize('start_date,end_date', RANGES)
+def test_commission_movements_by_period_matches_bkk_dates(conn, start_date, end_date):
+    movements = database.get_commission_movements_by_period(conn, start_date, end_date)
+    expected = _expected_rows(start_date, end_date)
+    assert sorted(row['timestamp'] for row in movements) == sorted(timestamp for timestamp, _ in expected)
+
+
+@pytest.mark.parametrize('start_date,end_date', RANGES)
+def test_live_commission_summary_matches_bkk_dates(conn, start_date, end_date):
+    summary = database.get_live_commission_summary(conn, start_date, end_date)
+    expected = _expected_rows(start_date, end_date)
+    if not expected:
+        assert summary == []
+        return
+    assert len(summary) == 1
+    assert summary[0]['total_units_sold'] == sum(quantity for _, quantity in expected)
+    assert summary[0]['total_commission'] == 10 * len(expected)
+
+
+@pytest.mark.parametrize('start_date,end_date', RANGES)
+def test_activity_logs_matches_bkk_dates(conn, start_date, end_date):
+    logs = database.get_activity_logs(conn, limit=100, start_date=start_date, end_date=end_date)
+    expected = _expected_rows(start_date, end_date)
+    assert sorted(log['timestamp'] for log in logs) == sorted(timestamp for timestamp, _ in expected)
+    assert database.get_activity_logs_count(conn, start_date=start_date, end_date=end_date) == len(expected)
+
+
+def test_boundary_rows_fall_on_their_bkk_day(conn):
+    # 00:00 และ 06:59:59 เวลาไทยเป็นวันก่อนหน้าตามเวลา UTC ต้องยังนับเป็นวันเดียวกับ 23:59:59.9
+    movements = database.get_commission_movements_by_period(conn, DAY, DAY)
+    times = sorted(row['timestamp'].time() for row in movements)
+    assert [(t.hour, t.minute, t.second, t.microsecond) for t in times] == BOUNDARY_TIMES
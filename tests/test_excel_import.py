@@ -0,0 +1,115 @@
+# ตรวจ pipeline นำเข้า Excel (app/excel_import.py): dry run ไม่เขียนอะไร, apply เขียนตามแผน
+# และงานเบื้องหลังที่ล้มเหลว/worker หยุดไปกลางทางต้องจบที่ status 'failed' (หน้าเว็บหยุด poll)
+import time
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+from flask import Flask
+
+import database
+from app import excel_import
+
+TIRE_COLUMNS = ['ยี่ห้อ', 'รุ่นยาง', 'เบอร์ยาง', 'ปีผลิต', 'สต็อก', 'ทุน', 'ทุนล็อต', 'ราคาส่ง 1', 'ราคาส่งหน้าร้าน', 'ราคาขาย']
+
+
+@pytest.fixture
+def tire_id(db_conn):
+    tire_id = database.add_tire(db_conn, 'michelin', 'primacy', '205/55R16', 4, 2000, None, None, 2500, 2400, 3000, None, '2024', user_id=1)
+    db_conn.commit()
+    return tire_id
+
+
+def _tire_sheet(rows):
+    return pd.DataFrame([dict(zip(TIRE_COLUMNS, row)) for row in rows], columns=TIRE_COLUMNS)
+
+
+def _sheet_with_update_and_insert():
+    return _tire_sheet([
+        ('Michelin', 'Primacy', '205/55R16', 2024, 10, 2000, None, 2500, 2400, 3200),
+        ('Bridgestone', 'Turanza', '215/45R17', 2025, 6, 2500, None, 3000, 2900, 3500),
+    ])
+
+
+def _tire_rows(conn):
+    return {row['brand']: dict(row) for row in conn.execute("SELECT * FROM tires")}
+
+
+def _wait_for_job(conn, job_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = excel_import.get_import_job(conn, job_id)
+        conn.commit()
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"import job {job_id} did not finish")
+
+
+def test_dry_run_reports_plan_without_writing(db_conn, tire_id):
+    before = _tire_rows(db_conn)
+    result = excel_import.run_import(db_conn, 'tire', _sheet_with_update_and_insert(), user_id=1, dry_run=True)
+    db_conn.rollback()
+
+    assert (result['updated_count'], result['imported_count'], result['errors']) == (1, 1, [])
+    changes = {change['action']: change for change in result['changes']}
+    assert changes['update']['item_id'] == tire_id
+    assert changes['update']['changes']['quantity'] == (4, 10)
+    assert changes['update']['changes']['price_per_item'] == (3000, 3200)
+    assert changes['insert']['changes'] == {'quantity': (None, 6)}
+    assert _tire_rows(db_conn) == before
+    assert db_conn.execute("SELECT COUNT(*) FROM tire_movements").fetchone()[0] == 1
+
+
+def test_apply_writes_updates_inserts_and_movements(db_conn, tire_id):
+    result = excel_import.run_import(db_conn, 'tire', _sheet_with_update_and_insert(), user_id=1)
+    db_conn.commit()
+
+    assert (result['updated_count'], result['imported_count']) == (1, 1)
+    tires = _tire_rows(db_conn)
+    assert (tires['michelin']['id'], tires['michelin']['quantity'], tires['michelin']['price_per_item']) == (tire_id, 10, 3200)
+    assert (tires['bridgestone']['quantity'], tires['bridgestone']['price_per_item']) == (6, 3500)
+    movements = db_conn.execute("SELECT tire_id, type, quantity_change, remaining_quantity FROM tire_movements ORDER BY id").fetchall()
+    assert [tuple(row) for row in movements[1:]] == [
+        (tire_id, 'IN', 6, 10),
+        (tires['bridgestone']['id'], 'IN', 6, 6),
+    ]
+
+
+def test_background_job_completes(db_conn, tire_id):
+    job_id = excel_import.start_import_job(Flask(__name__), 'tire', _sheet_with_update_and_insert(), user_id=1)
+    job = _wait_for_job(db_conn, job_id)
+
+    assert job['status'] == 'done'
+    assert (job['imported_count'], job['updated_count'], job['user_id']) == (1, 1, 1)
+    assert _tire_rows(db_conn)['michelin']['quantity'] == 10
+
+
+def test_background_job_failure_is_recorded_and_rolled_back(db_conn, tire_id, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('disk full')
+    monkeypatch.setattr(excel_import, 'apply_import_plan', fail)
+    before = _tire_rows(db_conn)
+
+    job_id = excel_import.start_import_job(Flask(__name__), 'tire', _sheet_with_update_and_insert(), user_id=1)
+    job = _wait_for_job(db_conn, job_id)
+
+    assert job['status'] == 'failed'
+    assert 'disk full' in job['message']
+    assert _tire_rows(db_conn) == before
+
+
+def test_job_without_heartbeat_is_marked_failed(db_conn):
+    # งานของ worker ที่ถูก kill: ยัง running อยู่ในตารางแต่ heartbeat หยุด
+    database.create_import_job(db_conn, 'stale', 'tire', 1, 100, 'web-1:1234')
+    database.update_import_job(db_conn, 'stale', status='running', processed=50)
+    stale_at = database.get_bkk_time() - timedelta(seconds=excel_import.JOB_STALE_AFTER + 1)
+    db_conn.execute("UPDATE import_jobs SET heartbeat_at = ? WHERE id = 'stale'", (stale_at.isoformat(),))
+    database.create_import_job(db_conn, 'alive', 'tire', 1, 100, 'web-1:1234')
+    database.update_import_job(db_conn, 'alive', status='running')
+    db_conn.commit()
+
+    stale = excel_import.get_import_job(db_conn, 'stale')
+    assert (stale['status'], stale['message']) == ('failed', excel_import.JOB_STALE_MESSAGE)
+    assert excel_import.get_import_job(db_conn, 'alive')['status'] == 'running'
+    assert excel_import.get_import_job(db_conn, 'missing') is None
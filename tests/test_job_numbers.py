@@ -0,0 +1,46 @@
+# ตรวจการออกเลขใบงาน JOB-yymmdd-NNNN จากตัวนับรายวัน (next_job_number) และ migration 5
+# ที่ตั้งค่าตัวนับจากใบงานเดิม (เลขใหม่ต้องต่อจากเลขสูงสุดของวันนั้น ไม่เริ่มที่ 0001 ซ้ำกับใบงานเดิม)
+from datetime import datetime
+
+import database
+
+
+def _bkk(*args):
+    return database.BKK_TZ.localize(datetime(*args))
+
+
+def test_numbers_are_consecutive_within_a_day(db_conn):
+    day = _bkk(2024, 3, 15, 9, 0)
+    assert [database.next_job_number(db_conn, day) for _ in range(3)] == [
+        'JOB-240315-0001', 'JOB-240315-0002', 'JOB-240315-0003']
+
+
+def test_counter_resets_on_a_new_bangkok_day(db_conn, monkeypatch):
+    # 00:00:30 เวลาไทยยังเป็นวันก่อนหน้าตามเวลา UTC แต่ต้องนับเป็นวันใหม่
+    now = [_bkk(2024, 3, 15, 23, 59, 59)]
+    monkeypatch.setattr(database, 'get_bkk_time', lambda: now[0])
+    assert database.next_job_number(db_conn) == 'JOB-240315-0001'
+    assert database.next_job_number(db_conn) == 'JOB-240315-0002'
+
+    now[0] = _bkk(2024, 3, 16, 0, 0, 30)
+    assert database.next_job_number(db_conn) == 'JOB-240316-0001'
+    assert database.next_job_number(db_conn, _bkk(2024, 3, 15, 12, 0)) == 'JOB-240315-0003'
+
+
+def test_migration_seeds_counters_from_existing_jobs(db_conn):
+    # ฐานข้อมูลเดิมก่อนมีตัวนับ: มีใบงานอยู่แล้วแต่ยังไม่ได้รัน migration 5
+    db_conn.execute("DROP TABLE job_number_counters")
+    db_conn.execute("DELETE FROM schema_migrations WHERE version = 5")
+    for job_number in ('JOB-240315-0007', 'JOB-240315-9999', 'JOB-240315-10000', 'JOB-240314-0003', 'OLD-001'):
+        db_conn.execute("""
+            INSERT INTO jobs (job_number, customer_name, sub_total, vat, grand_total, created_at)
+            VALUES (?, 'ลูกค้า', 0, 0, 0, '2024-03-15T09:00:00+07:00')
+        """, (job_number,))
+    db_conn.commit()
+
+    assert database.run_migrations(db_conn) == [5]
+    db_conn.commit()
+
+    assert database.next_job_number(db_conn, _bkk(2024, 3, 15, 9, 0)) == 'JOB-240315-10001'
+    assert database.next_job_number(db_conn, _bkk(2024, 3, 14, 9, 0)) == 'JOB-240314-0004'
+    assert database.next_job_number(db_conn, _bkk(2024, 3, 16, 9, 0)) == 'JOB-240316-0001'
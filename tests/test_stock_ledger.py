@@ -0,0 +1,101 @@
+# ตรวจ apply_stock_movements (database.py) ซึ่งทุกการรับเข้า/จ่ายออก/รับคืนผ่าน:
+# สต็อกไม่พอหรือสินค้าไม่ถูกต้องต้องไม่เขียนอะไร, หลายบรรทัดของสินค้าเดียวกันรวมกันก่อนเทียบสต็อก,
+# remaining_quantity ของแต่ละ movement ถูกต้อง และ snapshot รายวันถูกเขียนหลัง backfill เท่านั้น
+import pytest
+
+import database
+
+
+@pytest.fixture
+def items(db_conn):
+    tire_id = database.add_tire(db_conn, 'michelin', 'primacy', '205/55R16', 4, 2000, None, None, 2500, 2400, 3000, None, '2024', user_id=1)
+    wheel_id = database.add_wheel(db_conn, 'lenso', 'project d', 15, '4x100', 7, 35, 'black', 2, 3000, None, 3500, 3400, 4000, None, user_id=1)
+    db_conn.commit()
+    return {'tire': tire_id, 'wheel': wheel_id}
+
+
+def _quantity(conn, table_name, item_id):
+    return conn.execute(f"SELECT quantity FROM {table_name} WHERE id = ?", (item_id,)).fetchone()[0]
+
+
+def _movements(conn, table_name='tire_movements'):
+    return [tuple(row) for row in conn.execute(f"SELECT type, quantity_change, remaining_quantity FROM {table_name} ORDER BY id")]
+
+
+def test_out_with_insufficient_stock_writes_nothing(db_conn, items):
+    tire_movements, wheel_movements = _movements(db_conn), _movements(db_conn, 'wheel_movements')
+
+    with pytest.raises(ValueError, match='สต็อกไม่พอ'):
+        database.apply_stock_movements(db_conn, 'OUT', [('tire', items['tire'], 1), ('wheel', items['wheel'], 3)], 'ขาย', user_id=1)
+    db_conn.rollback()
+
+    assert (_quantity(db_conn, 'tires', items['tire']), _quantity(db_conn, 'wheels', items['wheel'])) == (4, 2)
+    assert (_movements(db_conn), _movements(db_conn, 'wheel_movements')) == (tire_movements, wheel_movements)
+
+
+def test_lines_for_the_same_item_are_summed_against_stock(db_conn, items):
+    # แต่ละบรรทัดไม่เกินสต็อก (3, 2 <= 4) แต่รวมกันเกิน
+    with pytest.raises(ValueError, match='ต้องการ: 5'):
+        database.apply_stock_movements(db_conn, 'OUT', [('tire', items['tire'], 3), ('tire', items['tire'], 2)], 'ขาย', user_id=1)
+    db_conn.rollback()
+    assert _quantity(db_conn, 'tires', items['tire']) == 4
+
+    database.apply_stock_movements(db_conn, 'OUT', [('tire', items['tire'], 3), ('tire', items['tire'], 1)], 'ขาย', user_id=1)
+    db_conn.commit()
+    assert _quantity(db_conn, 'tires', items['tire']) == 0
+
+
+@pytest.mark.parametrize('line,message', [
+    (('tire', 9999, 1), 'ไม่พบสินค้า'),
+    (('tyre', 1, 1), 'ประเภทสินค้าไม่ถูกต้อง'),
+    (('tire', 1, 0), 'จำนวนไม่ถูกต้อง'),
+])
+def test_invalid_lines_are_rejected(db_conn, items, line, message):
+    with pytest.raises(ValueError, match=message):
+        database.apply_stock_movements(db_conn, 'IN', [('tire', items['tire'], 1), line], 'รับเข้า', user_id=1)
+    db_conn.rollback()
+    assert _quantity(db_conn, 'tires', items['tire']) == 4
+    assert len(_movements(db_conn)) == 1
+
+
+def test_invalid_move_type_is_rejected(db_conn, items):
+    with pytest.raises(ValueError, match='ประเภทการทำรายการไม่ถูกต้อง'):
+        database.apply_stock_movements(db_conn, 'ADJUST', [('tire', items['tire'], 1)], '', user_id=1)
+
+
+def test_remaining_quantity_follows_line_order(db_conn, items):
+    results = database.apply_stock_movements(db_conn, 'IN', [('tire', items['tire'], 2), ('wheel', items['wheel'], 5),
+                                                             ('tire', items['tire'], 3)], 'รับเข้า', user_id=1)
+    db_conn.commit()
+    assert [(result['item_type'], result['quantity'], result['remaining_quantity']) for result in results] == [
+        ('tire', 2, 6), ('wheel', 5, 7), ('tire', 3, 9)]
+    assert results[0]['item']['quantity'] == 9
+
+    database.apply_stock_movements(db_conn, 'OUT', [('tire', items['tire'], 4), ('tire', items['tire'], 1)], 'ขาย', user_id=1)
+    db_conn.commit()
+    assert _movements(db_conn) == [('IN', 4, 4), ('IN', 2, 6), ('IN', 3, 9), ('OUT', 4, 5), ('OUT', 1, 4)]
+    assert _movements(db_conn, 'wheel_movements')[-1] == ('IN', 5, 7)
+    assert _quantity(db_conn, 'tires', items['tire']) == 4
+
+
+def _snapshots(conn):
+    return [tuple(row) for row in conn.execute("""
+        SELECT item_type, item_id, opening_quantity, in_quantity, out_quantity, return_quantity, closing_quantity
+        FROM daily_stock_snapshots ORDER BY item_type, item_id, snapshot_date
+    """)]
+
+
+def test_snapshots_are_written_only_after_backfill(db_conn, items):
+    database.apply_stock_movements(db_conn, 'OUT', [('tire', items['tire'], 1)], 'ขาย', user_id=1)
+    db_conn.commit()
+    assert _snapshots(db_conn) == []
+
+    database.rebuild_daily_stock_snapshots(db_conn) # backfill แล้วตั้งค่าว่า snapshot พร้อมใช้
+    db_conn.commit()
+    assert database.daily_stock_snapshots_ready(db_conn)
+    assert _snapshots(db_conn) == [('tire', items['tire'], 0, 4, 1, 0, 3), ('wheel', items['wheel'], 0, 2, 0, 0, 2)]
+
+    database.apply_stock_movements(db_conn, 'OUT', [('tire', items['tire'], 1), ('tire', items['tire'], 1)], 'ขาย', user_id=1)
+    database.apply_stock_movements(db_conn, 'RETURN', [('wheel', items['wheel'], 1)], 'รับคืน', user_id=1)
+    db_conn.commit()
+    assert _snapshots(db_conn) == [('tire', items['tire'], 0, 4, 3, 0, 1), ('wheel', items['wheel'], 0, 2, 0, 1, 3)]